@@ -15,8 +15,11 @@ import O4_Tile_Utils as TILE
 import O4_GUI_Utils as GUI
 import O4_Config_Utils as CFG  # CFG imported last because it can modify other modules variables
 import O4_Overlay_Utils as OVL
+import O4_Batch_Utils as BATCH
+import O4_Bench_Utils as BENCH
+import O4_Mock_Servers as MOCK
 
-cmd_line="USAGE: Ortho4XP.py lat lon imagery zl [custom_build_dir] (won't read a tile config)\n  OR:  Ortho4XP.py lat lon [custom_build_dir] (with existing tile config file)"
+cmd_line="USAGE: Ortho4XP.py lat lon imagery zl [custom_build_dir] (won't read a tile config)\n  OR:  Ortho4XP.py lat lon [custom_build_dir] (with existing tile config file)\n  OR:  Ortho4XP.py --batch manifest.json [--report file] [--restart] (headless batch, see src/O4_Batch_Utils.py)\n  OR:  Ortho4XP.py --bench [names] [--save-baseline] (offline benchmarks, see src/O4_Bench_Utils.py)\n  OR:  Ortho4XP.py --mock-server [--port p] [--providers dir] [--osm file] [--elevation dir] (local test servers, see src/O4_Mock_Servers.py)"
 
 if __name__ == '__main__':
     if not os.path.isdir(FNAMES.Utils_dir):
@@ -36,6 +39,12 @@ if __name__ == '__main__':
     IMG.initialize_color_filters_dict()
     IMG.initialize_providers_dict()
     IMG.initialize_combined_providers_dict()
+    if len(sys.argv)>1 and sys.argv[1]=='--batch': # headless batch build from a manifest
+        sys.exit(BATCH.main(sys.argv[2:]))
+    if len(sys.argv)>1 and sys.argv[1]=='--bench': # offline benchmarks on synthetic data
+        sys.exit(BENCH.main(sys.argv[2:]))
+    if len(sys.argv)>1 and sys.argv[1]=='--mock-server': # local imagery, OSM and elevation servers for tests
+        sys.exit(MOCK.main(sys.argv[2:]))
     if len(sys.argv)==1: # switch to the graphical interface
         Ortho4XP = GUI.Ortho4XP_GUI()
         Ortho4XP.mainloop()	    
@@ -0,0 +1,277 @@
+import argparse
+import json
+import os
+import re
+import signal
+from math import floor, ceil
+import O4_UI_Utils as UI
+import O4_Tile_Utils as TILE
+import O4_Config_Utils as CFG
+from O4_Cfg_Vars import cfg_vars, list_app_vars, list_tile_vars
+
+################################################################################
+#
+# Headless batch builds (Ortho4XP.py --batch manifest.json), for unattended
+# runs on build servers. The manifest is a JSON file such as :
+#
+# {
+#     "tiles": [[45, 5], "+45+006"],
+#     "bbox": [lat_min, lon_min, lat_max, lon_max],
+#     "steps": ["osm", "mesh", "mask", "dsf", "ovl"],
+#     "custom_build_dir": "",
+#     "use_global_cfg": false,
+#     "config": {"default_website": "BI", "default_zl": 16},
+#     "tile_config": {"+45+005": {"curvature_tol": 2}},
+#     "app_config": {"batch_tiles_in_flight": 2},
+#     "report": "my_job.report.json",
+#     "state_file": "my_job.state.json"
+# }
+#
+# Only one of tiles and bbox is required (a bbox stands for all the tiles
+# which intersect it). The steps default to osm, mesh, mask and dsf. config
+# applies to all the tiles, on top of their own config file (or of the global
+# one with use_global_cfg), and tile_config to a single one. The report and
+# state files default to the name of the manifest with .report.json and
+# .state.json in place of .json. The batch is resumed where it stopped if it
+# is launched again with the same manifest, after a crash or an interruption
+# (SIGINT/SIGTERM) alike.
+#
+################################################################################
+
+exit_ok = 0  # all the tiles were built
+exit_crash = 1  # unexpected error, see the log
+exit_usage = 2  # bad command line or manifest
+exit_failed_tiles = 3  # some tiles failed, see the report
+exit_interrupted = 4  # interrupted, can be resumed
+
+all_steps = ("osm", "mesh", "mask", "dsf", "ovl")
+default_steps = ("osm", "mesh", "mask", "dsf")
+
+################################################################################
+def is_number(value):
+    # JSON booleans are ints to Python
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+################################################################################
+def get_field(manifest, key, field_type, default):
+    value = manifest.get(key, default)
+    if not isinstance(value, field_type):
+        raise ValueError(
+            "The value of " + key + " must be a JSON "
+            + {dict: "object", list: "array", str: "string", bool: "boolean"}[
+                field_type
+            ]
+        )
+    return value
+
+
+################################################################################
+def parse_tile(item):
+    if isinstance(item, str):
+        match = re.fullmatch(r"\s*([+-]\d{1,2})\s*([+-]\d{1,3})\s*", item)
+        if not match:
+            raise ValueError("Invalid tile " + repr(item))
+        (lat, lon) = (int(match.group(1)), int(match.group(2)))
+    else:
+        if (
+            not isinstance(item, (list, tuple))
+            or len(item) != 2
+            or not all(is_number(x) for x in item)
+        ):
+            raise ValueError("Invalid tile " + repr(item))
+        (lat, lon) = item
+        if int(lat) != lat or int(lon) != lon:
+            raise ValueError("Invalid tile " + repr(item))
+        (lat, lon) = (int(lat), int(lon))
+    if not (-90 <= lat < 90 and -180 <= lon < 180):
+        raise ValueError("Tile out of range " + repr(item))
+    return (lat, lon)
+
+
+################################################################################
+def convert_value(var, value, allowed_vars):
+    if var not in allowed_vars:
+        raise ValueError("Unknown config variable " + repr(var))
+    var_type = cfg_vars[var]["type"]
+    if var_type in (bool, list):
+        if not isinstance(value, var_type):
+            raise ValueError(
+                "Config variable " + var + " must be a " + var_type.__name__
+            )
+        return value
+    try:
+        return var_type(value)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid value for " + var + ": " + repr(value))
+
+
+################################################################################
+def read_manifest(file_name):
+    """
+    Returns the job described by a manifest as a dict with keys tiles (list
+    of (lat, lon)), steps, custom_build_dir, use_global_cfg, tile_overrides
+    ({(lat, lon): {var: value}}), app_config, report and state_file. Raises
+    ValueError if the manifest is invalid.
+    """
+    with open(file_name, "r", encoding="utf-8") as f:
+        try:
+            manifest = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError("Not a valid JSON file (" + str(e) + ")")
+    if not isinstance(manifest, dict):
+        raise ValueError("The manifest must be a JSON object")
+    unknown = set(manifest) - {
+        "tiles",
+        "bbox",
+        "steps",
+        "custom_build_dir",
+        "use_global_cfg",
+        "config",
+        "tile_config",
+        "app_config",
+        "report",
+        "state_file",
+    }
+    if unknown:
+        raise ValueError("Unknown keys " + ", ".join(sorted(unknown)))
+    tiles = []
+    for item in get_field(manifest, "tiles", list, []):
+        tile = parse_tile(item)
+        if tile not in tiles:
+            tiles.append(tile)
+    if "bbox" in manifest:
+        bbox = get_field(manifest, "bbox", list, None)
+        if len(bbox) != 4 or not all(is_number(x) for x in bbox):
+            raise ValueError(
+                "The bbox must be [lat_min, lon_min, lat_max, lon_max]"
+            )
+        (lat_min, lon_min, lat_max, lon_max) = bbox
+        if lat_min >= lat_max or lon_min >= lon_max:
+            raise ValueError("Empty bbox")
+        for lat in range(floor(lat_min), ceil(lat_max)):
+            for lon in range(floor(lon_min), ceil(lon_max)):
+                tile = parse_tile((lat, lon))
+                if tile not in tiles:
+                    tiles.append(tile)
+    if not tiles:
+        raise ValueError("No tiles to build")
+    steps = get_field(manifest, "steps", list, list(default_steps))
+    if not steps or not all(step in all_steps for step in steps):
+        raise ValueError("Steps must be taken among " + ", ".join(all_steps))
+    config = {
+        var: convert_value(var, value, list_tile_vars)
+        for (var, value) in get_field(manifest, "config", dict, {}).items()
+    }
+    tile_overrides = {tile: dict(config) for tile in tiles} if config else {}
+    tile_config = get_field(manifest, "tile_config", dict, {})
+    for (key, overrides) in tile_config.items():
+        tile = parse_tile(key)
+        if tile not in tiles:
+            raise ValueError("tile_config for a tile not in the job " + key)
+        if not isinstance(overrides, dict):
+            raise ValueError(
+                "The tile_config of " + key + " must be a JSON object"
+            )
+        tile_overrides.setdefault(tile, dict(config)).update(
+            (var, convert_value(var, value, list_tile_vars))
+            for (var, value) in overrides.items()
+        )
+    app_config = {
+        var: convert_value(var, value, list_app_vars)
+        for (var, value) in get_field(manifest, "app_config", dict, {}).items()
+    }
+    for key in ("report", "state_file"):
+        if manifest.get(key) is not None:
+            get_field(manifest, key, str, None)
+    base_name = (
+        file_name[:-5] if file_name.lower().endswith(".json") else file_name
+    )
+    return {
+        "tiles": tiles,
+        "steps": [step for step in all_steps if step in steps],
+        "custom_build_dir": get_field(manifest, "custom_build_dir", str, ""),
+        "use_global_cfg": get_field(manifest, "use_global_cfg", bool, False),
+        "tile_overrides": tile_overrides,
+        "app_config": app_config,
+        "report": manifest.get("report") or base_name + ".report.json",
+        "state_file": manifest.get("state_file")
+        or base_name + ".state.json",
+    }
+
+
+################################################################################
+
+################################################################################
+def interrupt(signum, frame):
+    # the batch scheduler stops after the steps in progress, with its state
+    # saved for a later resume
+    UI.lvprint(0, "\nSignal", signum, "received, interrupting the batch.")
+    UI.red_flag = True
+
+
+################################################################################
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="Ortho4XP.py --batch",
+        description="Builds the tiles of a JSON manifest without the GUI.",
+    )
+    parser.add_argument("manifest", help="path to the job manifest")
+    parser.add_argument(
+        "--report", help="where to write the JSON report of the batch"
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="ignore the state of a previous interrupted run of the job",
+    )
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit as e:
+        return exit_usage if e.code else exit_ok
+    try:
+        job = read_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        UI.lvprint(0, "ERROR: Invalid manifest", args.manifest, ":", e)
+        return exit_usage
+    report_file = args.report or job["report"]
+    if args.restart and os.path.isfile(job["state_file"]):
+        os.remove(job["state_file"])
+    for (var, value) in job["app_config"].items():
+        CFG.set_global_variables(
+            var, repr(value) if isinstance(value, (bool, list)) else str(value)
+        )
+    (lat, lon) = job["tiles"][0]
+    previous_handlers = {
+        signum: signal.signal(signum, interrupt)
+        for signum in (signal.SIGINT, signal.SIGTERM)
+    }
+    try:
+        if os.path.isfile(report_file):
+            os.remove(report_file)
+        tile = CFG.Tile(lat, lon, job["custom_build_dir"])
+        TILE.build_tile_list(
+            tile,
+            job["tiles"],
+            *(step in job["steps"] for step in all_steps),
+            job["use_global_cfg"],
+            tile_overrides=job["tile_overrides"],
+            state_file=job["state_file"],
+            report_file=report_file,
+        )
+        with open(report_file, "r") as f:
+            report = json.load(f)
+    except Exception as e:
+        UI.lvprint(0, "ERROR: Batch", args.manifest, "crashed:", e)
+        return exit_crash
+    finally:
+        for (signum, handler) in previous_handlers.items():
+            signal.signal(signum, handler)
+    if report["interrupted"]:
+        UI.lvprint(
+            0, "Batch interrupted, launch it again to resume.", report_file
+        )
+        return exit_interrupted
+    if any(tile["status"] != "done" for tile in report["tiles"]):
+        return exit_failed_tiles
+    return exit_ok
@@ -13,7 +13,8 @@ def set_depth_ratio(n, node_is_coast, node_bathy, tile):
             min(10 * tile.ratio_bathy * node_bathy[n] / 255, 1),
             0.1)
 
-def recut_water_tris(node_coords, tri_idx, tri_types):
+def recut_water_tris_scalar(node_coords, tri_idx, tri_types):
+    # Reference implementation of recut_water_tris, one triangle at a time.
 
     assert(len(node_coords) % 5 == 0)
     nbr_nodes = len(node_coords) // 5;
@@ -180,12 +181,161 @@ def recut_water_tris(node_coords, tri_idx, tri_types):
 
     return (nbr_nodes, node_coords, node_types, node_is_coast, 
             nbr_tris, tri_idx, tri_types)
-    
 
+################################################################################
+#
+# Triangles created by recut_water_tris for a water triangle (a, b, c) with
+# cut nodes An, Bn, Cn in the middle of the edges opposed to a, b, c (or with
+# a node n at its barycenter), indexed by the set of cut edges (1 for ab, 2
+# for bc, 4 for ca, 8 for the barycenter). The first one takes the place of
+# the original triangle, the others are appended. Slots are a, b, c, An, Bn,
+# Cn, n.
+#
+################################################################################
+recut_patterns = {
+    1: ((5, 1, 2), (5, 2, 0)),
+    2: ((3, 2, 0), (3, 0, 1)),
+    4: ((4, 0, 1), (4, 1, 2)),
+    3: ((2, 0, 5), (5, 1, 3), (2, 5, 3)),
+    5: ((1, 2, 4), (4, 0, 5), (1, 4, 5)),
+    6: ((0, 1, 3), (3, 2, 4), (0, 3, 4)),
+    7: ((4, 0, 5), (5, 1, 3), (3, 2, 4), (4, 5, 3)),
+    8: ((0, 1, 6), (1, 2, 6), (2, 0, 6)),
+}
 
+################################################################################
+def recut_water_tris(node_coords, tri_idx, tri_types):
+    """
+    Splits the water triangles along the coastline as XP12 requires : the
+    water edges between two coastline nodes get a node in their middle, and
+    the water triangles whose three edges are coastline one at their
+    barycenter. tri_types must be in (0, 1, 2). Array based, same result as
+    recut_water_tris_scalar (down to the numbering of the new nodes and
+    triangles).
+    """
+    assert len(node_coords) % 5 == 0
+    nbr_nodes = len(node_coords) // 5
+    assert len(tri_idx) % 3 == 0
+    assert len(tri_idx) // 3 == len(tri_types)
+    node_coords = numpy.asarray(node_coords)
+    tri_idx = numpy.asarray(tri_idx)
+    tri_types = numpy.asarray(tri_types)
+    tris = tri_idx.reshape(-1, 3).astype(numpy.int64)
 
-def compute_depth_ratio_bounds_from_masks(
+    # Node types as a bit field, coastline nodes have both land and water
+    node_types = numpy.zeros(nbr_nodes, dtype=numpy.uint8)
+    for tri_type in (0, 1, 2):
+        touched = numpy.bincount(
+            tris[tri_types == tri_type].ravel(), minlength=nbr_nodes
+        )
+        node_types |= (touched > 0).astype(numpy.uint8) << tri_type
+    node_is_coast = ((node_types & 1) != 0) & ((node_types & 6) != 0)
+
+    # Edge table of the coastline triangles (those with a coastline node) :
+    # one entry per undirected edge, in order of first appearance, with the
+    # bit field of the types of the triangles around it
+    coast = numpy.flatnonzero(node_is_coast[tris].any(axis=1))
+    coast_tris = tris[coast]
+    heads = coast_tris.ravel()
+    tails = coast_tris[:, [1, 2, 0]].ravel()
+    keys = numpy.minimum(heads, tails) * nbr_nodes + numpy.maximum(heads, tails)
+    (keys, first, tri_edges) = numpy.unique(
+        keys, return_index=True, return_inverse=True
+    )
+    tri_edges = tri_edges.reshape(-1, 3)  # edges ab, bc, ca
+    edge_types = numpy.zeros(len(keys), dtype=numpy.uint8)
+    occurrence_types = numpy.repeat(tri_types[coast], 3)
+    for tri_type in (0, 1, 2):
+        present = numpy.bincount(
+            tri_edges.ravel()[occurrence_types == tri_type],
+            minlength=len(keys),
+        )
+        edge_types |= (present > 0).astype(numpy.uint8) << tri_type
+
+    # Cut the water edges between two coastline nodes
+    (lows, highs) = numpy.divmod(keys, nbr_nodes)
+    cut_edges = numpy.flatnonzero(
+        ((edge_types & 1) == 0) & node_is_coast[lows] & node_is_coast[highs]
+    )
+    cut_edges = cut_edges[numpy.argsort(first[cut_edges], kind="stable")]
+    edge_nodes = numpy.full(len(keys), -1, dtype=numpy.int64)
+    edge_nodes[cut_edges] = nbr_nodes + numpy.arange(len(cut_edges))
+    coords = node_coords.reshape(-1, 5)
+    cut_coords = (coords[lows[cut_edges]] + coords[highs[cut_edges]]) / 2.0
+    nbr_nodes += len(cut_edges)
+
+    # Cut the water triangles which need to
+    cuts = edge_nodes[tri_edges]
+    patterns = (
+        (cuts[:, 0] >= 0) * 1 + (cuts[:, 1] >= 0) * 2 + (cuts[:, 2] >= 0) * 4
+    )
+    is_bary = (patterns == 0) & ((edge_types[tri_edges] & 1) != 0).all(axis=1)
+    patterns[is_bary] = 8
+    patterns[tri_types[coast] == 0] = 0
+    is_bary &= patterns == 8
+    acting = numpy.flatnonzero(patterns)
+    bary_tris = coast[is_bary]
+    bary_nodes = numpy.full(len(coast), -1, dtype=numpy.int64)
+    bary_nodes[is_bary] = nbr_nodes + numpy.arange(len(bary_tris))
+    bary_coords = (
+        coords[tris[bary_tris, 0]]
+        + coords[tris[bary_tris, 1]]
+        + coords[tris[bary_tris, 2]]
+    ) / 3.0
+    nbr_nodes += len(bary_tris)
+    slots = numpy.column_stack(
+        (
+            coast_tris[acting],
+            cuts[acting][:, [1, 2, 0]],
+            bary_nodes[acting],
+        )
+    )
+    patterns = patterns[acting]
+    acting = coast[acting]
+    extra = numpy.zeros(len(acting), dtype=numpy.int64)
+    for (pattern, new_tris) in recut_patterns.items():
+        extra[patterns == pattern] = len(new_tris) - 1
+    starts = numpy.cumsum(extra) - extra
+    new_tris = numpy.empty((int(extra.sum()), 3), dtype=numpy.int64)
+    for (pattern, pattern_tris) in recut_patterns.items():
+        selected = numpy.flatnonzero(patterns == pattern)
+        tris[acting[selected]] = slots[selected][:, pattern_tris[0]]
+        for (k, corners) in enumerate(pattern_tris[1:]):
+            new_tris[starts[selected] + k] = slots[selected][:, corners]
+
+    node_coords = numpy.concatenate(
+        (node_coords, cut_coords.ravel(), bary_coords.ravel())
+    )
+    node_types = numpy.concatenate(
+        (
+            node_types,
+            edge_types[cut_edges],
+            tri_types[bary_tris].astype(numpy.uint8),
+        )
+    )
+    node_is_coast = numpy.concatenate(
+        (node_is_coast, numpy.zeros(nbr_nodes - len(node_is_coast), bool))
+    )
+    tri_idx = numpy.concatenate((tris.ravel(), new_tris.ravel())).astype(
+        tri_idx.dtype
+    )
+    tri_types = numpy.concatenate(
+        (tri_types, numpy.repeat(tri_types[acting], extra))
+    )
+    return (
+        nbr_nodes,
+        node_coords,
+        node_types,
+        node_is_coast,
+        len(tri_types),
+        tri_idx,
+        tri_types,
+    )
+
+
+def compute_depth_ratio_bounds_from_masks_scalar(
         nbr_nodes, node_coords, node_types, tile):
+    # Reference implementation of compute_depth_ratio_bounds_from_masks.
 
     water_nodes = [n for n in range(nbr_nodes) if (node_types[n] & 4 != 0)]
 
@@ -221,12 +371,106 @@ def compute_depth_ratio_bounds_from_masks(
             node_bathy[n] = mask_val[pixy, pixx]
 
     return node_bathy
-            
-
-
-
-
 
 
+################################################################################
+def compute_depth_ratio_bounds_from_masks(
+    nbr_nodes, node_coords, node_types, tile
+):
+    """
+    Distance to the coast (from the distance masks, 255 where there is none)
+    of the sea nodes. Batched by mask : each distance mask is read once and
+    sampled for all its nodes by array indexing. Same result as
+    compute_depth_ratio_bounds_from_masks_scalar.
+    """
+    node_bathy = numpy.full(nbr_nodes, 255, dtype=numpy.uint8)
+    water_nodes = numpy.flatnonzero(
+        numpy.asarray(node_types[:nbr_nodes]) & 4
+    )
+    node_coords = numpy.asarray(node_coords)
+    lons = node_coords[0::5][water_nodes]
+    lats = node_coords[1::5][water_nodes]
+    (til_x, til_y) = GEO.wgs84_to_orthogrid_vec(lats, lons, tile.mask_zl)
+    (masks, node_masks) = numpy.unique(
+        numpy.column_stack((til_x, til_y)), axis=0, return_inverse=True
+    )
+    node_masks = node_masks.reshape(-1)
+    order = numpy.argsort(node_masks, kind="stable")
+    bounds = numpy.searchsorted(node_masks[order], numpy.arange(len(masks) + 1))
+    for (k, (mask_x, mask_y)) in enumerate(masks.tolist()):
+        mask_file = os.path.join(
+            FNAMES.mask_dir(tile.lat, tile.lon),
+            FNAMES.distance_mask(mask_x, mask_y),
+        )
+        if not os.path.isfile(mask_file):
+            continue
+        mask_val = numpy.array(Image.open(mask_file), dtype=numpy.uint8)
+        selected = order[bounds[k] : bounds[k + 1]]
+        (s, t) = GEO.st_coord_vec(
+            lats[selected], lons[selected], mask_x, mask_y, tile.mask_zl
+        )
+        pixy = (1 - t) * 4095
+        # t went through numpy's log/tan, values within reach of a pixel
+        # boundary are recomputed with the scalar formula
+        for i in numpy.flatnonzero(
+            numpy.abs(pixy - numpy.round(pixy)) < 1e-6
+        ):
+            pixy[i] = (
+                1
+                - GEO.st_coord(
+                    lats[selected[i]],
+                    lons[selected[i]],
+                    mask_x,
+                    mask_y,
+                    tile.mask_zl,
+                    None,
+                )[1]
+            ) * 4095
+        node_bathy[water_nodes[selected]] = mask_val[
+            pixy.astype(numpy.int64), (s * 4095).astype(numpy.int64)
+        ]
+    return node_bathy
 
 
+################################################################################
+def cross_check(node_coords, tri_idx, tri_types, tile):
+    """
+    Cross-check harness of the array based functions of this module against
+    their scalar reference, on a mesh whose tri_types are already remapped in
+    (0, 1, 2) as in build_dsf (and with the distance masks of the tile, if
+    any). Returns the names of the outputs which differ, hence [] if all is
+    well.
+    """
+    mismatches = []
+    names = (
+        "nbr_nodes",
+        "node_coords",
+        "node_types",
+        "node_is_coast",
+        "nbr_tris",
+        "tri_idx",
+        "tri_types",
+    )
+    scalar = recut_water_tris_scalar(
+        numpy.array(node_coords), numpy.array(tri_idx), numpy.array(tri_types)
+    )
+    batched = recut_water_tris(node_coords, tri_idx, tri_types)
+    for (name, expected, result) in zip(names, scalar, batched):
+        if not numpy.array_equal(expected, result) or (
+            numpy.asarray(expected).dtype != numpy.asarray(result).dtype
+        ):
+            mismatches.append("recut_water_tris:" + name)
+    (nbr_nodes, node_coords, node_types) = batched[:3]
+    expected = compute_depth_ratio_bounds_from_masks_scalar(
+        nbr_nodes, node_coords, node_types, tile
+    )
+    result = compute_depth_ratio_bounds_from_masks(
+        nbr_nodes, node_coords, node_types, tile
+    )
+    if not numpy.array_equal(expected, result):
+        mismatches.append(
+            "compute_depth_ratio_bounds_from_masks: "
+            + str(int(numpy.sum(expected != result)))
+            + " nodes"
+        )
+    return mismatches
@@ -0,0 +1,806 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import queue
+import statistics
+import time
+from math import pi, sin, cos
+import numpy
+from PIL import Image
+import O4_File_Names as FNAMES
+import O4_UI_Utils as UI
+import O4_Geo_Utils as GEO
+import O4_DEM_Utils as DEM
+import O4_OSM_Utils as OSM
+import O4_Vector_Utils as VECT
+import O4_Triangle_IO as TRIIO
+import O4_Mesh_Utils as MESH
+import O4_Mask_Utils as MASK
+import O4_DSF_Utils as DSF
+import O4_Bathymetry as BATHY
+import O4_Imagery_Utils as IMG
+import O4_Overlay_Utils as OVL
+import O4_Config_Utils as CFG
+import O4_Mock_Servers as MOCK
+from O4_Cfg_Vars import cfg_vars, list_tile_vars
+
+################################################################################
+#
+# Offline benchmarks of the hot paths of a build (Ortho4XP.py --bench), for
+# performance regressions to be caught in review. Everything runs on
+# synthetic fixtures generated from a fixed seed in a sandbox directory (the
+# data directories and the log of the install are not touched) : an
+# elevation file, an OSM extract, a mesh, masks and local_tms imagery, for
+# the tile +45+005. No network, GPU or external tool is involved : the
+# download benchmarks fetch their imagery from a local mock server (see
+# O4_Mock_Servers).
+#
+# Each benchmark is timed over a few runs, and its result is reduced to a
+# fingerprint (a digest of its output). Both are compared to those of a
+# baseline, typically saved with --save-baseline from the branch a change is
+# reviewed against and on the same machine : a benchmark is reported slower
+# if its best time exceeds the baseline one by more than the tolerance, and
+# changed if its result differs. No baseline is shipped (timings are only
+# comparable on a same machine) : without one the run ends with the distinct
+# exit_no_baseline, so that a script can tell it from a clean comparison.
+#
+################################################################################
+
+fixtures_version = 1
+bench_lat = 45
+bench_lon = 5
+bench_zl = 16
+seed = 4517
+# OSM ways inserted by the insert_edge benchmark (per unit of scale)
+edge_ways = 400
+
+default_repeat = 3
+default_tolerance = 0.25
+min_run_time = 0.2  # seconds
+
+exit_ok = 0
+exit_regression = 1
+exit_usage = 2
+exit_no_baseline = 3
+
+################################################################################
+def terrain(x, y):
+    # altitude (m) at the tile offsets x (lon) and y (lat), sea to the west
+    z = (
+        600
+        + 400 * numpy.sin(3 * pi * x) * numpy.cos(2 * pi * y)
+        + 250 * numpy.sin(11 * x + 7 * y)
+        + 120 * numpy.cos(23 * x - 17 * y)
+    )
+    return z * numpy.clip((x - 0.05) / 0.1, 0, 1)
+
+
+def is_sea(x, y):
+    return (x < 0.06) & (y < 0.3)
+
+
+def is_lake(x, y):
+    return (x - 0.3) ** 2 + (y - 0.25) ** 2 < 0.03 ** 2
+
+
+################################################################################
+
+################################################################################
+class fixtures:
+    """
+    Paths and parameters of the fixtures of a sandbox directory, generated
+    there once (see build) for a given scale. The scale multiplies the size
+    of the OSM extract, of the mesh and of the set of edges.
+    """
+
+    def __init__(self, bench_dir, scale=1):
+        self.dir = os.path.abspath(bench_dir)
+        self.scale = scale
+        self.stamp_file = os.path.join(self.dir, "fixtures.json")
+        self.dem_file = os.path.join(self.dir, "N45E005.hgt")
+        self.osm_file = os.path.join(self.dir, "bench.osm")
+        self.tms_dir = os.path.join(self.dir, "local_tms")
+        self.provider_dir = os.path.join(self.dir, "Providers")
+        self.ways = None
+        self.server = None
+        # land textures in the north east of the tile, away from the water
+        (self.til_x, self.til_y) = GEO.wgs84_to_orthogrid(
+            bench_lat + 0.8, bench_lon + 0.8, bench_zl
+        )
+
+    def redirect(self):
+        # data directories into the sandbox
+        for name in (
+            "OSM_dir",
+            "Mask_dir",
+            "Imagery_dir",
+            "Elevation_dir",
+            "Geotiff_dir",
+            "Tile_dir",
+            "Tmp_dir",
+            "Provider_dir",
+        ):
+            setattr(
+                FNAMES,
+                name,
+                os.path.join(self.dir, os.path.basename(getattr(FNAMES, name))),
+            )
+            os.makedirs(getattr(FNAMES, name), exist_ok=True)
+        OVL.custom_overlay_src = OVL.custom_overlay_src_alternate = ""
+        # and the log, the errors met while benchmarking are no concern of
+        # the Ortho4XP.log of the install
+        UI.logprint = self.logprint
+
+    def logprint(self, *args):
+        try:
+            with open(os.path.join(self.dir, "Ortho4XP.log"), "a") as f:
+                f.write(
+                    time.strftime("%c")
+                    + " | "
+                    + " ".join([str(x) for x in args])
+                    + "\n"
+                )
+        except OSError:
+            pass
+
+    def tile(self):
+        tile = CFG.Tile(bench_lat, bench_lon, "")
+        for var in list_tile_vars:
+            setattr(tile, var, cfg_vars[var]["default"])
+        tile.default_website = "BENCHC"
+        tile.default_zl = bench_zl
+        tile.make_dirs()
+        for sub_dir in ("textures", "terrain", "Earth nav data"):
+            os.makedirs(os.path.join(tile.build_dir, sub_dir), exist_ok=True)
+        os.makedirs(
+            os.path.join(
+                tile.build_dir,
+                "Earth nav data",
+                FNAMES.round_latlon(bench_lat, bench_lon),
+            ),
+            exist_ok=True,
+        )
+        return tile
+
+    def is_built(self):
+        try:
+            with open(self.stamp_file, "r") as f:
+                stamp = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return stamp == {"version": fixtures_version, "scale": self.scale}
+
+    def build(self):
+        rng = numpy.random.RandomState(seed)
+        self.redirect()
+        if os.path.isfile(self.stamp_file):
+            os.remove(self.stamp_file)
+        UI.vprint(0, "-> Generating the benchmark fixtures in", self.dir)
+        self.write_dem(rng)
+        self.write_osm(rng)
+        self.write_providers()
+        self.write_imagery(rng)
+        tile = self.tile()
+        self.write_mesh(tile, rng)
+        with quiet(True):
+            MASK.build_masks(tile)
+        with open(self.stamp_file, "w") as f:
+            json.dump({"version": fixtures_version, "scale": self.scale}, f)
+
+    def write_dem(self, rng):
+        # SRTM3 like, with a few holes to be filled at load time
+        (y, x) = numpy.mgrid[1:-1:1201j, 0:1:1201j]
+        alt = terrain(x, y)
+        for (i, j) in rng.randint(50, 1150, (12, 2)):
+            alt[i : i + rng.randint(3, 30), j : j + rng.randint(3, 30)] = -32768
+        alt.round().astype(">i2").tofile(self.dem_file)
+
+    def write_osm(self, rng):
+        # roads (random walks), lakes and a multipolygon with an inner ring
+        nodes = []
+        ways = []
+
+        def node(x, y):
+            nodes.append((len(nodes) + 1, bench_lat + y, bench_lon + x))
+            return len(nodes)
+
+        for _ in range(2000 * self.scale):
+            n = rng.randint(3, 40)
+            walk = numpy.clip(
+                rng.rand(2) + numpy.cumsum(rng.normal(0, 0.004, (n, 2)), 0),
+                0,
+                1,
+            )
+            highway = ("primary", "secondary", "residential", "track")[
+                rng.randint(4)
+            ]
+            ways.append(
+                ([node(x, y) for (x, y) in walk], [("highway", highway)])
+            )
+        rings = []
+        for _ in range(150 * self.scale):
+            (cx, cy) = 0.05 + 0.9 * rng.rand(2)
+            r = 0.002 + 0.01 * rng.rand()
+            k = rng.randint(8, 60)
+            ring = [
+                node(cx + r * cos(2 * pi * i / k), cy + r * sin(2 * pi * i / k))
+                for i in range(k)
+            ]
+            rings.append(ring + ring[:1])
+        for ring in rings[:-2]:
+            ways.append((ring, [("natural", "water")]))
+        ways.append((rings[-2], []))
+        ways.append((rings[-1], []))
+        with open(self.osm_file, "w", encoding="utf-8") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            f.write('<osm version="0.6" generator="Ortho4XP">\n')
+            for (osmid, lat, lon) in nodes:
+                f.write(
+                    '  <node id="%d" lat="%.7f" lon="%.7f"/>\n'
+                    % (osmid, lat, lon)
+                )
+            for (osmid, (refs, tags)) in enumerate(ways, 1):
+                f.write('  <way id="%d">\n' % osmid)
+                for ref in refs:
+                    f.write('    <nd ref="%d"/>\n' % ref)
+                for (key, value) in tags:
+                    f.write('    <tag k="%s" v="%s"/>\n' % (key, value))
+                f.write("  </way>\n")
+            f.write('  <relation id="1">\n')
+            for (osmid, role) in (
+                (len(ways) - 1, "outer"),
+                (len(ways), "inner"),
+            ):
+                f.write(
+                    '    <member type="way" ref="%d" role="%s"/>\n'
+                    % (osmid, role)
+                )
+            f.write('    <tag k="type" v="multipolygon"/>\n')
+            f.write('    <tag k="natural" v="water"/>\n')
+            f.write("  </relation>\n")
+            f.write("</osm>\n")
+
+    def write_providers(self):
+        # two local_tms layers and their combination
+        os.makedirs(os.path.join(self.provider_dir, "Bench"), exist_ok=True)
+        resolutions = " ".join(
+            repr(20037508.34 / (128 * 2 ** i)) for i in range(21)
+        )
+        for code in ("BENCHA", "BENCHB"):
+            with open(
+                os.path.join(self.provider_dir, "Bench", code + ".lay"), "w"
+            ) as f:
+                f.write(
+                    "request_type=local_tms\n"
+                    + "epsg_code=3857\n"
+                    + "tile_size=256\n"
+                    + "top_left_corner=-20037508.34 20037508.34\n"
+                    + "resolutions="
+                    + resolutions
+                    + "\n"
+                    + "url_template="
+                    + os.path.join(self.tms_dir, code, "{x}_{y}.jpg")
+                    + "\n"
+                    + "imagery_dir=grouped\n"
+                    + "max_threads=4\n"
+                )
+        with open(os.path.join(self.provider_dir, "BENCHC.comb"), "w") as f:
+            f.write("BENCHA global none medium\n")
+            f.write("BENCHB global none high\n")
+
+    def write_imagery(self, rng):
+        # the 256 pixels tiles of a texture for each local_tms layer (named
+        # as local_tms expects them, with a margin of one tile since the
+        # bounds of the texture may round to the previous one), and whole
+        # textures of both layers
+        for (code, tint) in (("BENCHA", (30, 10, 0)), ("BENCHB", (0, 10, 30))):
+            os.makedirs(os.path.join(self.tms_dir, code), exist_ok=True)
+            texture = synthetic_image(rng, 18 * 256, tint)
+            for j in range(-1, 17):
+                for i in range(-1, 17):
+                    (x, y) = (256 * (i + 1), 256 * (j + 1))
+                    texture.crop((x, y, x + 256, y + 256)).save(
+                        os.path.join(
+                            self.tms_dir,
+                            code,
+                            str(5 * (self.til_x + i)).zfill(4)
+                            + "_"
+                            + str(-5 * (self.til_y + j)).zfill(4)
+                            + ".jpg",
+                        ),
+                        quality=90,
+                    )
+        self.load_providers()
+        for code in ("BENCHA", "BENCHB"):
+            texture = synthetic_image(rng, 4096, (20, 20, 20))
+            file_dir = FNAMES.jpeg_file_dir_from_attributes(
+                bench_lat, bench_lon, bench_zl, IMG.providers_dict[code]
+            )
+            os.makedirs(file_dir, exist_ok=True)
+            texture.save(
+                os.path.join(
+                    file_dir,
+                    FNAMES.jpeg_file_name_from_attributes(
+                        self.til_x, self.til_y + 16, bench_zl, code
+                    ),
+                ),
+                quality=90,
+            )
+
+    def mock_server(self):
+        # started on first use, with its providers added to those of the
+        # sandbox
+        if not self.server:
+            self.server = MOCK.mock_imagery_server().start()
+            MOCK.write_providers(self.provider_dir, self.server.url)
+            self.load_providers()
+        return self.server
+
+    def load_providers(self):
+        # only those of the sandbox
+        IMG.providers_dict.clear()
+        IMG.combined_providers_dict.clear()
+        IMG.initialize_providers_dict()
+        IMG.initialize_combined_providers_dict()
+
+    def write_mesh(self, tile, rng):
+        # a jittered grid with the output of Triangle4XP for altitudes,
+        # turned into a .mesh by the regular writer
+        n = int(200 * self.scale ** 0.5)
+        (y, x) = numpy.mgrid[0 : 1 : (n + 1) * 1j, 0 : 1 : (n + 1) * 1j]
+        jitter = rng.uniform(-0.3, 0.3, (2, n + 1, n + 1)) / n
+        jitter[:, [0, -1], :] = 0
+        jitter[:, :, [0, -1]] = 0
+        x = (x + jitter[0]).ravel()
+        y = (y + jitter[1]).ravel()
+        z = terrain(x, y)
+        eps = 1e-4
+        nx = (terrain(x - eps, y) - terrain(x + eps, y)) / (2 * eps) / 111000
+        ny = (terrain(x, y - eps) - terrain(x, y + eps)) / (2 * eps) / 111000
+        norm = numpy.sqrt(1 + nx ** 2 + ny ** 2)
+        vertices = numpy.column_stack(
+            (x, y, z, nx / norm, ny / norm, z)
+        ).ravel()
+        corner = (numpy.arange(n)[None, :] + (n + 1) * numpy.arange(n)[:, None])
+        corner = corner.ravel() + 1
+        tris = numpy.concatenate(
+            (
+                numpy.column_stack((corner, corner + 1, corner + n + 2)),
+                numpy.column_stack((corner, corner + n + 2, corner + n + 1)),
+            )
+        )
+        bary_x = x[tris - 1].mean(axis=1)
+        bary_y = y[tris - 1].mean(axis=1)
+        attr = numpy.zeros(len(tris), dtype=numpy.int64)
+        attr[is_lake(bary_x, bary_y)] = VECT.Vector_Map.dico_attributes["WATER"]
+        attr[is_sea(bary_x, bary_y)] = VECT.Vector_Map.dico_attributes["SEA"]
+        TRIIO.write_table(
+            FNAMES.output_ele_file(tile),
+            str(len(tris)) + " 3 1\n",
+            numpy.column_stack((tris, attr)),
+            "%d",
+        )
+        MESH.write_mesh_file(tile, vertices)
+
+    def load_ways(self):
+        # polylines for insert_edge : the roads and lakes of the OSM extract
+        if self.ways is None:
+            layer = OSM.OSM_layer()
+            with quiet(True):
+                layer.update_dicosm(self.osm_file)
+            self.ways = [
+                [
+                    (lon - bench_lon, lat - bench_lat, 0)
+                    for (lon, lat) in layer.way_coords(wayid).tolist()
+                ]
+                for wayid in sorted(layer.dicosmw, reverse=True)
+            ][: edge_ways * self.scale]
+        return self.ways
+
+
+################################################################################
+def synthetic_image(rng, size, tint):
+    # smooth colour fields plus noise, so that the jpeg and dds encoders have
+    # some texture to chew on
+    low = rng.randint(0, 200, (size // 64, size // 64, 3)).astype(numpy.uint8)
+    image = numpy.array(
+        Image.fromarray(low).resize((size, size), Image.BICUBIC),
+        dtype=numpy.int16,
+    )
+    image += numpy.array(tint, dtype=numpy.int16)
+    image += rng.randint(-20, 21, (size, size, 1)).astype(numpy.int16)
+    return Image.fromarray(numpy.clip(image, 0, 255).astype(numpy.uint8))
+
+
+################################################################################
+@contextlib.contextmanager
+def quiet(enabled):
+    # verbosity is lowered too for the worker processes
+    if not enabled:
+        yield
+        return
+    verbosity = UI.verbosity
+    UI.verbosity = -1
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        UI.verbosity = verbosity
+
+
+def digest(*items):
+    # fingerprint of arrays, bytes, files (paths) and plain values
+    hasher = hashlib.blake2b(digest_size=12)
+    for item in items:
+        if isinstance(item, numpy.ndarray):
+            hasher.update(numpy.ascontiguousarray(item).tobytes())
+        elif isinstance(item, bytes):
+            hasher.update(item)
+        elif isinstance(item, str) and os.path.isfile(item):
+            with open(item, "rb") as f:
+                hasher.update(f.read())
+        else:
+            hasher.update(repr(item).encode())
+    return hasher.hexdigest()
+
+
+################################################################################
+
+################################################################################
+# The benchmarks : setup(fixtures) is run before each timed run(fixtures,
+# state) and returns its state, run returns the fingerprint of the result.
+################################################################################
+def setup_none(fix):
+    return None
+
+
+def setup_tile(fix):
+    return fix.tile()
+
+
+def bench_load_dem(fix, state):
+    dem = DEM.DEM(bench_lat, bench_lon, fix.dem_file, fill_nodata=True)
+    return digest(dem.alt_dem)
+
+
+def bench_update_dicosm(fix, state):
+    layer = OSM.OSM_layer()
+    layer.update_dicosm(fix.osm_file)
+    return digest(
+        len(layer.dicosmn),
+        len(layer.dicosmw),
+        len(layer.dicosmr),
+        sorted(layer.dicosmtags["w"].items()),
+    )
+
+
+def setup_insert_edge(fix):
+    return (fix.load_ways(), VECT.Vector_Map())
+
+
+def bench_insert_edge(fix, state):
+    (ways, vector_map) = state
+    for way in ways:
+        vector_map.insert_way(way, "DUMMY")
+    return digest(
+        sorted(vector_map.nodes_dico.items()),
+        sorted(vector_map.edges_dico.items()),
+    )
+
+
+def setup_read_mesh_file_text(fix):
+    tile = fix.tile()
+    mesh_file = FNAMES.mesh_file(tile.build_dir, bench_lat, bench_lon)
+    if os.path.isfile(FNAMES.mesh_bin_file(mesh_file)):
+        os.remove(FNAMES.mesh_bin_file(mesh_file))
+    return mesh_file
+
+
+def setup_read_mesh_file(fix):
+    tile = fix.tile()
+    mesh_file = FNAMES.mesh_file(tile.build_dir, bench_lat, bench_lon)
+    MESH.read_mesh_file(mesh_file)  # makes sure the sidecar is there
+    return mesh_file
+
+
+def bench_read_mesh_file(fix, mesh_file):
+    return digest(*MESH.read_mesh_file(mesh_file))
+
+
+def setup_recut_water_tris(fix):
+    tile = fix.tile()
+    (_, _, node_coords, _, tri_idx, tri_types) = MESH.read_mesh_file(
+        FNAMES.mesh_file(tile.build_dir, bench_lat, bench_lon)
+    )
+    # water types remapped in (0, 1, 2) as in build_dsf
+    tri_types = tri_types & 7
+    tri_types[tri_types > 1] = 2
+    return (node_coords, tri_idx, tri_types)
+
+
+def bench_recut_water_tris(fix, mesh):
+    return digest(*BATHY.recut_water_tris(*mesh))
+
+
+def bench_build_masks(fix, tile):
+    MASK.build_masks(tile)
+    mask_dir = FNAMES.mask_dir(bench_lat, bench_lon)
+    return digest(
+        *(
+            os.path.join(mask_dir, name)
+            for name in sorted(os.listdir(mask_dir))
+            if name.endswith(".png")
+        )
+    )
+
+
+def setup_build_dsf(fix):
+    tile = fix.tile()
+    IMG.initialize_local_combined_providers_dict(tile)
+    return tile
+
+
+def bench_build_dsf(fix, tile):
+    download_queue = queue.Queue()
+    DSF.build_dsf(tile, download_queue)
+    textures = []
+    while not download_queue.empty():
+        textures.append(download_queue.get())
+    return digest(
+        os.path.join(
+            tile.build_dir,
+            "Earth nav data",
+            FNAMES.long_latlon(bench_lat, bench_lon) + ".dsf.tmp",
+        ),
+        sorted(map(repr, textures)),
+    )
+
+
+def setup_build_jpeg_ortho(fix, code="BENCHA"):
+    tile = fix.tile()
+    file_name = os.path.join(
+        FNAMES.jpeg_file_dir_from_attributes(
+            bench_lat, bench_lon, bench_zl, IMG.providers_dict[code]
+        ),
+        FNAMES.jpeg_file_name_from_attributes(
+            fix.til_x, fix.til_y, bench_zl, code
+        ),
+    )
+    if os.path.isfile(file_name):
+        os.remove(file_name)
+    return (tile, file_name)
+
+
+def bench_build_jpeg_ortho(fix, state, code="BENCHA"):
+    (tile, file_name) = state
+    IMG.build_jpeg_ortho(tile, fix.til_x, fix.til_y, bench_zl, code)
+    return digest(numpy.array(Image.open(file_name)))
+
+
+def setup_download(code):
+    def setup(fix):
+        fix.mock_server()
+        return setup_build_jpeg_ortho(fix, code)
+
+    return setup
+
+
+def bench_download(code):
+    def run(fix, state):
+        return bench_build_jpeg_ortho(fix, state, code)
+
+    return run
+
+
+def bench_combine_textures(fix, tile):
+    image = IMG.combine_textures(
+        tile, fix.til_x, fix.til_y + 16, bench_zl, "BENCHC"
+    )
+    return digest(numpy.array(image))
+
+
+def setup_convert_texture(fix):
+    tile = fix.tile()
+    IMG.dds_encoder = "internal"
+    return tile
+
+
+def bench_convert_texture(fix, tile):
+    IMG.convert_texture(tile, fix.til_x, fix.til_y + 16, bench_zl, "BENCHA")
+    return digest(
+        os.path.join(
+            tile.build_dir,
+            "textures",
+            FNAMES.dds_file_name_from_attributes(
+                fix.til_x, fix.til_y + 16, bench_zl, "BENCHA"
+            ),
+        )
+    )
+
+
+benchmarks = {
+    "load_dem": (setup_none, bench_load_dem),
+    "update_dicosm": (setup_none, bench_update_dicosm),
+    "insert_edge": (setup_insert_edge, bench_insert_edge),
+    "read_mesh_file_text": (setup_read_mesh_file_text, bench_read_mesh_file),
+    "read_mesh_file": (setup_read_mesh_file, bench_read_mesh_file),
+    "recut_water_tris": (setup_recut_water_tris, bench_recut_water_tris),
+    "build_masks": (setup_tile, bench_build_masks),
+    "build_dsf": (setup_build_dsf, bench_build_dsf),
+    "build_jpeg_ortho": (setup_build_jpeg_ortho, bench_build_jpeg_ortho),
+    "download_tms": (setup_download("MOCKT"), bench_download("MOCKT")),
+    "download_wms": (setup_download("MOCKS"), bench_download("MOCKS")),
+    "combine_textures": (setup_tile, bench_combine_textures),
+    "convert_texture": (setup_convert_texture, bench_convert_texture),
+}
+
+################################################################################
+
+################################################################################
+def run_benchmarks(fix, names, repeat, verbose=False):
+    results = {}
+    for name in names:
+        (setup, run) = benchmarks[name]
+        times = []
+        fingerprints = set()
+        for _ in range(repeat):
+            # short benchmarks are run several times in a row, and timed on
+            # average, to get above the timer and scheduling noise
+            (elapsed, runs) = (0, 0)
+            while not runs or elapsed < min_run_time and runs < 1000:
+                with quiet(not verbose):
+                    state = setup(fix)
+                    UI.red_flag = False
+                    UI.is_working = False
+                    start = time.perf_counter()
+                    fingerprints.add(run(fix, state))
+                    elapsed += time.perf_counter() - start
+                runs += 1
+            times.append(elapsed / runs)
+        results[name] = {
+            "best": min(times),
+            "median": statistics.median(times),
+            # a result which varies between runs is a finding as well
+            "result": fingerprints.pop() if len(fingerprints) == 1 else None,
+        }
+        UI.vprint(
+            0,
+            "   {:<22}{:>9.3f} s  (median {:.3f} s)".format(
+                name, results[name]["best"], results[name]["median"]
+            ),
+        )
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # returns the number of regressions (slower or changed benchmarks)
+    regressions = 0
+    UI.vprint(0, "\n-> Comparison with the baseline")
+    for (name, result) in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            UI.vprint(0, "   {:<22}{:>9}".format(name, "new"))
+            continue
+        ratio = result["best"] / max(reference["best"], 1e-9)
+        if result["result"] != reference["result"]:
+            status = "CHANGED RESULT"
+        elif ratio > 1 + tolerance:
+            status = "SLOWER"
+        elif ratio < 1 - tolerance:
+            status = "faster"
+        else:
+            status = "ok"
+        regressions += status in ("CHANGED RESULT", "SLOWER")
+        UI.vprint(
+            0,
+            "   {:<22}{:>8.2f}x  {}".format(name, ratio, status),
+        )
+    return regressions
+
+
+################################################################################
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="Ortho4XP.py --bench",
+        description="Times the hot paths of a build on synthetic data, "
+        + "and compares them to a baseline.",
+    )
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help="benchmarks to run (all by default): " + ", ".join(benchmarks),
+    )
+    parser.add_argument("--repeat", type=int, default=default_repeat)
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=default_tolerance,
+        help="relative slow down reported as a regression",
+    )
+    parser.add_argument(
+        "--dir",
+        default=os.path.join(FNAMES.Tmp_dir, "Bench"),
+        help="sandbox directory of the fixtures",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=FNAMES.resource_path("bench_baseline.json"),
+        help="baseline file",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="save the timings as the new baseline instead of comparing",
+    )
+    parser.add_argument(
+        "--rebuild-fixtures",
+        action="store_true",
+        help="generate the fixtures again",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit as e:
+        return exit_usage if e.code else exit_ok
+    names = args.names or list(benchmarks)
+    unknown = [name for name in names if name not in benchmarks]
+    if unknown:
+        UI.vprint(0, "ERROR: Unknown benchmark(s)", *unknown)
+        return exit_usage
+    if args.repeat < 1 or args.scale < 1:
+        UI.vprint(0, "ERROR: repeat and scale must be positive")
+        return exit_usage
+    fix = fixtures(args.dir, args.scale)
+    if args.rebuild_fixtures or not fix.is_built():
+        fix.build()
+    else:
+        fix.redirect()
+        fix.load_providers()
+    UI.vprint(
+        0, "-> Running", len(names), "benchmark(s),", args.repeat, "run(s) each"
+    )
+    results = run_benchmarks(fix, names, args.repeat, args.verbose)
+    if fix.server:
+        fix.server.stop()
+    settings = {"scale": args.scale, "fixtures_version": fixtures_version}
+    if args.save_baseline:
+        try:
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+            if baseline["settings"] != settings:
+                baseline["benchmarks"] = {}
+        except (OSError, ValueError, KeyError):
+            baseline = {"benchmarks": {}}
+        baseline["settings"] = settings
+        baseline["machine"] = platform.platform()
+        baseline["benchmarks"].update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        UI.vprint(0, "-> Baseline saved in", args.baseline)
+        return exit_ok
+    try:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        UI.vprint(
+            0,
+            "ERROR: No usable baseline in",
+            args.baseline,
+            "(see --save-baseline).",
+        )
+        return exit_no_baseline
+    if baseline.get("settings") != settings:
+        UI.vprint(
+            0,
+            "ERROR: The baseline was made with other settings",
+            baseline.get("settings"),
+        )
+        return exit_usage
+    if compare(results, baseline["benchmarks"], args.tolerance):
+        return exit_regression
+    return exit_ok
@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+import O4_File_Names as FNAMES
+import O4_UI_Utils as UI
+import O4_Mask_Utils as MASK
+import O4_Version
+from O4_Cfg_Vars import (
+    list_vector_vars,
+    list_mesh_vars,
+    list_mask_vars,
+    list_other_vars,
+)
+
+################################################################################
+#
+# Dependency aware cache of the first steps of a tile build. Each step gets a
+# key which fingerprints its inputs : the config variables it depends on and
+# the content of the files it reads, among which the outputs of the step
+# before. A step whose key is the one recorded after its last successful run,
+# and whose outputs are still those it produced then, can be skipped. Since
+# the keys depend on the content (not the date) of the files, rerunning a step
+# only invalidates the steps downstream if its result did change.
+#
+# Step 3 (imagery and DSF) is not cached : its result also depends on the
+# imagery servers, whose answers cannot be fingerprinted before downloading
+# them (and whose failures are filled with white). It already skips the
+# textures which are present, so that what it redoes is mostly the assembly
+# of the DSF.
+#
+################################################################################
+
+build_cache_version = 1
+
+step_vars = {
+    "osm": list_vector_vars + list_other_vars,
+    "mesh": list_mesh_vars + list_other_vars,
+    "mask": list_mask_vars + list_other_vars + ["ratio_water"],
+}
+
+cached_steps = tuple(step_vars)
+
+################################################################################
+def is_cacheable(stage, tile):
+    # mesh refinements (iterate) work on the files of the previous iteration
+    return stage in cached_steps and not tile.iterate
+
+
+################################################################################
+def tree_files(path):
+    # all the files below path (or path itself), in a stable order
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for (dir_path, dir_names, file_names) in os.walk(path):
+        dir_names.sort()
+        files.extend(
+            os.path.join(dir_path, name) for name in sorted(file_names)
+        )
+    return files
+
+
+################################################################################
+def dem_files(tile):
+    # Elevation files the DEM of the tile may be built from : those of the
+    # tile and of its neighbours (for the global sources) plus the local
+    # files listed in custom_dem.
+    files = []
+    for lat in (tile.lat - 1, tile.lat, tile.lat + 1):
+        for lon in (tile.lon - 1, tile.lon, tile.lon + 1):
+            lon = (lon + 180) % 360 - 180
+            base = FNAMES.base_file_name(lat, lon)
+            try:
+                names = sorted(os.listdir(os.path.dirname(base)))
+            except OSError:
+                continue
+            files.extend(
+                os.path.join(os.path.dirname(base), name)
+                for name in names
+                if name.startswith(os.path.basename(base))
+            )
+    for source in str(tile.custom_dem or "").split(";"):
+        if os.path.isfile(source):
+            files.append(source)
+    return files
+
+
+################################################################################
+def extent_files(code):
+    files = []
+    try:
+        dir_names = sorted(os.listdir(FNAMES.Extent_dir))
+    except OSError:
+        return files
+    for dir_name in dir_names:
+        files.extend(
+            path
+            for path in tree_files(os.path.join(FNAMES.Extent_dir, dir_name))
+            if os.path.basename(path).split(".")[0] == code
+        )
+    return files
+
+
+################################################################################
+def step_input_files(stage, tile):
+    if stage == "osm":
+        return (
+            tree_files(FNAMES.osm_dir(tile.lat, tile.lon))
+            + tree_files(FNAMES.patch_dir(tile.lat, tile.lon))
+            + dem_files(tile)
+        )
+    elif stage == "mesh":
+        return (
+            step_output_files("osm", tile)
+            + tree_files(FNAMES.custom_coastline(tile.lat, tile.lon))
+            + tree_files(FNAMES.custom_coastline_dir(tile.lat, tile.lon))
+            + dem_files(tile)
+        )
+    elif stage == "mask":
+        files = MASK.select_neighbor_meshes(tile)
+        if tile.masks_use_DEM_too:
+            files += dem_files(tile)
+        if tile.masks_custom_extent:
+            files += extent_files(tile.masks_custom_extent)
+        return files
+
+
+def step_output_files(stage, tile):
+    if stage == "osm":
+        return [
+            FNAMES.input_node_file(tile),
+            FNAMES.input_poly_file(tile),
+            FNAMES.alt_file(tile),
+            FNAMES.apt_file(tile),
+        ]
+    elif stage == "mesh":
+        return [FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)]
+    elif stage == "mask":
+        mask_dir = FNAMES.mask_dir(tile.lat, tile.lon)
+        try:
+            names = sorted(os.listdir(mask_dir))
+        except OSError:
+            names = []
+        return [
+            os.path.join(mask_dir, name)
+            for name in names
+            if os.path.isfile(os.path.join(mask_dir, name))
+        ]
+
+
+################################################################################
+
+################################################################################
+class build_cache:
+    """
+    Keys and outputs of the cached steps of a tile, saved next to its mesh.
+    The digests of the files are memoized by size and modification time so
+    that unchanged inputs (the OSM and DEM data mostly) are not read again.
+    """
+
+    def __init__(self, tile):
+        self.tile = tile
+        self.file_name = FNAMES.build_cache_file(tile)
+        self.steps = {}
+        self.digests = {}
+        self.inputs_before = {}
+        try:
+            with open(self.file_name, "r") as f:
+                data = json.load(f)
+            if data["version"] == build_cache_version:
+                self.steps = data["steps"]
+                self.digests = data["digests"]
+        except:
+            pass
+
+    def save(self):
+        try:
+            with open(self.file_name + ".tmp", "w") as f:
+                json.dump(
+                    {
+                        "version": build_cache_version,
+                        "steps": self.steps,
+                        "digests": self.digests,
+                    },
+                    f,
+                    indent=1,
+                )
+            os.replace(self.file_name + ".tmp", self.file_name)
+        except Exception as e:
+            UI.vprint(2, "   Could not save the build cache:", e)
+
+    def file_digest(self, path):
+        # None for a missing file, which is a state as well
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.digests.pop(path, None)
+            return None
+        memo = self.digests.get(path)
+        if memo and memo[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return memo[2]
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 22), b""):
+                digest.update(block)
+        self.digests[path] = [
+            stat.st_size,
+            stat.st_mtime_ns,
+            digest.hexdigest(),
+        ]
+        return self.digests[path][2]
+
+    def step_inputs(self, stage):
+        return {
+            path: self.file_digest(path)
+            for path in step_input_files(stage, self.tile)
+        }
+
+    def step_key(self, stage, inputs):
+        return hashlib.sha256(
+            json.dumps(
+                {
+                    "version": O4_Version.version,
+                    "stage": stage,
+                    "vars": {
+                        var: getattr(self.tile, var, None)
+                        for var in step_vars[stage]
+                    },
+                    "files": inputs,
+                },
+                sort_keys=True,
+                default=repr,
+            ).encode()
+        ).hexdigest()
+
+    def is_up_to_date(self, stage):
+        record = self.steps.get(stage)
+        if not record:
+            return False
+        if record["key"] != self.step_key(stage, self.step_inputs(stage)):
+            return False
+        outputs = step_output_files(stage, self.tile)
+        if sorted(outputs) != sorted(record["outputs"]):
+            return False
+        return all(
+            self.file_digest(path) == digest
+            for (path, digest) in record["outputs"].items()
+        )
+
+    def begin(self, stage):
+        self.inputs_before = self.step_inputs(stage)
+        if self.steps.pop(stage, None) is not None:
+            self.save()
+
+    def record(self, stage):
+        # The key is computed after the run, so that inputs fetched by the
+        # step itself (OSM data, elevation files) are part of it, while those
+        # it removed (cleaning_level) count with their former content.
+        inputs = self.step_inputs(stage)
+        for (path, digest) in self.inputs_before.items():
+            if inputs.get(path) is None:
+                inputs[path] = digest
+        self.steps[stage] = {
+            "key": self.step_key(stage, inputs),
+            "outputs": {
+                path: self.file_digest(path)
+                for path in step_output_files(stage, self.tile)
+            },
+        }
+        self.save()
@@ -28,6 +28,13 @@ cfg_app_vars = {
         "values": ["random"] + sorted(OSM.overpass_servers.keys()),
         "hint": "The (country) of the Overpass OSM server used to grab vector data. It can be modified on the fly (as all _Application_ variables) in case of problem with a particular server.",
     },
+    "overpass_max_parallel": {
+        "module": "OSM",
+        "type": int,
+        "default": 3,
+        "values": (1, 2, 3, 4, 6),
+        "hint": "Number of OSM queries of a same step sent simultaneously. With a random server choice they are spread over the servers, those which just failed being avoided for a while. The data is merged in the same order whatever the order of the answers.",
+    },
     "skip_downloads": {
         "module": "TILE",
         "type": bool,
@@ -47,6 +54,60 @@ cfg_app_vars = {
         "values": (1, 2, 4, 6, 8, 12, 16, 24, 32, 64),
         "hint": "Number of parallel threads for dds conversion. Should be mainly dictated by the number of cores in your CPU.",
     },
+    "dds_encoder": {
+        "module": "IMG",
+        "type": str,
+        "default": "nvcompress",
+        "values": ("nvcompress", "internal"),
+        "hint": "Tool used for the DDS conversion of the textures. \"internal\" uses a built-in encoder working directly from the image in memory, which avoids a temporary png and an external process for each texture.",
+    },
+    "batch_tiles_in_flight": {
+        "module": "TILE",
+        "type": int,
+        "default": 1,
+        "values": (1, 2, 3, 4, 6, 8),
+        "hint": "Number of tiles simultaneously in progress during a batch build. With 1 the tiles are built one after the other, with more the steps of consecutive tiles overlap (e.g. the imagery download of a tile runs while the next one is meshed), see also the batch_*_slots variables. An interrupted batch is resumed where it stopped when launched again with the same tiles and steps.",
+    },
+    "batch_mesh_slots": {
+        "module": "TILE",
+        "type": int,
+        "default": 1,
+        "values": (1, 2, 3, 4),
+        "hint": "Number of tiles of a batch build whose mesh (step 2) can be computed at the same time, when batch_tiles_in_flight is more than 1. A mesh waits anyway for the masks of the neighbouring tiles before it in the list, which read it.",
+    },
+    "batch_mask_slots": {
+        "module": "TILE",
+        "type": int,
+        "default": 1,
+        "values": (1, 2, 3, 4),
+        "hint": "Number of tiles of a batch build whose masks (step 2.5) can be built at the same time, when batch_tiles_in_flight is more than 1.",
+    },
+    "batch_ovl_slots": {
+        "module": "TILE",
+        "type": int,
+        "default": 1,
+        "values": (1, 2, 3, 4),
+        "hint": "Number of tiles of a batch build whose overlays (step 4) can be extracted at the same time, when batch_tiles_in_flight is more than 1.",
+    },
+    "build_cache": {
+        "module": "TILE",
+        "type": bool,
+        "default": True,
+        "hint": "Batch builds and 'All in one' skip steps 1, 2 and 2.5 of a tile when none of their inputs changed since they last completed: the config variables they depend on and the content of the files they read (OSM and elevation data, patches, the result of the previous step). A step rebuilt with an identical result doesn't force the following ones to be rebuilt. Step 3 always runs since its result depends on the imagery servers too, but it doesn't download or convert again the textures already present.",
+    },
+    "dem_store_size": {
+        "module": "DEM",
+        "type": int,
+        "default": 4,
+        "values": (0, 1, 2, 4, 8, 16, 32),
+        "hint": "Size in GB of the store of decoded elevation rasters in the tmp directory. Each elevation file is then decoded only once, and the builds of adjacent tiles (possibly in parallel) share the rasters of their common neighbours instead of reading them again. The least recently used rasters are removed beyond that size, 0 disables the store.",
+    },
+    "trace_builds": {
+        "module": "TRACE",
+        "type": bool,
+        "default": False,
+        "hint": "Records the wall time, CPU time, peak memory and bytes downloaded and written of each build step and of its main phases. The profile of a tile is saved in tmp/Profiles/ as a JSON file, and the steps of all the builds are summed up in tmp/Profiles/summary.json.",
+    },
     "check_tms_response": {
         "module": "IMG",
         "type": bool,
@@ -71,6 +132,32 @@ cfg_app_vars = {
         "default": 5,
         "hint": "How much times do we try again after an internal server error for an imagery request. Only used if check_tms_response is set to True.",
     },
+    "http_pool_size": {
+        "module": "HTTP",
+        "type": int,
+        "default": 16,
+        "values": (4, 8, 16, 32, 64),
+        "hint": "Number of connections kept alive (and reused) per imagery server. Should not be lower than the number of parallel downloads from a same server.",
+    },
+    "http_max_per_host": {
+        "module": "HTTP",
+        "type": int,
+        "default": 0,
+        "values": (0, 2, 4, 8, 16, 32),
+        "hint": "Maximum number of simultaneous requests to a same imagery server, whatever the number of download threads. 0 means no limit.",
+    },
+    "http_host_caps": {
+        "module": "HTTP",
+        "type": list,
+        "default": [],
+        "hint": 'Per server overrides of http_max_per_host, as a list of [server, cap] pairs where server is the host name (with its port if any) of the imagery URLs, e.g. [["tiles.example.com", 4]]. A cap of 0 means no limit.',
+    },
+    "http_keep_alive": {
+        "module": "HTTP",
+        "type": bool,
+        "default": True,
+        "hint": "Keeps the connections to the imagery servers open and reuses them for the next requests. Set to False for servers which misbehave with persistent connections.",
+    },
     "ovl_exclude_pol": {
         "module": "OVL",
         "type": list,
@@ -83,6 +170,12 @@ cfg_app_vars = {
         "default": [],
         "hint": "Indices of road types which one would like to left aside in the extraction of overlays. The list of these indices is can be in the roads.net file within X-Plane Resources, but some sceneries use their own corresponding net definition file. Powerlines have index 22001 in XP11 roads.net default file.",
     },
+    "ovl_keep_objects": {
+        "module": "OVL",
+        "type": bool,
+        "default": False,
+        "hint": "Also extract the objects (OBJECT_DEF) of the overlay source, which are otherwise left aside together with the terrain.",
+    },
     "custom_scenery_dir": {
         "type": str,
         "default": "",
@@ -100,6 +193,18 @@ cfg_app_vars = {
         "default": "",
         "hint": "If sceneries with overlays are not found in custom_overlay_src, set an alternate directory to search.",
     },
+    "overpass_custom_url": {
+        "module": "OSM",
+        "type": str,
+        "default": "",
+        "hint": "URL of an Overpass server (ending with /interpreter) to use instead of the public ones, whatever overpass_server_choice. Typically a local instance, or the mock server of Ortho4XP.py --mock-server for hermetic builds.",
+    },
+    "elevation_mirror_url": {
+        "module": "DEM",
+        "type": str,
+        "default": "",
+        "hint": "URL of a server mirroring the elevation servers, files are then fetched from <URL>/<host>/<path> instead. The SRTM and ALOS sources, which lost their direct downloads, can be fetched from such a mirror.",
+    },
 }
 
 cfg_tile_vars = {
@@ -351,23 +456,39 @@ list_app_vars = [
     "verbosity",
     "cleaning_level",
     "overpass_server_choice",
+    "overpass_max_parallel",
     "skip_downloads",
     "skip_converts",
     "max_convert_slots",
+    "dds_encoder",
+    "batch_tiles_in_flight",
+    "batch_mesh_slots",
+    "batch_mask_slots",
+    "batch_ovl_slots",
+    "build_cache",
+    "dem_store_size",
+    "trace_builds",
     "check_tms_response",
     "http_timeout",
     "max_connect_retries",
     "max_baddata_retries",
+    "http_pool_size",
+    "http_max_per_host",
+    "http_host_caps",
+    "http_keep_alive",
     "ovl_exclude_pol",
     "ovl_exclude_net",
+    "ovl_keep_objects",
     "custom_scenery_dir",
     "custom_overlay_src",
     "custom_overlay_src_alternate",
+    "overpass_custom_url",
+    "elevation_mirror_url",
 ]
 
-gui_app_vars_short = list_app_vars[:-3]
+gui_app_vars_short = list_app_vars[:-5]
 
-gui_app_vars_long = list_app_vars[-3:]
+gui_app_vars_long = list_app_vars[-5:]
 
 list_vector_vars = [
     "apt_smoothing_pix",
@@ -0,0 +1,223 @@
+import struct
+import numpy
+
+################################################################################
+#
+# In-process DDS (BC1 = DXT1, BC3 = DXT5) encoder with mipmaps, an alternative
+# to nvcompress which avoids the temporary png and the process start-up for
+# each texture. Endpoints are taken on the diagonal of the colour bounding box
+# of each 4x4 block (slightly inset, as in J.M.P. van Waveren's real-time DXT
+# compression), pixels are then projected on the segment between them. This
+# is in the spirit of "nvcompress -fast". Numpy releases the GIL on most of
+# the work, so that several convert workers do run in parallel.
+#
+################################################################################
+
+# Number of rows of 4x4 blocks encoded at once, bounds the temporary memory.
+block_rows_per_chunk = 32
+
+DDSD_FLAGS = 0x1 | 0x2 | 0x4 | 0x1000 | 0x20000 | 0x80000
+DDPF_FOURCC = 0x4
+DDSCAPS_FLAGS = 0x8 | 0x1000 | 0x400000
+
+# from the rounded position (in thirds, resp. sevenths) of a pixel between
+# the second and the first endpoint to its index in the block palette
+_bc1_index_lut = numpy.array([1, 3, 2, 0], dtype=numpy.uint32)
+_bc3_index_lut = numpy.array([1, 7, 6, 5, 4, 3, 2, 0], dtype=numpy.uint64)
+
+################################################################################
+def to_blocks(array):
+    """
+    (h, w, c) uint8 array to (c, 16, h/4 * w/4) planar blocks, blocks in row
+    major order as well as the pixels within them. Images smaller than 4
+    pixels (last mipmaps) are padded by replication. This layout makes the
+    per block reductions element-wise operations between 16 rows.
+    """
+    (h, w, c) = array.shape
+    if h % 4 or w % 4:
+        array = numpy.pad(
+            array, ((0, -h % 4), (0, -w % 4), (0, 0)), mode="edge"
+        )
+        (h, w, c) = array.shape
+    return numpy.ascontiguousarray(
+        array.reshape(h // 4, 4, w // 4, 4, c).transpose(4, 1, 3, 0, 2)
+    ).reshape(c, 16, -1)
+
+
+################################################################################
+
+################################################################################
+def encode_color_blocks(blocks):
+    """
+    BC1 colour part of (3, 16, n) uint8 blocks, returns (n, 8) uint8.
+    Endpoints are stored with c0 > c1 (four colours mode) unless the block is
+    uniform after quantization, in which case all indices are 0.
+    """
+    cmin = blocks.min(axis=1).astype(numpy.int32)
+    cmax = blocks.max(axis=1).astype(numpy.int32)
+    inset = (cmax - cmin) >> 4
+    cmin += inset
+    cmax -= inset
+    pixels = blocks.astype(numpy.int32)
+    # choose the diagonal of the bounding box along which the colours vary
+    centered = pixels - ((cmin + cmax) >> 1)[:, None, :]
+    for channel in (0, 1):
+        flip = (centered[channel] * centered[2]).sum(axis=0) < 0
+        (cmin[channel, flip], cmax[channel, flip]) = (
+            cmax[channel, flip],
+            cmin[channel, flip],
+        )
+    del centered
+    # 565 quantization
+    c0 = ((cmax[0] >> 3) << 11) | ((cmax[1] >> 2) << 5) | (cmax[2] >> 3)
+    c1 = ((cmin[0] >> 3) << 11) | ((cmin[1] >> 2) << 5) | (cmin[2] >> 3)
+    swap = c0 < c1
+    (c0[swap], c1[swap]) = (c1[swap], c0[swap])
+    p0 = expand_565(c0)
+    p1 = expand_565(c1)
+    # projection on the segment [p1, p0], in thirds
+    axis = p0 - p1
+    norm = (axis * axis).sum(axis=0)
+    dots = (pixels[0] - p1[0]) * axis[0]
+    dots += (pixels[1] - p1[1]) * axis[1]
+    dots += (pixels[2] - p1[2]) * axis[2]
+    steps = (3 * dots + (norm >> 1)) // numpy.maximum(norm, 1)
+    indices = _bc1_index_lut[numpy.clip(steps, 0, 3)]
+    indices[:, c0 == c1] = 0
+    packed = (indices << (2 * numpy.arange(16, dtype=numpy.uint32))[:, None]).sum(
+        axis=0, dtype=numpy.uint32
+    )
+    out = numpy.empty((len(c0), 8), dtype=numpy.uint8)
+    out[:, 0:2] = c0.astype("<u2").view(numpy.uint8).reshape(-1, 2)
+    out[:, 2:4] = c1.astype("<u2").view(numpy.uint8).reshape(-1, 2)
+    out[:, 4:8] = packed.astype("<u4").view(numpy.uint8).reshape(-1, 4)
+    return out
+
+
+################################################################################
+def expand_565(c):
+    r = (c >> 11) & 31
+    g = (c >> 5) & 63
+    b = c & 31
+    return numpy.stack(
+        ((r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2))
+    )
+
+
+################################################################################
+
+################################################################################
+def encode_alpha_blocks(alphas):
+    """
+    BC3 alpha part of (16, n) uint8 blocks, returns (n, 8) uint8 with
+    a0 = max > a1 = min (eight alpha values mode).
+    """
+    a0 = alphas.max(axis=0).astype(numpy.int32)
+    a1 = alphas.min(axis=0).astype(numpy.int32)
+    span = a0 - a1
+    steps = (7 * (alphas.astype(numpy.int32) - a1) + (span >> 1)) // numpy.maximum(
+        span, 1
+    )
+    indices = _bc3_index_lut[numpy.clip(steps, 0, 7)]
+    indices[:, span == 0] = 0
+    packed = (indices << (3 * numpy.arange(16, dtype=numpy.uint64))[:, None]).sum(
+        axis=0, dtype=numpy.uint64
+    )
+    out = numpy.empty((len(a0), 8), dtype=numpy.uint8)
+    out[:, 0] = a0
+    out[:, 1] = a1
+    out[:, 2:8] = packed.astype("<u8").view(numpy.uint8).reshape(-1, 8)[:, :6]
+    return out
+
+
+################################################################################
+def encode_level(array, alpha=False):
+    """
+    Blocks of one mipmap level, array is (h, w, 3) or (h, w, 4) uint8.
+    """
+    rows = max(1, (array.shape[0] + 3) // 4)
+    out = []
+    step = 4 * block_rows_per_chunk
+    for row in range(0, rows * 4, step):
+        blocks = to_blocks(array[row : row + step])
+        color = encode_color_blocks(blocks[:3])
+        if alpha:
+            out.append(numpy.hstack((encode_alpha_blocks(blocks[3]), color)))
+        else:
+            out.append(color)
+    return numpy.concatenate(out).tobytes()
+
+
+################################################################################
+
+################################################################################
+def mipmaps(array):
+    """
+    The full mipmap chain (down to 1x1) of a (h, w, c) uint8 array, the
+    reductions use a box filter.
+    """
+    yield array
+    while array.shape[0] > 1 or array.shape[1] > 1:
+        (h, w) = array.shape[:2]
+        acc = array.astype(numpy.uint16)
+        if h > 1:
+            acc = acc[0 : h - h % 2 : 2] + acc[1::2]
+        else:
+            acc = acc * 2
+        if w > 1:
+            acc = acc[:, 0 : w - w % 2 : 2] + acc[:, 1::2]
+        else:
+            acc = acc * 2
+        array = ((acc + 2) >> 2).astype(numpy.uint8)
+        yield array
+
+
+################################################################################
+
+################################################################################
+def dds_header(width, height, mipmap_count, alpha):
+    top_level_size = max(1, (width + 3) // 4) * max(1, (height + 3) // 4) * (
+        16 if alpha else 8
+    )
+    pixel_format = struct.pack(
+        "<II4s5I", 32, DDPF_FOURCC, b"DXT5" if alpha else b"DXT1", 0, 0, 0, 0, 0
+    )
+    return (
+        b"DDS "
+        + struct.pack(
+            "<7I",
+            124,
+            DDSD_FLAGS,
+            height,
+            width,
+            top_level_size,
+            0,
+            mipmap_count,
+        )
+        + bytes(44)
+        + pixel_format
+        + struct.pack("<5I", DDSCAPS_FLAGS, 0, 0, 0, 0)
+    )
+
+
+################################################################################
+
+################################################################################
+def write_dds(image, file_name, alpha=False):
+    """
+    Writes a PIL image (or an uint8 array) as a DDS file with mipmaps, BC3
+    if alpha else BC1.
+    """
+    if hasattr(image, "convert"):
+        image = image.convert("RGBA" if alpha else "RGB")
+    array = numpy.asarray(image)
+    (height, width) = array.shape[:2]
+    levels = [encode_level(level, alpha) for level in mipmaps(array)]
+    with open(file_name, "wb") as f:
+        f.write(dds_header(width, height, len(levels), alpha))
+        for level in levels:
+            f.write(level)
+    return 1
+
+
+################################################################################
@@ -1,11 +1,14 @@
 import os
 import io
 import time
-import requests
+import hashlib
+import json
+import threading
 import zipfile
 import itertools
 from math import sqrt
 import array
+from urllib.parse import urlsplit
 import numpy
 
 try:
@@ -17,6 +20,7 @@ except:
 from PIL import Image
 import O4_UI_Utils as UI
 import O4_File_Names as FNAMES
+import O4_Http_Utils as HTTP
 
 available_sources = (
     "View",
@@ -33,8 +37,23 @@ available_sources = (
 
 global_sources = ("View", "SRTM", "ALOS")
 
+# A server mirroring the elevation ones (e.g. the mock server of
+# O4_Mock_Servers), elevation files are then fetched from
+# <elevation_mirror_url>/<host>/<path> instead. The sources which lost their
+# direct downloads (SRTM, ALOS) can be fetched from a mirror as well.
+elevation_mirror_url = ""
+
+# Size (GB) of the DEM store (see read_elevation), 0 to disable it.
+dem_store_size = 4
+dem_store_version = 1
+_dem_store_lock = threading.Lock()
+
 ################################################################################
 class DEM:
+    # The raster of a DEM is a window onto the rasters of the elevation files
+    # it is made of, which are memory-mapped from the DEM store : a single
+    # file source is used in place (copy on write), the mosaic of a global
+    # source only reads the borders of the neighbouring tiles it needs.
     def __init__(self, lat, lon, source="", fill_nodata=True, info_only=False):
         self.lat = lat
         self.lon = lon
@@ -110,7 +129,7 @@ class DEM:
                         self.nxdem,
                         self.nydem,
                         self.alt_dem,
-                    ) = read_elevation_from_file(
+                    ) = read_elevation(
                         FNAMES.elevation_data(short_source, self.lat, self.lon),
                         self.lat,
                         self.lon,
@@ -151,7 +170,7 @@ class DEM:
                 self.nxdem,
                 self.nydem,
                 self.alt_dem,
-            ) = read_elevation_from_file(
+            ) = read_elevation(
                 file_name, self.lat, self.lon, info_only
             )
         if not local_sources:
@@ -172,7 +191,7 @@ class DEM:
         return
 
     def write_to_file(self, filename):
-        self.alt_dem.astype(numpy.float32).tofile(filename)
+        numpy.asarray(self.alt_dem, dtype=numpy.float32).tofile(filename)
         return
 
     def create_normal_map(self, pixx, pixy):
@@ -290,35 +309,24 @@ class DEM:
         return self.alt_nostrict(node)
 
     def alt_vec_nostrict(self, way):
+        # Same as alt_nostrict for each node of way, the corners of the cells
+        # are gathered at once (out of the raster they are those of the border)
         Nx = self.nxdem - 1
         Ny = self.nydem - 1
-        x, y = way[:, 0], way[:, 1]
-        x = numpy.maximum.reduce([x, self.x0 * numpy.ones(x.shape)])
-        x = numpy.minimum.reduce([x, self.x1 * numpy.ones(x.shape)])
-        y = numpy.maximum.reduce([y, self.y0 * numpy.ones(y.shape)])
-        y = numpy.minimum.reduce([y, self.y1 * numpy.ones(y.shape)])
+        x = numpy.clip(way[:, 0], self.x0, self.x1)
+        y = numpy.clip(way[:, 1], self.y0, self.y1)
         px = (x - self.x0) / (self.x1 - self.x0) * Nx
         py = (y - self.y0) / (self.y1 - self.y0) * Ny
-        nx = px.astype(numpy.uint16)
-        Nminusny = Ny - py.astype(numpy.uint16)
+        nx = px.astype(numpy.intp)
+        Nminusny = Ny - py.astype(numpy.intp)
         rx = px - nx
         ry = py + Nminusny - Ny
-        t1 = [self.alt_dem[i][j] for i, j in zip(Nminusny, nx)]
-        t2 = [
-            self.alt_dem[i][j]
-            for i, j in zip(
-                (Nminusny - 1) * (Nminusny >= 1),
-                (nx + 1) * (nx < Nx) + Nx * (nx == Nx),
-            )
-        ]
-        t3 = [
-            self.alt_dem[i][j]
-            for i, j in zip(Nminusny, (nx + 1) * (nx < Nx) + Nx * (nx == Nx))
-        ]
-        t4 = [
-            self.alt_dem[i][j]
-            for i, j in zip((Nminusny - 1) * (Nminusny >= 1), nx)
-        ]
+        up = numpy.maximum(Nminusny - 1, 0)
+        right = numpy.minimum(nx + 1, Nx)
+        t1 = self.alt_dem[Nminusny, nx]
+        t2 = self.alt_dem[up, right]
+        t3 = self.alt_dem[Nminusny, right]
+        t4 = self.alt_dem[up, nx]
         return ((1 - rx) * t1 + ry * t2 + (rx - ry) * t3) * (rx >= ry) + (
             (1 - ry) * t1 + rx * t2 + (ry - rx) * t4
         ) * (rx < ry)
@@ -327,23 +335,25 @@ class DEM:
         x, y = way[:, 0], way[:, 1]
         mask = (x >= self.x0) * (x <= self.x1) * (y >= self.y0) * (y <= self.y1)
         nx = numpy.round(
-            (x - self.x0) / (self.x1 - self.x0) * (self.nxdem - 1)
-        ).astype(numpy.uint16)
+            (numpy.clip(x, self.x0, self.x1) - self.x0)
+            / (self.x1 - self.x0)
+            * (self.nxdem - 1)
+        ).astype(numpy.intp)
         Nminusny = numpy.round(
-            (self.y1 - y) / (self.y1 - self.y0) * (self.nydem - 1)
-        ).astype(numpy.uint16)
-        return numpy.array(
-            [
-                self.alt_dem[i][j] if k else self.nodata
-                for i, j, k in zip(Nminusny, nx, mask)
-            ]
+            (self.y1 - numpy.clip(y, self.y0, self.y1))
+            / (self.y1 - self.y0)
+            * (self.nydem - 1)
+        ).astype(numpy.intp)
+        return numpy.where(
+            mask, self.alt_dem[Nminusny, nx].astype(numpy.float64), self.nodata
         )
 
     def alt_vec_composite(self, way):
         tmp = self.alt_vec_nostrict(way)
         for subdem in self.subdems:
             tmp2 = subdem.alt_vec_strict(way)
-            tmp[tmp2 != subdem.nodata] = tmp2[tmp2 != subdem.nodata]
+            has_data = tmp2 != subdem.nodata
+            tmp[has_data] = tmp2[has_data]
         return tmp
 
 ################################################################################
@@ -382,7 +392,7 @@ def build_combined_raster(source, lat, lon, info_only):
         if not world_tiles[y, x]:
             tmparray = numpy.zeros((base, base), dtype=numpy.float32)
         elif ensure_elevation(source, lat0, (lon0 + 180) % 360 - 180, verbose):
-            tmparray = read_elevation_from_file(
+            tmparray = read_elevation(
                 FNAMES.elevation_data(source, lat0, (lon0 + 180) % 360 - 180),
                 lat0,
                 (lon0 + 180) % 360 - 180,
@@ -437,6 +447,105 @@ def build_combined_raster(source, lat, lon, info_only):
             )
     return (epsg, x0, y0, x1, y1, nodata, nxdem, nydem, alt_dem)
 
+################################################################################
+#
+# The DEM store keeps the rasters of the elevation files as they are once
+# read (and upsampled for the 3" ones) as .npy files in the tmp dir, keyed by
+# the name, size and date of the files. Reading them again is then a mere
+# memory mapping, shared by all the DEMs of a batch which need a same file
+# (a tile and its neighbours) and by the build processes. The least recently
+# used entries are removed beyond dem_store_size.
+#
+################################################################################
+def read_elevation(
+    file_name, lat, lon, info_only=False, base_if_error=3601
+):
+    # Same as read_elevation_from_file, through the DEM store.
+    if info_only or not dem_store_size:
+        return read_elevation_from_file(
+            file_name, lat, lon, info_only, base_if_error
+        )
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return read_elevation_from_file(
+            file_name, lat, lon, info_only, base_if_error
+        )
+    key = hashlib.sha1(
+        repr(
+            (
+                dem_store_version,
+                os.path.abspath(file_name),
+                stat.st_size,
+                stat.st_mtime_ns,
+                lat,
+                lon,
+            )
+        ).encode()
+    ).hexdigest()[:16]
+    entry = os.path.join(
+        FNAMES.dem_store_dir(), os.path.basename(file_name) + "_" + key
+    )
+    try:
+        with open(entry + ".json", "r") as f:
+            header = json.load(f)
+        alt_dem = numpy.load(entry + ".npy", mmap_mode="c")
+        os.utime(entry + ".npy")
+        return tuple(header) + (alt_dem,)
+    except (OSError, ValueError):
+        pass
+    result = read_elevation_from_file(
+        file_name, lat, lon, info_only, base_if_error
+    )
+    try:
+        os.makedirs(FNAMES.dem_store_dir(), exist_ok=True)
+        # the same entry may be written by other threads or processes
+        tmp_suffix = ".{}_{}.tmp".format(os.getpid(), threading.get_ident())
+        numpy.save(
+            entry + tmp_suffix + ".npy",
+            numpy.asarray(result[-1], dtype=numpy.float32),
+        )
+        os.replace(entry + tmp_suffix + ".npy", entry + ".npy")
+        with open(entry + tmp_suffix, "w") as f:
+            json.dump(
+                [
+                    x.item() if isinstance(x, numpy.generic) else x
+                    for x in result[:-1]
+                ],
+                f,
+            )
+        os.replace(entry + tmp_suffix, entry + ".json")
+        evict_dem_store()
+    except Exception as e:
+        UI.vprint(2, "   Could not store", file_name, "in the DEM store:", e)
+    return result
+
+
+def evict_dem_store():
+    with _dem_store_lock:
+        entries = []
+        for file_name in os.listdir(FNAMES.dem_store_dir()):
+            if not file_name.endswith(".npy") or ".tmp" in file_name:
+                continue
+            try:
+                stat = os.stat(os.path.join(FNAMES.dem_store_dir(), file_name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_name[:-4]))
+        total = sum(entry[1] for entry in entries)
+        for (mtime, size, name) in sorted(entries):
+            if total <= dem_store_size * 2 ** 30:
+                break
+            for extension in (".json", ".npy"):
+                try:
+                    os.remove(
+                        os.path.join(FNAMES.dem_store_dir(), name + extension)
+                    )
+                except OSError:
+                    pass
+            total -= size
+
+
 ################################################################################
 def read_elevation_from_file(
     file_name, lat, lon, info_only=False, base_if_error=3601
@@ -590,7 +699,9 @@ def read_elevation_from_file(
 ##############################################################################
 
 ##############################################################################
-def ensure_elevation(source, lat, lon, verbose=True):
+def elevation_url(source, lat, lon):
+    # Where the elevation data of a tile is downloaded from, None if its
+    # source has no data there.
     if source == "View":
         # Viewfinderpanorama grouping of files and resolutions is a 
         # bit complicated...
@@ -936,7 +1047,7 @@ def ensure_elevation(source, lat, lon, verbose=True):
         # Wellington Intl has missing elevation data in 1" resolution
         if (lat, lon) == (-42, 174):
             resol = 3
-        url = (
+        return (
             "http://viewfinderpanoramas.org/dem"
             + str(resol)
             + "/"
@@ -944,8 +1055,55 @@ def ensure_elevation(source, lat, lon, verbose=True):
             + deferranti_nbr
             + ".zip"
         )
+    elif source in ("SRTM", "ALOS"):
+        url = "https://cloud.sdsc.edu/v1/AUTH_opentopography/Raster/"
+        if source == "SRTM":
+            url += "SRTM_GL1/SRTM_GL1_srtm/"
+            if lat < -60 or lat >= 60:
+                return None
+            if lat < 0:
+                url += "South/"
+            elif lat <= 29:
+                url += "North/North_0_29/"
+            else:
+                url += "North/North_30_60/"
+            url += os.path.basename(FNAMES.viewfinderpanorama(lat, lon))
+        elif source == "ALOS":
+            url += "AW3D30/AW3D30_alos/"
+            if lat < 0:
+                url += "South/"
+            elif lat <= 45:
+                url += "North/North_0_45/"
+            else:
+                url += "North/North_46_90/"
+            tmp = os.path.basename(FNAMES.base_file_name(lat, lon))
+            tmp = tmp[0] + "0" + tmp[1:] + "_AVE_DSM.tif"
+            url += tmp
+        return url
+    elif source in ("NED1", "NED1/3"):
+        nbr = "1" if source == "NED1" else "13"
+        url_base = (
+            "https://prd-tnm.s3.amazonaws.com/StagedProducts/Elevation/"
+            + nbr + "/TIFF/current/"
+        )
+        tid = "n" if lat >= 0 else "s"
+        tid = tid + str(abs(lat + 1)).zfill(2)
+        tid = tid + "w" if lon < 0 else "e"
+        tid = tid + str(abs(lon)).zfill(3)
+        url_base = url_base + tid + "/"
+        usgs_name = (
+            "USGS_" + nbr + "_" + tid + ".tif"
+        )
+        return url_base + usgs_name
+    return None
+
+
+################################################################################
+def ensure_elevation(source, lat, lon, verbose=True):
+    if source == "View":
+        url = elevation_url(source, lat, lon)
         if os.path.exists(FNAMES.viewfinderpanorama(lat, lon)) and (
-            resol == 3
+            "/dem3/" in url
             or os.path.getsize(FNAMES.viewfinderpanorama(lat, lon)) >= 25934402
         ):
             UI.vprint(2, "   Recycling ", FNAMES.viewfinderpanorama(lat, lon))
@@ -997,35 +1155,15 @@ def ensure_elevation(source, lat, lon, verbose=True):
                 2, "   Recycling ", FNAMES.elevation_data(source, lat, lon)
             )
             return 1
-        UI.vprint(
-            1,
-            "    WARNING : This elevation source has no longer direct downloads !"
-        )
-        return 0
-        # TODO : is there a way to get it back (worth it ?) 
-        url = "https://cloud.sdsc.edu/v1/AUTH_opentopography/Raster/"
-        if source == "SRTM":
-            url += "SRTM_GL1/SRTM_GL1_srtm/"
-            if lat < -60 or lat >= 60:
-                return 0
-            if lat < 0:
-                url += "South/"
-            elif lat <= 29:
-                url += "North/North_0_29/"
-            else:
-                url += "North/North_30_60/"
-            url += os.path.basename(FNAMES.viewfinderpanorama(lat, lon))
-        elif source == "ALOS":
-            url += "AW3D30/AW3D30_alos/"
-            if lat < 0:
-                url += "South/"
-            elif lat <= 45:
-                url += "North/North_0_45/"
-            else:
-                url += "North/North_46_90/"
-            tmp = os.path.basename(FNAMES.base_file_name(lat, lon))
-            tmp = tmp[0] + "0" + tmp[1:] + "_AVE_DSM.tif"
-            url += tmp
+        if not elevation_mirror_url:
+            UI.vprint(
+                1,
+                "    WARNING : This elevation source has no longer direct downloads !"
+            )
+            return 0
+        url = elevation_url(source, lat, lon)
+        if not url:
+            return 0
         r = http_request(url, source, verbose)
         if not r:
             return 0
@@ -1052,20 +1190,7 @@ def ensure_elevation(source, lat, lon, verbose=True):
             FNAMES.elevation_data(source, lat, lon),
             "from USGS.",
         )
-        nbr = "1" if source == "NED1" else "13"
-        url_base = (
-            "https://prd-tnm.s3.amazonaws.com/StagedProducts/Elevation/"
-            + nbr + "/TIFF/current/"
-        )
-        tid = "n" if lat >= 0 else "s"
-        tid = tid + str(abs(lat + 1)).zfill(2)
-        tid = tid + "w" if lon < 0 else "e"
-        tid = tid + str(abs(lon)).zfill(3)
-        url_base = url_base + tid + "/"
-        usgs_name = (
-            "USGS_" + nbr + "_" + tid + ".tif"
-        )
-        url = url_base + usgs_name
+        url = elevation_url(source, lat, lon)
         r = http_request(url, source, verbose)
         if not r:
             return 0
@@ -1085,9 +1210,19 @@ def ensure_elevation(source, lat, lon, verbose=True):
         return 0
     return 1
 
+################################################################################
+def mirrored_url(url):
+    # the same file on the elevation mirror if there is one
+    if not elevation_mirror_url:
+        return url
+    parts = urlsplit(url)
+    return elevation_mirror_url.rstrip("/") + "/" + parts.netloc + parts.path
+
+
 ################################################################################
 def http_request(url, source, verbose=False):
-    s = requests.Session()
+    url = mirrored_url(url)
+    s = HTTP.new_session()
     tentative = 0
     while True:
         try:
@@ -0,0 +1,614 @@
+import hashlib
+import lzma
+import struct
+import zlib
+import numpy
+
+# Command opcodes from the DSF specs that we emit (or decode back)
+POOL_SELECT = 1
+JUNCTION_OFFSET = 2
+SET_DEFINITION_8 = 3
+SET_DEFINITION_16 = 4
+SET_DEFINITION_32 = 5
+ROAD_SUBTYPE = 6
+TERRAIN_PATCH_FLAGS_LOD = 18
+PATCH_TRIANGLE = 23
+PATCH_TRIANGLE_CROSS_POOL = 24
+
+################################################################################
+class DSF_Writer:
+    """
+    Binary DSF writer. Atoms are handed over as whole buffers and written in
+    one go, the trailing MD5 signature is updated on the fly so that the
+    finished file never needs to be read back.
+    """
+
+    def __init__(self, file_name):
+        self._f = open(file_name, "wb")
+        self._md5 = hashlib.md5()
+        self.size = 0
+        self.write(b"XPLNEDSF" + struct.pack("<I", 1))
+
+    def write(self, data):
+        self._f.write(data)
+        self._md5.update(data)
+        self.size += len(data)
+
+    def write_atom(self, atom_id, payload=b""):
+        # atom_id is given as stored on disk, i.e. reversed ("DAEH" for HEAD)
+        self.write(atom_id + struct.pack("<I", 8 + len(payload)))
+        if payload:
+            self.write(payload)
+
+    def begin_super_atom(self, atom_id, size):
+        # size includes the 8 bytes of the super atom header
+        self.write(atom_id + struct.pack("<I", size))
+
+    def write_pool_atom(self, pool, plane_count):
+        self.write_atom(b"LOOP", encode_pool_atom(pool, plane_count))
+
+    def write_scal_atom(self, scal):
+        self.write_atom(b"LACS", encode_scal_atom(scal))
+
+    def close(self):
+        md5sum = self._md5.digest()
+        self._f.write(md5sum)
+        self._f.close()
+        self.size += len(md5sum)
+        return md5sum
+
+
+################################################################################
+
+################################################################################
+def encode_pool_atom(pool, plane_count):
+    """
+    POOL atom payload for a point pool given as a flat (interleaved) uint16
+    buffer, planes are stored un-encoded (encoding byte 0).
+    """
+    points = numpy.frombuffer(pool, dtype=numpy.uint16)
+    point_count = len(points) // plane_count
+    planes = numpy.ascontiguousarray(
+        points.reshape(point_count, plane_count).T, dtype="<u2"
+    )
+    out = numpy.zeros((plane_count, 1 + 2 * point_count), dtype=numpy.uint8)
+    out[:, 1:] = planes.view(numpy.uint8).reshape(plane_count, -1)
+    return struct.pack("<IB", point_count, plane_count) + out.tobytes()
+
+
+################################################################################
+
+################################################################################
+def encode_scal_atom(scal):
+    return numpy.asarray(scal, dtype="<f4").tobytes()
+
+
+################################################################################
+
+################################################################################
+def encode_patch_triangles(coords, cross_pool=False, pool_map=None):
+    """
+    PATCH TRIANGLE (resp. PATCH TRIANGLE CROSS-POOL) commands for a flat
+    buffer of point indices (resp. of (pool, point) index pairs), split into
+    runs of at most 255 coordinates. pool_map, if given, is an array used to
+    renumber the pool indices of cross-pool pairs.
+    """
+    coords = numpy.frombuffer(coords, dtype=numpy.uint16)
+    if cross_pool:
+        coords = coords.reshape(-1, 2).copy()
+        if pool_map is not None:
+            coords[:, 0] = pool_map[coords[:, 0]]
+        coords = coords.reshape(-1)
+        opcode = PATCH_TRIANGLE_CROSS_POOL
+        width = 2
+    else:
+        opcode = PATCH_TRIANGLE
+        width = 1
+    coord_count = len(coords) // width
+    blocks = coord_count // 255
+    remaining = coord_count % 255
+    out = b""
+    if blocks:
+        full = numpy.empty((blocks, 2 + 510 * width), dtype=numpy.uint8)
+        full[:, 0] = opcode
+        full[:, 1] = 255
+        full[:, 2:] = (
+            coords[: 255 * width * blocks]
+            .astype("<u2")
+            .view(numpy.uint8)
+            .reshape(blocks, -1)
+        )
+        out = full.tobytes()
+    if remaining:
+        out += struct.pack("<BB", opcode, remaining) + coords[
+            255 * width * blocks :
+        ].astype("<u2").tobytes()
+    return out
+
+
+################################################################################
+
+################################################################################
+def iter_atoms(data, offset=0, end=None):
+    """
+    Yields (atom_id, payload) for the atoms in data[offset:end], atom_id is
+    the on-disk (reversed) four letters code.
+    """
+    end = len(data) if end is None else end
+    while offset < end:
+        atom_id = bytes(data[offset : offset + 4])
+        atom_len = struct.unpack_from("<I", data, offset + 4)[0]
+        yield (atom_id, data[offset + 8 : offset + atom_len])
+        offset += atom_len
+
+
+################################################################################
+
+################################################################################
+def read_dsf_atoms(data):
+    """
+    Top level atoms of an uncompressed DSF file content, as a list of
+    (atom_id, payload). The MD5 signature is checked.
+    """
+    if bytes(data[:8]) != b"XPLNEDSF":
+        raise ValueError("Not a DSF file (or a compressed one).")
+    if hashlib.md5(data[:-16]).digest() != bytes(data[-16:]):
+        raise ValueError("DSF file with wrong MD5 signature.")
+    return list(iter_atoms(data, 12, len(data) - 16))
+
+
+################################################################################
+
+################################################################################
+def decode_pool_atom(payload):
+    """
+    Inverse of encode_pool_atom, returns a (point_count, plane_count) uint16
+    array. Only the raw and run-length encodings are supported.
+    """
+    (point_count, plane_count) = struct.unpack_from("<IB", payload, 0)
+    points = numpy.zeros((point_count, plane_count), dtype=numpy.uint16)
+    pos = 5
+    for plane in range(plane_count):
+        encoding = payload[pos]
+        pos += 1
+        if encoding & 2:  # run-length
+            filled = 0
+            while filled < point_count:
+                code = payload[pos]
+                pos += 1
+                count = code & 127
+                if code & 128:
+                    points[filled : filled + count, plane] = struct.unpack_from(
+                        "<H", payload, pos
+                    )[0]
+                    pos += 2
+                else:
+                    points[filled : filled + count, plane] = numpy.frombuffer(
+                        payload, dtype="<u2", count=count, offset=pos
+                    )
+                    pos += 2 * count
+                filled += count
+        else:
+            points[:, plane] = numpy.frombuffer(
+                payload, dtype="<u2", count=point_count, offset=pos
+            )
+            pos += 2 * point_count
+        if encoding & 1:  # differenced
+            points[:, plane] = numpy.cumsum(points[:, plane], dtype=numpy.uint16)
+    return points
+
+
+################################################################################
+
+################################################################################
+def decode_scal_atom(payload):
+    return numpy.frombuffer(payload, dtype="<f4").astype(numpy.float64)
+
+
+################################################################################
+
+################################################################################
+def decode_terrain_patches(payload):
+    """
+    Decodes a CMDS atom restricted to the commands emitted by build_dsf.
+    Returns a list of (terrain_idx, pool_idx, flag, far_lod, coords) where
+    coords is a flat list of point indices or, for cross-pool patches, of
+    (pool, point) pairs flattened. Consecutive runs of the same patch are
+    merged.
+    """
+    patches = []
+    terrain_idx = pool_idx = flag = far_lod = None
+    pos = 0
+    while pos < len(payload):
+        opcode = payload[pos]
+        pos += 1
+        if opcode == POOL_SELECT:
+            pool_idx = struct.unpack_from("<H", payload, pos)[0]
+            pos += 2
+        elif opcode == SET_DEFINITION_16:
+            terrain_idx = struct.unpack_from("<H", payload, pos)[0]
+            pos += 2
+        elif opcode == TERRAIN_PATCH_FLAGS_LOD:
+            (flag, _, far_lod) = struct.unpack_from("<Bff", payload, pos)
+            pos += 9
+            patches.append((terrain_idx, pool_idx, flag, far_lod, []))
+        elif opcode in (PATCH_TRIANGLE, PATCH_TRIANGLE_CROSS_POOL):
+            width = 1 if opcode == PATCH_TRIANGLE else 2
+            count = payload[pos] * width
+            pos += 1
+            patches[-1][-1].extend(struct.unpack_from("<%dH" % count, payload, pos))
+            pos += 2 * count
+        else:
+            raise ValueError("Unsupported DSF command " + str(opcode))
+    return patches
+
+
+################################################################################
+
+################################################################################
+#
+# In-process reading of the (7z compressed or not) DSF files of the Global
+# Scenery and extraction of their overlays, without the DSFTool round trip
+# through the text format. Only the 7z archives made of a single LZMA or LZMA2
+# compressed file are supported, which is what the X-Plane sceneries ship,
+# anything else raises a ValueError.
+#
+################################################################################
+
+_7z_signature = b"7z\xbc\xaf\x27\x1c"
+_7z_coders = {b"\x00": "copy", b"\x03\x01\x01": "lzma", b"\x21": "lzma2"}
+
+################################################################################
+def read_dsf_file(file_name):
+    """
+    Content of a DSF file, uncompressed if it is a 7z archive.
+    """
+    with open(file_name, "rb") as f:
+        data = f.read()
+    if data[:6] == _7z_signature:
+        data = unpack_7z(data)
+    return data
+
+
+################################################################################
+def unpack_7z(data):
+    if data[:6] != _7z_signature:
+        raise ValueError("Not a 7z archive.")
+    (next_offset, next_size, next_crc) = struct.unpack_from("<QQI", data, 12)
+    header = data[32 + next_offset : 32 + next_offset + next_size]
+    if len(header) != next_size or zlib.crc32(header) != next_crc:
+        raise ValueError("Truncated or corrupted 7z archive.")
+    if header[:1] == b"\x17":  # encoded header, itself a packed stream
+        header = unpack_7z_streams(data, *read_7z_streams_info(header, 1))[0]
+    if header[:2] != b"\x01\x04":  # header then main streams info
+        raise ValueError("Unsupported 7z archive (no or several files).")
+    outputs = unpack_7z_streams(data, *read_7z_streams_info(header, 2))
+    if len(outputs) != 1:
+        raise ValueError("Unsupported 7z archive (several files).")
+    return outputs[0]
+
+
+def unpack_7z_streams(data, pack_pos, pack_sizes, folders):
+    outputs = []
+    offset = 32 + pack_pos
+    for ((coder_id, props), unpack_size, crc) in folders:
+        packed = data[offset : offset + pack_sizes[len(outputs)]]
+        offset += len(packed)
+        method = _7z_coders.get(coder_id)
+        if method == "lzma":
+            filters = [{
+                "id": lzma.FILTER_LZMA1,
+                "lc": props[0] % 9,
+                "lp": props[0] // 9 % 5,
+                "pb": props[0] // 45,
+                "dict_size": struct.unpack_from("<I", props, 1)[0],
+            }]
+        elif method == "lzma2":
+            filters = [{
+                "id": lzma.FILTER_LZMA2,
+                "dict_size": min((2 | props[0] & 1) << (props[0] // 2 + 11),
+                                 1 << 30),
+            }]
+        elif method != "copy":
+            raise ValueError("Unsupported 7z compression method.")
+        try:
+            unpacked = packed if method == "copy" else lzma.LZMADecompressor(
+                format=lzma.FORMAT_RAW, filters=filters
+            ).decompress(packed, max_length=unpack_size)
+        except lzma.LZMAError as e:
+            raise ValueError("Corrupted 7z archive (" + str(e) + ").")
+        if len(unpacked) != unpack_size or (
+            crc is not None and zlib.crc32(unpacked) != crc
+        ):
+            raise ValueError("Corrupted 7z archive.")
+        outputs.append(unpacked)
+    return outputs
+
+
+def read_7z_number(data, pos):
+    first = data[pos]
+    mask = 0x80
+    for extra in range(8):
+        if not first & mask:
+            return (
+                int.from_bytes(data[pos + 1 : pos + 1 + extra], "little")
+                + ((first & (mask - 1)) << (8 * extra)),
+                pos + 1 + extra,
+            )
+        mask >>= 1
+    return (int.from_bytes(data[pos + 1 : pos + 9], "little"), pos + 9)
+
+
+def read_7z_digests(data, pos, count):
+    if data[pos]:
+        (defined, pos) = ([True] * count, pos + 1)
+    else:
+        bits = data[pos + 1 : pos + 1 + (count + 7) // 8]
+        defined = [bool(bits[k // 8] & (0x80 >> k % 8)) for k in range(count)]
+        pos += 1 + len(bits)
+    crcs = []
+    for is_defined in defined:
+        crcs.append(struct.unpack_from("<I", data, pos)[0] if is_defined else None)
+        pos += 4 if is_defined else 0
+    return (crcs, pos)
+
+
+def read_7z_streams_info(data, pos):
+    """
+    Returns (pack_pos, pack_sizes, folders) where each folder is
+    ((coder_id, props), unpack_size, crc). Folders with several coders (e.g.
+    BCJ filters) are rejected, the description of the files is skipped.
+    """
+    (pack_pos, pack_sizes, folders) = (0, [], [])
+    while data[pos]:
+        section = data[pos]
+        pos += 1
+        if section == 0x06:  # pack info
+            (pack_pos, pos) = read_7z_number(data, pos)
+            (count, pos) = read_7z_number(data, pos)
+            while data[pos]:
+                pos += 1
+                if data[pos - 1] == 0x09:
+                    for _ in range(count):
+                        (size, pos) = read_7z_number(data, pos)
+                        pack_sizes.append(size)
+                elif data[pos - 1] == 0x0A:
+                    pos = read_7z_digests(data, pos, count)[1]
+                else:
+                    raise ValueError("Unsupported 7z archive.")
+            pos += 1
+        elif section == 0x07:  # unpack info
+            if data[pos] != 0x0B:
+                raise ValueError("Unsupported 7z archive.")
+            (count, pos) = read_7z_number(data, pos + 1)
+            if data[pos]:
+                raise ValueError("Unsupported 7z archive (external folders).")
+            pos += 1
+            for _ in range(count):
+                (nbr_coders, pos) = read_7z_number(data, pos)
+                flags = data[pos]
+                if nbr_coders != 1 or flags & 0x90:
+                    raise ValueError("Unsupported 7z compression method.")
+                coder_id = bytes(data[pos + 1 : pos + 1 + (flags & 0x0F)])
+                pos += 1 + (flags & 0x0F)
+                props = b""
+                if flags & 0x20:
+                    (size, pos) = read_7z_number(data, pos)
+                    props = bytes(data[pos : pos + size])
+                    pos += size
+                folders.append([(coder_id, props), None, None])
+            if data[pos] != 0x0C:
+                raise ValueError("Unsupported 7z archive.")
+            pos += 1
+            for folder in folders:
+                (folder[1], pos) = read_7z_number(data, pos)
+            while data[pos]:
+                pos += 1
+                if data[pos - 1] != 0x0A:
+                    raise ValueError("Unsupported 7z archive.")
+                (crcs, pos) = read_7z_digests(data, pos, count)
+                for (folder, crc) in zip(folders, crcs):
+                    folder[2] = crc
+            pos += 1
+        elif section == 0x08:  # substreams info, one file per folder only
+            if data[pos] == 0x0D:
+                pos += 1
+                for _ in folders:
+                    (count, pos) = read_7z_number(data, pos)
+                    if count != 1:
+                        raise ValueError(
+                            "Unsupported 7z archive (several files)."
+                        )
+            break
+        else:
+            raise ValueError("Unsupported 7z archive.")
+    if len(pack_sizes) != len(folders):
+        raise ValueError("Unsupported 7z archive.")
+    return (pack_pos, pack_sizes, [tuple(folder) for folder in folders])
+
+
+################################################################################
+
+################################################################################
+def split_strings(payload):
+    # string table atoms (PROP, TERT, OBJT, POLY, NETW, DEMN)
+    return [item.decode("utf-8", "replace")
+            for item in bytes(payload).split(b"\0")[:-1]]
+
+
+################################################################################
+def filter_overlay_commands(payload, exclude_pol, exclude_net, keep_objects):
+    """
+    Selects in a CMDS atom the polygons whose definition is not in
+    exclude_pol, the network chains whose road subtype is not in exclude_net
+    and if keep_objects the objects. Returns the list of the commands kept,
+    as (uses_32bit_pool, pool, definition, subtype, junction_offset, bytes)
+    with the state they were issued in. Terrain patches and comments go.
+    """
+    kept = []
+    pool = definition = subtype = junction_offset = 0
+    pos = 0
+    end = len(payload)
+    while pos < end:
+        start = pos
+        opcode = payload[pos]
+        pos += 1
+        if opcode == POOL_SELECT:
+            pool = struct.unpack_from("<H", payload, pos)[0]
+            pos += 2
+        elif opcode == JUNCTION_OFFSET:
+            junction_offset = struct.unpack_from("<I", payload, pos)[0]
+            pos += 4
+        elif opcode == SET_DEFINITION_8:
+            definition = payload[pos]
+            pos += 1
+        elif opcode == SET_DEFINITION_16:
+            definition = struct.unpack_from("<H", payload, pos)[0]
+            pos += 2
+        elif opcode == SET_DEFINITION_32:
+            definition = struct.unpack_from("<I", payload, pos)[0]
+            pos += 4
+        elif opcode == ROAD_SUBTYPE:
+            subtype = payload[pos]
+            pos += 1
+        elif opcode in (7, 8):  # object, object range
+            pos += 2 if opcode == 7 else 4
+            if keep_objects:
+                kept.append((False, pool, definition, 0, 0, payload[start:pos]))
+        elif opcode in (9, 10, 11):  # network chain, range, chain 32
+            if opcode == 10:
+                pos += 4
+            else:
+                pos += 1 + payload[pos] * (2 if opcode == 9 else 4)
+            if subtype not in exclude_net:
+                kept.append((True, pool, definition, subtype,
+                             junction_offset, payload[start:pos]))
+        elif opcode in (12, 13, 14, 15):  # polygon, range, nested, nested range
+            if opcode == 12:
+                pos += 3 + 2 * payload[pos + 2]
+            elif opcode == 13:
+                pos += 6
+            elif opcode == 14:
+                windings = payload[pos + 2]
+                pos += 3
+                for _ in range(windings):
+                    pos += 1 + 2 * payload[pos]
+            else:
+                pos += 5 + 2 * payload[pos + 2]
+            if definition not in exclude_pol:
+                kept.append((False, pool, definition, 0, 0, payload[start:pos]))
+        elif opcode == 16:  # terrain patch
+            pass
+        elif opcode == 17:  # terrain patch with flags
+            pos += 1
+        elif opcode == TERRAIN_PATCH_FLAGS_LOD:
+            pos += 9
+        elif opcode in (23, 26, 29):  # triangles, strip, fan
+            pos += 1 + 2 * payload[pos]
+        elif opcode in (24, 27, 30):  # their cross-pool variants
+            pos += 1 + 4 * payload[pos]
+        elif opcode in (25, 28, 31):  # their range variants
+            pos += 4
+        elif opcode == 32:  # comments
+            pos += 1 + payload[pos]
+        elif opcode == 33:
+            pos += 2 + struct.unpack_from("<H", payload, pos)[0]
+        elif opcode == 34:
+            pos += 4 + struct.unpack_from("<I", payload, pos)[0]
+        else:
+            raise ValueError("Unsupported DSF command " + str(opcode))
+    if pos != end:
+        raise ValueError("Truncated DSF command.")
+    return kept
+
+
+################################################################################
+def encode_overlay_commands(kept, pool_maps):
+    """
+    CMDS atom payload for the commands selected by filter_overlay_commands,
+    their pools being renumbered through pool_maps (one dict for the 16 bit
+    pools, one for the 32 bit ones). The state commands are issued again
+    where the state of a command differs from the one of the previous.
+    """
+    out = []
+    state = [None] * 4
+    for (is_32bit, pool, definition, subtype, junction_offset, command) in kept:
+        pool = pool_maps[is_32bit][pool]
+        if pool != state[0]:
+            out.append(struct.pack("<BH", POOL_SELECT, pool))
+            state[0] = pool
+        if definition != state[1]:
+            if definition < 1 << 8:
+                out.append(struct.pack("<BB", SET_DEFINITION_8, definition))
+            elif definition < 1 << 16:
+                out.append(struct.pack("<BH", SET_DEFINITION_16, definition))
+            else:
+                out.append(struct.pack("<BI", SET_DEFINITION_32, definition))
+            state[1] = definition
+        if is_32bit and subtype != state[2]:
+            out.append(struct.pack("<BB", ROAD_SUBTYPE, subtype))
+            state[2] = subtype
+        if is_32bit and junction_offset != state[3]:
+            out.append(struct.pack("<BI", JUNCTION_OFFSET, junction_offset))
+            state[3] = junction_offset
+        out.append(command)
+    return b"".join(out)
+
+
+################################################################################
+def write_overlay_dsf(atoms, file_name, exclude_pol=(), exclude_net=(),
+                      keep_objects=False):
+    """
+    Writes to file_name the overlay part of a DSF given by its top level
+    atoms (see read_dsf_atoms) : its properties with sim/overlay set, its
+    polygon and network (and possibly object) definitions, the commands
+    selected by filter_overlay_commands and the point pools they use. The
+    terrain, rasters and unused pools are dropped without being decoded.
+    Returns the number of commands kept.
+    """
+    atoms = {atom_id: payload for (atom_id, payload) in atoms}
+    kept = filter_overlay_commands(
+        atoms[b"SDMC"], set(exclude_pol), set(exclude_net), keep_objects
+    )
+    pool_maps = ({}, {})
+    for item in kept:
+        pool_maps[item[0]].setdefault(item[1], None)
+    for pool_map in pool_maps:
+        for (new, old) in enumerate(sorted(pool_map)):
+            pool_map[old] = new
+    head = [
+        (sub_id, b"sim/overlay\x001\x00" + bytes(sub)
+         if sub_id == b"PORP" else sub)
+        for (sub_id, sub) in iter_atoms(atoms[b"DAEH"])
+    ]
+    definitions = [
+        (sub_id, sub if sub_id in (b"YLOP", b"WTEN")
+         or (sub_id == b"TJBO" and keep_objects) else b"")
+        for (sub_id, sub) in iter_atoms(atoms[b"NFED"])
+    ]
+    # the k-th SCAL atom is the scale of the k-th POOL, same for 32 bit ones
+    counters = {}
+    geodata = []
+    for (sub_id, sub) in iter_atoms(atoms[b"DOEG"]):
+        idx = counters.get(sub_id, 0)
+        counters[sub_id] = idx + 1
+        if idx in pool_maps[sub_id in (b"23OP", b"23CS")]:
+            geodata.append((sub_id, sub))
+    commands = encode_overlay_commands(kept, pool_maps)
+    dsf = DSF_Writer(file_name)
+    for (atom_id, sub_atoms) in (
+        (b"DAEH", head),
+        (b"NFED", definitions),
+        (b"DOEG", geodata),
+    ):
+        dsf.begin_super_atom(
+            atom_id, 8 + sum(8 + len(sub) for (_, sub) in sub_atoms)
+        )
+        for (sub_id, sub) in sub_atoms:
+            dsf.write_atom(sub_id, sub)
+    dsf.write_atom(b"SDMC", commands)
+    dsf.close()
+    return len(kept)
+
+
+################################################################################
@@ -1,6 +1,5 @@
 import array
 import hashlib
-import io
 import numpy
 import os
 import pickle
@@ -10,12 +9,15 @@ from collections import defaultdict
 from math import ceil, floor
 from PIL import Image, ImageDraw
 import subprocess
+import threading
 import O4_Bathymetry as BATHY
+import O4_DSF_IO as DSFIO
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_Mask_Utils as MASK
 import O4_Mesh_Utils as MESH
 import O4_Overlay_Utils as OVL
+import O4_Trace_Utils as TRACE
 import O4_UI_Utils as UI
 
 quad_init_level = 3
@@ -25,6 +27,9 @@ quad_capacity_low = 35000
 # For Laminar test suite
 use_test_texture = False
 
+# to be bumped when the rasters taken from the Global Scenery change
+gs_raster_cache_version = 1
+
 ################################################################################
 def float2qquad(x):
     if x >= 1:
@@ -358,7 +363,10 @@ def create_terrain_file(
 ################################################################################
 
 ################################################################################
+@TRACE.traced("extract_elevation_and_bathymetry_data", latlon_args=True)
 def extract_elevation_and_bathymetry_data(lat, lon):
+    # The rasters are cached by checksum of the Global Scenery DSF, so that
+    # the file is only decoded once whatever the number of builds of the tile
     UI.vprint(1, "     Extracting some rasters from X-Plane's Global Scenery")
     global_scenery_dsf = os.path.join(
         OVL.custom_overlay_src,
@@ -379,93 +387,175 @@ def extract_elevation_and_bathymetry_data(lat, lon):
             "window first.",
         )
         return (b"", b"")
-    tmp_file = os.path.join(
-        FNAMES.Tmp_dir, FNAMES.short_latlon(lat, lon) + ".dsf"
-    )
-    UI.vprint(2, "     Making a copy of the Global Scenery DSF in tmp dir")
     try:
-        shutil.copy(global_scenery_dsf, tmp_file)
-    except:
+        with open(global_scenery_dsf, "rb") as f:
+            data = f.read()
+    except OSError:
         UI.exit_message_and_bottom_line(
-            "     ERROR: could not copy it. Disk full, write permissions,",
-            " erased tmp dir ?",
+            "     ERROR: could not read it. Read permissions ?"
         )
         return (b"", b"")
+    cache_file = os.path.join(
+        FNAMES.gs_raster_cache_dir(),
+        FNAMES.short_latlon(lat, lon)
+        + "_"
+        + hashlib.blake2b(
+            data,
+            digest_size=16,
+            person=b"O4XP-GS-v%d" % gs_raster_cache_version,
+        ).hexdigest()
+        + ".bin",
+    )
+    try:
+        with open(cache_file, "rb") as f:
+            cached = f.read()
+        demn_len = struct.unpack_from("<I", cached)[0]
+        UI.vprint(2, "     Rasters found in the cache.")
+        return (cached[4 : 4 + demn_len], cached[4 + demn_len :])
+    except (OSError, struct.error):
+        pass
+    try:
+        if data[:2] == b"7z":
+            UI.vprint(2, "     The original DSF is a 7z archive, uncompressing...")
+            data = DSFIO.unpack_7z(data)
+        (bDEMN, bDEMS) = decode_elevation_and_bathymetry_data(data)
+    except ValueError as e:
+        UI.vprint(1, "     Could not decode it in-process (" + str(e) + "),",
+                  "using 7z instead.")
+        data = uncompress_with_7z(global_scenery_dsf, lat, lon)
+        try:
+            (bDEMN, bDEMS) = decode_elevation_and_bathymetry_data(data)
+        except ValueError:
+            UI.exit_message_and_bottom_line("     ERROR: Corrupted DSF file.")
+            return (b"", b"")
+    try:
+        os.makedirs(FNAMES.gs_raster_cache_dir(), exist_ok=True)
+        for file_name in os.listdir(FNAMES.gs_raster_cache_dir()):
+            # older versions of the Global Scenery file
+            if file_name.startswith(FNAMES.short_latlon(lat, lon) + "_"):
+                os.remove(os.path.join(FNAMES.gs_raster_cache_dir(), file_name))
+        tmp_file = cache_file + ".{}_{}.tmp".format(
+            os.getpid(), threading.get_ident()
+        )
+        with open(tmp_file, "wb") as f:
+            f.write(struct.pack("<I", len(bDEMN)) + bDEMN + bDEMS)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        UI.vprint(2, "     Could not cache the rasters:", e)
+    return (bDEMN, bDEMS)
 
-    f = open(tmp_file, "rb")
-    dsfid = f.read(2).decode("ascii")
-    f.close()
-    if dsfid == "7z":
-        UI.vprint(2, "     The original DSF is a 7z archive, uncompressing...")
-        os.replace(tmp_file, tmp_file + ".7z")
-        subprocess.run([OVL.unzip_cmd, "e", f"-o{FNAMES.Tmp_dir}", f"{tmp_file}.7z"])
-        os.remove(tmp_file + '.7z')
-    file_len = os.path.getsize(tmp_file)
-    f = open(tmp_file, "rb")
-    # read filetype cookie
-    dsfid = f.read(8).decode("ascii")
-    if dsfid != "XPLNEDSF":
-        UI.exit_message_and_bottom_line("     ERROR: Corrupted DSF file.")
-        os.remove(tmp_file)
-        return (b"", b"")
-    # skip format number
-    f.read(4)
-    # read atoms
-    atoms_len = file_len - 12 - 16  # 12 for HDR and 16 for MD5
-    atoms_consumed = 0
-    while atoms_consumed < atoms_len:
-        atom_hdr = f.read(4).decode("ascii")
-        atom_len = struct.unpack("<I", f.read(4))[0]
-        if atom_hdr == "SMED":
-            bDEMS_orig = f.read(atom_len - 8)
-            bDEMS = b""
-            bELEV = b""
-            g = io.BytesIO(bDEMS_orig)
-            consumed = 8
+
+def uncompress_with_7z(file_name, lat, lon):
+    # former route, for the archives unpack_7z doesn't handle
+    tmp_file = os.path.join(
+        FNAMES.Tmp_dir, FNAMES.short_latlon(lat, lon) + ".dsf"
+    )
+    try:
+        shutil.copy(file_name, tmp_file + ".7z")
+        subprocess.run(
+            [OVL.unzip_cmd, "e", "-y", f"-o{FNAMES.Tmp_dir}", f"{tmp_file}.7z"]
+        )
+        with open(tmp_file, "rb") as f:
+            return f.read()
+    except OSError:
+        return b""
+    finally:
+        for file_name in (tmp_file, tmp_file + ".7z"):
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
+
+
+def decode_elevation_and_bathymetry_data(data):
+    """
+    DEMN definition atom and DEMS atom payloads of an uncompressed DSF, for
+    a copy in the DSF of the tile.
+    """
+    if data[:8] != b"XPLNEDSF":
+        raise ValueError("Not a DSF file.")
+    bDEMN = bDEMS = b""
+    for (atom_id, payload) in DSFIO.iter_atoms(data, 12, len(data) - 16):
+        if atom_id == b"NFED":
+            bDEMN = bytes(dict(DSFIO.iter_atoms(payload)).get(b"NMED", b""))
+        elif atom_id == b"SMED":
+            sub_atoms = []
             i = 0
-            while consumed < atom_len:
-                bH = g.read(4)
-                sub_atom_hdr = bH.decode("ascii")
-                bL = g.read(4)
-                sub_atom_len = struct.unpack("<I", bL)[0]
-                bDATA = g.read(sub_atom_len - 8)
-                if (sub_atom_len > 100):
+            for (sub_atom_id, bDATA) in DSFIO.iter_atoms(payload):
+                if 8 + len(bDATA) > 100:
                     i += 1
-                    if (i == 1):
+                    if i == 1:
                         bELEV = bDATA
-                    elif (i == 2):
+                    elif i == 2:
                         # XP bathy data for inland water is only partial,
                         # we use a safe margin = DEM_elev - 2 to cope with it
                         bathy = numpy.frombuffer(bDATA, dtype=numpy.int16)
-                        safe  = numpy.frombuffer(bELEV, dtype=numpy.int16) - 2 
-                        bathy = numpy.minimum(bathy, safe)
-                        bDATA = bytes(bathy)
-                bDEMS += bH + bL + bDATA
-                consumed += sub_atom_len
-            g.close()
-        elif atom_hdr == "NFED":
-            consumed = 8
-            while consumed < atom_len:
-                sub_atom_hdr = f.read(4).decode("ascii")
-                sub_atom_len = struct.unpack("<I", f.read(4))[0]
-                data = f.read(sub_atom_len - 8)
-                if sub_atom_hdr == "NMED":
-                    bDEMN = data
-                consumed += sub_atom_len
-        else:
-            f.read(atom_len - 8)
+                        safe = numpy.frombuffer(bELEV, dtype=numpy.int16) - 2
+                        bDATA = numpy.minimum(bathy, safe).tobytes()
+                sub_atoms.append(
+                    sub_atom_id + struct.pack("<I", 8 + len(bDATA)) + bDATA
+                )
+            bDEMS = b"".join(sub_atoms)
+    return (bDEMN, bDEMS)
 
-        atoms_consumed += atom_len
 
-    f.close()
-    os.remove(tmp_file)
+################################################################################
 
-    return (bDEMN, bDEMS)
+################################################################################
+@TRACE.traced("assign_textures")
+def assign_textures(tile, dico_customzl, node_coords, tri_idx):
+    """
+    Bulk counterpart of the per triangle texture lookups of build_dsf.
+    Returns the list of distinct texture attributes met in the mesh, the
+    index in that list of the texture of each triangle, and for each
+    triangle the uint16 (s,t) coordinates of its three vertices (in tri_idx
+    order) within that texture.
+    """
+    nbr_tris = len(tri_idx) // 3
+    corners = numpy.asarray(tri_idx, dtype=numpy.int64).reshape(nbr_tris, 3)
+    lons = node_coords[0::5][corners]
+    lats = node_coords[1::5][corners]
+    # same summation order as the scalar code, to get the same barycenters
+    bary_lon = (lons[:, 0] + lons[:, 1] + lons[:, 2]) / 3
+    bary_lat = (lats[:, 0] + lats[:, 1] + lats[:, 2]) / 3
+    (til_x, til_y) = GEO.wgs84_to_orthogrid_vec(
+        bary_lat, bary_lon, tile.mesh_zl
+    )
+    (keys, tri_textures) = numpy.unique(
+        numpy.column_stack((til_x, til_y)), axis=0, return_inverse=True
+    )
+    tri_textures = tri_textures.reshape(-1)
+    texture_list = [dico_customzl[(int(x), int(y))] for (x, y) in keys]
+    tex_x = numpy.array([attr[0] for attr in texture_list], dtype=numpy.int64)
+    tex_y = numpy.array([attr[1] for attr in texture_list], dtype=numpy.int64)
+    tex_zl = numpy.array([attr[2] for attr in texture_list], dtype=numpy.int64)
+    (s, t) = GEO.st_coord_vec(
+        lats,
+        lons,
+        tex_x[tri_textures][:, None],
+        tex_y[tri_textures][:, None],
+        tex_zl[tri_textures][:, None],
+    )
+    s = numpy.round(s * 65535)
+    t *= 65535
+    # t went through numpy's log/tan, values too close to a rounding tie are
+    # recomputed with the scalar formula for the output to stay identical
+    for i in numpy.flatnonzero(numpy.abs(t - numpy.floor(t) - 0.5) < 1e-6):
+        (tri, j) = divmod(int(i), 3)
+        t[tri, j] = GEO.st_coord(
+            lats[tri, j], lons[tri, j], *texture_list[tri_textures[tri]]
+        )[1] * 65535
+    t = numpy.round(t)
+    tri_st = numpy.empty((nbr_tris, 6), dtype=numpy.uint16)
+    tri_st[:, 0::2] = s
+    tri_st[:, 1::2] = t
+    return (texture_list, tri_textures, tri_st)
 
 
 ################################################################################
 
 ################################################################################
+@TRACE.traced("build_dsf")
 def build_dsf(tile, download_queue):
 
     
@@ -495,6 +585,11 @@ def build_dsf(tile, download_queue):
                             nbr_nodes, node_coords, node_types, tile)
     
     UI.vprint(1, "-> Computing point pools and texture requirements")
+
+    # Texture of each triangle and st coordinates of its vertices, in bulk
+    (texture_list, tri_textures, tri_st) = assign_textures(
+        tile, dico_customzl, node_coords, tri_idx
+    )
     
     # 5 Compute quadtree
     if (tile.use_masks_for_inland):
@@ -654,19 +749,7 @@ def build_dsf(tile, download_queue):
                 UI.vprint(1, "DSF construction interrupted.")
                 return 0
         done += 1
-        bary_lon = (
-            node_coords[5 * n1 + 0]
-            + node_coords[5 * n2 + 0]
-            + node_coords[5 * n3 + 0]
-        ) / 3
-        bary_lat = (
-            node_coords[5 * n1 + 1]
-            + node_coords[5 * n2 + 1]
-            + node_coords[5 * n3 + 1]
-        ) / 3
-        texture_attributes = dico_customzl[
-            GEO.wgs84_to_orthogrid(bary_lat, bary_lon, tile.mesh_zl)
-        ]
+        texture_attributes = texture_list[tri_textures[tri]]
         # The entries for the terrain and texture main dictionnaries
         terrain_attributes = (texture_attributes, tri_type)
         is_overlay = False
@@ -776,7 +859,8 @@ def build_dsf(tile, download_queue):
         # First the ones associated to the dico_customzl
         if terrain_idx:
             tri_p = array.array("H")
-            for n in (n1, n3, n2):  # beware of ordering for orientation !
+            # beware of ordering for orientation !
+            for (j, n) in ((0, n1), (2, n3), (1, n2)):
                 idx_pool = idx_node_to_idx_pool[n]
                 node_hash = (
                     idx_pool,
@@ -786,11 +870,7 @@ def build_dsf(tile, download_queue):
                 if node_hash in textured_nodes:
                     (idx_dsfpool, pos_in_pool) = textured_nodes[node_hash]
                 else:
-                    (s, t) = GEO.st_coord(
-                        node_coords[5 * n + 1],
-                        node_coords[5 * n],
-                        *texture_attributes
-                    )
+                    (s, t) = tri_st[tri, 2 * j : 2 * j + 2].tolist()
                     # BEWARE : normal coordinates are pointing (EAST,SOUTH)
                     # in X-Plane, not (EAST,NORTH) ! (cfr DSF specs), so v -> -v
                     if is_overlay: 
@@ -799,14 +879,7 @@ def build_dsf(tile, download_queue):
                         dsf_pools[idx_dsfpool].extend(
                             node_icoords[5 * n : 5 * n + 5]
                         )
-                        dsf_pools[idx_dsfpool].extend(
-                            (
-                                int(round(s * 65535)),
-                                int(round(t * 65535)),
-                                int(round(s * 65535)),
-                                int(round(t * 65535)),
-                            )
-                        )
+                        dsf_pools[idx_dsfpool].extend((s, t, s, t))
                     else:  # dtx5 dds with mask included
                         idx_dsfpool = idx_pool + pool_nbr
                         dsf_pools[idx_dsfpool].extend(
@@ -818,7 +891,7 @@ def build_dsf(tile, download_queue):
                         ratio_fetch = 1
                         dsf_pools[idx_dsfpool].extend(
                             (int(65535 * ratio_fetch), int(65535 * ratio_bathy), 
-                             int(round(s * 65535)), int(round(t * 65535)))
+                             s, t)
                         )
                     len_textured_nodes += 1
                     pos_in_pool = dsf_pool_length[idx_dsfpool]
@@ -889,17 +962,7 @@ def build_dsf(tile, download_queue):
                 UI.vprint(1, "DSF construction interrupted.")
                 return 0
         done += 1
-        bary_lon = (
-            node_coords[5 * n1] + node_coords[5 * n2] + node_coords[5 * n3]
-        ) / 3
-        bary_lat = (
-            node_coords[5 * n1 + 1]
-            + node_coords[5 * n2 + 1]
-            + node_coords[5 * n3 + 1]
-        ) / 3
-        texture_attributes = dico_customzl[
-            GEO.wgs84_to_orthogrid(bary_lat, bary_lon, tile.mesh_zl)
-        ]
+        texture_attributes = texture_list[tri_textures[tri]]
         # The entries for the terrain and texture main dictionnaries
         terrain_attributes = (texture_attributes, tri_type)
         is_overlay = False
@@ -947,7 +1010,8 @@ def build_dsf(tile, download_queue):
         # We put the tri in the right terrain
         # First the ones associated to the dico_customzl
         tri_p = array.array("H")
-        for n in (n1, n3, n2):  # beware of ordering for orientation !
+        # beware of ordering for orientation !
+        for (j, n) in ((0, n1), (2, n3), (1, n2)):
             idx_pool = idx_node_to_idx_pool[n]
             node_hash = (
                 idx_pool,
@@ -957,11 +1021,7 @@ def build_dsf(tile, download_queue):
             if node_hash in textured_nodes:
                 (idx_dsfpool, pos_in_pool) = textured_nodes[node_hash]
             else:
-                (s, t) = GEO.st_coord(
-                    node_coords[5 * n + 1],
-                    node_coords[5 * n],
-                    *texture_attributes
-                )
+                (s, t) = tri_st[tri, 2 * j : 2 * j + 2].tolist()
                 # BEWARE : normal coordinates are pointing (EAST,SOUTH) in 
                 # X-Plane, not (EAST,NORTH) ! (cfr DSF specs), so v -> -v
                 if not tri_type:  # land
@@ -969,9 +1029,7 @@ def build_dsf(tile, download_queue):
                     dsf_pools[idx_dsfpool].extend(
                         node_icoords[5 * n : 5 * n + 5]
                     )
-                    dsf_pools[idx_dsfpool].extend(
-                        (int(round(s * 65535)), int(round(t * 65535)))
-                    )
+                    dsf_pools[idx_dsfpool].extend((s, t))
                 else:  # inland water
                     idx_dsfpool = idx_pool + pool_nbr
                     # constant alpha overlay with flat shading
@@ -982,8 +1040,8 @@ def build_dsf(tile, download_queue):
                         (
                             32768,
                             32768,
-                            int(round(s * 65535)),
-                            int(round(t * 65535)),
+                            s,
+                            t,
                             0,
                             int(round(tile.ratio_water * 65535)),
                         )
@@ -1088,7 +1146,6 @@ def build_dsf(tile, download_queue):
 
     # Computation of intermediate and of total length
     size_of_head_atom = 16 + len(bPROP)
-    size_of_prop_atom = 8 + len(bPROP)
     size_of_defn_atom = (
         48 + len(bTERT) + len(bOBJT) + len(bPOLY) + len(bNETW) + len(bDEMN)
     )
@@ -1105,71 +1162,36 @@ def build_dsf(tile, download_queue):
     UI.vprint(
         2, "     Size of GEOD atom : " + str(size_of_geod_atom) + " bytes."
     )
-    f = open(dsf_file_name + ".tmp", "wb")
-    f.write(b"XPLNEDSF")
-    f.write(struct.pack("<I", 1))
+    f = DSFIO.DSF_Writer(dsf_file_name + ".tmp")
 
     # Head super-atom
-    f.write(b"DAEH")
-    f.write(struct.pack("<I", size_of_head_atom))
-    f.write(b"PORP")
-    f.write(struct.pack("<I", size_of_prop_atom))
-    f.write(bPROP)
+    f.begin_super_atom(b"DAEH", size_of_head_atom)
+    f.write_atom(b"PORP", bPROP)
 
     # Definitions super-atom
-    f.write(b"NFED")
-    f.write(struct.pack("<I", size_of_defn_atom))
-    f.write(b"TRET")
-    f.write(struct.pack("<I", 8 + len(bTERT)))
-    f.write(bTERT)
-    f.write(b"TJBO")
-    f.write(struct.pack("<I", 8 + len(bOBJT)))
-    f.write(bOBJT)
-    f.write(b"YLOP")
-    f.write(struct.pack("<I", 8 + len(bPOLY)))
-    f.write(bPOLY)
-    f.write(b"WTEN")
-    f.write(struct.pack("<I", 8 + len(bNETW)))
-    f.write(bNETW)
-    f.write(b"NMED")
-    f.write(struct.pack("<I", 8 + len(bDEMN)))
-    f.write(bDEMN)
+    f.begin_super_atom(b"NFED", size_of_defn_atom)
+    f.write_atom(b"TRET", bTERT)
+    f.write_atom(b"TJBO", bOBJT)
+    f.write_atom(b"YLOP", bPOLY)
+    f.write_atom(b"WTEN", bNETW)
+    f.write_atom(b"NMED", bDEMN)
 
     # Geodata super-atom
-    f.write(b"DOEG")
-    f.write(struct.pack("<I", size_of_geod_atom))
+    f.begin_super_atom(b"DOEG", size_of_geod_atom)
     f.write(bGEOD)
     for k in range(dsf_pool_nbr):
         if dsf_pool_length[k] == 0:
             continue
-        f.write(b"LOOP")
-        f.write(
-            struct.pack(
-                "<I",
-                13
-                + dsf_pool_plane[k]
-                + 2 * dsf_pool_plane[k] * dsf_pool_length[k],
-            )
-        )
-        f.write(struct.pack("<I", dsf_pool_length[k]))
-        f.write(struct.pack("<B", dsf_pool_plane[k]))
-        for l in range(dsf_pool_plane[k]):
-            f.write(struct.pack("<B", 0))
-            for m in range(dsf_pool_length[k]):
-                f.write(
-                    struct.pack("<H", dsf_pools[k][dsf_pool_plane[k] * m + l])
-                )
+        f.write_pool_atom(dsf_pools[k], dsf_pool_plane[k])
     for k in range(dsf_pool_nbr):
         if dsf_pool_length[k] == 0:
             continue
-        f.write(b"LACS")
-        f.write(struct.pack("<I", 8 + 8 * dsf_pool_plane[k]))
-        for l in range(2 * dsf_pool_plane[k]):
-            f.write(struct.pack("<f", pool_param[k % pool_nbr][l]))
+        f.write_scal_atom(pool_param[k % pool_nbr][: 2 * dsf_pool_plane[k]])
 
     UI.progress_bar(1, 95)
     if UI.red_flag:
         UI.vprint(1, "DSF construction interrupted.")
+        f.close()
         return 0
 
     # Since we possibly skipped some pools, and since we possibly
@@ -1178,177 +1200,67 @@ def build_dsf(tile, download_queue):
     # to the stripping :
 
     dico_new_dsf_pool = {}
+    new_dsf_pool = numpy.zeros(dsf_pool_nbr, dtype=numpy.uint16)
     new_idx_dsfpool = nbr_dsfpools_yet_in
     for k in range(dsf_pool_nbr):
         if dsf_pool_length[k] != 0:
             dico_new_dsf_pool[k] = new_idx_dsfpool
+            new_dsf_pool[k] = new_idx_dsfpool
             new_idx_dsfpool += 1
 
     # Commands atom
-    # we first compute its size :
-    size_of_cmds_atom = 8 + len(bCMDS)
-    for terrain_idx in textured_tris:
-        if len(textured_tris[terrain_idx]) == 0:
-            continue
-        size_of_cmds_atom += 3
-        for idx_dsfpool in textured_tris[terrain_idx]:
-            if idx_dsfpool != "cross-pool":
-                size_of_cmds_atom += 13 + 2 * (
-                    len(textured_tris[terrain_idx][idx_dsfpool])
-                    + ceil(len(textured_tris[terrain_idx][idx_dsfpool]) / 255)
-                )
-            else:
-                size_of_cmds_atom += 13 + 2 * (
-                    len(textured_tris[terrain_idx][idx_dsfpool])
-                    + ceil(len(textured_tris[terrain_idx][idx_dsfpool]) / 510)
-                )
-    UI.vprint(
-        2, "     Size of CMDS atom : " + str(size_of_cmds_atom) + " bytes."
-    )
-    f.write(b"SDMC")  # CMDS header
-    f.write(struct.pack("<I", size_of_cmds_atom))  # CMDS length
-    f.write(bCMDS)
+    cmds = [bCMDS]
     for terrain_idx in textured_tris:
         if len(textured_tris[terrain_idx]) == 0:
             continue
-        # print("terrain_idx = "+str(terrain_idx))
-        f.write(struct.pack("<B", 4))  # SET DEFINITION 16
-        f.write(struct.pack("<H", terrain_idx))  # TERRAIN INDEX
+        cmds.append(struct.pack("<BH", DSFIO.SET_DEFINITION_16, terrain_idx))
         flag = (
             1 if terrain_idx not in overlay_terrains else 2
         )  # physical or overlay
         lod = -1 if flag == 1 else tile.overlay_lod
         for idx_dsfpool in textured_tris[terrain_idx]:
+            coords = textured_tris[terrain_idx][idx_dsfpool]
             if idx_dsfpool != "cross-pool":
-                f.write(struct.pack("<B", 1))  # POOL SELECT
-                f.write(
-                    struct.pack("<H", dico_new_dsf_pool[idx_dsfpool])
-                )  # POOL INDEX
-
-                f.write(struct.pack("<B", 18))  # TERRAIN PATCH FLAGS AND LOD
-                f.write(struct.pack("<B", flag))  # FLAG
-                f.write(struct.pack("<f", 0))  # NEAR LOD
-                f.write(struct.pack("<f", lod))  # FAR LOD
-
-                blocks = floor(
-                    len(textured_tris[terrain_idx][idx_dsfpool]) / 255
-                )
-                for j in range(blocks):
-                    f.write(struct.pack("<B", 23))  # PATCH TRIANGLE
-                    f.write(struct.pack("<B", 255))  # COORDINATE COUNT
-
-                    for k in range(255):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    255 * j + k
-                                ],
-                            )
-                        )  # COORDINATE IDX
-                remaining_tri_p = (
-                    len(textured_tris[terrain_idx][idx_dsfpool]) % 255
-                )
-                if remaining_tri_p != 0:
-                    f.write(struct.pack("<B", 23))  # PATCH TRIANGLE
-                    f.write(
-                        struct.pack("<B", remaining_tri_p)
-                    )  # COORDINATE COUNT
-                    for k in range(remaining_tri_p):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    255 * blocks + k
-                                ],
-                            )
-                        )  # COORDINATE IDX
-            else:  # idx_dsfpool == 'cross-pool'
-                pool_idx_init = textured_tris[terrain_idx][idx_dsfpool][0]
-                f.write(struct.pack("<B", 1))  # POOL SELECT
-                f.write(
-                    struct.pack("<H", dico_new_dsf_pool[pool_idx_init])
-                )  # POOL INDEX
-                f.write(struct.pack("<B", 18))  # TERRAIN PATCH FLAGS AND LOD
-                f.write(struct.pack("<B", flag))  # FLAG
-                f.write(struct.pack("<f", 0))  # NEAR LOD
-                f.write(struct.pack("<f", lod))  # FAR LOD
-
-                blocks = floor(
-                    len(textured_tris[terrain_idx][idx_dsfpool]) / 510
+                pool_select = dico_new_dsf_pool[idx_dsfpool]
+            else:
+                pool_select = dico_new_dsf_pool[coords[0]]
+            cmds.append(
+                struct.pack(
+                    "<BHBBff",
+                    DSFIO.POOL_SELECT,
+                    pool_select,
+                    DSFIO.TERRAIN_PATCH_FLAGS_LOD,
+                    flag,
+                    0,
+                    lod,
                 )
-                for j in range(blocks):
-                    f.write(struct.pack("<B", 24))  # PATCH TRIANGLE CROSS-POOL
-                    f.write(struct.pack("<B", 255))  # COORDINATE COUNT
-                    for k in range(255):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                dico_new_dsf_pool[
-                                    textured_tris[terrain_idx][idx_dsfpool][
-                                        510 * j + 2 * k
-                                    ]
-                                ],
-                            )
-                        )  # POOL IDX
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    510 * j + 2 * k + 1
-                                ],
-                            )
-                        )  # POS_IN_POOL IDX
-                remaining_tri_p = int(
-                    (len(textured_tris[terrain_idx][idx_dsfpool]) % 510) / 2
+            )
+            cmds.append(
+                DSFIO.encode_patch_triangles(
+                    coords,
+                    cross_pool=(idx_dsfpool == "cross-pool"),
+                    pool_map=new_dsf_pool,
                 )
-                if remaining_tri_p != 0:
-                    f.write(struct.pack("<B", 24))  # PATCH TRIANGLE CROSS-POOL
-                    f.write(
-                        struct.pack("<B", remaining_tri_p)
-                    )  # COORDINATE COUNT
-                    for k in range(remaining_tri_p):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                dico_new_dsf_pool[
-                                    textured_tris[terrain_idx][idx_dsfpool][
-                                        510 * blocks + 2 * k
-                                    ]
-                                ],
-                            )
-                        )  # POOL IDX
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    510 * blocks + 2 * k + 1
-                                ],
-                            )
-                        )  # POS_IN_PO0L IDX
+            )
+    bCMDS = b"".join(cmds)
+    size_of_cmds_atom = 8 + len(bCMDS)
+    UI.vprint(
+        2, "     Size of CMDS atom : " + str(size_of_cmds_atom) + " bytes."
+    )
+    f.write_atom(b"SDMC", bCMDS)
 
     # DEMS atom
     if bDEMS != b"":
-        f.write(b"SMED")
-        f.write(struct.pack("<I", 8 + len(bDEMS)))
-        f.write(bDEMS)
+        f.write_atom(b"SMED", bDEMS)
 
     UI.progress_bar(1, 98)
     if UI.red_flag:
         UI.vprint(1, "DSF construction interrupted.")
+        f.close()
         return 0
 
     f.close()
-
-    f = open(dsf_file_name + ".tmp", "rb")
-    data = f.read()
-    m = hashlib.md5()
-    m.update(data)
-    md5sum = m.digest()
-    f.close()
-    f = open(dsf_file_name + ".tmp", "ab")
-    f.write(md5sum)
-    f.close()
+    TRACE.wrote(dsf_file_name + ".tmp")
     
     UI.progress_bar(1, 100)
     
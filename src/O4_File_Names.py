@@ -204,6 +204,44 @@ def mesh_file(build_dir, lat, lon):
     return os.path.join(build_dir, "Data" + short_latlon(lat, lon) + ".mesh")
 
 
+def mesh_bin_file(mesh_file_name):
+    # binary sidecar of a text .mesh file, see O4_Mesh_Utils
+    return mesh_file_name + ".bin"
+
+
+def build_cache_file(tile):
+    # fingerprints of the steps of the tile, see O4_Build_Cache
+    return os.path.join(
+        tile.build_dir, "Data" + short_latlon(tile.lat, tile.lon) + ".steps"
+    )
+
+
+def batch_state_file():
+    # job state of the last (unfinished) batch build, see O4_Tile_Utils
+    return os.path.join(Tmp_dir, "batch_state.json")
+
+
+def profile_file(lat, lon):
+    # build profile of the tile, see O4_Trace_Utils
+    return os.path.join(
+        Tmp_dir, "Profiles", short_latlon(lat, lon) + ".json"
+    )
+
+
+def profile_summary_file():
+    return os.path.join(Tmp_dir, "Profiles", "summary.json")
+
+
+def dem_store_dir():
+    # memory-mapped elevation rasters, see O4_DEM_Utils
+    return os.path.join(Tmp_dir, "DEM_store")
+
+
+def gs_raster_cache_dir():
+    # rasters of the Global Scenery DSFs, see O4_DSF_Utils
+    return os.path.join(Tmp_dir, "GS_rasters")
+
+
 def dsf_file(build_dir, lat, lon):
     return os.path.join(
         build_dir, "Earth nav data", long_latlon(lat, lon) + ".dsf"
@@ -1,4 +1,5 @@
 from math import log, tan, pi, atan, exp, cos, sin, sqrt, atan2
+import numpy
 from pyproj import CRS, Transformer
 
 earth_radius = 6378137
@@ -149,3 +150,54 @@ def st_coord(lat, lon, tex_x, tex_y, zoomlevel, provider_code):
     t = t if t <= 1 else 1
     return (s, t)
 ################################################################################
+
+################################################################################
+def _ratio_y(lat):
+    return log(tan((90 + lat) * pi / 360)) / pi
+################################################################################
+
+################################################################################
+def _ratio_y_vec(lat):
+    return numpy.log(numpy.tan((90 + lat) * pi / 360)) / pi
+################################################################################
+
+################################################################################
+def wgs84_to_orthogrid_vec(lat, lon, zoomlevel):
+    """
+    Array version of wgs84_to_orthogrid. numpy's log and tan need not round
+    like the C library ones, so the few values falling within reach of a grid
+    line are recomputed with the scalar formula, and results always match
+    those of wgs84_to_orthogrid.
+    """
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    lon = numpy.asarray(lon, dtype=numpy.float64)
+    ratio_x = lon / 180
+    mult = 2 ** (zoomlevel - 5)
+    grid_x = (ratio_x + 1) * mult
+    grid_y = (1 - _ratio_y_vec(lat)) * mult
+    for i in numpy.flatnonzero(numpy.abs(grid_y - numpy.round(grid_y)) < 1e-6):
+        grid_y.flat[i] = (1 - _ratio_y(lat.flat[i])) * mult
+    til_x = grid_x.astype(numpy.int64) * 16
+    til_y = grid_y.astype(numpy.int64) * 16
+    return (til_x, til_y)
+################################################################################
+
+################################################################################
+def st_coord_vec(lat, lon, tex_x, tex_y, zoomlevel):
+    """
+    Array version of st_coord, arguments are broadcast against each other.
+    The results may only differ from st_coord in the last bits of t (see
+    wgs84_to_orthogrid_vec), callers needing exact equality after some
+    rounding should recompute ambiguous values with st_coord.
+    """
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    lon = numpy.asarray(lon, dtype=numpy.float64)
+    tex_x = numpy.asarray(tex_x, dtype=numpy.int64)
+    tex_y = numpy.asarray(tex_y, dtype=numpy.int64)
+    ratio_x = lon / 180
+    ratio_y = _ratio_y_vec(lat)
+    mult = 2.0 ** (numpy.asarray(zoomlevel) - 5)
+    s = (ratio_x + 1) * mult - (tex_x // 16)
+    t = 1 - ((1 - ratio_y) * mult - tex_y // 16)
+    return (numpy.clip(s, 0, 1), numpy.clip(t, 0, 1))
+################################################################################
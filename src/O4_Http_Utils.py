@@ -0,0 +1,129 @@
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+import requests.adapters
+import O4_Trace_Utils as TRACE
+
+################################################################################
+#
+# Shared HTTP sessions, one per host (scheme + network location), so that the
+# connections to a provider are kept alive and reused by all the download
+# workers instead of being re-established for each texture.
+#
+################################################################################
+
+# Connections kept open per host, should at least match the number of
+# download workers hitting a same host (max_threads of the providers).
+http_pool_size = 16
+# Set to False for servers which misbehave with persistent connections.
+http_keep_alive = True
+# Maximum number of simultaneous requests to a same host (0 = no limit), and
+# per host overrides as (host, cap) pairs, e.g. [["tiles.example.com", 4]].
+http_max_per_host = 0
+http_host_caps = []
+
+_lock = threading.Lock()
+_sessions = {}
+_host_slots = {}
+
+################################################################################
+def host_key(url):
+    parts = urlsplit(url)
+    return (parts.scheme.lower(), parts.netloc.lower())
+
+################################################################################
+def new_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=max(1, http_pool_size)
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not http_keep_alive:
+        session.headers["Connection"] = "close"
+    session.hooks["response"].append(TRACE.count_download)
+    return session
+
+################################################################################
+def get_session(url):
+    key = host_key(url)
+    with _lock:
+        if key not in _sessions:
+            _sessions[key] = new_session()
+        return _sessions[key]
+
+################################################################################
+def reset_session(url, session=None):
+    # After a connection failure : the next request to the host will use a
+    # fresh session. Workers sharing the failed one don't all need to renew
+    # it, hence the optional check that it was not already replaced.
+    key = host_key(url)
+    with _lock:
+        if key in _sessions and (
+            session is None or _sessions[key] is session
+        ):
+            _sessions.pop(key).close()
+
+################################################################################
+def close_sessions():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+################################################################################
+def host_slot(url):
+    # A context manager bounding the number of simultaneous requests to the
+    # host of url, a no-op if there is no cap.
+    (_, netloc) = key = host_key(url)
+    caps = {host.lower(): cap for (host, cap) in dict(http_host_caps).items()}
+    cap = caps.get(netloc, http_max_per_host)
+    if not cap:
+        return _no_slot
+    with _lock:
+        if key not in _host_slots or _host_slots[key][0] != cap:
+            _host_slots[key] = (cap, threading.BoundedSemaphore(cap))
+        return _host_slots[key][1]
+
+
+class _no_cap:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_no_slot = _no_cap()
+
+################################################################################
+class token_bucket:
+    # Rate limiter shared by threads : at most burst requests at once, then
+    # rate requests per second on average.
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, abort=lambda: False):
+        # Blocks until a token is available, returns False if abort() became
+        # true in the meantime. A rate of 0 means no limit.
+        if self.rate <= 0:
+            return True
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._stamp) * self.rate
+                )
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if abort():
+                return False
+            time.sleep(min(wait, 0.5))
@@ -6,6 +6,11 @@ import O4_Vector_Utils as VECT
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_UI_Utils as UI
+import O4_Http_Utils as HTTP
+import O4_DDS_Utils as DDS
+import O4_Trace_Utils as TRACE
+import collections
+import threading
 import time
 import os
 import sys
@@ -16,7 +21,7 @@ import queue
 import random
 from math import ceil, log, tan, pi
 import numpy
-from PIL import Image, ImageFilter, ImageEnhance, ImageOps
+from PIL import Image, ImageFilter, ImageEnhance
 
 Image.MAX_IMAGE_PIXELS = 1000000000  # Not a decompression bomb attack!
 
@@ -40,6 +45,8 @@ except:
 
 http_timeout = 10
 check_tms_response = False
+# "nvcompress" or "internal" (O4_DDS_Utils) for the DDS conversion
+dds_encoder = "nvcompress"
 max_connect_retries = 10
 max_baddata_retries = 10
 errors = []
@@ -846,6 +853,140 @@ def read_tilematrixsets(file_name):
 
 ################################################################################
 
+################################################################################
+#
+# Cache of the decoded extent rasters (and of the sea masks used by the mask
+# layers) for has_data, each png is decoded only once instead of at every
+# query. Entries are keyed by file name, size and modification time so that
+# rebuilt masks are picked up. With extent_cache_mmap the extents are
+# stored once as .npy files in the tmp dir and memory-mapped, which keeps
+# the large ones out of the memory of each process. The coverage answers
+# are bounded the same way, the least recently used ones are dropped first.
+#
+################################################################################
+extent_cache_mmap = False
+mask_cache_size = 8
+coverage_cache_size = 4096
+_raster_cache_lock = threading.Lock()
+_extent_arrays = {}
+_mask_arrays = collections.OrderedDict()
+_coverage_answers = collections.OrderedDict()
+
+################################################################################
+def file_stamp(file_name):
+    stat = os.stat(file_name)
+    return (file_name, stat.st_size, stat.st_mtime_ns)
+
+################################################################################
+def cached_raster(file_name, cache, max_entries=None, mmap=False):
+    key = file_stamp(file_name)
+    with _raster_cache_lock:
+        if key in cache:
+            if max_entries:
+                cache.move_to_end(key)
+            return cache[key]
+        array = None
+        if mmap:
+            npy_file_name = os.path.join(
+                FNAMES.Tmp_dir,
+                "Extents_cache",
+                "_".join(
+                    os.path.relpath(file_name, FNAMES.Extent_dir).split(os.sep)
+                )
+                + "_"
+                + str(key[1])
+                + "_"
+                + str(key[2])
+                + ".npy",
+            )
+            try:
+                array = numpy.load(npy_file_name, mmap_mode="r")
+            except:
+                pass
+        if array is None:
+            array = numpy.array(Image.open(file_name).convert("L"))
+            if mmap:
+                try:
+                    os.makedirs(os.path.dirname(npy_file_name), exist_ok=True)
+                    numpy.save(npy_file_name + ".tmp.npy", array)
+                    os.replace(npy_file_name + ".tmp.npy", npy_file_name)
+                    array = numpy.load(npy_file_name, mmap_mode="r")
+                except Exception as e:
+                    UI.vprint(2, "Could not memory-map", file_name, e)
+        if max_entries is None:
+            # a new version of a file replaces the old one
+            for old_key in [k for k in cache if k[0] == file_name]:
+                del cache[old_key]
+        cache[key] = array
+        if max_entries:
+            while len(cache) > max_entries:
+                cache.popitem(last=False)
+        return array
+
+################################################################################
+def coverage_answer(key):
+    with _raster_cache_lock:
+        if key not in _coverage_answers:
+            return None
+        _coverage_answers.move_to_end(key)
+        return _coverage_answers[key]
+
+################################################################################
+def remember_coverage(key, answer):
+    with _raster_cache_lock:
+        _coverage_answers[key] = answer
+        _coverage_answers.move_to_end(key)
+        while len(_coverage_answers) > coverage_cache_size:
+            _coverage_answers.popitem(last=False)
+    return answer
+
+################################################################################
+def extent_array(extent_code):
+    return cached_raster(
+        os.path.join(
+            FNAMES.Extent_dir,
+            extents_dict[extent_code]["dir"],
+            extents_dict[extent_code]["code"] + ".png",
+        ),
+        _extent_arrays,
+        mmap=extent_cache_mmap,
+    )
+
+################################################################################
+def clear_raster_cache():
+    with _raster_cache_lock:
+        _extent_arrays.clear()
+        _mask_arrays.clear()
+        _coverage_answers.clear()
+
+################################################################################
+def crop_array(array, box):
+    # Same as PIL's crop : the parts of box outside of array are set to 0.
+    (x0, y0, x1, y1) = box
+    out = numpy.zeros((max(0, y1 - y0), max(0, x1 - x0)), dtype=numpy.uint8)
+    (sizey, sizex) = array.shape
+    (cx0, cy0, cx1, cy1) = (max(x0, 0), max(y0, 0), min(x1, sizex), min(y1, sizey))
+    if cx1 > cx0 and cy1 > cy0:
+        out[cy0 - y0 : cy1 - y0, cx0 - x0 : cx1 - x0] = array[cy0:cy1, cx0:cx1]
+    return out
+
+################################################################################
+def crop_has_data(array, box, negative):
+    # Whether crop_array(array, box) (resp. its inverse) has a non zero
+    # pixel, without copying it.
+    (x0, y0, x1, y1) = box
+    if x1 <= x0 or y1 <= y0:
+        return False
+    (sizey, sizex) = array.shape
+    (cx0, cy0, cx1, cy1) = (max(x0, 0), max(y0, 0), min(x1, sizex), min(y1, sizey))
+    inner = array[cy0:cy1, cx0:cx1]
+    if negative:
+        # the padding is 0, hence 255 once inverted
+        return inner.size < (x1 - x0) * (y1 - y0) or bool((inner != 255).any())
+    return bool(inner.any())
+
+################################################################################
+
 ################################################################################
 def has_data(
     bbox,
@@ -886,14 +1027,8 @@ def has_data(
         if x0 > xmax or x1 < xmin or y0 < ymin or y1 > ymax:
             return negative
         if (not is_mask_layer) or (x1 - x0) == 1:
-            mask_im = Image.open(
-                os.path.join(
-                    FNAMES.Extent_dir,
-                    extents_dict[extent_code]["dir"],
-                    extents_dict[extent_code]["code"] + ".png",
-                )
-            ).convert("L")
-            (sizex, sizey) = mask_im.size
+            mask_array = extent_array(extent_code)
+            (sizey, sizex) = mask_array.shape
             pxx0 = int((x0 - xmin) / (xmax - xmin) * sizex)
             pxx1 = int((x1 - xmin) / (xmax - xmin) * sizex)
             pxy0 = int((ymax - y0) / (ymax - ymin) * sizey)
@@ -903,13 +1038,15 @@ def has_data(
                 pxx1 = min(sizex, pxx1)
                 pxy0 = max(-1, pxy0)
                 pxy1 = min(sizey, pxy1)
-            mask_im = mask_im.crop((pxx0, pxy0, pxx1, pxy1))
+                return crop_has_data(
+                    mask_array, (pxx0, pxy0, pxx1, pxy1), negative
+                )
+            mask_array = crop_array(mask_array, (pxx0, pxy0, pxx1, pxy1))
             if negative:
-                mask_im = ImageOps.invert(mask_im)
-            if not mask_im.getbbox():
+                mask_array = 255 - mask_array
+            if not mask_array.any():
                 return False
-            if not return_mask:
-                return True
+            mask_im = Image.fromarray(mask_array)
             if is_sharp_resize:
                 return mask_im.resize(mask_size)
             else:
@@ -934,25 +1071,38 @@ def has_data(
                 os.path.join(check_dir, FNAMES.legacy_mask(m_tilx, m_tily))
             ):
                 return False
+            sea_mask_file = os.path.join(
+                check_dir, FNAMES.legacy_mask(m_tilx, m_tily)
+            )
+            # coverage answers are remembered, the bbox of a texture is
+            # typically tested several times along the build
+            answer_key = (
+                tuple(bbox),
+                extent_code,
+                negative,
+                mask_size,
+                is_sharp_resize,
+                is_mask_layer,
+                file_stamp(sea_mask_file),
+            )
+            if not return_mask:
+                answer = coverage_answer(answer_key)
+                if answer is not None:
+                    return answer
             # build extent mask_im
             if extent_code != "global":
-                mask_im = Image.open(
-                    os.path.join(
-                        FNAMES.Extent_dir,
-                        extents_dict[extent_code]["dir"],
-                        extents_dict[extent_code]["code"] + ".png",
-                    )
-                ).convert("L")
-                (sizex, sizey) = mask_im.size
+                mask_array = extent_array(extent_code)
+                (sizey, sizex) = mask_array.shape
                 pxx0 = int((x0 - xmin) / (xmax - xmin) * sizex)
                 pxx1 = int((x1 - xmin) / (xmax - xmin) * sizex)
                 pxy0 = int((ymax - y0) / (ymax - ymin) * sizey)
                 pxy1 = int((ymax - y1) / (ymax - ymin) * sizey)
-                mask_im = mask_im.crop((pxx0, pxy0, pxx1, pxy1))
+                mask_array = crop_array(mask_array, (pxx0, pxy0, pxx1, pxy1))
                 if negative:
-                    mask_im = ImageOps.invert(mask_im)
-                if not mask_im.getbbox():
-                    return False
+                    mask_array = 255 - mask_array
+                if not mask_array.any():
+                    return remember_coverage(answer_key, False)
+                mask_im = Image.fromarray(mask_array)
                 if is_sharp_resize:
                     mask_im = mask_im.resize(mask_size)
                 else:
@@ -962,30 +1112,29 @@ def has_data(
             # build sea mask_im2
             (ymax, xmin) = GEO.gtile_to_wgs84(m_tilx, m_tily, mask_zl)
             (ymin, xmax) = GEO.gtile_to_wgs84(m_tilx + 16, m_tily + 16, mask_zl)
-            mask_im2 = Image.open(
-                os.path.join(check_dir, FNAMES.legacy_mask(m_tilx, m_tily))
-            ).convert("L")
-            (sizex, sizey) = mask_im2.size
+            sea_array = cached_raster(
+                sea_mask_file, _mask_arrays, max_entries=mask_cache_size
+            )
+            (sizey, sizex) = sea_array.shape
             pxx0 = int((x0 - xmin) / (xmax - xmin) * sizex)
             pxx1 = int((x1 - xmin) / (xmax - xmin) * sizex)
             pxy0 = int((ymax - y0) / (ymax - ymin) * sizey)
             pxy1 = int((ymax - y1) / (ymax - ymin) * sizey)
-            mask_im2 = mask_im2.crop((pxx0, pxy0, pxx1, pxy1)).resize(
-                mask_size, Image.BICUBIC
-            )
+            mask_im2 = Image.fromarray(
+                crop_array(sea_array, (pxx0, pxy0, pxx1, pxy1))
+            ).resize(mask_size, Image.BICUBIC)
             # invert it
             mask_array2 = 255 - numpy.array(mask_im2, dtype=numpy.uint8)
             # let full sea down (if you wish to...)
             # mask_array2[mask_array2==255]=0
-            #  combine (multiply) both
+            #  combine (multiply) both
             mask_array = numpy.array(mask_im, dtype=numpy.uint16)
             mask_array = (mask_array * mask_array2 / 255).astype(numpy.uint8)
-            mask_im = Image.fromarray(mask_array).convert("L")
-            if not mask_im.getbbox():
+            if not remember_coverage(answer_key, bool(mask_array.any())):
                 return False
             if not return_mask:
                 return True
-            return mask_im
+            return Image.fromarray(mask_array).convert("L")
     except Exception as e:
         UI.vprint(1, "Could not test coverage of ", extent_code, " !!!")
         UI.vprint(2, e)
@@ -1001,7 +1150,7 @@ def has_data(
 ################################################################################
 
 ################################################################################
-def http_request_to_image(width, height, url, request_headers, http_session):
+def http_request_to_image(width, height, url, request_headers):
     UI.vprint(
         3, "HTTP request issued :", url, "\nRequest headers :", request_headers
     )
@@ -1010,12 +1159,14 @@ def http_request_to_image(width, height, url, request_headers, http_session):
     r = False
     while True:
         try:
-            if request_headers:
-                r = http_session.get(
-                    url, timeout=http_timeout, headers=request_headers
-                )
-            else:
-                r = http_session.get(url, timeout=http_timeout)
+            http_session = HTTP.get_session(url)
+            with HTTP.host_slot(url):
+                if request_headers:
+                    r = http_session.get(
+                        url, timeout=http_timeout, headers=request_headers
+                    )
+                else:
+                    r = http_session.get(url, timeout=http_timeout)
             status_code = str(r)
             # Bing white image with small camera or Arcgis no data yet =>
             # try to downsample to lower ZL
@@ -1078,7 +1229,7 @@ def http_request_to_image(width, height, url, request_headers, http_session):
             if not check_tms_response:
                 break
             # trying a new session ?
-            http_session = requests.Session()
+            HTTP.reset_session(url, http_session)
             time.sleep(2)
             if UI.red_flag:
                 return (0, "Stopped")
@@ -1094,7 +1245,7 @@ def http_request_to_image(width, height, url, request_headers, http_session):
 ################################################################################
 
 ################################################################################
-def get_wms_image(bbox, width, height, provider, http_session):
+def get_wms_image(bbox, width, height, provider):
     request_headers = None
     if has_URL and provider["code"] in URL.custom_url_list:
         (url, request_headers) = URL.custom_wms_request(
@@ -1137,7 +1288,7 @@ def get_wms_image(bbox, width, height, provider, http_session):
         else:
             request_headers = request_headers_generic
     (success, data) = http_request_to_image(
-        width, height, url, request_headers, http_session
+        width, height, url, request_headers
     )
     if success:
         return (1, data)
@@ -1148,7 +1299,7 @@ def get_wms_image(bbox, width, height, provider, http_session):
 ################################################################################
 
 ################################################################################
-def get_wmts_image(tilematrix, til_x, til_y, provider, http_session):
+def get_wmts_image(tilematrix, til_x, til_y, provider):
     til_x_orig, til_y_orig = til_x, til_y
     down_sample = 0
     while True:
@@ -1249,7 +1400,7 @@ def get_wmts_image(tilematrix, til_x, til_y, provider, http_session):
                 request_headers = request_headers_generic
         width = height = provider["tile_size"]
         (success, data) = http_request_to_image(
-            width, height, url, request_headers, http_session
+            width, height, url, request_headers
         )
         if success and not down_sample:
             return (success, data)
@@ -1290,12 +1441,8 @@ def get_wmts_image(tilematrix, til_x, til_y, provider, http_session):
 ################################################################################
 
 ################################################################################
-def get_and_paste_wms_part(
-    bbox, width, height, provider, big_image, x0, y0, http_session
-):
-    (success, small_image) = get_wms_image(
-        bbox, width, height, provider, http_session
-    )
+def get_and_paste_wms_part(bbox, width, height, provider, big_image, x0, y0):
+    (success, small_image) = get_wms_image(bbox, width, height, provider)
     big_image.paste(small_image, (x0, y0))
     return success
 
@@ -1311,11 +1458,10 @@ def get_and_paste_wmts_part(
     big_image,
     x0,
     y0,
-    http_session,
     subt_size=None,
 ):
     (success, small_image) = get_wmts_image(
-        tilematrix, til_x, til_y, provider, http_session
+        tilematrix, til_x, til_y, provider
     )
     if not subt_size:
         big_image.paste(small_image, (x0, y0))
@@ -1336,7 +1482,6 @@ def build_texture_from_tilbox(tilbox, zoomlevel, provider, progress=None):
     width = height = provider["tile_size"]
     big_image = Image.new("RGB", (width * parts_x, height * parts_y))
     # we set-up the queue of downloads
-    http_session = requests.Session()
     download_queue = queue.Queue()
     for monty in range(0, parts_y):
         for montx in range(0, parts_x):
@@ -1350,7 +1495,6 @@ def build_texture_from_tilbox(tilbox, zoomlevel, provider, progress=None):
                 big_image,
                 x0,
                 y0,
-                http_session,
             )
             download_queue.put(fargs)
     # then the number of workers
@@ -1457,7 +1601,6 @@ def build_texture_from_bbox_and_size(t_bbox, t_epsg, t_size, provider):
         else:
             subt_size = None
     big_image = Image.new("RGB", (width * parts_x, height * parts_y))
-    http_session = requests.Session()
     download_queue = queue.Queue()
     for monty in range(0, parts_y):
         for montx in range(0, parts_x):
@@ -1477,7 +1620,6 @@ def build_texture_from_bbox_and_size(t_bbox, t_epsg, t_size, provider):
                     big_image,
                     x0,
                     y0,
-                    http_session,
                 ]
             elif provider["request_type"] in ["wmts", "tms", "local_tms"]:
                 fargs = [
@@ -1488,7 +1630,6 @@ def build_texture_from_bbox_and_size(t_bbox, t_epsg, t_size, provider):
                     big_image,
                     x0,
                     y0,
-                    http_session,
                     subt_size,
                 ]
             download_queue.put(fargs)
@@ -1595,6 +1736,7 @@ def download_jpeg_ortho(
                 ),
                 Image.BICUBIC,
             ).save(os.path.join(file_dir, file_name))
+        TRACE.wrote(os.path.join(file_dir, file_name))
     except Exception as e:
         UI.lvprint(
             0,
@@ -1609,6 +1751,7 @@ def download_jpeg_ortho(
 ################################################################################
 
 ################################################################################
+@TRACE.traced("build_jpeg_ortho")
 def build_jpeg_ortho(
     tile, til_x_left, til_y_top, zoomlevel, provider_code, out_file_name=""
 ):
@@ -1898,7 +2041,7 @@ def build_combined_ortho(
 
 ################################################################################
 def build_geotiffs(tile, texture_attributes_list):
-    UI.red_flag = False
+    UI.clear_red_flag()
     timer = time.time()
     initialize_color_filters_dict()
     initialize_providers_dict()
@@ -1992,7 +2135,7 @@ def build_provider_texture(dest_dir, provider_code, zoomlevel):
 
 ################################################################################
 def create_tile_preview(lat, lon, zoomlevel, provider_code):
-    UI.red_flag = False
+    UI.clear_red_flag()
     if not os.path.exists(FNAMES.Preview_dir):
         os.makedirs(FNAMES.Preview_dir)
     filepreview = FNAMES.preview(lat, lon, zoomlevel, provider_code)
@@ -2290,6 +2433,7 @@ def combine_textures(tile, til_x_left, til_y_top, zoomlevel, provider_code):
 ################################################################################
 
 ################################################################################
+@TRACE.traced("convert_texture")
 def convert_texture(
     tile, til_x_left, til_y_top, zoomlevel, provider_code, type="dds"
 ):
@@ -2315,6 +2459,8 @@ def convert_texture(
     )
     erase_tmp_png = False
     erase_tmp_tif = False
+    # the in-process encoder works from the image in memory, no tmp png
+    in_process = type == "dds" and dds_encoder == "internal"
     dxt5 = False
     masked_texture = False
     if tile.imprint_masks_to_dds and type == "dds":
@@ -2390,9 +2536,12 @@ def convert_texture(
                 except:
                     pass
             dxt5 = True
-        file_to_convert = os.path.join(FNAMES.resource_path("tmp"), png_file_name)
-        erase_tmp_png = True
-        big_image.save(file_to_convert)
+        if not in_process:
+            file_to_convert = os.path.join(
+                FNAMES.resource_path("tmp"), png_file_name
+            )
+            erase_tmp_png = True
+            big_image.save(file_to_convert)
         # If one wanted to distribute jpegs instead of dds, uncomment the
         # next line.
         # big_image.convert('RGB').save(os.path.join(tile.build_dir,
@@ -2426,13 +2575,34 @@ def convert_texture(
                 except:
                     pass
             dxt5 = True
-        file_to_convert = os.path.join(FNAMES.resource_path("tmp"), png_file_name)
-        erase_tmp_png = True
-        big_image.save(file_to_convert)
+        if not in_process:
+            file_to_convert = os.path.join(
+                FNAMES.resource_path("tmp"), png_file_name
+            )
+            erase_tmp_png = True
+            big_image.save(file_to_convert)
     # finally if nothing needs to be done prior to the conversion
+    elif in_process:
+        big_image = Image.open(os.path.join(file_dir, jpeg_file_name))
     else:
         file_to_convert = os.path.join(file_dir, jpeg_file_name)
     # eventually the dds conversion
+    if in_process:
+        try:
+            DDS.write_dds(
+                big_image,
+                os.path.join(tile.build_dir, "textures", out_file_name),
+                alpha=dxt5,
+            )
+            TRACE.wrote(os.path.join(tile.build_dir, "textures", out_file_name))
+        except Exception as e:
+            UI.lvprint(
+                1,
+                "ERROR: Could not convert texture",
+                os.path.join(tile.build_dir, "textures", out_file_name),
+            )
+            UI.vprint(3, e)
+        return
     if type == "dds":
         if not dxt5:
             conv_cmd = [
@@ -2531,6 +2701,11 @@ def convert_texture(
         if not subprocess.call(
             conv_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
         ):
+            TRACE.wrote(
+                os.path.join(tile.build_dir, "textures", out_file_name)
+                if type == "dds"
+                else os.path.join(FNAMES.Geotiff_dir, out_file_name)
+            )
             break
         tentative += 1
         if tentative == 10:
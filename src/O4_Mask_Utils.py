@@ -2,7 +2,7 @@ import os
 import sys
 import time
 import queue
-from math import atan, ceil, floor
+from math import atan, ceil, floor, log2
 import numpy
 from PIL import Image, ImageDraw, ImageFilter, ImageOps
 import skfmm
@@ -14,10 +14,22 @@ import O4_Imagery_Utils as IMG
 import O4_OSM_Utils as OSM
 import O4_Vector_Utils as VECT
 import O4_Mesh_Utils as MESH
+import O4_Trace_Utils as TRACE
 from O4_Parallel_Utils import parallel_execute
 
 mask_altitude_above = 0.5
 masks_build_slots = 4
+# Masks are CPU bound (rasterization, blur, distance), "process" builds them
+# in separate processes rather than threads. It is opt-in : the workers are
+# forked from the GUI (a multi-threaded Tk process) on Linux, and under the
+# spawn start method (Windows, macOS) the tile with its DEM and the sea and
+# inland dicts are pickled into each of them.
+masks_build_backend = "thread"
+# blur kernels at least this long are applied through FFTs (see convolve_axis)
+blur_fft_min_kernel = 160
+blur_chunk_lines = 512
+# the one pixel growth steps of 3steps only blur the blocks along the edge
+grow_block_size = 64
 
 ################################################################################
 def mask_name_for_texture(tile, til_x_left, til_y_top, zl, *args):
@@ -61,9 +73,10 @@ def needs_mask(tile, til_x_left, til_y_top, zl, *args):
 ################################################################################
 
 ################################################################################
+@TRACE.traced("build_masks")
 def build_masks(tile, for_imagery=False):
     
-    if UI.is_working:
+    if UI.is_busy():
         return 0
     UI.is_working = 1
     
@@ -72,7 +85,7 @@ def build_masks(tile, for_imagery=False):
     sea_level = im.getpixel((0, 127 * (1 - min(1, 0.1 + tile.ratio_water))))
     del im
     
-    UI.red_flag = False
+    UI.clear_red_flag()
     UI.logprint(
         "Step 2.5 for tile lat=", tile.lat, ", lon=", tile.lon, ": starting."
     )
@@ -136,89 +149,99 @@ def build_masks(tile, for_imagery=False):
             )
             return 0
 
-    #################################
-    def build_mask(til_x, til_y):
-
-        (til_x_min, til_y_min) = GEO.wgs84_to_orthogrid(
-            tile.lat + 1, tile.lon, tile.mask_zl)
-        (til_x_max, til_y_max) = GEO.wgs84_to_orthogrid(
-            tile.lat, tile.lon + 1, tile.mask_zl)
-        if (til_x < til_x_min or til_x > til_x_max or til_y < til_y_min or 
-            til_y > til_y_max):
-            return 1
-
-        pre_mask = build_water_pre_mask(til_x, til_y, mesh_list, dico_sea,
-                                         dico_inland, sea_level, tile) 
-        if tile.masks_use_DEM_too:
-            dem_array = build_dem_pre_mask(til_x, til_y, tile)
-            pre_mask = numpy.maximum(pre_mask, dem_array)
-            del(dem_array)
-
-        if tile.masks_custom_extent:
-            custom_array = build_custom_pre_mask(til_x, til_y, sea_level, tile)
-
-        if (pre_mask.max() == 0) and (
-                not tile.masks_custom_extent or custom_array.max() == 0):
-            return 1
-        
-        
-        blured_mask = blur_mask(pre_mask, tile, sea_level)
-
-        # Ensure land is kept to 255 on the mask to avoid unecessary ones, crop 
-        # to final size, and take the max with the possible custom extent mask
-        blured_mask = numpy.maximum(
-            (pre_mask > 0).astype(numpy.uint8) * 255, 
-            blured_mask
-        )[1024 : 4096 + 1024, 1024 : 4096 + 1024]
-        
-        if tile.masks_custom_extent:
-            blured_mask = numpy.maximum(blured_mask, custom_mask)
-
-        if not (blured_mask.max() == 0 or blured_mask.min() == 255):
-            mask_im = Image.fromarray(blured_mask)
-            mask_im.save(os.path.join(
-                dest_dir, FNAMES.legacy_mask(til_x, til_y)))
-            del blured_mask
-            
-            # Distance masks for bathymetry cut-off
-            if (tile.distance_masks_too):
-                pre_mask = (pre_mask > 0).astype(float) * 2 - 1
-                band = 255 / 2**(16 - tile.mask_zl)
-                dist_array = skfmm.distance(pre_mask, narrow = band)
-                if (isinstance(dist_array, numpy.ma.core.MaskedArray)):
-                    dist_array = dist_array.filled(-99999)
-                dist_array[pre_mask > 0] = 0
-                del(pre_mask)
-                dist_array = dist_array[1024 : 4096 + 1024, 1024 : 4096 + 1024]
-                dist_array = dist_array * (2**(16 - tile.mask_zl))
-                dist_array = numpy.minimum(-numpy.minimum(dist_array, 0), 255)
-                dist_array = dist_array.astype(numpy.uint8)
-                masks_im = Image.fromarray(dist_array)
-                masks_im.save(os.path.join(
-                    dest_dir, FNAMES.distance_mask(til_x, til_y)))
-                UI.vprint(1, "   Created", FNAMES.legacy_mask(til_x, til_y),
-                "and", FNAMES.distance_mask(til_x, til_y))
-            else:
-                UI.vprint(1, "   Created", FNAMES.legacy_mask(til_x, til_y))
-        return 1
-    #################################
-    
     masks_queue = queue.Queue()
     for key in dico_sea:
         masks_queue.put(key)
     dico_progress = {"done": 0, "bar": 1}
 
-    parallel_execute(build_mask, masks_queue, masks_build_slots,
-                     progress=dico_progress)
+    # traced as a whole, the masks may be built in other processes (their
+    # CPU time and peak RSS count once these are over)
+    with TRACE.span("build_mask"):
+        parallel_execute(build_mask, masks_queue, masks_build_slots,
+                         progress=dico_progress, backend=masks_build_backend,
+                         common_args=(tile, mesh_list, dico_sea, dico_inland,
+                                      sea_level, dest_dir))
 
     UI.progress_bar(1, 100)
     UI.timings_and_bottom_line(timer)
     UI.logprint(
         "Step 2.5 for tile lat=", tile.lat, ", lon=", tile.lon, ": normal exit."
     )
-    return
+    return 1
 ################################################################################
     
+################################################################################
+def build_mask(tile, mesh_list, dico_sea, dico_inland, sea_level, dest_dir,
+               til_x, til_y):
+
+    (til_x_min, til_y_min) = GEO.wgs84_to_orthogrid(
+        tile.lat + 1, tile.lon, tile.mask_zl)
+    (til_x_max, til_y_max) = GEO.wgs84_to_orthogrid(
+        tile.lat, tile.lon + 1, tile.mask_zl)
+    if (til_x < til_x_min or til_x > til_x_max or til_y < til_y_min or 
+        til_y > til_y_max):
+        return 1
+
+    pre_mask = build_water_pre_mask(til_x, til_y, mesh_list, dico_sea,
+                                     dico_inland, sea_level, tile) 
+    if tile.masks_use_DEM_too:
+        dem_array = build_dem_pre_mask(til_x, til_y, tile)
+        pre_mask = numpy.maximum(pre_mask, dem_array)
+        del(dem_array)
+
+    if tile.masks_custom_extent:
+        custom_array = build_custom_pre_mask(til_x, til_y, sea_level, tile)
+
+    if (pre_mask.max() == 0) and (
+            not tile.masks_custom_extent or custom_array.max() == 0):
+        return 1
+    
+    
+    blured_mask = blur_mask(pre_mask, tile, sea_level)
+
+    # Ensure land is kept to 255 on the mask to avoid unecessary ones, crop 
+    # to final size, and take the max with the possible custom extent mask
+    blured_mask = numpy.maximum(
+        (pre_mask > 0).astype(numpy.uint8) * 255, 
+        blured_mask
+    )[1024 : 4096 + 1024, 1024 : 4096 + 1024]
+    
+    if tile.masks_custom_extent:
+        blured_mask = numpy.maximum(blured_mask, custom_mask)
+
+    if not (blured_mask.max() == 0 or blured_mask.min() == 255):
+        mask_im = Image.fromarray(blured_mask)
+        mask_im.save(os.path.join(
+            dest_dir, FNAMES.legacy_mask(til_x, til_y)))
+        TRACE.wrote(os.path.join(dest_dir, FNAMES.legacy_mask(til_x, til_y)))
+        del blured_mask
+        
+        # Distance masks for bathymetry cut-off
+        if (tile.distance_masks_too):
+            pre_mask = (pre_mask > 0).astype(float) * 2 - 1
+            band = 255 / 2**(16 - tile.mask_zl)
+            dist_array = skfmm.distance(pre_mask, narrow = band)
+            if (isinstance(dist_array, numpy.ma.core.MaskedArray)):
+                dist_array = dist_array.filled(-99999)
+            dist_array[pre_mask > 0] = 0
+            del(pre_mask)
+            dist_array = dist_array[1024 : 4096 + 1024, 1024 : 4096 + 1024]
+            dist_array = dist_array * (2**(16 - tile.mask_zl))
+            dist_array = numpy.minimum(-numpy.minimum(dist_array, 0), 255)
+            dist_array = dist_array.astype(numpy.uint8)
+            masks_im = Image.fromarray(dist_array)
+            masks_im.save(os.path.join(
+                dest_dir, FNAMES.distance_mask(til_x, til_y)))
+            TRACE.wrote(
+                os.path.join(dest_dir, FNAMES.distance_mask(til_x, til_y))
+            )
+            UI.vprint(1, "   Created", FNAMES.legacy_mask(til_x, til_y),
+            "and", FNAMES.distance_mask(til_x, til_y))
+        else:
+            UI.vprint(1, "   Created", FNAMES.legacy_mask(til_x, til_y))
+    return 1
+################################################################################
+
 ################################################################################
 def select_neighbor_meshes(tile):
     mesh_list = []
@@ -391,6 +414,7 @@ def build_custom_pre_mask(til_x, til_y, sea_level, tile):
 ################################################################################
 
 ################################################################################
+@TRACE.traced("record_water_tris")
 def record_water_tris(tile):
     mesh_list = []
     for close_lat in range(tile.lat - 1, tile.lat + 2):
@@ -430,32 +454,15 @@ def record_water_tris(tile):
     UI.vprint(1, "-> Reading mesh data")
     for mesh_file_name in mesh_list:
         try:
-            f_mesh = open(mesh_file_name, "r")
+            (mesh_version, nbr_pt_in, pt_in, nbr_tri_in, tri_idx, tri_types) \
+                    = MESH.read_mesh_file(mesh_file_name)
             UI.vprint(1, "   * ", mesh_file_name)
         except:
             UI.lvprint(
                 1, "Mesh file ", mesh_file_name, " could not be read. Skipped."
             )
             continue
-        mesh_version = float(f_mesh.readline().strip().split()[-1])
         has_water = 7 if mesh_version >= 1.3 else 3
-        for i in range(3):
-            f_mesh.readline()
-        nbr_pt_in = int(f_mesh.readline())
-        pt_in = numpy.zeros(5 * nbr_pt_in, "float")
-        for i in range(0, nbr_pt_in):
-            pt_in[5 * i : 5 * i + 3] = [
-                float(x) for x in f_mesh.readline().split()[:3]
-            ]
-        for i in range(0, 3):
-            f_mesh.readline()
-        for i in range(0, nbr_pt_in):
-            pt_in[5 * i + 3 : 5 * i + 5] = [
-                float(x) for x in f_mesh.readline().split()[:2]
-            ]
-        for i in range(0, 2):  # skip 2 lines
-            f_mesh.readline()
-        nbr_tri_in = int(f_mesh.readline())  # read nbr of tris
         step_stones = nbr_tri_in // 100
         percent = -1
         UI.vprint(
@@ -471,10 +478,8 @@ def record_water_tris(tile):
                 if UI.red_flag:
                     UI.exit_message_and_bottom_line()
                     return 0
-            (n1, n2, n3, tri_type) = [
-                int(x) - 1 for x in f_mesh.readline().split()[:4]
-            ]
-            tri_type += 1
+            (n1, n2, n3) = tri_idx[3 * i : 3 * i + 3]
+            tri_type = tri_types[i]
             if (
                 (not tri_type)
                 or (not (tri_type & has_water))
@@ -583,16 +588,8 @@ def record_water_tris(tile):
                     dico_sea[(til_x, til_y + 16)] = [
                         (lat1, lon1, lat2, lon2, lat3, lon3)
                     ]
-        f_mesh.close()
         if not tile.use_masks_for_inland:
             UI.vprint(2, "   Taking care of inland water near shoreline")
-            f_mesh = open(mesh_file_name, "r")
-            for i in range(0, 4):
-                f_mesh.readline()
-            nbr_pt_in = int(f_mesh.readline())
-            for i in range(0, 2 * nbr_pt_in + 5):
-                f_mesh.readline()
-            nbr_tri_in = int(f_mesh.readline())  # read nbr of tris
             step_stones = nbr_tri_in // 100
             percent = -1
             for i in range(0, nbr_tri_in):
@@ -602,10 +599,8 @@ def record_water_tris(tile):
                     if UI.red_flag:
                         UI.exit_message_and_bottom_line()
                         return 0
-                (n1, n2, n3, tri_type) = [
-                    int(x) - 1 for x in f_mesh.readline().split()[:4]
-                ]
-                tri_type += 1
+                (n1, n2, n3) = tri_idx[3 * i : 3 * i + 3]
+                tri_type = tri_types[i]
                 if not (tri_type & has_water) == 1:
                     continue
                 (lon1, lat1) = pt_in[5 * n1 : 5 * n1 + 2]
@@ -639,11 +634,123 @@ def record_water_tris(tile):
                         dico_inland[(til_x, til_y)] = [
                             (lat1, lon1, lat2, lon2, lat3, lon3)
                         ]
-            f_mesh.close()
     
     return (dico_sea, dico_inland)
 ################################################################################
         
+################################################################################
+def fft_size(n):
+    # smallest integer >= n without prime factors above 5, FFTs are fast there
+    best = 2 ** ceil(log2(n))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            size = p35
+            while size < n:
+                size *= 2
+            best = min(best, size)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+################################################################################
+def convolve_axis(array, kernel, axis, dtype=numpy.float64):
+    """
+    Convolution of the lines of a 2D array along axis with a 1D kernel, as
+    numpy.convolve(line, kernel, "same") on each of them up to rounding
+    errors, cast to dtype (truncated for integers, so sums falling on an
+    integer may lose one unit). Short kernels are applied line by line, long
+    ones through FFTs by chunks of lines, whose cost does not depend on the
+    length of the kernel.
+    """
+    array = numpy.moveaxis(array, axis, -1)
+    out = numpy.empty(array.shape, dtype=dtype)
+    length = array.shape[-1]
+    if not blur_fft_min_kernel <= len(kernel) <= length:
+        for i in range(len(array)):
+            out[i] = numpy.convolve(array[i], kernel, "same")
+        return numpy.moveaxis(out, -1, axis)
+    size = fft_size(length + len(kernel) - 1)
+    fft_kernel = numpy.fft.rfft(kernel, size)
+    start = (len(kernel) - 1) // 2
+    for i in range(0, len(array), blur_chunk_lines):
+        out[i : i + blur_chunk_lines] = numpy.fft.irfft(
+            numpy.fft.rfft(array[i : i + blur_chunk_lines], size) * fft_kernel,
+            size,
+        )[:, start : start + length]
+    return numpy.moveaxis(out, -1, axis)
+
+
+################################################################################
+def grow_mask(mask_array):
+    """
+    One step of growth of a mask, i.e. 255 * (GaussianBlur(1) > 0). The blur
+    only changes the blocks along the edge of the mask (and their halo holds
+    its support), hence runs of these are blurred alone when they are few.
+    """
+    halo = 8
+    block = grow_block_size
+    (rows, cols) = mask_array.shape
+    (brows, bcols) = (ceil(rows / block), ceil(cols / block))
+    padded = numpy.pad(
+        mask_array,
+        ((0, brows * block - rows), (0, bcols * block - cols)),
+        mode="edge",
+    ).reshape(brows, block, bcols, block)
+    # extreme values of the blocks and of their neighbours
+    extremes = []
+    for reduce in (numpy.max, numpy.min):
+        values = numpy.pad(reduce(padded, axis=(1, 3)), 1, mode="edge")
+        extremes.append(
+            reduce(
+                [
+                    values[1 + di : 1 + di + brows, 1 + dj : 1 + dj + bcols]
+                    for di in (-1, 0, 1)
+                    for dj in (-1, 0, 1)
+                ],
+                axis=0,
+            )
+        )
+    active = extremes[0] != extremes[1]
+    if active.mean() > 0.5:
+        runs = [(0, rows, 0, cols)]
+    else:
+        runs = []
+        for bi in range(brows):
+            # starts and ends of the runs of active blocks in that row
+            edges = numpy.diff(numpy.concatenate(([0], active[bi], [0])))
+            (starts, ends) = (
+                numpy.nonzero(edges == 1)[0],
+                numpy.nonzero(edges == -1)[0],
+            )
+            for (bj0, bj1) in zip(starts, ends):
+                runs.append(
+                    (
+                        bi * block,
+                        min((bi + 1) * block, rows),
+                        bj0 * block,
+                        min(bj1 * block, cols),
+                    )
+                )
+    # constant blocks stay so through the blur
+    grown_array = (mask_array > 0).astype(numpy.uint8) * 255
+    for (y0, y1, x0, x1) in runs:
+        (ya, xa) = (max(y0 - halo, 0), max(x0 - halo, 0))
+        (yb, xb) = (min(y1 + halo, rows), min(x1 + halo, cols))
+        blurred = numpy.array(
+            Image.fromarray(mask_array[ya:yb, xa:xb])
+            .convert("L")
+            .filter(ImageFilter.GaussianBlur(1)),
+            dtype=numpy.uint8,
+        )
+        grown_array[y0:y1, x0:x1] = (
+            blurred[y0 - ya : y1 - ya, x0 - xa : x1 - xa] > 0
+        ).astype(numpy.uint8) * 255
+    return grown_array
+
+
 ################################################################################
 def blur_mask(img_array, tile, sea_level):
     ##########################################
@@ -665,16 +772,15 @@ def blur_mask(img_array, tile, sea_level):
     # Sand mode
     if tile.masking_mode == "sand" and blur_width:
         # convolution with a hat function
-        b_img_array = numpy.array(img_array)
+        b_img_array = img_array
         kernel = numpy.array(range(1, 2 * blur_width))
         kernel[blur_width:] = range(blur_width - 1, 0, -1)
         kernel = kernel / blur_width ** 2
-        for i in range(0, len(b_img_array)):
-            b_img_array[i] = numpy.convolve(b_img_array[i], kernel, "same")
-        b_img_array = b_img_array.transpose()
-        for i in range(0, len(b_img_array)):
-            b_img_array[i] = numpy.convolve(b_img_array[i], kernel, "same")
-        b_img_array = b_img_array.transpose()
+        # rows then columns, truncated to bytes after each pass
+        for axis in (1, 0):
+            b_img_array = convolve_axis(
+                b_img_array, kernel, axis, img_array.dtype
+            )
         b_img_array = 2 * numpy.minimum(b_img_array, 127)
         b_img_array = numpy.array(b_img_array, dtype=numpy.uint8)
     # Rocks mode
@@ -741,15 +847,7 @@ def blur_mask(img_array, tile, sea_level):
             value = shore_level + transition_profile(
                 (i + 1) / stepsin, "parabolic"
             ) * (sea_level - shore_level)
-            b_mask_array = (
-                numpy.array(
-                    Image.fromarray(b_mask_array)
-                    .convert("L")
-                    .filter(ImageFilter.GaussianBlur(1)),
-                    dtype=numpy.uint8,
-                )
-                > 0
-            ).astype(numpy.uint8) * 255
+            b_mask_array = grow_mask(b_mask_array)
             b_img_array[(b_img_array == 0) * (b_mask_array != 0)] = value
             UI.vprint(2, value)
         # Next the intermediate zone at constant transparency
@@ -785,15 +883,7 @@ def blur_mask(img_array, tile, sea_level):
             value = sea_level * (
                 1 - transition_profile((i + 1) / stepsout, "linear")
             )
-            b_mask_array = (
-                numpy.array(
-                    Image.fromarray(b_mask_array)
-                    .convert("L")
-                    .filter(ImageFilter.GaussianBlur(1)),
-                    dtype=numpy.uint8,
-                )
-                > 0
-            ).astype(numpy.uint8) * 255
+            b_mask_array = grow_mask(b_mask_array)
             b_img_array[(b_img_array == 0) * (b_mask_array != 0)] = value
             UI.vprint(2, value)
         # To smoothen the thresolding introduced above we do a global short 
@@ -2,15 +2,19 @@ import time
 import sys
 import os
 import pickle
+import struct
 import subprocess
+import zlib
 import numpy
 import requests
-from math import sqrt, cos, pi
+from math import sqrt
 import O4_DEM_Utils as DEM
 import O4_UI_Utils as UI
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_Vector_Utils as VECT
+import O4_Triangle_IO as TRIIO
+import O4_Trace_Utils as TRACE
 import O4_OSM_Utils as OSM
 import O4_Version
 
@@ -53,6 +57,7 @@ if os.path.exists(FNAMES.resource_path("community_server.txt")):
         pass
 
 
+@TRACE.traced("community_mesh")
 def community_mesh(tile):
     if not community_server:
         UI.exit_message_and_bottom_line(
@@ -67,7 +72,9 @@ def community_mesh(tile):
     timer = time.time()
     UI.vprint(0, "Querying", url, "...")
     try:
-        r = requests.get(url, timeout=30)
+        r = requests.get(
+            url, timeout=30, hooks={"response": TRACE.count_download}
+        )
         if "[200]" in str(r):
             UI.vprint(0, "We've got something !")
             f = open(
@@ -227,142 +234,128 @@ def build_curv_tol_weight_map(tile, weight_array):
 
 
 ################################################################################
+@TRACE.traced("post_process_nodes_altitudes")
 def post_process_nodes_altitudes(tile):
     dico_attributes = VECT.Vector_Map.dico_attributes
-    f_node = open(FNAMES.output_node_file(tile), "r")
-    init_line_f_node = f_node.readline()
-    nbr_pt = int(init_line_f_node.split()[0])
-    vertices = numpy.zeros(6 * nbr_pt)
     UI.vprint(1, "-> Loading of the mesh computed by Triangle4XP.")
-    for i in range(0, nbr_pt):
-        vertices[6 * i : 6 * i + 6] = [
-            float(x) for x in f_node.readline().split()[1:7]
-        ]
-    end_line_f_node = f_node.readline()
-    f_node.close()
+    (init_line_f_node, nodes, end_line_f_node) = TRIIO.read_node_file(
+        FNAMES.output_node_file(tile)
+    )
+    nodes = numpy.array(nodes[:, :6])
     UI.vprint(1, "-> Post processing of altitudes according to vector data")
-    f_ele = open(FNAMES.output_ele_file(tile), "r")
-    nbr_tri = int(f_ele.readline().split()[0])
-    water_tris = set()
-    sea_tris = set()
-    interp_alt_tris = set()
-    for i in range(nbr_tri):
-        line = f_ele.readline()
-        # triangle attributes are powers of 2, except for the dummy attributed
-        # which doesn't require post-treatment
-        if line[-2] == "0":
-            continue
-        (v1, v2, v3, attr) = [int(x) - 1 for x in line.split()[1:5]]
-        attr += 1
-        if attr >= dico_attributes["INTERP_ALT"]:
-            interp_alt_tris.add((v1, v2, v3))
-        elif attr & dico_attributes["SEA"]:
-            sea_tris.add((v1, v2, v3))
-        elif (
-            attr & dico_attributes["WATER"]
-            or attr & dico_attributes["SEA_EQUIV"]
-        ):
-            water_tris.add((v1, v2, v3))
+    (_, tris, _) = TRIIO.read_ele_file(FNAMES.output_ele_file(tile))
+    tris = tris[:, :4] - 1
+    attr = tris[:, 3] + 1
+    # triangle attributes are powers of 2, except for the dummy attributed
+    # which doesn't require post-treatment (tested as before on the last
+    # digit of the attribute)
+    treated = attr % 10 != 0
+    interp_alt = treated & (attr >= dico_attributes["INTERP_ALT"])
+    sea = treated & ~interp_alt & (attr & dico_attributes["SEA"] != 0)
+    water_attr = dico_attributes["WATER"] | dico_attributes["SEA_EQUIV"]
+    water = treated & ~interp_alt & ~sea & (attr & water_attr != 0)
+    # The smoothings below depend on the order in which the triangles are
+    # visited, hence the sets (in file order) and the Python loops.
+    altitudes = nodes[:, 2].tolist()
     if tile.water_smoothing:
         UI.vprint(1, "   Smoothing inland water.")
+        water_tris = set(map(tuple, tris[water, :3].tolist()))
         for j in range(tile.water_smoothing):
             for v1, v2, v3 in water_tris:
-                zmean = (
-                    vertices[6 * v1 + 2]
-                    + vertices[6 * v2 + 2]
-                    + vertices[6 * v3 + 2]
-                ) / 3
-                vertices[6 * v1 + 2] = zmean
-                vertices[6 * v2 + 2] = zmean
-                vertices[6 * v3 + 2] = zmean
+                zmean = (altitudes[v1] + altitudes[v2] + altitudes[v3]) / 3
+                altitudes[v1] = zmean
+                altitudes[v2] = zmean
+                altitudes[v3] = zmean
     UI.vprint(1, "   Smoothing of sea water.")
-    for v1, v2, v3 in sea_tris:
-        if tile.sea_smoothing_mode == "zero":
-            vertices[6 * v1 + 2] = 0
-            vertices[6 * v2 + 2] = 0
-            vertices[6 * v3 + 2] = 0
-        elif tile.sea_smoothing_mode == "mean":
-            zmean = (
-                vertices[6 * v1 + 2]
-                + vertices[6 * v2 + 2]
-                + vertices[6 * v3 + 2]
-            ) / 3
-            vertices[6 * v1 + 2] = zmean
-            vertices[6 * v2 + 2] = zmean
-            vertices[6 * v3 + 2] = zmean
-        else:
-            vertices[6 * v1 + 2] = max(vertices[6 * v1 + 2], 0)
-            vertices[6 * v2 + 2] = max(vertices[6 * v2 + 2], 0)
-            vertices[6 * v3 + 2] = max(vertices[6 * v3 + 2], 0)
+    if tile.sea_smoothing_mode == "mean":
+        for v1, v2, v3 in set(map(tuple, tris[sea, :3].tolist())):
+            zmean = (altitudes[v1] + altitudes[v2] + altitudes[v3]) / 3
+            altitudes[v1] = zmean
+            altitudes[v2] = zmean
+            altitudes[v3] = zmean
+    nodes[:, 2] = altitudes
+    sea_vertices = tris[sea, :3].ravel()
+    if tile.sea_smoothing_mode == "zero":
+        nodes[sea_vertices, 2] = 0
+    elif tile.sea_smoothing_mode != "mean":
+        sea_altitudes = nodes[sea_vertices, 2]
+        nodes[sea_vertices, 2] = numpy.where(
+            sea_altitudes < 0, 0, sea_altitudes
+        )
     UI.vprint(1, "   Treatment of airports, roads and patches.")
-    for v1, v2, v3 in interp_alt_tris:
-        vertices[6 * v1 + 2] = vertices[6 * v1 + 5]
-        vertices[6 * v2 + 2] = vertices[6 * v2 + 5]
-        vertices[6 * v3 + 2] = vertices[6 * v3 + 5]
-        vertices[6 * v1 + 3] = 0
-        vertices[6 * v2 + 3] = 0
-        vertices[6 * v3 + 3] = 0
-        vertices[6 * v1 + 4] = 0
-        vertices[6 * v2 + 4] = 0
-        vertices[6 * v3 + 4] = 0
+    interp_vertices = tris[interp_alt, :3].ravel()
+    nodes[interp_vertices, 2] = nodes[interp_vertices, 5]
+    nodes[interp_vertices, 3:5] = 0
     UI.vprint(1, "-> Writing output nodes file.")
-    f_node = open(FNAMES.output_node_file(tile), "w")
-    f_node.write(init_line_f_node)
-    for i in range(0, nbr_pt):
-        f_node.write(
-            str(i + 1)
-            + " "
-            + " ".join(
-                ("{:.15f}".format(x) for x in vertices[6 * i : 6 * i + 6])
-            )
-            + "\n"
-        )
-    f_node.write(end_line_f_node)
-    f_node.close()
-    return vertices
+    TRIIO.write_table(
+        FNAMES.output_node_file(tile),
+        init_line_f_node,
+        nodes,
+        "%.15f",
+        trailer=end_line_f_node,
+    )
+    return nodes.ravel()
 
 
 ################################################################################
+@TRACE.traced("write_mesh_file")
 def write_mesh_file(tile, vertices):
-    UI.vprint(
-        1,
-        "-> Writing final mesh to the file "
-        + FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon),
-    )
-    f_ele = open(FNAMES.output_ele_file(tile), "r")
+    mesh_file = FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)
+    UI.vprint(1, "-> Writing final mesh to the file " + mesh_file)
+    (_, tris, _) = TRIIO.read_ele_file(FNAMES.output_ele_file(tile))
     nbr_vert = len(vertices) // 6
-    nbr_tri = int(f_ele.readline().split()[0])
-    f = open(FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon), "w")
+    nbr_tri = len(tris)
+    # The binary sidecar is fed with the parse of the strings written, i.e.
+    # exactly what a reader of the text file would get. This is done by
+    # chunks to keep the memory footprint of the strings low.
+    node_coords = numpy.zeros(5 * nbr_vert)
+    chunk = 100000
+    f = open(mesh_file, "w")
     f.write("MeshVersionFormatted 2\n")
     f.write("Dimension 3\n\n")
     f.write("Vertices\n")
     f.write(str(nbr_vert) + "\n")
-    for i in range(0, nbr_vert):
-        f.write(
-            "{:.15f}".format(vertices[6 * i] + tile.lon)
-            + " "
-            + "{:.15f}".format(vertices[6 * i + 1] + tile.lat)
-            + " "
-            + "{:.15f}".format(vertices[6 * i + 2] / 100000)
-            + " 0\n"
-        )
+    for i0 in range(0, nbr_vert, chunk):
+        i1 = min(i0 + chunk, nbr_vert)
+        lons = [
+            "{:.15f}".format(x)
+            for x in vertices[6 * i0 : 6 * i1 : 6] + tile.lon
+        ]
+        lats = [
+            "{:.15f}".format(x)
+            for x in vertices[6 * i0 + 1 : 6 * i1 : 6] + tile.lat
+        ]
+        alts = [
+            "{:.15f}".format(x)
+            for x in vertices[6 * i0 + 2 : 6 * i1 : 6] / 100000
+        ]
+        for (lon, lat, alt) in zip(lons, lats, alts):
+            f.write(lon + " " + lat + " " + alt + " 0\n")
+        node_coords[5 * i0 : 5 * i1 : 5] = list(map(float, lons))
+        node_coords[5 * i0 + 1 : 5 * i1 : 5] = list(map(float, lats))
+        node_coords[5 * i0 + 2 : 5 * i1 : 5] = list(map(float, alts))
     f.write("\n")
     f.write("Normals\n")
     f.write(str(nbr_vert) + "\n")
-    for i in range(0, nbr_vert):
-        f.write(
-            "{:.2f}".format(vertices[6 * i + 3])
-            + " "
-            + "{:.2f}".format(vertices[6 * i + 4])
-            + " 0\n"
-        )
+    for i0 in range(0, nbr_vert, chunk):
+        i1 = min(i0 + chunk, nbr_vert)
+        nxs = ["{:.2f}".format(x) for x in vertices[6 * i0 + 3 : 6 * i1 : 6]]
+        nys = ["{:.2f}".format(x) for x in vertices[6 * i0 + 4 : 6 * i1 : 6]]
+        for (nx, ny) in zip(nxs, nys):
+            f.write(nx + " " + ny + " 0\n")
+        node_coords[5 * i0 + 3 : 5 * i1 : 5] = list(map(float, nxs))
+        node_coords[5 * i0 + 4 : 5 * i1 : 5] = list(map(float, nys))
+    node_coords[2::5] *= 100000
     f.write("\n")
     f.write("Triangles\n")
     f.write(str(nbr_tri) + "\n")
-    for i in range(0, nbr_tri):
-        f.write(" ".join(f_ele.readline().split()[1:]) + "\n")
-    f_ele.close()
+    TRIIO.write_rows(f, None, tris, "%d")
     f.close()
+    tri_idx = (tris[:, :3] - 1).astype(numpy.uint32).reshape(-1)
+    tri_types = tris[:, 3].astype(numpy.uint32)
+    write_mesh_bin_file(mesh_file, 2.0, node_coords, tri_idx, tri_types)
+    TRACE.wrote(mesh_file)
+    TRACE.wrote(FNAMES.mesh_bin_file(mesh_file))
     return
 
 
@@ -372,7 +365,7 @@ def write_mesh_file(tile, vertices):
 def extract_mesh_to_obj(
     mesh_file, til_x_left, til_y_top, zoomlevel, provider_code
 ):
-    UI.red_flag = False
+    UI.clear_red_flag()
     timer = time.time()
     (latmax, lonmin) = GEO.gtile_to_wgs84(til_x_left, til_y_top, zoomlevel)
     (latmin, lonmax) = GEO.gtile_to_wgs84(
@@ -384,29 +377,13 @@ def extract_mesh_to_obj(
     mtl_file_name = FNAMES.mtl_file(
         til_x_left, til_y_top, zoomlevel, provider_code
     )
-    f_mesh = open(mesh_file, "r")
-    for i in range(4):
-        f_mesh.readline()
-    nbr_pt_in = int(f_mesh.readline())
-    UI.vprint(1, "    Reading nodes...")
-    pt_in = numpy.zeros(5 * nbr_pt_in, "float")
-    for i in range(nbr_pt_in):
-        pt_in[5 * i : 5 * i + 3] = [
-            float(x) for x in f_mesh.readline().split()[:3]
-        ]
-    for i in range(3):
-        f_mesh.readline()
-    for i in range(nbr_pt_in):
-        pt_in[5 * i + 3 : 5 * i + 5] = [
-            float(x) for x in f_mesh.readline().split()[:2]
-        ]
-    for i in range(0, 2):  # skip 2 lines
-        f_mesh.readline()
+    UI.vprint(1, "    Reading mesh...")
+    (_, nbr_pt_in, pt_in, nbr_tri_in, tri_idx, _) = read_mesh_file(mesh_file)
+    # altitudes are wanted in .mesh units here
+    pt_in[2::5] /= 100000
     if UI.red_flag:
         UI.exit_message_and_bottom_line()
         return 0
-    UI.vprint(1, "    Reading triangles...")
-    nbr_tri_in = int(f_mesh.readline())  # read nbr of tris
     textured_nodes = {}
     textured_nodes_inv = {}
     nodes_st_coord = {}
@@ -414,7 +391,7 @@ def extract_mesh_to_obj(
     dico_new_tri = {}
     len_dico_new_tri = 0
     for i in range(0, nbr_tri_in):
-        (n1, n2, n3) = [int(x) - 1 for x in f_mesh.readline().split()[:3]]
+        (n1, n2, n3) = tri_idx[3 * i : 3 * i + 3]
         (lon1, lat1, z1, u1, v1) = pt_in[5 * n1 : 5 * n1 + 5]
         (lon2, lat2, z2, u2, v2) = pt_in[5 * n2 : 5 * n2 + 5]
         (lon3, lat3, z3, u3, v3) = pt_in[5 * n3 : 5 * n3 + 5]
@@ -520,7 +497,6 @@ def extract_mesh_to_obj(
             + str(three)
             + "\n"
         )
-    f_mesh.close()
     f.close()
     # then the mtl file
     f = open(mtl_file_name, "w")
@@ -537,12 +513,12 @@ def extract_mesh_to_obj(
 
 
 ################################################################################
+@TRACE.traced("build_mesh")
 def build_mesh(tile):
-    if UI.is_working:
+    if UI.is_busy():
         return 0
     UI.is_working = 1
-    UI.red_flag = False
-    VECT.scalx = cos((tile.lat + 0.5) * pi / 180)
+    UI.clear_red_flag()
     UI.logprint(
         "Step 2 for tile lat=", tile.lat, ", lon=", tile.lon, ": starting."
     )
@@ -786,7 +762,7 @@ def sort_mesh(tile):
     if UI.is_working:
         return 0
     UI.is_working = 1
-    UI.red_flag = False
+    UI.clear_red_flag()
     mesh_file = FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)
     if not os.path.isfile(mesh_file):
         UI.exit_message_and_bottom_line("\nERROR: Could not find ", mesh_file)
@@ -846,6 +822,10 @@ def triangulate(name, path_to_Ortho4XP_dir):
 ##############################################################################
 def read_mesh_file(mesh_file):
     
+    mesh_data = read_mesh_bin_file(mesh_file)
+    if mesh_data:
+        return mesh_data
+
     f = open(mesh_file,"r")
     mesh_version = float(f.readline().strip().split()[-1])
     
@@ -891,6 +871,95 @@ def read_mesh_file(mesh_file):
         tri_types[i] = t + 1
     f.close()
 
+    # next readers (e.g. masks of the neighbouring tiles) will be faster
+    write_mesh_bin_file(mesh_file, mesh_version, node_coords, tri_idx,
+                        tri_types)
+
     return (mesh_version, nbr_nodes, node_coords, nbr_tris, tri_idx, tri_types)
 ##############################################################################
 
+##############################################################################
+# Binary sidecar of the text .mesh files. It holds the raw arrays returned by
+# read_mesh_file, preceded by a header which records the size and
+# modification time of the text file it was derived from (so that a mesh
+# rewritten by other means, e.g. the moulinette or a community download,
+# invalidates it) and a CRC32 of the arrays.
+##############################################################################
+mesh_bin_magic = b"O4XPMSHB"
+mesh_bin_version = 1
+# magic, version, mesh_version, nbr_nodes, nbr_tris, text size, text mtime,
+# crc32 of the payload
+mesh_bin_header = struct.Struct("<8sIdQQQqI")
+
+
+def write_mesh_bin_file(mesh_file, mesh_version, node_coords, tri_idx,
+                        tri_types):
+    bin_file = FNAMES.mesh_bin_file(mesh_file)
+    try:
+        stat = os.stat(mesh_file)
+        payload = (
+            numpy.ascontiguousarray(node_coords, dtype="<f8").tobytes(),
+            numpy.ascontiguousarray(tri_idx, dtype="<u4").tobytes(),
+            numpy.ascontiguousarray(tri_types, dtype="<u4").tobytes(),
+        )
+        crc = 0
+        for data in payload:
+            crc = zlib.crc32(data, crc)
+        with open(bin_file + ".tmp", "wb") as f:
+            f.write(
+                mesh_bin_header.pack(
+                    mesh_bin_magic,
+                    mesh_bin_version,
+                    mesh_version,
+                    len(node_coords) // 5,
+                    len(tri_types),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    crc,
+                )
+            )
+            for data in payload:
+                f.write(data)
+        os.replace(bin_file + ".tmp", bin_file)
+    except Exception as e:
+        # The sidecar is only a cache, the text mesh remains the reference
+        UI.vprint(2, "   Could not write binary mesh file", bin_file, ":", e)
+        return 0
+    return 1
+
+
+def read_mesh_bin_file(mesh_file):
+    bin_file = FNAMES.mesh_bin_file(mesh_file)
+    if not os.path.isfile(bin_file):
+        return None
+    try:
+        stat = os.stat(mesh_file)
+        with open(bin_file, "rb") as f:
+            (magic, version, mesh_version, nbr_nodes, nbr_tris, text_size,
+             text_mtime, crc) = mesh_bin_header.unpack(
+                f.read(mesh_bin_header.size)
+            )
+            if (magic != mesh_bin_magic or version != mesh_bin_version
+                    or text_size != stat.st_size
+                    or text_mtime != stat.st_mtime_ns):
+                UI.vprint(2, "   Binary mesh file", bin_file, "is outdated.")
+                return None
+            payload = f.read()
+    except Exception:
+        return None
+    if (len(payload) != 8 * 5 * nbr_nodes + 4 * 4 * nbr_tris
+            or zlib.crc32(payload) != crc):
+        UI.vprint(1, "   WARNING: Corrupted binary mesh file", bin_file)
+        return None
+    node_coords = numpy.frombuffer(
+        payload, dtype="<f8", count=5 * nbr_nodes
+    ).astype(numpy.float64)
+    tri_idx = numpy.frombuffer(
+        payload, dtype="<u4", count=3 * nbr_tris, offset=40 * nbr_nodes
+    ).astype(numpy.uint32)
+    tri_types = numpy.frombuffer(
+        payload, dtype="<u4", count=nbr_tris,
+        offset=40 * nbr_nodes + 12 * nbr_tris
+    ).astype(numpy.uint32)
+    return (mesh_version, nbr_nodes, node_coords, nbr_tris, tri_idx, tri_types)
+##############################################################################
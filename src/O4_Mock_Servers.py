@@ -0,0 +1,761 @@
+import argparse
+import bz2
+import collections
+import functools
+import hashlib
+import io
+import os
+import posixpath
+import re
+import shutil
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, unquote
+from xml.etree import ElementTree
+import numpy
+from PIL import Image
+import O4_File_Names as FNAMES
+import O4_UI_Utils as UI
+import O4_DEM_Utils as DEM
+import O4_OSM_Utils as OSM
+
+################################################################################
+#
+# Local stand-ins for the servers a build talks to, so that the downloaders
+# can be tested and timed without network. Each server runs in a background
+# thread of the calling process (see start and stop) and is fully
+# deterministic : what it answers only depends on the request, on its
+# settings and on the number of times the same request was made before.
+#
+# The imagery server answers, in the web mercator grid (EPSG:3857) :
+#
+#   TMS   /tms/{zoom}/{x}/{y}.jpg
+#   WMTS  /wmts?SERVICE=WMTS&REQUEST=GetTile&TILEMATRIX=..&TILEROW=..&TILECOL=..
+#         /wmts?SERVICE=WMTS&REQUEST=GetCapabilities
+#   WMS   /wms?SERVICE=WMS&REQUEST=GetMap&BBOX=..&WIDTH=..&HEIGHT=..
+#
+# with any path prefix before tms, wmts or wms. The images are drawn from
+# a same pattern of the map coordinates, so that all the services and zoom
+# levels agree. The tiles above max_zl and those in holes (or a hole_rate
+# fraction of them) are answered with a 404, a fraction error_rate of the
+# requests with an error_status, and a fraction empty_rate of the tiles with
+# an empty image : under a path containing virtualearth or arcgisonline
+# these have the exact size by which Ortho4XP recognizes the empty images of
+# Bing and ArcGIS, elsewhere they are plain white tiles.
+#
+# The Overpass server answers the queries of the OSM downloads from an OSM
+# extract, and the elevation server mirrors the elevation servers from a
+# fixture directory. With overpass_custom_url and elevation_mirror_url set
+# to them, and imagery from the mock providers (see write_providers), a
+# whole tile can be built without network.
+#
+################################################################################
+
+default_port = 8417
+tile_size = 256
+jpeg_quality = 90
+earth_half = 20037508.34  # half of the extent of the web mercator grid
+# Content-Length of the empty images of Bing and ArcGIS
+empty_sizes = {"virtualearth": 1033, "arcgisonline": 2521}
+provider_prefix = "MOCK"
+
+################################################################################
+def pattern(x, y):
+    # RGB colours of the points of map coordinates (x, y) : smooth variations
+    # at the scale of the km and details at the scale of the pixel at ZL 17+
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    red = 120 + 60 * numpy.sin(x / 5000) + 40 * numpy.sin((x + y) / 310)
+    green = 120 + 60 * numpy.cos(y / 7000) + 40 * numpy.sin((x - y) / 170)
+    blue = 110 + 70 * numpy.sin((x + 2 * y) / 11000) + 25 * numpy.cos(x / 7)
+    return numpy.clip(numpy.dstack((red, green, blue)), 0, 255).astype(
+        numpy.uint8
+    )
+
+
+def render(x_min, y_max, x_max, y_min, width, height):
+    x = x_min + (numpy.arange(width) + 0.5) * (x_max - x_min) / width
+    y = y_max - (numpy.arange(height) + 0.5) * (y_max - y_min) / height
+    (x, y) = numpy.meshgrid(x, y)
+    return encode(Image.fromarray(pattern(x, y)))
+
+
+def encode(image, image_format="JPEG"):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, quality=jpeg_quality)
+    return buffer.getvalue()
+
+
+@functools.lru_cache(maxsize=1024)
+def render_tile(zoom, til_x, til_y):
+    size = 2 * earth_half / 2 ** zoom
+    return render(
+        -earth_half + til_x * size,
+        earth_half - til_y * size,
+        -earth_half + (til_x + 1) * size,
+        earth_half - (til_y + 1) * size,
+        tile_size,
+        tile_size,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def empty_image(size=None):
+    # a white tile, padded to size bytes if given
+    data = encode(Image.new("RGB", (tile_size, tile_size), "white"))
+    if size is None:
+        return data
+    data = encode(Image.new("RGB", (8, 8), "white"))
+    return data + b"\0" * (size - len(data))
+
+
+def draw(key, *items):
+    # deterministic number in [0, 1) for items (e.g. a tile) and a key
+    digest = hashlib.blake2b(repr((key,) + items).encode(), digest_size=8)
+    return int.from_bytes(digest.digest(), "big") / 2 ** 64
+
+
+################################################################################
+def capabilities(layer="mock"):
+    # in the layout read_tilematrixsets expects, one element per line
+    lines = [
+        '<?xml version="1.0"?>',
+        '<Capabilities xmlns="http://www.opengis.net/wmts/1.0" '
+        + 'xmlns:ows="http://www.opengis.net/ows/1.1" version="1.0.0">',
+        "  <Contents>",
+        "    <Layer>",
+        "      <ows:Identifier>" + layer + "</ows:Identifier>",
+        "    </Layer>",
+        "    <TileMatrixSet>",
+        "      <ows:Identifier>GoogleMapsCompatible</ows:Identifier>",
+        "      <ows:SupportedCRS>EPSG:3857</ows:SupportedCRS>",
+    ]
+    for zoom in range(21):
+        lines += [
+            "      <TileMatrix>",
+            "        <ows:Identifier>" + str(zoom) + "</ows:Identifier>",
+            "        <ScaleDenominator>"
+            + repr(2 * earth_half / (tile_size * 2 ** zoom) / 0.00028)
+            + "</ScaleDenominator>",
+            "        <TopLeftCorner>"
+            + repr(-earth_half)
+            + " "
+            + repr(earth_half)
+            + "</TopLeftCorner>",
+            "        <TileWidth>" + str(tile_size) + "</TileWidth>",
+            "        <TileHeight>" + str(tile_size) + "</TileHeight>",
+            "        <MatrixWidth>" + str(2 ** zoom) + "</MatrixWidth>",
+            "        <MatrixHeight>" + str(2 ** zoom) + "</MatrixHeight>",
+            "      </TileMatrix>",
+        ]
+    lines += ["    </TileMatrixSet>", "  </Contents>", "</Capabilities>", ""]
+    return "\n".join(lines)
+
+
+################################################################################
+def write_providers(provider_dir, url, prefix=provider_prefix):
+    """
+    Writes the definitions of providers served by an imagery server at url
+    in a subdirectory of provider_dir : <prefix>T (TMS), <prefix>B and
+    <prefix>A (TMS under a Bing and an ArcGIS like path), <prefix>W (WMTS)
+    and <prefix>S (WMS). Returns their codes.
+    """
+    layer_dir = os.path.join(provider_dir, prefix.capitalize())
+    os.makedirs(layer_dir, exist_ok=True)
+    tms = "grid_type=webmercator\nurl_template=" + url + "{}/tms/{{zoom}}/"
+    tms += "{{x}}/{{y}}.jpg\n"
+    layers = {
+        "T": tms.format(""),
+        "B": tms.format("/virtualearth"),
+        "A": tms.format("/arcgisonline"),
+        "W": "request_type=wmts\nepsg_code=3857\nlayers=mock\n"
+        + "tilematrixset=GoogleMapsCompatible\ntile_size=256\n"
+        + "url_prefix="
+        + url
+        + "/wmts?\n",
+        "S": "request_type=wms\nwms_size=512\nepsg_code=3857\n"
+        + "wms_version=1.1.1\nlayers=mock\nurl_prefix="
+        + url
+        + "/wms?\n",
+    }
+    for (suffix, definition) in layers.items():
+        with open(os.path.join(layer_dir, prefix + suffix + ".lay"), "w") as f:
+            f.write(definition + "imagery_dir=code\nin_GUI=False\n")
+    with open(os.path.join(layer_dir, "capabilities.xml"), "w") as f:
+        f.write(capabilities())
+    return [prefix + suffix for suffix in layers]
+
+
+################################################################################
+
+################################################################################
+class mock_server:
+    """
+    Base of the local servers : an HTTP server on 127.0.0.1 (any free port
+    by default) whose answers are made by the answer method of the subclass,
+    after latency seconds, but for a fraction error_rate of the requests
+    which get an error_status. The counts of the requests, of their status
+    codes and of the bytes sent are in stats.
+    """
+
+    def __init__(
+        self, port=0, latency=0, error_rate=0, error_status=500, seed=0
+    ):
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.seed = seed
+        self.httpd = None
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.attempts = collections.Counter()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.port)
+
+    def start(self):
+        server = self
+
+        class handler(BaseHTTPRequestHandler):
+            # keep-alive, as the providers do
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", self.port), handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+        return False
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats.clear()
+            self.attempts.clear()
+
+    def count(self, *keys, nbr=1):
+        with self.lock:
+            for key in keys:
+                self.stats[key] += nbr
+
+    def handle(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        parts = urlsplit(request.path)
+        query = {key.upper(): value for (key, value) in parse_qsl(parts.query)}
+        with self.lock:
+            self.attempts[request.path] += 1
+            attempt = self.attempts[request.path]
+        try:
+            # errors change with the attempt, so that retries eventually
+            # succeed
+            if draw(self.seed, "error", request.path, attempt) < (
+                self.error_rate
+            ):
+                (status, content_type, body) = (
+                    self.error_status,
+                    "text/plain",
+                    b"Mock error",
+                )
+            else:
+                (status, content_type, body) = self.answer(
+                    parts.path, query, attempt
+                )
+        except (KeyError, ValueError) as e:
+            (status, content_type, body) = (400, "text/plain", str(e).encode())
+        self.count("requests", str(status))
+        self.count("bytes", nbr=len(body))
+        request.send_response(status)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def answer(self, path, query, attempt):
+        # returns (status, content type, body), a 404 as the subclasses do
+        # for the paths out of their service
+        return (404, "text/plain", b"Unknown service")
+
+
+################################################################################
+
+################################################################################
+class mock_imagery_server(mock_server):
+    def __init__(
+        self,
+        port=0,
+        latency=0,
+        error_rate=0,
+        error_status=500,
+        holes=(),
+        hole_rate=0,
+        max_zl=None,
+        empty_rate=0,
+        seed=0,
+    ):
+        super().__init__(port, latency, error_rate, error_status, seed)
+        self.holes = set(holes)  # (zoom, til_x, til_y)
+        self.hole_rate = hole_rate
+        self.max_zl = max_zl
+        self.empty_rate = empty_rate
+
+    def answer(self, path, query, attempt):
+        segments = path.strip("/").split("/")
+        if "tms" in segments:
+            (zoom, til_x, til_y) = segments[-3:]
+            tile = (int(zoom), int(til_x), int(til_y.split(".")[0]))
+        elif "wmts" in segments:
+            if query.get("REQUEST", "").lower() == "getcapabilities":
+                return (200, "text/xml", capabilities().encode())
+            tile = (
+                int(query["TILEMATRIX"]),
+                int(query["TILECOL"]),
+                int(query["TILEROW"]),
+            )
+        elif "wms" in segments:
+            return self.answer_wms(path, query)
+        else:
+            return (404, "text/plain", b"Unknown service")
+        (zoom, til_x, til_y) = tile
+        if not (0 <= til_x < 2 ** zoom and 0 <= til_y < 2 ** zoom):
+            return (404, "text/plain", b"Out of the grid")
+        if (
+            (self.max_zl is not None and zoom > self.max_zl)
+            or tile in self.holes
+            or draw(self.seed, "hole", tile) < self.hole_rate
+        ):
+            return (404, "text/plain", b"No tile here")
+        if draw(self.seed, "empty", tile) < self.empty_rate:
+            self.count("empty")
+            size = next(
+                (size for (key, size) in empty_sizes.items() if key in path),
+                None,
+            )
+            return (200, "image/jpeg", empty_image(size))
+        return (200, "image/jpeg", render_tile(*tile))
+
+    def answer_wms(self, path, query):
+        bbox = [float(value) for value in query["BBOX"].split(",")]
+        if query.get("VERSION", "1.1.1").split(".")[1] == "3":
+            # axis order swapped by get_wms_image for WMS 1.3
+            bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+        (x_min, y_min, x_max, y_max) = bbox
+        if draw(self.seed, "hole", bbox) < self.hole_rate:
+            return (404, "text/plain", b"No image here")
+        (width, height) = (int(query["WIDTH"]), int(query["HEIGHT"]))
+        if draw(self.seed, "empty", bbox) < self.empty_rate:
+            self.count("empty")
+            return (
+                200,
+                "image/jpeg",
+                encode(Image.new("RGB", (width, height), "white")),
+            )
+        return (
+            200,
+            "image/jpeg",
+            render(x_min, y_max, x_max, y_min, width, height),
+        )
+
+
+################################################################################
+
+################################################################################
+overpass_statement = re.compile(
+    r"(node|way|relation|rel|nwr)((?:\[[^\]]*\])*)\(([^)]*)\)"
+)
+overpass_filter = re.compile(
+    r'\[\s*"([^"]*)"\s*(?:(!=|=|~)\s*"([^"]*)")?\s*\]'
+)
+
+################################################################################
+class mock_overpass_server(mock_server):
+    """
+    Answers the Overpass queries of OSM.get_overpass_data (statements such as
+    way["highway"="motorway"](s, w, n, e), recursed down and output with out
+    meta) from an OSM extract, on any path ending with interpreter. As for
+    Overpass, a way is in a bbox if one of its nodes is, and a relation if
+    one of its member nodes or ways is.
+    """
+
+    def __init__(
+        self,
+        osm_file,
+        port=0,
+        latency=0,
+        error_rate=0,
+        error_status=504,
+        seed=0,
+    ):
+        super().__init__(port, latency, error_rate, error_status, seed)
+        self.osm_file = osm_file
+        self.elements = None
+
+    def start(self):
+        if self.elements is None:
+            self.load()
+        return super().start()
+
+    def load(self):
+        # type -> {id: (attributes, children, tags)}, the children being the
+        # node ids of a way and the (type, ref, role) of the members of a
+        # relation
+        self.elements = {"node": {}, "way": {}, "relation": {}}
+        opener = bz2.open if self.osm_file.endswith(".bz2") else open
+        with opener(self.osm_file, "rb") as f:
+            for (event, element) in ElementTree.iterparse(f):
+                if element.tag not in self.elements:
+                    continue
+                tags = {
+                    child.get("k"): child.get("v")
+                    for child in element
+                    if child.tag == "tag"
+                }
+                if element.tag == "way":
+                    children = [
+                        int(child.get("ref"))
+                        for child in element
+                        if child.tag == "nd"
+                    ]
+                elif element.tag == "relation":
+                    children = [
+                        (child.get("type"), int(child.get("ref")), child.get("role"))
+                        for child in element
+                        if child.tag == "member"
+                    ]
+                else:
+                    children = []
+                self.elements[element.tag][int(element.get("id"))] = (
+                    dict(element.attrib),
+                    children,
+                    tags,
+                )
+                element.clear()
+
+    def in_bbox(self, osm_type, osm_id, bbox):
+        (south, west, north, east) = bbox
+        if osm_type == "node":
+            attributes = self.elements["node"][osm_id][0]
+            return (
+                south <= float(attributes["lat"]) <= north
+                and west <= float(attributes["lon"]) <= east
+            )
+        if osm_type == "way":
+            return any(
+                node_id in self.elements["node"]
+                and self.in_bbox("node", node_id, bbox)
+                for node_id in self.elements["way"][osm_id][1]
+            )
+        return any(
+            member_type in ("node", "way")
+            and member_id in self.elements[member_type]
+            and self.in_bbox(member_type, member_id, bbox)
+            for (member_type, member_id, role) in self.elements[osm_type][
+                osm_id
+            ][1]
+        )
+
+    def select(self, statement, filters, bbox):
+        osm_types = {
+            "node": ("node",),
+            "way": ("way",),
+            "rel": ("relation",),
+            "relation": ("relation",),
+            "nwr": ("node", "way", "relation"),
+        }[statement]
+        selection = []
+        for osm_type in osm_types:
+            for (osm_id, (attributes, children, tags)) in self.elements[
+                osm_type
+            ].items():
+                if all(
+                    matches(tags, key, operator, value)
+                    for (key, operator, value) in filters
+                ) and self.in_bbox(osm_type, osm_id, bbox):
+                    selection.append((osm_type, osm_id))
+        return selection
+
+    def recurse_down(self, selection):
+        # (._;>>;) : the members of the relations (recursively), then the
+        # nodes of the ways
+        selection = set(selection)
+        todo = [item for item in selection if item[0] == "relation"]
+        while todo:
+            for (member_type, member_id, role) in self.elements["relation"][
+                todo.pop()[1]
+            ][1]:
+                item = (member_type, member_id)
+                if member_id in self.elements.get(member_type, ()) and (
+                    item not in selection
+                ):
+                    selection.add(item)
+                    if member_type == "relation":
+                        todo.append(item)
+        for (osm_type, osm_id) in list(selection):
+            if osm_type == "way":
+                selection.update(
+                    ("node", node_id)
+                    for node_id in self.elements["way"][osm_id][1]
+                    if node_id in self.elements["node"]
+                )
+        return selection
+
+    def answer(self, path, query, attempt):
+        if not path.endswith("interpreter"):
+            return (404, "text/plain", b"Unknown service")
+        data = query["DATA"]
+        selection = []
+        for match in overpass_statement.finditer(data):
+            bbox = [float(value) for value in match.group(3).split(",")]
+            if len(bbox) != 4:
+                raise ValueError("Unsupported query " + match.group(0))
+            filters = overpass_filter.findall(match.group(2))
+            selection += self.select(match.group(1), filters, bbox)
+        if "._;>>;" in data.replace(" ", ""):
+            selection = self.recurse_down(selection)
+        return (200, "application/osm3s+xml", self.to_xml(selection))
+
+    def to_xml(self, selection):
+        lines = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<osm version="0.6" generator="Overpass API (Ortho4XP mock)">',
+        ]
+        order = {"node": 0, "way": 1, "relation": 2}
+        for (osm_type, osm_id) in sorted(
+            set(selection), key=lambda item: (order[item[0]], item[1])
+        ):
+            (attributes, children, tags) = self.elements[osm_type][osm_id]
+            lines.append(
+                "  <"
+                + osm_type
+                + "".join(
+                    " " + key + '="' + OSM.xml_escape(value) + '"'
+                    for (key, value) in attributes.items()
+                )
+                + (">" if children or tags else "/>")
+            )
+            if not (children or tags):
+                continue
+            if osm_type == "way":
+                lines += ['    <nd ref="' + str(ref) + '"/>' for ref in children]
+            elif osm_type == "relation":
+                lines += [
+                    '    <member type="'
+                    + member_type
+                    + '" ref="'
+                    + str(ref)
+                    + '" role="'
+                    + OSM.xml_escape(role or "")
+                    + '"/>'
+                    for (member_type, ref, role) in children
+                ]
+            lines += [
+                '    <tag k="'
+                + OSM.xml_escape(key)
+                + '" v="'
+                + OSM.xml_escape(value)
+                + '"/>'
+                for (key, value) in tags.items()
+            ]
+            lines.append("  </" + osm_type + ">")
+        lines.append("</osm>")
+        return "\n".join(lines).encode("utf-8")
+
+
+def matches(tags, key, operator, value):
+    if not operator:
+        return key in tags
+    if operator == "=":
+        return tags.get(key) == value
+    if operator == "!=":
+        return tags.get(key) != value
+    return key in tags and re.search(value, tags[key]) is not None
+
+
+################################################################################
+
+################################################################################
+class mock_elevation_server(mock_server):
+    """
+    Serves the files of a fixture directory laid out as <host>/<path> of the
+    elevation servers (see write_elevation_fixture), to be used as the
+    elevation_mirror_url of DEM.
+    """
+
+    def __init__(
+        self,
+        fixture_dir,
+        port=0,
+        latency=0,
+        error_rate=0,
+        error_status=503,
+        seed=0,
+    ):
+        super().__init__(port, latency, error_rate, error_status, seed)
+        self.dir = os.path.abspath(fixture_dir)
+
+    def answer(self, path, query, attempt):
+        file_name = os.path.normpath(
+            os.path.join(self.dir, *unquote(path).strip("/").split("/"))
+        )
+        if not file_name.startswith(self.dir + os.sep) or not os.path.isfile(
+            file_name
+        ):
+            return (404, "text/plain", b"Not Found")
+        with open(file_name, "rb") as f:
+            body = f.read()
+        return (
+            200,
+            "application/zip"
+            if file_name.endswith(".zip")
+            else "application/octet-stream",
+            body,
+        )
+
+
+################################################################################
+def write_elevation_fixture(fixture_dir, source, lat, lon, file_name):
+    """
+    Puts the elevation file file_name of a tile in fixture_dir, where a
+    mirror of the server of source would have it (within the archive of the
+    tile for Viewfinderpanoramas). Returns the path of the fixture.
+    """
+    url = DEM.elevation_url(source, lat, lon)
+    if not url:
+        raise ValueError("No elevation server for " + source + " there")
+    parts = urlsplit(url)
+    path = os.path.join(
+        fixture_dir, parts.netloc, *parts.path.strip("/").split("/")
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if source != "View":
+        shutil.copyfile(file_name, path)
+        return path
+    # archives hold the files of several tiles
+    member = posixpath.join(
+        os.path.basename(path)[:-4],
+        os.path.basename(FNAMES.viewfinderpanorama(lat, lon)),
+    )
+    members = {}
+    if os.path.isfile(path):
+        with zipfile.ZipFile(path, "r") as zip_ref:
+            members = {name: zip_ref.read(name) for name in zip_ref.namelist()}
+    with open(file_name, "rb") as f:
+        members[member] = f.read()
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for name in sorted(members):
+            zip_ref.writestr(name, members[name])
+    return path
+
+
+################################################################################
+
+################################################################################
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="Ortho4XP.py --mock-server",
+        description="Serves deterministic imagery, and optionally OSM and "
+        + "elevation data, locally until interrupted.",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=default_port,
+        help="port of the imagery server, the Overpass and elevation ones "
+        + "use the next two",
+    )
+    parser.add_argument("--latency", type=float, default=0, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--hole-rate", type=float, default=0)
+    parser.add_argument("--max-zl", type=int)
+    parser.add_argument("--empty-rate", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--providers",
+        metavar="DIR",
+        help="write the definitions of the mock providers in DIR",
+    )
+    parser.add_argument(
+        "--osm", metavar="FILE", help="OSM extract for an Overpass server"
+    )
+    parser.add_argument(
+        "--elevation",
+        metavar="DIR",
+        help="fixture directory for an elevation server",
+    )
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit as e:
+        return 2 if e.code else 0
+    common_args = {
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "seed": args.seed,
+    }
+    servers = [
+        mock_imagery_server(
+            args.port,
+            error_status=args.error_status,
+            hole_rate=args.hole_rate,
+            max_zl=args.max_zl,
+            empty_rate=args.empty_rate,
+            **common_args
+        )
+    ]
+    if args.osm:
+        servers.append(
+            mock_overpass_server(args.osm, args.port + 1, **common_args)
+        )
+    if args.elevation:
+        servers.append(
+            mock_elevation_server(args.elevation, args.port + 2, **common_args)
+        )
+    try:
+        for server in servers:
+            server.start()
+    except OSError as e:
+        UI.vprint(0, "ERROR: Could not start the mock server:", e)
+        for server in servers:
+            server.stop()
+        return 1
+    UI.vprint(0, "Mock imagery server listening on", servers[0].url)
+    if args.providers:
+        codes = write_providers(args.providers, servers[0].url)
+        UI.vprint(0, "Providers", ", ".join(codes), "written in", args.providers)
+    for server in servers[1:]:
+        if isinstance(server, mock_overpass_server):
+            UI.vprint(
+                0, "overpass_custom_url =", server.url + "/api/interpreter"
+            )
+        else:
+            UI.vprint(0, "elevation_mirror_url =", server.url)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.stop()
+        UI.vprint(0, "Served:", dict(server.stats))
+    return 0
@@ -1,13 +1,21 @@
 import os
 import time
-import io
+import array
 import bz2
+import collections.abc
+import html
+import itertools
+import re
+from xml.sax.saxutils import escape
 import random
-import requests
+import threading
+import queue
 import numpy
 from shapely import geometry, ops
 import O4_UI_Utils as UI
 import O4_File_Names as FNAMES
+import O4_Http_Utils as HTTP
+import O4_Parallel_Utils as PARALLEL
 
 overpass_servers = {
     "Main Overpass API instance": "https://overpass-api.de/api/interpreter",
@@ -18,16 +26,49 @@ overpass_servers = {
 }
 # KU server does not rate limit as of 2024-07-08
 overpass_server_choice = "VK Maps Overpass API instance"
+# An Overpass server used instead of all of the above if set (a local
+# instance, or the mock server of O4_Mock_Servers for hermetic builds).
+overpass_custom_url = ""
+custom_overpass_server = "Custom Overpass server"
 max_osm_tentatives = 8
+# Queries of a same layer sent simultaneously (to different servers if
+# overpass_server_choice is random), and the global rate limit on all
+# requests to the Overpass servers.
+overpass_max_parallel = 3
+overpass_requests_per_sec = 1.0
+overpass_burst = 3
+# Servers which just failed are left aside for that long (doubled at each new
+# failure, up to overpass_max_cooldown) when choosing one at random.
+overpass_cooldown = 4
+overpass_max_cooldown = 300
+
+_overpass_lock = threading.Lock()
+_overpass_bucket = None
+_overpass_health = {}  # server code -> (consecutive failures, retry after)
+# bytes of (uncompressed) osm data read at once by the parser
+osm_chunk_size = 1 << 24
+
+################################################################################
+def xml_escape(value):
+    # tag keys and values are stored unescaped in the layers
+    return escape(value, {'"': "&quot;"})
 
 ################################################################################
 class OSM_layer:
     def __init__(self):
-        self.dicosmn = (
-            {}
-        )  # keys are ints (ids) and values are tuple of (lat,lon)
+        # Compact tables : the (lon,lat) of the node of id -1-i are at position
+        # 2*i and 2*i+1 of node_table, the node ids of the way of id -1-i start
+        # at way_starts[i] in way_table (and end at the start of the next one).
+        # Ids are handed out sequentially (and only the last one is ever taken
+        # back) so that the tables are dense.
+        self.node_table = array.array("d")
+        self.way_table = array.array("q")
+        self.way_starts = array.array("q")
+        # read-only dict views of them, keys are ints (ids) and values are
+        # tuple of (lon,lat), resp. lists of node ids
+        self.dicosmn = node_view(self)
         self.dicosmn_reverse = {}  # reverese of the previous one
-        self.dicosmw = {}
+        self.dicosmw = way_view(self)
         self.next_node_id = -1
         self.next_way_id = -1
         self.next_rel_id = -1
@@ -49,6 +90,22 @@ class OSM_layer:
             self.dicosmtags,
         ]
 
+    def node_coords(self, nodeids):
+        # (n,2) array of the (lon,lat) of a sequence of node ids
+        nodes = numpy.frombuffer(self.node_table, dtype=numpy.float64)
+        return nodes.reshape(-1, 2)[-1 - numpy.asarray(nodeids, dtype=int)]
+
+    def way_coords(self, wayid):
+        # (n,2) array of the (lon,lat) of the nodes of a way
+        i = -1 - wayid
+        end = (
+            self.way_starts[i + 1]
+            if i + 1 < len(self.way_starts)
+            else len(self.way_table)
+        )
+        nodeids = numpy.frombuffer(self.way_table, dtype=numpy.int64)
+        return self.node_coords(nodeids[self.way_starts[i] : end])
+
     def update_dicosm(self, osm_input, input_tags=None, target_tags=None):
         # input_tags (dict or None) are the input query tags (per osm type)
         # target_tags (dict or None) are the the tags which should be kept 
@@ -57,17 +114,16 @@ class OSM_layer:
         initnodes = len(self.dicosmn)
         initways = len(self.dicosmfirst["w"])
         initrels = len(self.dicosmfirst["r"])
-        dicosmn_id_map = {}
-        dicosmw_id_map = {}
+        parser = OSM_parser(self, input_tags, target_tags)
         # osm_input may either refer to an osm filename (e.g. cached data) or
         # to a xml bytestring (direct download)
         if isinstance(osm_input, str):
             osm_file_name = osm_input
             try:
                 if osm_file_name[-4:] == ".bz2":
-                    pfile = bz2.open(osm_file_name, "rt", encoding="utf-8")
+                    pfile = bz2.open(osm_file_name, "rb")
                 else:
-                    pfile = open(osm_file_name, "r", encoding="utf-8")
+                    pfile = open(osm_file_name, "rb")
             except:
                 UI.vprint(
                     1,
@@ -76,194 +132,10 @@ class OSM_layer:
                     "for reading (corrupted ?).",
                 )
                 return 0
-        elif isinstance(osm_input, bytes):
-            pfile = io.StringIO(osm_input.decode(encoding="utf-8"))
-        first_line = pfile.readline()
-        if "<osm " not in first_line:
-            first_line = pfile.readline()
-        separator = "'" if "'" in first_line else '"'
-        normal_exit = False
-        for line in pfile:
-            items = line.split(separator)
-            if "<node id=" in items[0]:
-                osmtype = "n"
-                osmid = items[1]
-                for j in range(0, len(items)):
-                    if items[j] == " lat=":
-                        latp = float(items[j + 1])
-                    elif items[j] == " lon=":
-                        lonp = float(items[j + 1])
-                if (lonp, latp) in self.dicosmn_reverse:
-                    true_osmid = self.dicosmn_reverse[(lonp, latp)]
-                    dicosmn_id_map[osmid] = true_osmid
-                    osmid = true_osmid
-                else:
-                    true_osmid = self.next_node_id
-                    dicosmn_id_map[osmid] = true_osmid
-                    osmid = true_osmid
-                    self.dicosmn_reverse[(lonp, latp)] = osmid
-                    self.dicosmn[osmid] = (lonp, latp)
-                    self.next_node_id -= 1
-            elif "<way id=" in items[0]:
-                osmtype = "w"
-                osmid = items[1]
-                true_osmid = self.next_way_id
-                self.next_way_id -= 1
-                dicosmw_id_map[osmid] = true_osmid
-                osmid = true_osmid
-                self.dicosmw[osmid] = []
-                if not input_tags:
-                    self.dicosmfirst["w"].add(osmid)
-            elif "<nd ref=" in items[0]:
-                self.dicosmw[osmid].append(dicosmn_id_map[items[1]])
-            elif "<relation id=" in items[0]:
-                osmtype = "r"
-                osmid = items[1]
-                true_osmid = self.next_rel_id
-                self.next_rel_id -= 1
-                osmid = true_osmid
-                self.dicosmr[osmid] = {"outer": [], "inner": []}
-                self.dicosmrorig[osmid] = {"outer": [], "inner": []}
-                dico_rel_check = {"inner": {}, "outer": {}}
-                if not input_tags:
-                    self.dicosmfirst["r"].add(osmid)
-            elif "<member type=" in items[0]:
-                role = items[5]
-                if items[1] != "way" or role not in ("outer", "inner"):
-                    if items[1] == "node":
-                        continue  # not necessary to report these
-                    UI.lvprint(
-                        2,
-                        "Relation id=",
-                        osmid,
-                        "contains a member of type",
-                        "'" + items[1] + "'",
-                        "and role",
-                        "'" + role + "'",
-                        "which was not treated (only deal with 'ways' of role ",
-                        "'inner' or 'outer').",
-                    )
-                    continue
-                try:
-                    wayid = dicosmw_id_map[items[3]]
-                except:
-                    continue
-                self.dicosmrorig[osmid][role].append(wayid)
-                endpt1 = self.dicosmw[wayid][0]
-                endpt2 = self.dicosmw[wayid][-1]
-                if endpt1 == endpt2:
-                    self.dicosmr[osmid][role].append(self.dicosmw[wayid])
-                else:
-                    if endpt1 in dico_rel_check[role]:
-                        dico_rel_check[role][endpt1].append(wayid)
-                    else:
-                        dico_rel_check[role][endpt1] = [wayid]
-                    if endpt2 in dico_rel_check[role]:
-                        dico_rel_check[role][endpt2].append(wayid)
-                    else:
-                        dico_rel_check[role][endpt2] = [wayid]
-            elif "<tag k=" in items[0]:
-                # Do we need to catch that tag ?
-                if (
-                    (not input_tags)
-                    or (("all", "") in target_tags[osmtype])
-                    or ((items[1], "") in target_tags[osmtype])
-                    or ((items[1], items[3]) in target_tags[osmtype])
-                ):
-                    if osmid not in self.dicosmtags[osmtype]:
-                        self.dicosmtags[osmtype][osmid] = {items[1]: items[3]}
-                    else:
-                        self.dicosmtags[osmtype][osmid][items[1]] = items[3]
-                    # If so, do we need to declare this osmid as a first catch, 
-                    # not one only brought with as a child
-                    if input_tags and (
-                        ((items[1], "") in input_tags[osmtype])
-                        or ((items[1], items[3]) in input_tags[osmtype])
-                    ):
-                        self.dicosmfirst[osmtype].add(osmid)
-            elif "</way" in items[0]:
-                if not self.dicosmw[osmid]:
-                    del self.dicosmw[osmid]
-                    self.next_way_id += 1
-                    if osmid in self.dicosmfirst["w"]:
-                        self.dicosmfirst["w"].remove(osmid)
-                    if osmid in self.dicosmtags["w"]:
-                        del self.dicosmtags[osmtype][osmid]
-            elif "</relation>" in items[0]:
-                bad_rel = False
-                for role, endpt in (
-                    (r, e)
-                    for r in ["outer", "inner"]
-                    for e in dico_rel_check[r]
-                ):
-                    if len(dico_rel_check[role][endpt]) != 2:
-                        bad_rel = True
-                        break
-                if bad_rel == True:
-                    UI.lvprint(
-                        2,
-                        "Relation id=",
-                        osmid,
-                        "is ill formed and was not treated.",
-                    )
-                    del self.dicosmr[osmid]
-                    del self.dicosmrorig[osmid]
-                    del dico_rel_check
-                    self.next_rel_id += 1
-                    if osmid in self.dicosmfirst["r"]:
-                        self.dicosmfirst["r"].remove(osmid)
-                    if osmid in self.dicosmtags["r"]:
-                        del self.dicosmtags["r"][osmid]
-                    continue
-                for role in ["outer", "inner"]:
-                    while dico_rel_check[role]:
-                        nodeids = []
-                        endpt = next(iter(dico_rel_check[role]))
-                        wayid = dico_rel_check[role][endpt][0]
-                        endptinit = self.dicosmw[wayid][0]
-                        endpt1 = endptinit
-                        endpt2 = self.dicosmw[wayid][-1]
-                        for nodeid in self.dicosmw[wayid][:-1]:
-                            nodeids.append(nodeid)
-                        while endpt2 != endptinit:
-                            if dico_rel_check[role][endpt2][0] == wayid:
-                                wayid = dico_rel_check[role][endpt2][1]
-                            else:
-                                wayid = dico_rel_check[role][endpt2][0]
-                            endpt1 = endpt2
-                            if self.dicosmw[wayid][0] == endpt1:
-                                endpt2 = self.dicosmw[wayid][-1]
-                                for nodeid in self.dicosmw[wayid][:-1]:
-                                    nodeids.append(nodeid)
-                            else:
-                                endpt2 = self.dicosmw[wayid][0]
-                                for nodeid in self.dicosmw[wayid][-1:0:-1]:
-                                    nodeids.append(nodeid)
-                            del dico_rel_check[role][endpt1]
-                        nodeids.append(endptinit)
-                        self.dicosmr[osmid][role].append(nodeids)
-                        del dico_rel_check[role][endptinit]
-                if target_tags == None:
-                    for wayid in (
-                        self.dicosmrorig[osmid]["outer"]
-                        + self.dicosmrorig[osmid]["inner"]
-                    ):
-                        try:
-                            self.dicosmfirst["w"].remove(wayid)
-                        except:
-                            pass
-                if not self.dicosmr[osmid]["outer"]:
-                    del self.dicosmr[osmid]
-                    del self.dicosmrorig[osmid]
-                    self.next_rel_id += 1
-                    if osmid in self.dicosmfirst["r"]:
-                        self.dicosmfirst["r"].remove(osmid)
-                    if osmid in self.dicosmtags["r"]:
-                        del self.dicosmtags["r"][osmid]
-                del dico_rel_check
-            elif "</osm>" in items[0]:
-                normal_exit = True
-        pfile.close()
+            with pfile:
+                normal_exit = parser.parse(pfile)
+        else:
+            normal_exit = parser.parse(osm_input)
         if not normal_exit:
             UI.lvprint(
                 0,
@@ -332,9 +204,9 @@ class OSM_layer:
                     for tag in self.dicosmtags["n"][nodeid]:
                         fout.write(
                             '    <tag k="'
-                            + tag
+                            + xml_escape(tag)
                             + '" v="'
-                            + self.dicosmtags["n"][nodeid][tag]
+                            + xml_escape(self.dicosmtags["n"][nodeid][tag])
                             + '"/>\n'
                         )
                     fout.write("  </node>\n")
@@ -351,9 +223,9 @@ class OSM_layer:
             ):
                 fout.write(
                     '    <tag k="'
-                    + tag
+                    + xml_escape(tag)
                     + '" v="'
-                    + self.dicosmtags["w"][wayid][tag]
+                    + xml_escape(self.dicosmtags["w"][wayid][tag])
                     + '"/>\n'
                 )
             fout.write("  </way>\n")
@@ -380,9 +252,9 @@ class OSM_layer:
             ):
                 fout.write(
                     '    <tag k="'
-                    + tag
+                    + xml_escape(tag)
                     + '" v="'
-                    + self.dicosmtags["r"][relid][tag]
+                    + xml_escape(self.dicosmtags["r"][relid][tag])
                     + '"/>\n'
                 )
             fout.write("  </relation>\n")
@@ -390,6 +262,349 @@ class OSM_layer:
         fout.close()
         return 1
 
+################################################################################
+class node_view(collections.abc.Mapping):
+    def __init__(self, osm_layer):
+        self.table = osm_layer.node_table
+
+    def __len__(self):
+        return len(self.table) // 2
+
+    def __iter__(self):
+        return iter(range(-1, -1 - len(self.table) // 2, -1))
+
+    def __contains__(self, nodeid):
+        try:
+            return -(len(self.table) // 2) <= nodeid < 0
+        except TypeError:
+            return False
+
+    def __getitem__(self, nodeid):
+        if not nodeid in self:
+            raise KeyError(nodeid)
+        i = -2 - 2 * nodeid
+        return (self.table[i], self.table[i + 1])
+
+
+################################################################################
+class way_view(collections.abc.Mapping):
+    def __init__(self, osm_layer):
+        self.table = osm_layer.way_table
+        self.starts = osm_layer.way_starts
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(range(-1, -1 - len(self.starts), -1))
+
+    def __contains__(self, wayid):
+        try:
+            return -len(self.starts) <= wayid < 0
+        except TypeError:
+            return False
+
+    def __getitem__(self, wayid):
+        if not wayid in self:
+            raise KeyError(wayid)
+        i = -1 - wayid
+        if i + 1 < len(self.starts):
+            return self.table[self.starts[i] : self.starts[i + 1]].tolist()
+        return self.table[self.starts[i] :].tolist()
+
+
+################################################################################
+class OSM_parser:
+    # Streaming parser filling an OSM_layer, from a binary file object (possibly
+    # a bz2 one) or from bytes. The input is read by chunks cut before a node,
+    # way or relation element, and each run of consecutive elements of the same
+    # kind is decoded at once by regular expressions (rather than element by
+    # element) : coordinates are turned into floats and object ids are mapped
+    # to those of the layer in bulk, nodes with the same coordinates are merged.
+    # Like the line parser it replaces, it expects one kind of quotes for all
+    # attributes and the attributes order of Overpass answers (also that of
+    # JOSM and of write_to_file).
+    kinds = (b"node", b"way", b"relation")
+
+    def __init__(self, osm_layer, input_tags, target_tags):
+        self.layer = osm_layer
+        self.input_tags = input_tags
+        self.target_tags = target_tags
+        self.dicosmn_id_map = {}
+        self.dicosmw_id_map = {}
+        self.patterns = None
+
+    def parse(self, osm_input):
+        try:
+            if isinstance(osm_input, bytes):
+                self.parse_chunk(osm_input)
+                return b"</osm>" in osm_input[-64:]
+            tail = b""
+            while True:
+                data = osm_input.read(osm_chunk_size)
+                if not data:
+                    self.parse_chunk(tail)
+                    return b"</osm>" in tail[-64:]
+                tail += data
+                cut = max(tail.rfind(b"<" + kind + b" ") for kind in self.kinds)
+                if cut > 0:
+                    self.parse_chunk(tail[:cut])
+                    tail = tail[cut:]
+        except (OSError, EOFError) as e:
+            UI.vprint(2, "      ", e)
+            return False
+
+    def parse_chunk(self, chunk):
+        if not self.patterns:
+            # the quotes used for the attributes, as in the osm header
+            start = chunk.find(b"<osm")
+            quote = b"'" if b"'" in chunk[start : chunk.find(b">", start)] else b'"'
+            self.patterns = osm_patterns(quote)
+        for (kind, start, end) in self.runs(chunk):
+            if kind == b"node":
+                self.parse_nodes(chunk, start, end)
+            elif kind == b"way":
+                self.parse_ways(chunk, start, end)
+            else:
+                self.parse_relations(chunk, start, end)
+
+    def runs(self, chunk):
+        # (kind, start, end) of the maximal runs of elements of a same kind
+        tags = {kind: b"<" + kind + b" " for kind in self.kinds}
+        starts = {kind: chunk.find(tags[kind]) for kind in self.kinds}
+        while True:
+            present = [(pos, kind) for (kind, pos) in starts.items() if pos >= 0]
+            if not present:
+                return
+            (start, kind) = min(present)
+            end = min(
+                [pos for (pos, other) in present if other != kind]
+                or [len(chunk)]
+            )
+            yield (kind, start, end)
+            starts[kind] = chunk.find(tags[kind], end)
+
+    def parse_nodes(self, chunk, start, end):
+        layer = self.layer
+        patterns = self.patterns
+        # these attributes can only be found in the node elements themselves
+        osmids = patterns["id"].findall(chunk, start, end)
+        lons = patterns["lon"].findall(chunk, start, end)
+        lats = patterns["lat"].findall(chunk, start, end)
+        count = chunk.count(b"<node ", start, end)
+        if not len(osmids) == len(lons) == len(lats) == count:
+            raise ValueError("Missing id, lat or lon attribute of a node.")
+        coords = list(zip(map(float, lons), map(float, lats)))
+        reverse = layer.dicosmn_reverse
+        fresh = [node for node in dict.fromkeys(coords) if node not in reverse]
+        reverse.update(
+            zip(
+                fresh,
+                range(layer.next_node_id, layer.next_node_id - len(fresh), -1),
+            )
+        )
+        layer.next_node_id -= len(fresh)
+        layer.node_table.extend(itertools.chain.from_iterable(fresh))
+        self.dicosmn_id_map.update(zip(osmids, map(reverse.__getitem__, coords)))
+        # tags of the nodes which have some
+        close = chunk.find(b"</node>", start, end)
+        while close >= 0:
+            open_ = chunk.rfind(b"<node ", start, close)
+            head_end = chunk.find(b">", open_, close)
+            osmid = self.dicosmn_id_map[
+                patterns["id"].search(chunk, open_, head_end)[1]
+            ]
+            for (key, value) in patterns["tag"].findall(chunk, head_end, close):
+                self.tag("n", osmid, key, value)
+            close = chunk.find(b"</node>", close + 7, end)
+
+    def parse_ways(self, chunk, start, end):
+        layer = self.layer
+        patterns = self.patterns
+        run = chunk[start:end]
+        pieces = run.split(b"<way ")[1:]
+        osmids = patterns["id"].findall(run)
+        if len(osmids) != len(pieces):
+            raise ValueError("Missing id attribute of a way.")
+        position = len(layer.way_table)
+        layer.way_table.extend(
+            map(self.dicosmn_id_map.__getitem__, patterns["nd"].findall(run))
+        )
+        for (way_osmid, piece) in zip(osmids, pieces):
+            osmid = layer.next_way_id
+            self.dicosmw_id_map[way_osmid] = osmid
+            count = piece.count(b"<nd ")
+            if not count:
+                # empty ways are dropped (and their id given back)
+                continue
+            layer.next_way_id -= 1
+            layer.way_starts.append(position)
+            position += count
+            if not self.input_tags:
+                layer.dicosmfirst["w"].add(osmid)
+            if b"<tag " in piece:
+                for (key, value) in patterns["tag"].findall(piece):
+                    self.tag("w", osmid, key, value)
+
+    def parse_relations(self, chunk, start, end):
+        patterns = self.patterns
+        for piece in chunk[start:end].split(b"<relation ")[1:]:
+            osmid = self.layer.next_rel_id
+            self.layer.next_rel_id -= 1
+            members = [
+                (member_type.decode(), ref, role.decode())
+                for (member_type, ref, role) in patterns["member"].findall(piece)
+            ]
+            tags = patterns["tag"].findall(piece)
+            self.relation(osmid, members, tags)
+
+    def tag(self, osmtype, osmid, key, value):
+        key = decode_xml_text(key)
+        value = decode_xml_text(value)
+        # Do we need to catch that tag ?
+        input_tags = self.input_tags
+        target_tags = self.target_tags
+        if (
+            (not input_tags)
+            or (("all", "") in target_tags[osmtype])
+            or ((key, "") in target_tags[osmtype])
+            or ((key, value) in target_tags[osmtype])
+        ):
+            dicosmtags = self.layer.dicosmtags[osmtype]
+            if osmid not in dicosmtags:
+                dicosmtags[osmid] = {key: value}
+            else:
+                dicosmtags[osmid][key] = value
+            # If so, do we need to declare this osmid as a first catch, 
+            # not one only brought with as a child
+            if input_tags and (
+                ((key, "") in input_tags[osmtype])
+                or ((key, value) in input_tags[osmtype])
+            ):
+                self.layer.dicosmfirst[osmtype].add(osmid)
+
+    def relation(self, osmid, members, tags):
+        layer = self.layer
+        layer.dicosmr[osmid] = {"outer": [], "inner": []}
+        layer.dicosmrorig[osmid] = {"outer": [], "inner": []}
+        dico_rel_check = {"inner": {}, "outer": {}}
+        if not self.input_tags:
+            layer.dicosmfirst["r"].add(osmid)
+        for (member_type, ref, role) in members:
+            if member_type != "way" or role not in ("outer", "inner"):
+                if member_type == "node":
+                    continue  # not necessary to report these
+                UI.lvprint(
+                    2,
+                    "Relation id=",
+                    osmid,
+                    "contains a member of type",
+                    "'" + member_type + "'",
+                    "and role",
+                    "'" + role + "'",
+                    "which was not treated (only deal with 'ways' of role ",
+                    "'inner' or 'outer').",
+                )
+                continue
+            try:
+                wayid = self.dicosmw_id_map[ref]
+            except:
+                continue
+            layer.dicosmrorig[osmid][role].append(wayid)
+            way = layer.dicosmw[wayid]
+            (endpt1, endpt2) = (way[0], way[-1])
+            if endpt1 == endpt2:
+                layer.dicosmr[osmid][role].append(way)
+            else:
+                if endpt1 in dico_rel_check[role]:
+                    dico_rel_check[role][endpt1].append(wayid)
+                else:
+                    dico_rel_check[role][endpt1] = [wayid]
+                if endpt2 in dico_rel_check[role]:
+                    dico_rel_check[role][endpt2].append(wayid)
+                else:
+                    dico_rel_check[role][endpt2] = [wayid]
+        for (key, value) in tags:
+            self.tag("r", osmid, key, value)
+        bad_rel = False
+        for role, endpt in (
+            (r, e) for r in ["outer", "inner"] for e in dico_rel_check[r]
+        ):
+            if len(dico_rel_check[role][endpt]) != 2:
+                bad_rel = True
+                break
+        if bad_rel == True:
+            UI.lvprint(
+                2, "Relation id=", osmid, "is ill formed and was not treated."
+            )
+            self.drop_relation(osmid)
+            return
+        for role in ["outer", "inner"]:
+            while dico_rel_check[role]:
+                nodeids = []
+                endpt = next(iter(dico_rel_check[role]))
+                wayid = dico_rel_check[role][endpt][0]
+                way = layer.dicosmw[wayid]
+                endptinit = way[0]
+                endpt1 = endptinit
+                endpt2 = way[-1]
+                nodeids.extend(way[:-1])
+                while endpt2 != endptinit:
+                    if dico_rel_check[role][endpt2][0] == wayid:
+                        wayid = dico_rel_check[role][endpt2][1]
+                    else:
+                        wayid = dico_rel_check[role][endpt2][0]
+                    endpt1 = endpt2
+                    way = layer.dicosmw[wayid]
+                    if way[0] == endpt1:
+                        endpt2 = way[-1]
+                        nodeids.extend(way[:-1])
+                    else:
+                        endpt2 = way[0]
+                        nodeids.extend(way[-1:0:-1])
+                    del dico_rel_check[role][endpt1]
+                nodeids.append(endptinit)
+                layer.dicosmr[osmid][role].append(nodeids)
+                del dico_rel_check[role][endptinit]
+        if self.target_tags == None:
+            for wayid in (
+                layer.dicosmrorig[osmid]["outer"]
+                + layer.dicosmrorig[osmid]["inner"]
+            ):
+                layer.dicosmfirst["w"].discard(wayid)
+        if not layer.dicosmr[osmid]["outer"]:
+            self.drop_relation(osmid)
+
+    def drop_relation(self, osmid):
+        layer = self.layer
+        del layer.dicosmr[osmid]
+        del layer.dicosmrorig[osmid]
+        layer.next_rel_id += 1
+        layer.dicosmfirst["r"].discard(osmid)
+        layer.dicosmtags["r"].pop(osmid, None)
+
+
+################################################################################
+def osm_patterns(quote):
+    value = quote + b"([^" + quote + b"]*)" + quote
+    return {
+        "id": re.compile(rb" id=" + value),
+        "lon": re.compile(rb" lon=" + value),
+        "lat": re.compile(rb" lat=" + value),
+        "nd": re.compile(rb"<nd ref=" + value),
+        "tag": re.compile(rb"<tag\s+k=" + value + rb"\s+v=" + value),
+        "member": re.compile(
+            rb"<member\s+type=" + value + rb"\s+ref=" + value + rb"\s+role=" + value
+        ),
+    }
+
+
+################################################################################
+def decode_xml_text(text):
+    text = text.decode("utf-8")
+    return html.unescape(text) if "&" in text else text
+
+
 ################################################################################
 def OSM_queries_to_OSM_layer(
     queries,
@@ -427,22 +642,46 @@ def OSM_queries_to_OSM_layer(
         return osm_layer.update_dicosm(
             cached_data_filename, input_tags, target_tags
         )
+    # look first for cached data (old scheme)
+    old_cached_data_filenames = []
     for query in queries:
-        # look first for cached data (old scheme)
-        if isinstance(query, str):
-            old_cached_data_filename = FNAMES.osm_old_cached(lat, lon, query)
-            if os.path.isfile(old_cached_data_filename):
-                UI.vprint(1, "    * Recycling OSM data for", query)
-                osm_layer.update_dicosm(
-                    old_cached_data_filename, input_tags, target_tags
-                )
-                continue
-        UI.vprint(1, "    * Downloading OSM data for", query)
-        response = get_overpass_data(
-            query, (lat, lon, lat + 1, lon + 1), server_code
+        old_cached_data_filename = (
+            FNAMES.osm_old_cached(lat, lon, query)
+            if isinstance(query, str)
+            else ""
         )
-        if UI.red_flag:
-            return 0
+        old_cached_data_filenames.append(
+            old_cached_data_filename
+            if old_cached_data_filename
+            and os.path.isfile(old_cached_data_filename)
+            else ""
+        )
+    # the downloads run concurrently, their results are nevertheless merged
+    # in the order of the queries so that the layer (and the cached data) do
+    # not depend on which answer came first
+    responses = get_overpass_data_list(
+        [
+            query
+            for (query, old_cached_data_filename) in zip(
+                queries, old_cached_data_filenames
+            )
+            if not old_cached_data_filename
+        ],
+        (lat, lon, lat + 1, lon + 1),
+        server_code,
+    )
+    if UI.red_flag:
+        return 0
+    for (query, old_cached_data_filename) in zip(
+        queries, old_cached_data_filenames
+    ):
+        if old_cached_data_filename:
+            UI.vprint(1, "    * Recycling OSM data for", query)
+            osm_layer.update_dicosm(
+                old_cached_data_filename, input_tags, target_tags
+            )
+            continue
+        response = responses.pop(0)
         if not response:
             UI.logprint(
                 "No valid answer for",
@@ -511,25 +750,55 @@ def OSM_query_to_OSM_layer(
             osm_layer.write_to_file(cached_file_name)
     return 1
 
+################################################################################
+def get_overpass_data_list(queries, bbox, server_code=None):
+    # Answers to a list of queries (0 for those which failed), in order.
+    for query in queries:
+        UI.vprint(1, "    * Downloading OSM data for", query)
+    if overpass_max_parallel <= 1 or len(queries) <= 1:
+        responses = []
+        for query in queries:
+            responses.append(get_overpass_data(query, bbox, server_code))
+            if UI.red_flag:
+                break
+        return responses
+    responses = [0] * len(queries)
+    overpass_queue = queue.Queue()
+    for (i, query) in enumerate(queries):
+        overpass_queue.put((i, query))
+    PARALLEL.parallel_execute(
+        store_overpass_data,
+        overpass_queue,
+        min(overpass_max_parallel, len(queries)),
+        backend="thread",
+        common_args=(responses, bbox, server_code),
+    )
+    return responses
+
+################################################################################
+def store_overpass_data(responses, bbox, server_code, i, query):
+    responses[i] = get_overpass_data(query, bbox, server_code)
+    return 1
+
 ################################################################################
 def get_overpass_data(query, bbox, server_code=None):
     tentative = 1
     while True:
-        s = requests.Session()
-        true_server_code = server_code
-        if not server_code:
-            true_server_code = (
-                random.choice(list(overpass_servers.keys()))
-                if overpass_server_choice == "random"
-                else overpass_server_choice
-            )
-        base_url = overpass_servers[true_server_code]
+        true_server_code = choose_overpass_server(server_code)
+        base_url = (
+            overpass_custom_url
+            if true_server_code == custom_overpass_server
+            else overpass_servers[true_server_code]
+        )
         if isinstance(query, str):
             overpass_query = query + str(bbox) + ";"
         else:  # query is a tuple
             overpass_query = "".join([x + str(bbox) + ";" for x in query])
         url = base_url + "?data=(" + overpass_query + ");(._;>>;);out meta;"
         UI.vprint(3, url)
+        if not overpass_token():
+            return 0
+        s = HTTP.get_session(base_url)
         try:
             r = s.get(url, timeout=60)
             UI.vprint(3, "OSM response status :", r)
@@ -558,6 +827,7 @@ def get_overpass_data(query, bbox, server_code=None):
                         "sec...",
                     )
                 else:
+                    report_overpass_server(true_server_code, True)
                     break
             else:
                 UI.vprint(
@@ -569,6 +839,7 @@ def get_overpass_data(query, bbox, server_code=None):
                     "sec...",
                 )
         except:
+            HTTP.reset_session(base_url, s)
             UI.vprint(
                 1,
                 "        OSM server",
@@ -577,6 +848,7 @@ def get_overpass_data(query, bbox, server_code=None):
                 2 ** tentative,
                 "sec...",
             )
+        report_overpass_server(true_server_code, False)
         if tentative >= max_osm_tentatives:
             return 0
         if UI.red_flag:
@@ -585,6 +857,56 @@ def get_overpass_data(query, bbox, server_code=None):
         tentative += 1
     return r.content
 
+################################################################################
+def choose_overpass_server(server_code=None):
+    if overpass_custom_url:
+        return custom_overpass_server
+    if server_code:
+        return server_code
+    if overpass_server_choice != "random":
+        return overpass_server_choice
+    now = time.time()
+    with _overpass_lock:
+        candidates = [
+            code
+            for code in overpass_servers
+            if _overpass_health.get(code, (0, 0))[1] <= now
+        ]
+        if not candidates:
+            # all of them failed recently, take the one back first
+            return min(
+                overpass_servers,
+                key=lambda code: _overpass_health.get(code, (0, 0))[1],
+            )
+    return random.choice(candidates)
+
+################################################################################
+def report_overpass_server(server_code, success):
+    with _overpass_lock:
+        if success:
+            _overpass_health.pop(server_code, None)
+            return
+        failures = _overpass_health.get(server_code, (0, 0))[0] + 1
+        cooldown = min(
+            overpass_cooldown * 2 ** (failures - 1), overpass_max_cooldown
+        )
+        _overpass_health[server_code] = (failures, time.time() + cooldown)
+
+################################################################################
+def overpass_token():
+    # Waits for the shared rate limiter, False if interrupted meanwhile.
+    global _overpass_bucket
+    with _overpass_lock:
+        if _overpass_bucket is None or (
+            _overpass_bucket.rate,
+            _overpass_bucket.burst,
+        ) != (overpass_requests_per_sec, max(1, overpass_burst)):
+            _overpass_bucket = HTTP.token_bucket(
+                overpass_requests_per_sec, overpass_burst
+            )
+        bucket = _overpass_bucket
+    return bucket.acquire(lambda: UI.red_flag)
+
 ################################################################################
 def OSM_to_MultiLineString(
     osm_layer, lat, lon, tags_for_exclusion=set(), filter=None
@@ -608,13 +930,7 @@ def OSM_to_MultiLineString(
             done += 1
             continue
         way = numpy.round(
-            numpy.array(
-                [
-                    osm_layer.dicosmn[nodeid]
-                    for nodeid in osm_layer.dicosmw[wayid]
-                ],
-                dtype=numpy.float64,
-            )
+            osm_layer.way_coords(wayid)
             - numpy.array([[lon, lat]], dtype=numpy.float64),
             7,
         )
@@ -660,13 +976,7 @@ def OSM_to_MultiPolygon(osm_layer, lat, lon, filter=None):
             done += 1
             continue
         way = numpy.round(
-            numpy.array(
-                [
-                    osm_layer.dicosmn[nodeid]
-                    for nodeid in osm_layer.dicosmw[wayid]
-                ],
-                dtype=numpy.float64,
-            )
+            osm_layer.way_coords(wayid)
             - numpy.array([[lon, lat]], dtype=numpy.float64),
             7,
         )
@@ -698,10 +1008,7 @@ def OSM_to_MultiPolygon(osm_layer, lat, lon, filter=None):
             multiout = [
                 geometry.Polygon(
                     numpy.round(
-                        numpy.array(
-                            [osm_layer.dicosmn[nodeid] for nodeid in nodelist],
-                            dtype=numpy.float64,
-                        )
+                        osm_layer.node_coords(nodelist)
                         - numpy.array([lon, lat], dtype=numpy.float64),
                         7,
                     )
@@ -714,10 +1021,7 @@ def OSM_to_MultiPolygon(osm_layer, lat, lon, filter=None):
             multiin = [
                 geometry.Polygon(
                     numpy.round(
-                        numpy.array(
-                            [osm_layer.dicosmn[nodeid] for nodeid in nodelist],
-                            dtype=numpy.float64,
-                        )
+                        osm_layer.node_coords(nodelist)
                         - numpy.array([lon, lat], dtype=numpy.float64),
                         7,
                     )
@@ -2,14 +2,18 @@ import time
 import os
 import shutil
 import sys
+import struct
 import subprocess
 import O4_File_Names as FNAMES
 import O4_UI_Utils as UI
+import O4_Trace_Utils as TRACE
+import O4_DSF_IO as DSFIO
 
 # the following is meant to be modified directly by users who need it (in the 
 # config window, not here!)
 ovl_exclude_pol = [0]
 ovl_exclude_net = []
+ovl_keep_objects = False
 
 # the following is meant to be modified by the CFG module at run time
 custom_overlay_src = ""
@@ -25,9 +29,76 @@ else:
     unzip_cmd = "7z"
     dsftool_cmd = os.path.join(FNAMES.Utils_dir, "lin", "DSFTool ")
 
+# The overlay is extracted in-process from the binary DSF (see O4_DSF_IO),
+# DSFTool and 7z are only used for the files this fails with.
+native_extraction = True
+
 ################################################################################
+def excluded_polygons(pol_dict):
+    # indices of the polygon definitions (pol_dict: index -> name) matched by
+    # ovl_exclude_pol
+    excluded = set()
+    for item in ovl_exclude_pol:
+        if isinstance(item, int):
+            excluded.add(item)
+        elif isinstance(item, str):
+            if item and item[0] == "!":
+                excluded.update(
+                    k for k in pol_dict if item[1:] not in pol_dict[k]
+                )
+            else:
+                excluded.update(k for k in pol_dict if item in pol_dict[k])
+    return excluded
+
+
+def excluded_road_subtypes():
+    if "" in ovl_exclude_net or "*" in ovl_exclude_net:
+        return set(range(256))
+    return {item for item in ovl_exclude_net if isinstance(item, int)}
+
+
+################################################################################
+def extract_overlay(file_name, dest_file):
+    """
+    In-process counterpart of the DSFTool route of build_overlay. Returns
+    False (with a message) if the file could not be handled that way.
+    """
+    try:
+        atoms = DSFIO.read_dsf_atoms(DSFIO.read_dsf_file(file_name))
+        definitions = dict(DSFIO.iter_atoms(dict(atoms)[b"NFED"]))
+        pol_dict = dict(
+            enumerate(DSFIO.split_strings(definitions.get(b"YLOP", b"")))
+        )
+        for (pol_type, name) in pol_dict.items():
+            UI.vprint(2 if "facade" not in name else 3, pol_type, ":", name)
+        UI.vprint(1, "-> Selecting overlays for copy/paste")
+        os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+        kept = DSFIO.write_overlay_dsf(
+            atoms,
+            dest_file + ".tmp",
+            excluded_polygons(pol_dict),
+            excluded_road_subtypes(),
+            ovl_keep_objects,
+        )
+        os.replace(dest_file + ".tmp", dest_file)
+    except (OSError, ValueError, KeyError, IndexError, struct.error) as e:
+        UI.vprint(
+            1,
+            "   Could not extract it in-process (" + str(e) + "),",
+            "using DSFTool instead.",
+        )
+        try:
+            os.remove(dest_file + ".tmp")
+        except OSError:
+            pass
+        return False
+    UI.vprint(2, "  ", kept, "overlay commands kept.")
+    return True
+
+################################################################################
+@TRACE.traced("build_overlay", latlon_args=True)
 def build_overlay(lat, lon):
-    if UI.is_working:
+    if UI.is_busy():
         return 0
     UI.is_working = 1
     timer = time.time()
@@ -57,6 +128,17 @@ def build_overlay(lat, lon):
             "in the config window first.",
         )
         return 0
+    dest_file = os.path.join(
+        FNAMES.Overlay_dir,
+        "Earth nav data",
+        FNAMES.round_latlon(lat, lon),
+        FNAMES.short_latlon(lat, lon) + ".dsf",
+    )
+    if native_extraction and extract_overlay(file_to_sniff, dest_file):
+        UI.vprint(1, "-> Final overlay DSF written in " + dest_file)
+        TRACE.wrote(dest_file)
+        UI.timings_and_bottom_line(timer)
+        return 1
     file_to_sniff_loc = os.path.join(
         FNAMES.Tmp_dir, FNAMES.short_latlon(lat, lon) + ".dsf"
     )
@@ -117,7 +199,7 @@ def build_overlay(lat, lon):
     pol_type = 0
     pol_dict = {}
     exclude_set_updated = False
-    full_ovl_exclude_pol = set(ovl_exclude_pol)
+    full_ovl_exclude_pol = set()
     while line:
         if "PROPERTY" in line:
             g.write(line)
@@ -129,23 +211,11 @@ def build_overlay(lat, lon):
             g.write(line)
         elif "NETWORK_DEF" in line:
             g.write(line)
+        elif ovl_keep_objects and line.startswith("OBJECT"):
+            g.write(line)
         elif "BEGIN_POLYGON" in line:
             if not exclude_set_updated:
-                tmp = set()
-                for item in full_ovl_exclude_pol:
-                    if isinstance(item, int):
-                        tmp.add(item)
-                    elif isinstance(item, str):
-                        if item and item[0] == "!":
-                            item = item[1:]
-                            tmp = tmp.union(
-                                [k for k in pol_dict if item not in pol_dict[k]]
-                            )
-                        else:
-                            tmp = tmp.union(
-                                [k for k in pol_dict if item in pol_dict[k]]
-                            )
-                full_ovl_exclude_pol = tmp
+                full_ovl_exclude_pol = excluded_polygons(pol_dict)
                 exclude_set_updated = True
             pol_type = int(line.split()[1])
             if pol_type not in full_ovl_exclude_pol:
@@ -215,6 +285,7 @@ def build_overlay(lat, lon):
         ),
         os.path.join(dest_dir, FNAMES.short_latlon(lat, lon) + ".dsf"),
     )
+    TRACE.wrote(os.path.join(dest_dir, FNAMES.short_latlon(lat, lon) + ".dsf"))
     os.remove(
         os.path.join(
             FNAMES.Tmp_dir,
@@ -1,14 +1,26 @@
+import concurrent.futures
+import multiprocessing
+import pickle
+import sys
 import threading
 import O4_UI_Utils as UI
+import O4_Trace_Utils as TRACE
+
+# Backends for parallel_execute / parallel_launch : "thread" is the right
+# choice for IO bound tasks (downloads), "process" for CPU bound ones which
+# would otherwise be serialized by the GIL. A process task must be a module
+# level function, and its arguments must be picklable.
+default_backend = "thread"
 
 ################################################################################
 class parallel_worker(threading.Thread):
-    def __init__(self, task, queue, progress=None, success=[1]):
+    def __init__(self, task, queue, progress=None, success=[1], common_args=()):
         threading.Thread.__init__(self)
         self._task = task
         self._queue = queue
         self._progress = progress
         self._success = success
+        self._common_args = common_args
 
     def run(self):
         while True:
@@ -19,7 +31,9 @@ class parallel_worker(threading.Thread):
                 except:
                     pass
                 return 1
-            self._success[0] = self._task(*args) and self._success[0]
+            self._success[0] = (
+                self._task(*self._common_args, *args) and self._success[0]
+            )
             if self._progress:
                 self._progress["done"] += 1
                 UI.progress_bar(
@@ -34,14 +48,222 @@ class parallel_worker(threading.Thread):
                 return 0
 
 ################################################################################
-def parallel_execute(task, queue, nbr_workers, progress=None):
+
+################################################################################
+# Process backend. A single dispatcher thread in the main process consumes the
+# queue and feeds a pool of nbr_workers processes, so that callers keep the
+# same queue based interface. UI.red_flag is forwarded to the workers through
+# a multiprocessing Event, tasks can therefore keep on checking UI.red_flag
+# for cooperative cancellation. The messages of UI.vprint and UI.lvprint in
+# the workers come back with the results of their tasks, and are printed by
+# the main process (hence in the GUI log and the log file as usual), so do
+# the bytes they counted for the build traces.
+################################################################################
+_process_task = None
+_process_common_args = ()
+_process_messages = []
+
+
+def _process_vprint(min_verbosity, *args):
+    _process_messages.append(
+        ("vprint", min_verbosity, tuple(str(arg) for arg in args))
+    )
+
+
+def _process_lvprint(min_verbosity, *args):
+    _process_messages.append(
+        ("lvprint", min_verbosity, tuple(str(arg) for arg in args))
+    )
+
+
+def _process_initializer(task, common_args, stop_event, trace_builds):
+    global _process_task, _process_common_args
+    _process_task = task
+    _process_common_args = common_args
+    TRACE.trace_builds = trace_builds
+    TRACE.take_bytes()
+    # a forked worker must not touch the Tk widgets of its parent
+    UI.gui = None
+    sys.stdout = sys.__stdout__
+    UI.vprint = _process_vprint
+    UI.lvprint = _process_lvprint
+    UI.red_flag = False
+
+    def watch_stop_event():
+        stop_event.wait()
+        UI.red_flag = True
+
+    threading.Thread(target=watch_stop_event, daemon=True).start()
+
+
+def _process_run(args):
+    # (result, messages, byte counts, error)
+    del _process_messages[:]
+    try:
+        result = _process_task(*_process_common_args, *args)
+    except Exception as e:
+        return (0, list(_process_messages), TRACE.take_bytes(), str(e))
+    return (result, list(_process_messages), TRACE.take_bytes(), None)
+
+
+class parallel_process_dispatcher(threading.Thread):
+    def __init__(self, task, queue, nbr_workers, progress=None, success=[1],
+                 common_args=()):
+        threading.Thread.__init__(self)
+        self._task = task
+        self._queue = queue
+        self._nbr_workers = nbr_workers
+        self._progress = progress
+        self._success = success
+        self._common_args = common_args
+
+    def _collect(self, futures):
+        for future in futures:
+            try:
+                (result, messages, counts, error) = future.result()
+            except concurrent.futures.CancelledError:
+                continue
+            except Exception as e:
+                (result, messages, counts, error) = (0, [], {}, e)
+            for (kind, min_verbosity, args) in messages:
+                getattr(UI, kind)(min_verbosity, *args)
+            for (kind, nbytes) in counts.items():
+                TRACE.add_bytes(kind, nbytes)
+            if error is not None:
+                UI.vprint(1, "   Parallel task failed:", error)
+                result = 0
+            self._success[0] = result and self._success[0]
+            if self._progress:
+                self._progress["done"] += 1
+                UI.progress_bar(
+                    self._progress["bar"],
+                    int(
+                        100
+                        * self._progress["done"]
+                        / (self._progress["done"] + self._queue.qsize())
+                    ),
+                )
+
+    def _wait(self, pending, return_when):
+        # wait with an eye on red_flag, returns False when interrupted
+        while pending:
+            (done, not_done) = concurrent.futures.wait(
+                pending, timeout=0.5, return_when=return_when
+            )
+            self._collect(done)
+            pending.clear()
+            pending.update(not_done)
+            if UI.red_flag:
+                return False
+            if done and return_when == concurrent.futures.FIRST_COMPLETED:
+                break
+        return True
+
+    def _run_threads(self, nbr_workers):
+        # fallback when the worker processes cannot be started, the threads
+        # consume the rest of the queue, one of its remaining "quit" each
+        workers = []
+        for _ in range(nbr_workers):
+            worker = parallel_worker(self._task, self._queue, self._progress,
+                                     self._success, self._common_args)
+            worker.start()
+            workers.append(worker)
+        parallel_join(workers)
+
+    def run(self):
+        stop_event = multiprocessing.Event()
+        try:
+            pool = concurrent.futures.ProcessPoolExecutor(
+                self._nbr_workers,
+                initializer=_process_initializer,
+                initargs=(
+                    self._task,
+                    self._common_args,
+                    stop_event,
+                    TRACE.trace_builds,
+                ),
+            )
+        except Exception as e:
+            UI.vprint(1, "   Could not start worker processes, using threads:", e)
+            self._run_threads(self._nbr_workers)
+            return
+        pending = set()
+        quits = 0
+        interrupted = False
+        broken = False
+        while quits < self._nbr_workers:
+            args = self._queue.get()
+            if isinstance(args, str) and args == "quit":
+                quits += 1
+                continue
+            if len(pending) >= self._nbr_workers:
+                if not self._wait(pending, concurrent.futures.FIRST_COMPLETED):
+                    interrupted = True
+                    break
+            if UI.red_flag:
+                interrupted = True
+                break
+            # The pool only starts its processes with the first submit, this
+            # is where an unpicklable task or common_args (spawn start method)
+            # or a worker unable to start shows up.
+            try:
+                pending.add(pool.submit(_process_run, args))
+            except (
+                pickle.PicklingError,
+                concurrent.futures.process.BrokenProcessPool,
+                OSError,
+                AttributeError,
+                TypeError,
+            ) as e:
+                UI.vprint(
+                    1, "   Could not start worker processes, using threads:", e
+                )
+                broken = True
+                break
+        if broken:
+            self._collect(pending)
+            pool.shutdown(wait=True)
+            self._success[0] = (
+                self._task(*self._common_args, *args) and self._success[0]
+            )
+            if UI.red_flag:
+                return
+            self._run_threads(self._nbr_workers - quits)
+            return
+        if not interrupted:
+            interrupted = not self._wait(
+                pending, concurrent.futures.ALL_COMPLETED
+            )
+        if interrupted:
+            stop_event.set()
+            for future in pending:
+                future.cancel()
+        pool.shutdown(wait=True)
+        if interrupted:
+            self._collect(pending)
+        elif self._progress:
+            UI.progress_bar(self._progress["bar"], 100)
+
+################################################################################
+
+################################################################################
+def parallel_execute(task, queue, nbr_workers, progress=None, backend=None,
+                     common_args=()):
     workers = []
     success = [1]
     for _ in range(nbr_workers):
         queue.put("quit")
-        worker = parallel_worker(task, queue, progress, success)
+    if (backend or default_backend) == "process":
+        worker = parallel_process_dispatcher(
+            task, queue, nbr_workers, progress, success, common_args
+        )
         worker.start()
         workers.append(worker)
+    else:
+        for _ in range(nbr_workers):
+            worker = parallel_worker(task, queue, progress, success, common_args)
+            worker.start()
+            workers.append(worker)
     for worker in workers:
         worker.join()
     if UI.red_flag:
@@ -50,10 +272,18 @@ def parallel_execute(task, queue, nbr_workers, progress=None):
 
 
 ################################################################################
-def parallel_launch(task, queue, nbr_workers, progress=None):
+def parallel_launch(task, queue, nbr_workers, progress=None, backend=None,
+                    common_args=()):
     workers = []
+    if (backend or default_backend) == "process":
+        worker = parallel_process_dispatcher(
+            task, queue, nbr_workers, progress, [1], common_args
+        )
+        worker.start()
+        workers.append(worker)
+        return workers
     for _ in range(nbr_workers):
-        worker = parallel_worker(task, queue, progress)
+        worker = parallel_worker(task, queue, progress, common_args=common_args)
         worker.start()
         workers.append(worker)
     return workers
@@ -61,4 +291,4 @@ def parallel_launch(task, queue, nbr_workers, progress=None):
 ################################################################################
 def parallel_join(workers):
     for worker in workers:
-        worker.join()
\ No newline at end of file
+        worker.join()
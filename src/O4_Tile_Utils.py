@@ -1,3 +1,5 @@
+import copy
+import json
 import logging
 import os
 import time
@@ -12,13 +14,31 @@ import O4_Mesh_Utils as MESH
 import O4_Mask_Utils as MASK
 import O4_DSF_Utils as DSF
 import O4_Overlay_Utils as OVL
+import O4_Build_Cache as CACHE
+import O4_Trace_Utils as TRACE
 from O4_Parallel_Utils import parallel_launch, parallel_join
 
 max_convert_slots = 4
 skip_downloads = False
 skip_converts = False
+# Batch builds : number of tiles in progress at the same time (with more than
+# one, the steps of consecutive tiles overlap, e.g. the imagery download of a
+# tile with the mesh of the next one) and concurrency of each step.
+batch_tiles_in_flight = 1
+batch_mesh_slots = 1
+batch_mask_slots = 1
+batch_ovl_slots = 1
+# Steps 1 and 3 rely on module level state (VECT.scalx, the local combined
+# providers of IMG), only one tile at a time can go through them.
+batch_single_slot_stages = ("osm", "dsf")
+batch_state_version = 1
+# Skip the steps 1 to 2.5 whose inputs are unchanged, see O4_Build_Cache
+# (step 3 is not cached, see there why).
+build_cache = True
+step_numbers = {"osm": "1", "mesh": "2", "mask": "2.5"}
 
 ################################################################################
+@TRACE.traced("download_textures")
 def download_textures(tile, download_queue, convert_queue):
     UI.vprint(1, "-> Opening download queue.")
     done = 0
@@ -41,11 +61,12 @@ def download_textures(tile, download_queue, convert_queue):
     return 1
 
 ################################################################################
+@TRACE.traced("build_tile")
 def build_tile(tile):
-    if UI.is_working:
+    if UI.is_busy():
         return 0
     UI.is_working = 1
-    UI.red_flag = False
+    UI.clear_red_flag()
     UI.logprint(
         "Step 3 for tile lat=", tile.lat, ", lon=", tile.lon, ": starting."
     )
@@ -183,6 +204,14 @@ def build_tile(tile):
             os.remove(FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon))
         except:
             pass
+        try:
+            os.remove(
+                FNAMES.mesh_bin_file(
+                    FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)
+                )
+            )
+        except:
+            pass
         try:
             os.remove(FNAMES.apt_file(tile))
         except:
@@ -197,15 +226,15 @@ def build_tile(tile):
 
 ################################################################################
 def build_all(tile):
-    VMAP.build_poly_file(tile)
+    cached_step("osm", tile, VMAP.build_poly_file)
     if UI.red_flag:
         UI.exit_message_and_bottom_line("")
         return 0
-    MESH.build_mesh(tile)
+    cached_step("mesh", tile, MESH.build_mesh)
     if UI.red_flag:
         UI.exit_message_and_bottom_line("")
         return 0
-    MASK.build_masks(tile)
+    cached_step("mask", tile, MASK.build_masks)
     if UI.red_flag:
         UI.exit_message_and_bottom_line("")
         return 0
@@ -216,72 +245,247 @@ def build_all(tile):
     UI.is_working = 0
     return 1
 
+################################################################################
+def cached_step(stage, tile, step):
+    # Runs step(tile) unless its inputs did not change since it last
+    # completed for this tile.
+    if not build_cache or not CACHE.is_cacheable(stage, tile):
+        return step(tile)
+    cache = CACHE.build_cache(tile)
+    if cache.is_up_to_date(stage):
+        UI.lvprint(
+            1,
+            "Step",
+            step_numbers[stage],
+            "for tile",
+            FNAMES.short_latlon(tile.lat, tile.lon),
+            "skipped, its inputs did not change since it was last completed.",
+        )
+        return 1
+    cache.begin(stage)
+    result = step(tile)
+    if result and not UI.red_flag:
+        cache.record(stage)
+    return result
+
 ################################################################################
 def build_tile_list(
-    tile, list_lat_lon, do_osm, do_mesh, do_mask, do_dsf, do_ovl, override_cfg
+    tile,
+    list_lat_lon,
+    do_osm,
+    do_mesh,
+    do_mask,
+    do_dsf,
+    do_ovl,
+    override_cfg,
+    tile_overrides=None,
+    state_file=None,
+    report_file=None,
 ):
+    # tile_overrides : optional {(lat, lon): {var: value}} applied to the
+    # tile configs once read. state_file : where the job state is kept for
+    # resuming. report_file : if given, receives a JSON report (status and
+    # timings of each tile) at the end of the batch, see batch_state.report.
     if UI.is_working:
         return 0
     UI.red_flag = 0
+    UI.is_working = True
+    UI.batch_running = True
+    try:
+        return run_tile_list(
+            tile,
+            list_lat_lon,
+            (do_osm, do_mesh, do_mask, do_dsf, do_ovl),
+            override_cfg,
+            tile_overrides or {},
+            state_file,
+            report_file,
+        )
+    finally:
+        UI.batch_running = False
+        UI.is_working = False
+
+
+################################################################################
+def run_tile_list(
+    tile,
+    list_lat_lon,
+    todo,
+    override_cfg,
+    tile_overrides,
+    state_file,
+    report_file,
+):
+    (do_osm, do_mesh, do_mask, do_dsf, do_ovl) = todo
     timer = time.time()
     UI.lvprint(
         0, "Batch build launched for a number of", len(list_lat_lon), "tiles."
     )
-    k = 0
-    for (lat, lon) in list_lat_lon:
-        k += 1
-        UI.vprint(
-            1,
-            "Dealing with tile ",
-            k,
-            "/",
-            len(list_lat_lon),
-            ":",
-            FNAMES.short_latlon(lat, lon),
+    stages = [
+        stage
+        for (stage, todo) in (
+            ("osm", do_osm),
+            ("mesh", do_mesh),
+            ("mask", do_mask),
+            ("dsf", do_dsf),
+            ("ovl", do_ovl),
         )
-        (tile.lat, tile.lon) = (lat, lon)
-        tile.build_dir = FNAMES.build_dir(
-            tile.lat, tile.lon, tile.custom_build_dir
+        if todo
+    ]
+    state = batch_state(
+        list_lat_lon,
+        stages,
+        tile.custom_build_dir,
+        override_cfg,
+        tile_overrides,
+        state_file,
+    )
+    nbr_tiles = len(list_lat_lon)
+    finished = [len(state.done[k]) == len(stages) for k in range(nbr_tiles)]
+    if any(finished):
+        UI.lvprint(
+            0,
+            "Resuming an interrupted batch,",
+            sum(finished),
+            "tiles were already done (delete",
+            state.file_name,
+            "to start afresh).",
         )
-        tile.dem = None
-        if override_cfg:
-            tile.read_from_config(use_global=True)
-        else:
-            tile.read_from_config()
-        if do_osm or do_mesh or do_dsf:
-            tile.make_dirs()
-        if do_osm:
-            VMAP.build_poly_file(tile)
-            if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
-        if do_mesh:
-            MESH.build_mesh(tile)
-            if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
-        if do_mask:
-            MASK.build_masks(tile)
-            if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
-        if do_dsf:
-            build_tile(tile)
-            if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
-        if do_ovl:
-            OVL.build_overlay(lat, lon)
-            if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
+    stage_slots = {
+        "mesh": batch_mesh_slots,
+        "mask": batch_mask_slots,
+        "ovl": batch_ovl_slots,
+    }
+    slots = {
+        stage: 1
+        if stage in batch_single_slot_stages
+        else max(1, stage_slots.get(stage, 1))
+        for stage in stages
+    }
+    busy = {stage: 0 for stage in stages}
+    tiles = [None] * nbr_tiles
+    running = [None] * nbr_tiles
+    in_flight = []
+    to_admit = [k for k in range(nbr_tiles) if not finished[k]]
+    condition = threading.Condition()
+
+    def finish(k):
+        # called with the condition held
+        finished[k] = True
+        in_flight.remove(k)
+        tiles[k] = None
+        if state.failed[k]:
+            return
         try:
             UI.gui.earth_window.canvas.delete(
-                UI.gui.earth_window.dico_tiles_todo[(lat, lon)]
+                UI.gui.earth_window.dico_tiles_todo[list_lat_lon[k]]
             )
-            UI.gui.earth_window.dico_tiles_todo.pop((lat, lon), None)
+            UI.gui.earth_window.dico_tiles_todo.pop(list_lat_lon[k], None)
         except:
             pass
+
+    def runnable(k, stage):
+        # A mask step reads the meshes of the neighbouring tiles, which
+        # must therefore not be rebuilt under its feet: the mesh of a tile
+        # waits for the masks of the neighbours that precede it in the list.
+        # This is the order of a sequential batch, hence the same result.
+        if busy[stage] >= slots[stage]:
+            return False
+        if stage == "mesh" and "mask" in stages:
+            (lat, lon) = list_lat_lon[k]
+            for j in range(k):
+                (other_lat, other_lon) = list_lat_lon[j]
+                if abs(other_lat - lat) > 1 or abs(other_lon - lon) > 1:
+                    continue
+                if not (
+                    "mask" in state.done[j] or state.failed[j] or finished[j]
+                ):
+                    return False
+        return True
+
+    def run_step(k, stage):
+        step_timer = time.time()
+        result = batch_step(stage, tiles[k])
+        with condition:
+            state.timings[k][stage] = round(time.time() - step_timer, 3)
+            busy[stage] -= 1
+            running[k] = None
+            # A failed step ends its tile, the next steps would read its
+            # missing or partial output.
+            if result:
+                state.done[k].append(stage)
+            elif not UI.red_flag:
+                state.failed[k] = stage
+            if state.failed[k] or len(state.done[k]) == len(stages):
+                finish(k)
+            state.save()
+            condition.notify()
+
+    with condition:
+        while True:
+            stop = bool(UI.red_flag)
+            while (
+                not stop
+                and to_admit
+                and len(in_flight) < max(1, batch_tiles_in_flight)
+            ):
+                k = to_admit.pop(0)
+                (lat, lon) = list_lat_lon[k]
+                UI.vprint(
+                    1,
+                    "Dealing with tile ",
+                    k + 1,
+                    "/",
+                    nbr_tiles,
+                    ":",
+                    FNAMES.short_latlon(lat, lon),
+                )
+                in_flight.append(k)
+                tiles[k] = batch_tile(
+                    tile,
+                    lat,
+                    lon,
+                    override_cfg,
+                    do_osm or do_mesh or do_dsf,
+                    tile_overrides.get((lat, lon)),
+                )
+                if not tiles[k]:
+                    state.failed[k] = stages[len(state.done[k])]
+                    finish(k)
+                    state.save()
+            for k in in_flight:
+                if stop or running[k]:
+                    continue
+                stage = stages[len(state.done[k])]
+                if not runnable(k, stage):
+                    continue
+                busy[stage] += 1
+                running[k] = stage
+                threading.Thread(target=run_step, args=[k, stage]).start()
+            if not any(running) and (stop or not in_flight):
+                break
+            condition.wait(1)
+    UI.batch_running = False
+    UI.is_working = False
+    if report_file:
+        state.write_report(
+            report_file, bool(UI.red_flag), time.time() - timer, IMG.errors
+        )
+    if UI.red_flag:
+        UI.exit_message_and_bottom_line()
+        return 0
+    failed = [
+        FNAMES.short_latlon(*list_lat_lon[k]) + " (" + state.failed[k] + ")"
+        for k in range(nbr_tiles)
+        if state.failed[k]
+    ]
+    if failed:
+        UI.lvprint(
+            0, "\nERROR: The following tiles could not be completed:",
+            ", ".join(failed),
+        )
+    else:
+        state.remove()
     UI.lvprint(
         0, "Batch process completed in", UI.nicer_timer(time.time() - timer)
     )
@@ -297,6 +501,171 @@ def build_tile_list(
         )
     return 1
 
+################################################################################
+def batch_tile(template, lat, lon, override_cfg, make_dirs, overrides=None):
+    # Each tile of a batch gets its own Tile object since several of them
+    # can be in progress at the same time.
+    dem = template.dem
+    template.dem = None
+    try:
+        tile = copy.deepcopy(template)
+    finally:
+        template.dem = dem
+    (tile.lat, tile.lon) = (lat, lon)
+    tile.build_dir = FNAMES.build_dir(lat, lon, tile.custom_build_dir)
+    if override_cfg:
+        tile.read_from_config(use_global=True)
+    else:
+        tile.read_from_config()
+    for (var, value) in (overrides or {}).items():
+        setattr(tile, var, value)
+    if make_dirs:
+        try:
+            tile.make_dirs()
+        except:
+            return None
+    return tile
+
+################################################################################
+def batch_step(stage, tile):
+    UI.batch_thread.active = True
+    try:
+        if stage == "osm":
+            return cached_step(stage, tile, VMAP.build_poly_file)
+        elif stage == "mesh":
+            return cached_step(stage, tile, MESH.build_mesh)
+        elif stage == "mask":
+            return cached_step(stage, tile, MASK.build_masks)
+        elif stage == "dsf":
+            return build_tile(tile)
+        elif stage == "ovl":
+            return OVL.build_overlay(tile.lat, tile.lon)
+    except Exception as e:
+        UI.lvprint(
+            0,
+            "ERROR: Step",
+            stage,
+            "failed for tile",
+            FNAMES.short_latlon(tile.lat, tile.lon),
+            ":",
+            e,
+        )
+        return 0
+
+################################################################################
+class batch_state:
+    """
+    On-disk job state of a batch build : the steps completed by each tile
+    (and the one which failed, if any) and how long they took. It is
+    rewritten after each step so that an interrupted batch can be resumed,
+    and its content only depends on the steps done, not on the order in which
+    concurrent steps completed.
+    """
+
+    def __init__(
+        self,
+        list_lat_lon,
+        stages,
+        custom_build_dir,
+        override_cfg,
+        tile_overrides=None,
+        file_name=None,
+    ):
+        self.file_name = file_name or FNAMES.batch_state_file()
+        self.list_lat_lon = list(list_lat_lon)
+        self.job = {
+            "version": batch_state_version,
+            "custom_build_dir": custom_build_dir,
+            "override_cfg": bool(override_cfg),
+            "stages": list(stages),
+            "tiles": [[lat, lon] for (lat, lon) in list_lat_lon],
+        }
+        if tile_overrides:
+            self.job["overrides"] = {
+                FNAMES.short_latlon(lat, lon): overrides
+                for ((lat, lon), overrides) in sorted(tile_overrides.items())
+            }
+        self.done = [[] for _ in list_lat_lon]
+        self.failed = [None for _ in list_lat_lon]
+        self.timings = [{} for _ in list_lat_lon]
+        try:
+            with open(self.file_name, "r") as f:
+                previous = json.load(f)
+            if previous["job"] == self.job:
+                # failed steps are tried again
+                self.done = previous["done"]
+                self.timings = previous.get("timings", self.timings)
+        except:
+            pass
+
+    def save(self):
+        try:
+            if not os.path.isdir(os.path.dirname(self.file_name)):
+                os.makedirs(os.path.dirname(self.file_name))
+            with open(self.file_name + ".tmp", "w") as f:
+                json.dump(
+                    {
+                        "job": self.job,
+                        "done": self.done,
+                        "failed": self.failed,
+                        "timings": self.timings,
+                    },
+                    f,
+                    indent=1,
+                )
+            os.replace(self.file_name + ".tmp", self.file_name)
+        except Exception as e:
+            UI.vprint(2, "Could not save the batch state:", e)
+
+    def remove(self):
+        try:
+            os.remove(self.file_name)
+        except:
+            pass
+
+    def report(self, interrupted, elapsed, imagery_errors=()):
+        # status of a tile : "done", "failed" (at step failed_step) or
+        # "incomplete" (batch interrupted before all its steps were done)
+        tiles = []
+        for (k, (lat, lon)) in enumerate(self.list_lat_lon):
+            if self.failed[k]:
+                status = "failed"
+            elif len(self.done[k]) == len(self.job["stages"]):
+                status = "done"
+            else:
+                status = "incomplete"
+            tiles.append(
+                {
+                    "tile": FNAMES.short_latlon(lat, lon),
+                    "lat": lat,
+                    "lon": lon,
+                    "status": status,
+                    "done": list(self.done[k]),
+                    "failed_step": self.failed[k],
+                    "timings": dict(self.timings[k]),
+                }
+            )
+        return {
+            "version": batch_state_version,
+            "stages": list(self.job["stages"]),
+            "interrupted": interrupted,
+            "elapsed": round(elapsed, 3),
+            "tiles": tiles,
+            "imagery_errors": sorted(set(imagery_errors)),
+        }
+
+    def write_report(self, file_name, *args):
+        try:
+            if os.path.dirname(file_name) and not os.path.isdir(
+                os.path.dirname(file_name)
+            ):
+                os.makedirs(os.path.dirname(file_name))
+            with open(file_name + ".tmp", "w") as f:
+                json.dump(self.report(*args), f, indent=1)
+            os.replace(file_name + ".tmp", file_name)
+        except Exception as e:
+            UI.lvprint(0, "ERROR: Could not write the batch report:", e)
+
 ################################################################################
 def remove_unwanted_textures(tile):
     texture_list = []
@@ -0,0 +1,253 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import O4_File_Names as FNAMES
+import O4_UI_Utils as UI
+
+try:
+    import resource
+except ImportError:
+    # Windows, no peak RSS then
+    resource = None
+
+################################################################################
+#
+# Lightweight tracing of the tile builds (trace_builds in the config). The
+# steps of a build and their main phases are spans (see traced) which record
+# their wall time, CPU time, the peak RSS of the process and the number of
+# bytes downloaded and written while they were open. When a step is over, the
+# spans of its tile are aggregated by path (e.g. build_mesh/write_mesh_file)
+# into the JSON profile of the tile, and the step is added to the summary of
+# all the runs (Tmp_dir/Profiles/summary.json).
+#
+# The CPU times include the child processes which returned meanwhile
+# (Triangle4XP, nvcompress, ...), and like the RSS and the byte counts they
+# are process wide : with several tiles in flight or parallel workers, a span
+# also accounts for what the others did at the same time. The wall times of
+# spans run by parallel workers add up, and may exceed the one of their step.
+#
+################################################################################
+
+# the following is meant to be modified by the CFG module at run time
+trace_builds = False
+
+_lock = threading.Lock()
+_local = threading.local()
+_counters = {"bytes_downloaded": 0, "bytes_written": 0}
+# (lat, lon) -> [step span, {path: stats}] for the steps in progress
+_steps = {}
+
+################################################################################
+def add_bytes(kind, nbytes):
+    if not trace_builds:
+        return
+    with _lock:
+        _counters[kind] += nbytes
+
+
+def take_bytes():
+    # the byte counts since the last call, for the worker processes which
+    # hand them over to the main one (see O4_Parallel_Utils)
+    with _lock:
+        counts = dict(_counters)
+        for kind in _counters:
+            _counters[kind] = 0
+    return counts
+
+
+def wrote(file_name):
+    # to be called once an output file is written
+    if not trace_builds:
+        return
+    try:
+        add_bytes("bytes_written", os.path.getsize(file_name))
+    except OSError:
+        pass
+
+
+def count_download(response, *args, **kwargs):
+    # response hook of the HTTP sessions
+    if trace_builds:
+        add_bytes("bytes_downloaded", len(response.content))
+
+
+################################################################################
+def peak_rss():
+    # (self, children) in bytes, None where unknown
+    if resource is None:
+        return (None, None)
+    scale = 1 if sys.platform == "darwin" else 1024
+    return tuple(
+        resource.getrusage(who).ru_maxrss * scale
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    )
+
+
+def snapshot():
+    times = os.times()
+    cpu = times.user + times.system + times.children_user
+    cpu += times.children_system
+    with _lock:
+        counters = dict(_counters)
+    return (time.perf_counter(), cpu, counters)
+
+
+def tile_key(args, latlon_args):
+    # the tile a call is about : its first argument with lat and lon
+    # attributes, or its two first ones with latlon_args
+    if latlon_args:
+        return tuple(args[:2]) if len(args) >= 2 else None
+    for arg in args:
+        if hasattr(arg, "lat") and hasattr(arg, "lon"):
+            return (arg.lat, arg.lon)
+    return None
+
+
+################################################################################
+
+################################################################################
+class span:
+    """
+    Context manager timing a part of a build, a no-op unless trace_builds.
+    A span with a tile opens a step if none is in progress for that tile,
+    the spans of the same tile opened meanwhile (in any thread) are then part
+    of the step. Spans without a tile belong to the one of their parent.
+    """
+
+    def __init__(self, name, key=None):
+        self.name = name
+        self.key = key
+        self.active = False
+
+    def __enter__(self):
+        if not trace_builds:
+            return self
+        self.active = True
+        stack = _local.__dict__.setdefault("stack", [])
+        parent = stack[-1] if stack else None
+        if self.key is None and parent:
+            self.key = parent.key
+        with _lock:
+            step = _steps.get(self.key)
+            self.is_step = self.key is not None and step is None
+            if self.is_step:
+                _steps[self.key] = [self, {}]
+        if parent and parent.key == self.key:
+            self.path = parent.path + "/" + self.name
+        elif step:
+            # worker threads of the step
+            self.path = step[0].path + "/" + self.name
+        else:
+            self.path = self.name
+        stack.append(self)
+        self.start = snapshot()
+        return self
+
+    def __exit__(self, *args):
+        if not self.active:
+            return False
+        _local.stack.pop()
+        (wall, cpu, counters) = snapshot()
+        (rss, rss_children) = peak_rss()
+        stats = {
+            "count": 1,
+            "wall": wall - self.start[0],
+            "cpu": cpu - self.start[1],
+            "peak_rss": rss,
+            "peak_rss_children": rss_children,
+        }
+        for kind in counters:
+            stats[kind] = counters[kind] - self.start[2][kind]
+        with _lock:
+            step = _steps.get(self.key)
+            if step:
+                merge_stats(step[1].setdefault(self.path, {}), stats)
+            if self.is_step:
+                del _steps[self.key]
+        if self.is_step:
+            try:
+                save_profile(self.key, self.name, step[1])
+            except Exception as e:
+                UI.vprint(2, "   Could not save the build profile:", e)
+        return False
+
+
+################################################################################
+def traced(name, latlon_args=False):
+    """
+    Decorator making a span of each call of a function, whose tile is found
+    from its arguments (see tile_key).
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not trace_builds:
+                return func(*args, **kwargs)
+            with span(name, tile_key(args, latlon_args)):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+################################################################################
+
+################################################################################
+def merge_stats(total, stats):
+    for (item, value) in stats.items():
+        if value is None:
+            total.setdefault(item, None)
+        elif item.startswith("peak"):
+            total[item] = max(total.get(item) or 0, value)
+        else:
+            total[item] = total.get(item, 0) + value
+
+
+def load_json(file_name):
+    try:
+        with open(file_name, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def dump_json(file_name, data):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name + ".tmp", "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(file_name + ".tmp", file_name)
+
+
+def save_profile(key, step_name, spans):
+    (lat, lon) = key
+    with _lock:
+        file_name = FNAMES.profile_file(lat, lon)
+        profile = load_json(file_name)
+        profile.setdefault("steps", {})[step_name] = {
+            "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "spans": spans,
+        }
+        dump_json(file_name, profile)
+        file_name = FNAMES.profile_summary_file()
+        summary = load_json(file_name)
+        stats = dict(spans[step_name])
+        stats["runs"] = stats.pop("count")
+        merge_stats(summary.setdefault("steps", {}).setdefault(step_name, {}),
+                    stats)
+        tiles = summary.setdefault("tiles", {})
+        tiles[FNAMES.short_latlon(lat, lon)] = (
+            tiles.get(FNAMES.short_latlon(lat, lon), 0) + 1
+        )
+        dump_json(file_name, summary)
+    UI.vprint(
+        2,
+        "   Build profile of",
+        step_name,
+        "saved in",
+        FNAMES.profile_file(lat, lon),
+    )
@@ -0,0 +1,100 @@
+import warnings
+import numpy
+
+################################################################################
+#
+# Array based readers and writers for the text files exchanged with Triangle
+# (and Triangle4XP) : .node, .ele and the segments section of .poly files.
+# Each of these is a header line, one line per item starting with its index,
+# and possibly trailing "#" comment lines. Triangle has no binary variant of
+# them that Triangle4XP would read, so the text format is kept as is and only
+# the conversion to and from it is done in bulk.
+#
+################################################################################
+
+# Lines formatted at once by the writers, bounds the size of the temporary
+# strings.
+rows_per_chunk = 100000
+
+################################################################################
+def read_table(file_name, dtype=numpy.float64):
+    """
+    Returns (header, table, trailer) : the header line, the (n, k) array of
+    the values of the n items without their index column, and the trailing
+    comment lines. The number of values per item is the one of the header
+    (1 + the sum of its fields after the first, for .node as for .ele files)
+    and the items must be numbered consecutively, as Triangle does. Raises
+    ValueError otherwise or on anything else than numbers.
+    """
+    with open(file_name, "r") as f:
+        text = f.read()
+    header_end = text.index("\n") + 1
+    header = text[:header_end]
+    fields = [int(field) for field in header.split()]
+    nbr_rows = fields[0]
+    nbr_cols = 1 + sum(fields[1:])
+    body_end = text.find("\n#", header_end - 1) + 1 or len(text)
+    # numpy < 2 only warns (and stops) at the first value it cannot parse
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            values = numpy.fromstring(
+                text[header_end:body_end], dtype=dtype, sep=" "
+            )
+        except (DeprecationWarning, ValueError):
+            raise ValueError("Invalid values in " + file_name)
+    if len(values) != nbr_rows * nbr_cols:
+        raise ValueError("Inconsistent number of values in " + file_name)
+    table = values.reshape(nbr_rows, nbr_cols)
+    if nbr_rows and numpy.any(
+        table[:, 0] != table[0, 0] + numpy.arange(nbr_rows)
+    ):
+        raise ValueError("Items not numbered consecutively in " + file_name)
+    return (header, table[:, 1:], text[body_end:])
+
+
+def read_node_file(file_name):
+    return read_table(file_name, numpy.float64)
+
+
+def read_ele_file(file_name):
+    return read_table(file_name, numpy.int64)
+
+
+################################################################################
+
+################################################################################
+def write_rows(f, ids, values, fmt):
+    """
+    Writes one line "id v1 v2 ..." per row of values (just "v1 v2 ..." if ids
+    is None), with fmt the %-style format of a single value (e.g. "%.15f" or
+    "%d"). Same output as str(id) + " " + " ".join(format(v) for v in row).
+    """
+    values = numpy.asarray(values)
+    if values.ndim == 1:
+        values = values.reshape(-1, 1)
+    if ids is None:
+        rows = values
+        line_fmt = " ".join([fmt] * values.shape[1]) + "\n"
+    else:
+        # ids are exact in float64 too, "%d" formats them the same way
+        rows = numpy.column_stack((ids, values))
+        line_fmt = "%d" + (" " + fmt) * values.shape[1] + "\n"
+    for i0 in range(0, len(rows), rows_per_chunk):
+        chunk = rows[i0 : i0 + rows_per_chunk]
+        f.write((line_fmt * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+
+################################################################################
+
+################################################################################
+def write_table(file_name, header, values, fmt, first_id=1, trailer=""):
+    """
+    Writes a whole .node or .ele file, items numbered from first_id.
+    """
+    with open(file_name, "w") as f:
+        f.write(header)
+        write_rows(
+            f, numpy.arange(first_id, first_id + len(values)), values, fmt
+        )
+        f.write(trailer)
@@ -1,5 +1,6 @@
 import os
 import sys
+import threading
 import time
 
 import O4_File_Names as FNAMES
@@ -10,6 +11,27 @@ is_working = False
 cleaning_level = 1
 gui = None
 log = True
+# Steps launched by the batch scheduler (O4_Tile_Utils.build_tile_list) run
+# concurrently on purpose, their threads are flagged here so that they are not
+# refused by the is_working guard.
+batch_thread = threading.local()
+# While a batch runs, its scheduler owns red_flag and is_working : the steps
+# (and the threads they start) neither clear a Stop meant for all the tiles,
+# nor end is_working when they are done.
+batch_running = False
+
+################################################################################
+def is_busy():
+    return is_working and not getattr(batch_thread, "active", False)
+
+
+################################################################################
+def clear_red_flag():
+    # at the start of a step
+    global red_flag
+    if not batch_running:
+        red_flag = False
+
 
 ################################################################################
 def progress_bar(nbr, percentage, message=None):
@@ -67,7 +89,8 @@ def exit_message_and_bottom_line(*args):
         "_____________________________________________________________"
         + "____________________________________"
     )
-    is_working = False
+    if not batch_running:
+        is_working = False
 
 
 ################################################################################
@@ -78,7 +101,8 @@ def timings_and_bottom_line(tinit):
         "_____________________________________________________________"
         + "____________________________________"
     )
-    is_working = False
+    if not batch_running:
+        is_working = False
 
 
 ################################################################################
@@ -12,15 +12,17 @@ import O4_Vector_Utils as VECT
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_Airport_Utils as APT
+import O4_Trace_Utils as TRACE
 
 good_imagery_list = ()
 
 ################################################################################
+@TRACE.traced("build_poly_file")
 def build_poly_file(tile):
-    if UI.is_working:
+    if UI.is_busy():
         return 0
     UI.is_working = 1
-    UI.red_flag = 0
+    UI.clear_red_flag()
     # in case that was forgotten by the user
     tile.iterate = 0
     # update the lat/lon scaling factor in VECT
@@ -167,6 +169,8 @@ def build_poly_file(tile):
     vector_map.snap_to_grid(9) 
     vector_map.write_node_file(node_file)
     vector_map.write_poly_file(poly_file)
+    TRACE.wrote(node_file)
+    TRACE.wrote(poly_file)
 
     UI.vprint(
         1, "\nFinal number of constrained edges :", len(vector_map.dico_edges)
@@ -179,6 +183,7 @@ def build_poly_file(tile):
 
 
 ################################################################################
+@TRACE.traced("include_airports")
 def include_airports(vector_map, tile):
     UI.vprint(0, "-> Dealing with airports")
     airport_layer = OSM.OSM_layer()
@@ -225,6 +230,7 @@ def include_airports(vector_map, tile):
 
 
 ################################################################################
+@TRACE.traced("include_roads")
 def include_roads(vector_map, tile, apt_array, apt_area):
     def road_is_too_much_banked(way, filtered_segs):
         (col, row) = numpy.minimum(
@@ -360,6 +366,7 @@ def include_roads(vector_map, tile, apt_array, apt_area):
 
 
 ################################################################################
+@TRACE.traced("include_sea")
 def include_sea(vector_map, tile):
     UI.vprint(0, "-> Dealing with coastline")
     sea_layer = OSM.OSM_layer()
@@ -451,6 +458,7 @@ def include_sea(vector_map, tile):
 
 
 ################################################################################
+@TRACE.traced("include_water")
 def include_water(vector_map, tile):
     large_lake_threshold = (
         tile.max_area * 1e6 / (GEO.lat_to_m * GEO.lon_to_m(tile.lat + 0.5))
@@ -636,6 +644,7 @@ def include_water(vector_map, tile):
 
 
 ################################################################################
+@TRACE.traced("include_patches")
 def include_patches(vector_map, tile):
     def tanh_profile(alpha, x):
         return (numpy.tanh((x - 0.5) * alpha) / numpy.tanh(0.5 * alpha) + 1) / 2
@@ -5,6 +5,7 @@ from shapely import ops
 from rtree import index
 import O4_UI_Utils as UI
 import O4_Geo_Utils as GEO
+import O4_Triangle_IO as TRIIO
 
 # Some functions further down rely not only on a vector structure but also on a
 # metric (distances of course but more importantly angles and normals).
@@ -17,6 +18,10 @@ scaly = 1
 # These parameters are meant to be updated at runtime by the program, typically
 # with scaly=1 and scalx=cos(lat*pi/180).
 
+# From that many candidate edges on, insert_edge first sorts out in bulk those
+# which clearly cannot be encroached (see encroachment_candidates).
+encroach_batch_min = 4
+
 
 # The first class we introduce is a vector map: this is simply a set of nodes
 # and edges with an insert_edge function that will compute and resolve all edge
@@ -124,10 +129,16 @@ class Vector_Map:
         # affine coordinates of points in between pts id0 and id1 that belong
         # to existing edges
         id_list = []  # ids of these points
-        task = self.ebbox.intersection(
-            self.bbox_from_node_ids(id0, id1), objects=True
+        task = list(
+            self.ebbox.intersection(
+                self.bbox_from_node_ids(id0, id1), objects=True
+            )
         )  # which other edges to search for instersection
-        for hits in task:
+        for hits, candidate in zip(
+            task, self.encroachment_candidates(id0, id1, task)
+        ):
+            if not candidate:
+                continue
             edge_id = hits.id
             edge_bbox = hits.bbox
             (id2, id3) = self.edges_dico[edge_id]
@@ -249,6 +260,51 @@ class Vector_Map:
         )
         return (xmin, ymin, xmax, ymax)
 
+    def encroachment_candidates(self, id0, id1, hits):
+        # Bulk version of a necessary condition for are_encroached : False for
+        # the edges of hits which are clearly not parallel to id0->id1 and
+        # whose (alpha,beta) from Cramer's rule is out of [0,1] by more than
+        # a bound on the rounding errors of both this and numpy.linalg.solve,
+        # are_encroached would then return False as well. The remaining ones
+        # (True) are left to are_encroached, so that the vector map does not
+        # depend on whether this filter was used.
+        if len(hits) < encroach_batch_min:
+            return [True] * len(hits)
+        a = numpy.array(self.nodes_dico[id0], dtype=float)
+        b = numpy.array(self.nodes_dico[id1], dtype=float)
+        cd = numpy.array(
+            [
+                self.nodes_dico[node_id]
+                for hit in hits
+                for node_id in self.edges_dico[hit.id]
+            ],
+            dtype=float,
+        ).reshape(-1, 2, 2)
+        ab = b - a
+        dc = cd[:, 0] - cd[:, 1]
+        ac = cd[:, 0] - a
+        det = ab[0] * dc[:, 1] - ab[1] * dc[:, 0]
+        ab_norm = numpy.hypot(*ab)
+        dc_norm = numpy.hypot(dc[:, 0], dc[:, 1])
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            alpha = (ac[:, 0] * dc[:, 1] - ac[:, 1] * dc[:, 0]) / det
+            beta = (ab[0] * ac[:, 1] - ab[1] * ac[:, 0]) / det
+            tol = (
+                1e-9
+                * (ab_norm + dc_norm) ** 2
+                / numpy.abs(det)
+                * (1 + numpy.abs(alpha) + numpy.abs(beta))
+            )
+            outside = (
+                (alpha < -tol)
+                | (alpha > 1 + tol)
+                | (beta < -tol)
+                | (beta > 1 + tol)
+            )
+        # are_encroached takes the transverse branch above 1e-8 * norms
+        transverse = numpy.abs(det) > 2e-8 * ab_norm * dc_norm
+        return ~(transverse & outside)
+
     def are_encroached(self, a, b, c, d):
         # A crucial one !
         # returns False if the only mutual points of the closed segments a->b
@@ -538,24 +594,14 @@ class Vector_Map:
         # note that Triangle4XP too is writing a(nother) node file, which as
         # more node attributes
         total_nodes = len(self.dico_nodes)
+        ids = sorted(self.nodes_dico.keys())
+        values = numpy.array(
+            [(*self.nodes_dico[idx], self.data_nodes[idx]) for idx in ids],
+            dtype=numpy.float64,
+        ).reshape(-1, 3)
         f = open(node_file_name, "w")
         f.write(str(total_nodes) + " 2 1 0\n")
-        for idx in sorted(self.nodes_dico.keys()):
-            f.write(
-                str(idx)
-                + " "
-                + " ".join(
-                    [
-                        "{:.9f}".format(x)
-                        for x in (
-                            self.nodes_dico[idx][0],
-                            self.nodes_dico[idx][1],
-                            self.data_nodes[idx],
-                        )
-                    ]
-                )
-                + "\n"
-            )
+        TRIIO.write_rows(f, ids, values, "%.9f")
         f.close()
 
     def write_poly_file(self, poly_file_name):
@@ -564,19 +610,18 @@ class Vector_Map:
         f.write("\n")
         total_edges = len(self.edges_dico)
         f.write(str(total_edges) + " 1\n")
-        idx = 1
-        for edge_id in self.edges_dico:
-            f.write(
-                str(idx)
-                + " "
-                + str(self.edges_dico[edge_id][0])
-                + " "
-                + str(self.edges_dico[edge_id][1])
-                + " "
-                + str(self.data_edges[edge_id])
-                + "\n"
-            )
-            idx += 1
+        TRIIO.write_rows(
+            f,
+            numpy.arange(1, total_edges + 1),
+            numpy.array(
+                [
+                    (*self.edges_dico[edge_id], self.data_edges[edge_id])
+                    for edge_id in self.edges_dico
+                ],
+                dtype=numpy.int64,
+            ).reshape(-1, 3),
+            "%d",
+        )
         f.write("\n" + str(len(self.holes)) + "\n")
         idx = 1
         for hole in self.holes:
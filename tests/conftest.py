@@ -0,0 +1,24 @@
+import os
+import sys
+import pytest
+
+# The modules are imported the way Ortho4XP.py does, from the root of the
+# install (the data directories of O4_File_Names are relative to it).
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root_dir, "src"))
+os.chdir(root_dir)
+
+import O4_UI_Utils as UI
+
+
+@pytest.fixture(autouse=True)
+def log_file(monkeypatch, tmp_path):
+    # Keep the messages of the tests out of the Ortho4XP.log of the install.
+    file_name = tmp_path / "Ortho4XP.log"
+
+    def logprint(*args):
+        with open(file_name, "a") as f:
+            f.write(" ".join(str(x) for x in args) + "\n")
+
+    monkeypatch.setattr(UI, "logprint", logprint)
+    return file_name
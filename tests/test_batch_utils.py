@@ -0,0 +1,59 @@
+import json
+import pytest
+import O4_UI_Utils as UI
+import O4_Batch_Utils as BATCH
+
+
+def write_manifest(tmp_path, manifest):
+    file_name = tmp_path / "job.json"
+    file_name.write_text(json.dumps(manifest))
+    return str(file_name)
+
+
+def test_read_manifest(tmp_path):
+    job = BATCH.read_manifest(
+        write_manifest(
+            tmp_path,
+            {
+                "tiles": [[45, 5], "+45+006"],
+                "bbox": [44.5, 5.5, 45.5, 6.5],
+                "steps": ["mesh", "osm"],
+                "tile_config": {"+45+005": {"curvature_tol": 2}},
+            },
+        )
+    )
+    assert job["tiles"] == [(45, 5), (45, 6), (44, 5), (44, 6)]
+    assert job["steps"] == ["osm", "mesh"]
+    assert job["tile_overrides"] == {(45, 5): {"curvature_tol": 2.0}}
+    assert job["state_file"] == str(tmp_path / "job.state.json")
+
+
+@pytest.mark.parametrize(
+    "manifest",
+    [
+        [],
+        {"tiles": 45},
+        {"tiles": [45]},
+        {"tiles": [[45, "5"]]},
+        {"tiles": [[45, 5, 6]]},
+        {"tiles": ["+45+005"], "config": []},
+        {"tiles": ["+45+005"], "config": {"curvature_tol": {}}},
+        {"tiles": ["+45+005"], "tile_config": {"+45+005": 2}},
+        {"tiles": ["+45+005"], "app_config": "batch_tiles_in_flight"},
+        {"bbox": ["a", 1, 2, 3]},
+        {"bbox": [1, 2, 3]},
+        {"bbox": 45},
+        {"tiles": ["+45+005"], "steps": [["osm"]]},
+        {"tiles": ["+45+005"], "steps": "osm"},
+        {"tiles": ["+45+005"], "custom_build_dir": 1},
+        {"tiles": ["+45+005"], "use_global_cfg": "yes"},
+        {"tiles": ["+45+005"], "report": []},
+    ],
+)
+def test_invalid_manifest(tmp_path, monkeypatch, manifest):
+    # a manifest with fields of the wrong type is a usage error, not a crash
+    monkeypatch.setattr(UI, "lvprint", lambda *args: None)
+    file_name = write_manifest(tmp_path, manifest)
+    with pytest.raises(ValueError):
+        BATCH.read_manifest(file_name)
+    assert BATCH.main([file_name]) == BATCH.exit_usage
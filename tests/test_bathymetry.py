@@ -0,0 +1,149 @@
+import types
+import numpy
+import pytest
+from PIL import Image
+import O4_File_Names as FNAMES
+import O4_Geo_Utils as GEO
+import O4_Bathymetry as BATHY
+
+
+def grid_mesh(size, layout, rng):
+    # size x size nodes, each cell split in two triangles along alternating
+    # diagonals, tri_types in (0, 1, 2) as after the remap of build_dsf
+    (x, y) = numpy.meshgrid(numpy.arange(size), numpy.arange(size))
+    node_coords = numpy.zeros((size * size, 5))
+    node_coords[:, 0] = x.ravel() + rng.uniform(-0.3, 0.3, size * size)
+    node_coords[:, 1] = y.ravel() + rng.uniform(-0.3, 0.3, size * size)
+    node_coords[:, 2:] = rng.uniform(-100, 100, (size * size, 3))
+    tris = []
+    for j in range(size - 1):
+        for i in range(size - 1):
+            (a, b, c, d) = (
+                j * size + i,
+                j * size + i + 1,
+                (j + 1) * size + i + 1,
+                (j + 1) * size + i,
+            )
+            if (i + j) % 2:
+                tris += [(a, b, c), (a, c, d)]
+            else:
+                tris += [(a, b, d), (b, c, d)]
+    tri_idx = numpy.array(tris, dtype=numpy.uint32).ravel()
+    centers = node_coords[tri_idx.astype(numpy.int64), :2].reshape(-1, 3, 2)
+    centers = centers.mean(axis=1)
+    count = len(tris)
+    if layout == "random":
+        tri_types = rng.integers(0, 3, count)
+    elif layout == "smooth":
+        field = numpy.sin(centers[:, 0] / 3) + numpy.cos(centers[:, 1] / 4)
+        tri_types = numpy.digitize(field, (0, 1))
+    elif layout == "sparse":
+        tri_types = (rng.random(count) < 0.05) * rng.integers(1, 3, count)
+    elif layout == "island":
+        radius = numpy.hypot(*(centers - (size - 1) / 2).T)
+        tri_types = numpy.where(radius < size / 3, 0, 1)
+    elif layout == "no-water":
+        tri_types = numpy.zeros(count)
+    else:  # all-water
+        tri_types = rng.integers(1, 3, count)
+    return (node_coords.ravel(), tri_idx, tri_types.astype(numpy.uint32))
+
+
+def recut_pattern_counts(tri_idx, tri_types):
+    # Recut pattern of each water triangle, straight from the definition :
+    # bit 1, 2, 4 for a cut edge ab, bc, ca (a water edge between two
+    # coastline nodes), 8 for a triangle whose three edges touch land
+    tris = tri_idx.reshape(-1, 3)
+    land_nodes = set(tris[tri_types == 0].ravel())
+    water_nodes = set(tris[tri_types != 0].ravel())
+    coast_nodes = land_nodes & water_nodes
+    land_edges = set()
+    for (a, b, c) in tris[tri_types == 0]:
+        land_edges |= {frozenset(e) for e in ((a, b), (b, c), (c, a))}
+    counts = {}
+    for (tri, tri_type) in zip(tris, tri_types):
+        if tri_type == 0:
+            continue
+        (a, b, c) = tri
+        pattern = 0
+        for (bit, edge) in ((1, (a, b)), (2, (b, c)), (4, (c, a))):
+            if frozenset(edge) not in land_edges and set(edge) <= coast_nodes:
+                pattern |= bit
+        if not pattern and all(
+            frozenset(edge) in land_edges for edge in ((a, b), (b, c), (c, a))
+        ):
+            pattern = 8
+        counts[pattern] = counts.get(pattern, 0) + 1
+    return counts
+
+
+layouts = ("random", "smooth", "sparse", "island", "no-water", "all-water")
+
+
+def test_recut_water_tris():
+    rng = numpy.random.default_rng(0)
+    seen = {}
+    for layout in layouts:
+        for size in (3, 12, 60):
+            (node_coords, tri_idx, tri_types) = grid_mesh(size, layout, rng)
+            expected = BATHY.recut_water_tris_scalar(
+                node_coords.copy(), tri_idx.copy(), tri_types.copy()
+            )
+            result = BATHY.recut_water_tris(node_coords, tri_idx, tri_types)
+            assert len(result) == len(expected)
+            for (value, reference) in zip(result, expected):
+                if isinstance(reference, numpy.ndarray):
+                    assert value.dtype == reference.dtype
+                    numpy.testing.assert_array_equal(value, reference)
+                else:
+                    assert value == reference
+            for (pattern, count) in recut_pattern_counts(
+                tri_idx, tri_types
+            ).items():
+                seen[pattern] = seen.get(pattern, 0) + count
+    # every recut pattern, and the water triangles left alone
+    assert set(seen) == {0} | set(BATHY.recut_patterns)
+
+
+@pytest.mark.parametrize("layout", ("no-water", "all-water"))
+def test_recut_nothing_to_cut(layout):
+    rng = numpy.random.default_rng(1)
+    (node_coords, tri_idx, tri_types) = grid_mesh(10, layout, rng)
+    result = BATHY.recut_water_tris(node_coords, tri_idx, tri_types)
+    assert result[0] == 100 and result[4] == len(tri_types)
+    numpy.testing.assert_array_equal(result[5], tri_idx)
+
+
+def tile_mesh(tile, size, rng):
+    # grid mesh laid over the tile, in lon/lat
+    (node_coords, tri_idx, tri_types) = grid_mesh(size, "smooth", rng)
+    node_coords = node_coords.reshape(-1, 5)
+    node_coords[:, :2] = numpy.clip(node_coords[:, :2], 0, size - 1) / (
+        size - 1
+    ) + (tile.lon, tile.lat)
+    return (node_coords.ravel(), tri_idx, tri_types)
+
+
+@pytest.mark.parametrize("with_mask", (True, False))
+def test_cross_check(monkeypatch, tmp_path, with_mask):
+    rng = numpy.random.default_rng(2)
+    tile = types.SimpleNamespace(lat=45, lon=5, mask_zl=11)
+    monkeypatch.setattr(FNAMES, "mask_dir", lambda lat, lon: str(tmp_path))
+    (node_coords, tri_idx, tri_types) = tile_mesh(tile, 40, rng)
+    # the tile spans several distance masks, only one of them is written
+    mask_attr = GEO.wgs84_to_orthogrid(tile.lat + 0.5, tile.lon + 0.5, 11)
+    if with_mask:
+        (x, y) = numpy.meshgrid(numpy.arange(4096), numpy.arange(4096))
+        Image.fromarray(((x // 7 + y // 5) % 256).astype(numpy.uint8)).save(
+            tmp_path / FNAMES.distance_mask(*mask_attr)
+        )
+    assert BATHY.cross_check(node_coords, tri_idx, tri_types, tile) == []
+    # the masks were actually sampled, or not at all
+    (nbr_nodes, node_coords, node_types) = BATHY.recut_water_tris(
+        node_coords, tri_idx, tri_types
+    )[:3]
+    node_bathy = BATHY.compute_depth_ratio_bounds_from_masks(
+        nbr_nodes, node_coords, node_types, tile
+    )
+    assert numpy.any(numpy.asarray(node_types[:nbr_nodes]) & 4)
+    assert numpy.any(node_bathy != 255) == with_mask
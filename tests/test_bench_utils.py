@@ -0,0 +1,29 @@
+import os
+import O4_File_Names as FNAMES
+import O4_UI_Utils as UI
+import O4_Overlay_Utils as OVL
+import O4_Bench_Utils as BENCH
+
+
+def test_log_in_sandbox(monkeypatch, tmp_path, log_file):
+    # redirect sets these, monkeypatch puts them back
+    for name in (
+        "OSM_dir",
+        "Mask_dir",
+        "Imagery_dir",
+        "Elevation_dir",
+        "Geotiff_dir",
+        "Tile_dir",
+        "Tmp_dir",
+        "Provider_dir",
+    ):
+        monkeypatch.setattr(FNAMES, name, getattr(FNAMES, name))
+    for name in ("custom_overlay_src", "custom_overlay_src_alternate"):
+        monkeypatch.setattr(OVL, name, getattr(OVL, name))
+    fix = BENCH.fixtures(str(tmp_path / "Bench"))
+    fix.redirect()
+    assert FNAMES.Tmp_dir == str(tmp_path / "Bench" / "tmp")
+    UI.lvprint(0, "ERROR: Something went wrong.")
+    with open(os.path.join(fix.dir, "Ortho4XP.log")) as f:
+        assert f.read().endswith(" | ERROR: Something went wrong.\n")
+    assert not log_file.exists()
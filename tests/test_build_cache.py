@@ -0,0 +1,181 @@
+import os
+import types
+import pytest
+import O4_File_Names as FNAMES
+import O4_UI_Utils as UI
+import O4_Tile_Utils as TILE
+
+
+class stub_steps:
+    # Steps 1 to 2.5 reduced to what the cache sees of them : the files they
+    # read and write, and the variables their result depends on.
+
+    def __init__(self):
+        self.runs = []
+
+    def osm(self, tile):
+        self.runs.append("osm")
+        with open(os.path.join(FNAMES.osm_dir(tile.lat, tile.lon),
+                               "data.osm")) as f:
+            data = f.read()
+        for file_name in (
+            FNAMES.input_node_file(tile),
+            FNAMES.input_poly_file(tile),
+            FNAMES.alt_file(tile),
+            FNAMES.apt_file(tile),
+        ):
+            with open(file_name, "w") as f:
+                f.write(data + str(tile.road_level))
+        return 1
+
+    def mesh(self, tile):
+        # min_angle is a mesh var which does not change this mesh
+        self.runs.append("mesh")
+        with open(FNAMES.input_poly_file(tile)) as f:
+            data = f.read()
+        with open(FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon),
+                  "w") as f:
+            f.write(data + str(tile.curvature_tol))
+        if UI.cleaning_level > 2:
+            for file_name in (
+                FNAMES.alt_file(tile),
+                FNAMES.input_node_file(tile),
+                FNAMES.input_poly_file(tile),
+            ):
+                os.remove(file_name)
+        return 1
+
+    def mask(self, tile):
+        self.runs.append("mask")
+        with open(FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)) as f:
+            data = f.read()
+        mask_dir = FNAMES.mask_dir(tile.lat, tile.lon)
+        os.makedirs(mask_dir, exist_ok=True)
+        with open(os.path.join(mask_dir, "mask.png"), "w") as f:
+            f.write(data + str(tile.masks_width))
+        return 1
+
+    def run(self, tile):
+        del self.runs[:]
+        for stage in ("osm", "mesh", "mask"):
+            assert TILE.cached_step(stage, tile, getattr(self, stage))
+        return self.runs
+
+
+@pytest.fixture
+def tile(monkeypatch, tmp_path):
+    for (var, name) in (
+        ("OSM_dir", "OSM_data"),
+        ("Patch_dir", "Patches"),
+        ("Elevation_dir", "Elevation_data"),
+        ("Mask_dir", "Masks"),
+        ("Extent_dir", "Extents"),
+        ("Tile_dir", "Tiles"),
+    ):
+        monkeypatch.setattr(FNAMES, var, str(tmp_path / name))
+    monkeypatch.setattr(TILE, "build_cache", True)
+    monkeypatch.setattr(UI, "cleaning_level", 1)
+    tile = types.SimpleNamespace(
+        lat=45,
+        lon=5,
+        iterate=0,
+        grouped=False,
+        custom_dem="",
+        fill_nodata=True,
+        road_level=1,
+        curvature_tol=2.0,
+        min_angle=10,
+        mask_zl=14,
+        masks_width=100,
+        masks_use_DEM_too=False,
+        masks_custom_extent="",
+    )
+    tile.build_dir = FNAMES.build_dir(tile.lat, tile.lon, "")
+    os.makedirs(tile.build_dir)
+    osm_dir = FNAMES.osm_dir(tile.lat, tile.lon)
+    os.makedirs(osm_dir)
+    with open(os.path.join(osm_dir, "data.osm"), "w") as f:
+        f.write("osm")
+    return tile
+
+
+def test_unchanged_rerun(tile):
+    steps = stub_steps()
+    assert steps.run(tile) == ["osm", "mesh", "mask"]
+    assert steps.run(tile) == []
+    # the cache is kept next to the mesh, a new session reads it
+    assert os.path.isfile(FNAMES.build_cache_file(tile))
+    assert stub_steps().run(tile) == []
+
+
+def test_changed_vars(tile):
+    steps = stub_steps()
+    steps.run(tile)
+    # a new mesh, hence new masks
+    tile.curvature_tol = 3.0
+    assert steps.run(tile) == ["mesh", "mask"]
+    # the same mesh again, the masks need not be redone
+    tile.min_angle = 5
+    assert steps.run(tile) == ["mesh"]
+    tile.masks_width = 50
+    assert steps.run(tile) == ["mask"]
+    tile.road_level = 2
+    assert steps.run(tile) == ["osm", "mesh", "mask"]
+    assert steps.run(tile) == []
+
+
+def test_changed_input_file(tile):
+    steps = stub_steps()
+    steps.run(tile)
+    with open(os.path.join(FNAMES.osm_dir(tile.lat, tile.lon), "data.osm"),
+              "w") as f:
+        f.write("new osm")
+    assert steps.run(tile) == ["osm", "mesh", "mask"]
+
+
+def test_missing_or_modified_output(tile):
+    steps = stub_steps()
+    steps.run(tile)
+    mesh_file = FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)
+    os.remove(mesh_file)
+    # the mesh built again is the same, the masks are kept
+    assert steps.run(tile) == ["mesh"]
+    with open(mesh_file, "a") as f:
+        f.write(" edited")
+    assert steps.run(tile) == ["mesh"]
+    mask_file = os.path.join(FNAMES.mask_dir(tile.lat, tile.lon), "mask.png")
+    with open(mask_file, "a") as f:
+        f.write(" edited")
+    assert steps.run(tile) == ["mask"]
+    # an extra output (a mask of a former build) is not one of this build
+    with open(mask_file + ".old.png", "w") as f:
+        f.write("old")
+    assert steps.run(tile) == ["mask"]
+    assert steps.run(tile) == []
+
+
+def test_inputs_removed_by_cleaning(tile, monkeypatch):
+    # With cleaning_level > 2 the mesh step removes its inputs. They count
+    # with the content they had, so that once step 1 has rebuilt them the
+    # same, the mesh and masks are not redone.
+    monkeypatch.setattr(UI, "cleaning_level", 3)
+    steps = stub_steps()
+    steps.run(tile)
+    assert not os.path.exists(FNAMES.input_poly_file(tile))
+    assert steps.run(tile) == ["osm"]
+    # the mesh step was skipped, so its inputs are still there
+    assert steps.run(tile) == []
+    with open(os.path.join(FNAMES.osm_dir(tile.lat, tile.lon), "data.osm"),
+              "w") as f:
+        f.write("new osm")
+    assert steps.run(tile) == ["osm", "mesh", "mask"]
+
+
+def test_failed_step_not_recorded(tile):
+    steps = stub_steps()
+    steps.run(tile)
+    tile.curvature_tol = 3.0
+    assert not TILE.cached_step("mesh", tile, lambda tile: 0)
+    tile.curvature_tol = 2.0
+    # the previous record was dropped when the step began
+    assert steps.run(tile) == ["mesh"]
@@ -0,0 +1,191 @@
+import struct
+import numpy
+import pytest
+import O4_DDS_Utils as DDS
+
+
+def decode_565(c):
+    return DDS.expand_565(numpy.asarray(c, dtype=numpy.int32)).T
+
+
+def decode_color_blocks(data):
+    # reference BC1 decoder, (n, 8) uint8 to (n, 16, 3) int32
+    data = numpy.asarray(data, dtype=numpy.uint8)
+    c0 = data[:, 0:2].copy().view("<u2")[:, 0].astype(numpy.int32)
+    c1 = data[:, 2:4].copy().view("<u2")[:, 0].astype(numpy.int32)
+    bits = data[:, 4:8].copy().view("<u4")[:, 0]
+    (p0, p1) = (decode_565(c0), decode_565(c1))
+    palette = numpy.where(
+        (c0 > c1)[:, None, None],
+        numpy.stack(
+            (p0, p1, (2 * p0 + p1) // 3, (p0 + 2 * p1) // 3), axis=1
+        ),
+        numpy.stack((p0, p1, (p0 + p1) // 2, 0 * p0), axis=1),
+    )
+    indices = (bits[:, None] >> (2 * numpy.arange(16, dtype=numpy.uint32))) & 3
+    return numpy.take_along_axis(
+        palette, indices[:, :, None].astype(numpy.int64), axis=1
+    )
+
+
+def decode_alpha_blocks(data):
+    # reference BC3 alpha decoder, (n, 8) uint8 to (n, 16) int32
+    data = numpy.asarray(data, dtype=numpy.uint8)
+    (a0, a1) = (data[:, 0].astype(numpy.int32), data[:, 1].astype(numpy.int32))
+    bits = numpy.zeros((len(data), 8), dtype=numpy.uint8)
+    bits[:, :6] = data[:, 2:8]
+    bits = bits.view("<u8")[:, 0]
+    k = numpy.arange(1, 7)
+    eight = numpy.column_stack(
+        (a0, a1, ((7 - k) * a0[:, None] + k * a1[:, None]) // 7)
+    )
+    k = numpy.arange(1, 5)
+    six = numpy.column_stack(
+        (
+            a0,
+            a1,
+            ((5 - k) * a0[:, None] + k * a1[:, None]) // 5,
+            0 * a0,
+            0 * a0 + 255,
+        )
+    )
+    palette = numpy.where((a0 > a1)[:, None], eight, six)
+    indices = (bits[:, None] >> (3 * numpy.arange(16, dtype=numpy.uint64))) & 7
+    return numpy.take_along_axis(palette, indices.astype(numpy.int64), axis=1)
+
+
+def decode_level(data, height, width, alpha):
+    # (h, w, 3 or 4) int32 image of the blocks of a level
+    block_size = 16 if alpha else 8
+    blocks = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, block_size)
+    pixels = decode_color_blocks(blocks[:, -8:])
+    if alpha:
+        pixels = numpy.concatenate(
+            (pixels, decode_alpha_blocks(blocks[:, :8])[:, :, None]), axis=2
+        )
+    (rows, cols) = ((height + 3) // 4, (width + 3) // 4)
+    image = pixels.reshape(rows, cols, 4, 4, -1).transpose(0, 2, 1, 3, 4)
+    return image.reshape(4 * rows, 4 * cols, -1)[:height, :width]
+
+
+def block_ranges(array):
+    # range of each channel within the 4x4 block of each pixel
+    (h, w) = array.shape[:2]
+    padded = numpy.pad(
+        array.astype(numpy.int32), ((0, -h % 4), (0, -w % 4), (0, 0)),
+        mode="edge",
+    )
+    (ph, pw) = padded.shape[:2]
+    blocks = padded.reshape(ph // 4, 4, pw // 4, 4, -1)
+    ranges = numpy.ptp(blocks, axis=(1, 3), keepdims=True)
+    return numpy.broadcast_to(ranges, blocks.shape).reshape(padded.shape)[
+        :h, :w
+    ]
+
+
+def gradient(height, width, channels):
+    (y, x) = numpy.mgrid[0:height, 0:width]
+    planes = [
+        255 * x / max(1, width - 1),
+        255 * y / max(1, height - 1),
+        127 + 64 * numpy.sin((x + y) / 40),
+        255 * (x + 2 * y) / max(1, width - 1 + 2 * (height - 1)),
+    ]
+    return numpy.stack(planes[:channels], axis=2).round().astype(numpy.uint8)
+
+
+@pytest.mark.parametrize("alpha", (False, True))
+def test_gradient(alpha):
+    array = gradient(64, 96, 4 if alpha else 3)
+    data = DDS.encode_level(array, alpha)
+    assert len(data) == 16 * 24 * (16 if alpha else 8)
+    error = numpy.abs(decode_level(data, 64, 96, alpha) - array)
+    # the palette of a block spans its colours, 565 quantization aside
+    assert error[:, :, :3].max() <= 16
+    assert error[:, :, :3].mean() < 3
+    if alpha:
+        assert error[:, :, 3].max() <= 2
+
+
+@pytest.mark.parametrize("alpha", (False, True))
+def test_flat(alpha):
+    rng = numpy.random.default_rng(0)
+    for color in rng.integers(0, 256, (20, 4)):
+        array = numpy.empty((8, 12, 4 if alpha else 3), dtype=numpy.uint8)
+        array[:, :] = color[: array.shape[2]]
+        data = DDS.encode_level(array, alpha)
+        decoded = decode_level(data, 8, 12, alpha)
+        # the 565 rounding only, and all indices 0 on a uniform block
+        assert numpy.all(numpy.abs(decoded[:, :, :3] - array[:, :, :3]) <= 8)
+        assert numpy.ptp(decoded, axis=(0, 1)).max() == 0
+        if alpha:
+            assert numpy.all(decoded[:, :, 3] == color[3])
+
+
+def test_alpha_steps():
+    # every alpha value between the extremes of a block is within half a step
+    alphas = numpy.array([[0, 17, 34, 51, 68, 85, 102, 119, 136, 153, 170,
+                           187, 204, 221, 238, 255]], dtype=numpy.uint8)
+    array = numpy.zeros((4, 4, 4), dtype=numpy.uint8)
+    array[:, :, 3] = alphas.reshape(4, 4)
+    data = DDS.encode_level(array, alpha=True)
+    decoded = decode_level(data, 4, 4, True)[:, :, 3]
+    assert data[0] == 255 and data[1] == 0
+    assert numpy.abs(decoded - array[:, :, 3]).max() <= 255 // 14 + 1
+
+
+def ramp(height, width, channels):
+    # colours on a segment, which BC1 can render at any scale
+    (y, x) = numpy.mgrid[0:height, 0:width]
+    t = (x + 2 * y) / max(1, width - 1 + 2 * (height - 1))
+    planes = [
+        255 * t, 255 * (1 - t), 64 + 128 * t, 255 * x / max(1, width - 1)
+    ]
+    return numpy.stack(planes[:channels], axis=2).round().astype(numpy.uint8)
+
+
+@pytest.mark.parametrize(
+    "size", ((256, 256), (12, 20), (20, 12), (37, 5), (1, 9), (3, 3))
+)
+@pytest.mark.parametrize("alpha", (False, True))
+def test_write_dds(tmp_path, size, alpha):
+    (height, width) = size
+    array = ramp(height, width, 4 if alpha else 3)
+    file_name = str(tmp_path / "test.dds")
+    assert DDS.write_dds(array, file_name, alpha)
+    with open(file_name, "rb") as f:
+        data = f.read()
+    assert data[:4] == b"DDS "
+    (header_size, flags, h, w, linear_size, depth, mipmap_count) = (
+        struct.unpack_from("<7I", data, 4)
+    )
+    assert (header_size, flags) == (124, DDS.DDSD_FLAGS)
+    assert (h, w, depth) == (height, width, 0)
+    (pf_size, pf_flags, four_cc) = struct.unpack_from("<II4s", data, 76)
+    assert (pf_size, pf_flags) == (32, DDS.DDPF_FOURCC)
+    assert four_cc == (b"DXT5" if alpha else b"DXT1")
+    assert struct.unpack_from("<I", data, 108)[0] == DDS.DDSCAPS_FLAGS
+    # mipmaps down to 1x1, each side halved and rounded down
+    sizes = [(height, width)]
+    while sizes[-1] != (1, 1):
+        sizes.append(tuple(max(1, side // 2) for side in sizes[-1]))
+    assert mipmap_count == len(sizes)
+    block_size = 16 if alpha else 8
+    level_sizes = [
+        ((h + 3) // 4) * ((w + 3) // 4) * block_size for (h, w) in sizes
+    ]
+    assert linear_size == level_sizes[0]
+    assert len(data) == 128 + sum(level_sizes)
+    offset = 128
+    for ((h, w), level, level_size) in zip(
+        sizes, DDS.mipmaps(array), level_sizes
+    ):
+        assert level.shape[:2] == (h, w)
+        decoded = decode_level(data[offset : offset + level_size], h, w, alpha)
+        # half a palette step and the inset of the endpoints, plus the 565
+        # rounding for the colours
+        error = numpy.abs(decoded - level)
+        bound = block_ranges(level) * (1 / 6 + 1 / 16 + 1 / 64) + 1
+        bound[:, :, :3] += 8
+        assert numpy.all(error <= bound)
+        offset += level_size
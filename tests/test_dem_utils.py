@@ -0,0 +1,122 @@
+import numpy
+import pytest
+import O4_DEM_Utils as DEM
+
+
+def make_dem(alt_dem, x0, x1, y0, y1, nodata=-32768, subdems=()):
+    # a DEM over a given raster, without the elevation files
+    dem = DEM.DEM.__new__(DEM.DEM)
+    (dem.x0, dem.x1, dem.y0, dem.y1) = (x0, x1, y0, y1)
+    (dem.nydem, dem.nxdem) = alt_dem.shape
+    dem.alt_dem = alt_dem
+    dem.nodata = nodata
+    dem.subdems = tuple(subdems)
+    return dem
+
+
+def sample_points(dem, count=2000, seed=0):
+    rng = numpy.random.default_rng(seed)
+    (x0, x1, y0, y1) = (dem.x0, dem.x1, dem.y0, dem.y1)
+    (nx, ny) = (dem.nxdem - 1, dem.nydem - 1)
+    points = [
+        # random ones, a bit beyond the raster too
+        numpy.column_stack(
+            (
+                rng.uniform(x0 - 0.1, x1 + 0.1, count),
+                rng.uniform(y0 - 0.1, y1 + 0.1, count),
+            )
+        ),
+        # on the grid lines and at the nodes of the grid
+        numpy.column_stack(
+            (
+                x0 + rng.integers(0, nx + 1, count) * (x1 - x0) / nx,
+                rng.uniform(y0, y1, count),
+            )
+        ),
+        numpy.column_stack(
+            (
+                rng.uniform(x0, x1, count),
+                y0 + rng.integers(0, ny + 1, count) * (y1 - y0) / ny,
+            )
+        ),
+        numpy.column_stack(
+            (
+                x0 + rng.integers(0, nx + 1, count) * (x1 - x0) / nx,
+                y0 + rng.integers(0, ny + 1, count) * (y1 - y0) / ny,
+            )
+        ),
+        # on the borders of the tile, its corners, and right beyond them
+        numpy.array(
+            [(x, y) for x in (x0, x1) for y in numpy.linspace(y0, y1, 50)]
+            + [(x, y) for y in (y0, y1) for x in numpy.linspace(x0, x1, 50)]
+            + [
+                (x, y)
+                for x in (x0 - 1e-12, x1 + 1e-12, 0.5 * (x0 + x1))
+                for y in (y0 - 1e-12, y1 + 1e-12, 0.5 * (y0 + y1))
+            ]
+        ),
+    ]
+    return numpy.vstack(points)
+
+
+def check_equal(vec_alts, alts):
+    assert vec_alts.shape == (len(alts),)
+    numpy.testing.assert_array_equal(vec_alts, numpy.array(alts, dtype=float))
+
+
+@pytest.fixture(
+    params=[
+        (37, 37, 0.0, 1.0, 0.0, 1.0),
+        (3673, 3673, -0.01, 1.01, -0.01, 1.01),
+        (21, 45, 5.2, 5.8, 45.1, 45.3),
+    ]
+)
+def dem(request):
+    (ny, nx, x0, x1, y0, y1) = request.param
+    rng = numpy.random.default_rng(ny * nx)
+    if ny * nx > 10 ** 6:
+        alt_dem = rng.integers(-100, 4000, (ny, nx), dtype=numpy.int16)
+    else:
+        alt_dem = rng.normal(500, 300, (ny, nx)).astype(numpy.float32)
+    return make_dem(alt_dem, x0, x1, y0, y1)
+
+
+def test_alt_vec_nostrict(dem):
+    points = sample_points(dem)
+    check_equal(
+        dem.alt_vec_nostrict(points), [dem.alt_nostrict(p) for p in points]
+    )
+
+
+def test_alt_vec_strict(dem):
+    # with nodata cells, which are returned as such
+    dem.alt_dem = numpy.array(dem.alt_dem)
+    dem.alt_dem[::3, ::2] = dem.nodata
+    points = sample_points(dem)
+    vec_alts = dem.alt_vec_strict(points)
+    check_equal(vec_alts, [dem.alt_strict(p) for p in points])
+    assert (vec_alts == dem.nodata).any()
+
+
+def test_alt_vec_composite():
+    rng = numpy.random.default_rng(1)
+    base = make_dem(
+        rng.normal(500, 300, (61, 61)).astype(numpy.float32), 0, 1, 0, 1
+    )
+    subdems = []
+    for (x0, x1, y0, y1, shape) in (
+        (0.2, 0.7, 0.1, 0.6, (26, 31)),
+        (0.5, 1.0, 0.4, 0.9, (51, 26)),
+    ):
+        alt_dem = rng.normal(100, 50, shape).astype(numpy.float32)
+        # nodata holes in the local sources, to fall back on the others
+        alt_dem[rng.random(shape) < 0.3] = -32768
+        subdems.append(make_dem(alt_dem, x0, x1, y0, y1))
+    base.subdems = tuple(subdems)
+    # on the grids and the borders of the sub DEMs too
+    points = numpy.vstack(
+        [sample_points(base)] + [sample_points(sub) for sub in subdems]
+    )
+    check_equal(
+        base.alt_vec_composite(points), [base.alt_composite(p) for p in points]
+    )
@@ -0,0 +1,369 @@
+import hashlib
+import lzma
+import struct
+import zlib
+import numpy
+import pytest
+import O4_DSF_IO as DSFIO
+import O4_Overlay_Utils as OVL
+
+
+def write_test_dsf(file_name, pools, scals, cmds):
+    # same layout as build_dsf : HEAD, DEFN, GEOD (POOL then SCAL), CMDS
+    bPROP = b"sim/planet\0earth\0"
+    bTERT = b"terrain_Water\0../textures/test.ter\0"
+    size_of_geod_atom = 8
+    for (pool, plane_count) in pools:
+        point_count = len(pool) // (2 * plane_count)
+        size_of_geod_atom += 21 + plane_count * (9 + 2 * point_count)
+    f = DSFIO.DSF_Writer(file_name)
+    f.begin_super_atom(b"DAEH", 16 + len(bPROP))
+    f.write_atom(b"PORP", bPROP)
+    f.begin_super_atom(b"NFED", 48 + len(bTERT))
+    f.write_atom(b"TRET", bTERT)
+    f.write_atom(b"TJBO")
+    f.write_atom(b"YLOP")
+    f.write_atom(b"WTEN")
+    f.write_atom(b"NMED")
+    f.begin_super_atom(b"DOEG", size_of_geod_atom)
+    for (pool, plane_count) in pools:
+        f.write_pool_atom(pool, plane_count)
+    for scal in scals:
+        f.write_scal_atom(scal)
+    f.write_atom(b"SDMC", cmds)
+    return f.close()
+
+
+def test_dsf_round_trip(tmp_path):
+    rng = numpy.random.default_rng(0)
+    # pools of 5, 7 and 9 planes as in build_dsf, the points are interleaved
+    pool_arrays = [
+        rng.integers(0, 65536, (count, planes), dtype=numpy.uint16)
+        for (count, planes) in ((1000, 5), (3, 7), (700, 9))
+    ]
+    pools = [(array.tobytes(), array.shape[1]) for array in pool_arrays]
+    scals = [
+        rng.uniform(-1000, 1000, 2 * array.shape[1]).astype(numpy.float32)
+        for array in pool_arrays
+    ]
+    # runs of more and less than 255 coordinates, plain and cross-pool
+    plain = rng.integers(0, 1000, 3 * 300, dtype=numpy.uint16)
+    short = rng.integers(0, 700, 3 * 10, dtype=numpy.uint16)
+    cross = numpy.column_stack(
+        (
+            rng.integers(0, 2, 3 * 200, dtype=numpy.uint16),
+            rng.integers(0, 3, 3 * 200, dtype=numpy.uint16),
+        )
+    ).reshape(-1)
+    pool_map = numpy.array([1, 2], dtype=numpy.uint16)
+    patches = [
+        (7, 0, 1, -1.0, plain, False),
+        (7, 2, 2, 25000.0, short, False),
+        (3, 1, 1, -1.0, cross, True),
+    ]
+    cmds = []
+    for (terrain_idx, pool_idx, flag, lod, coords, cross_pool) in patches:
+        cmds.append(
+            struct.pack("<BH", DSFIO.SET_DEFINITION_16, terrain_idx)
+            + struct.pack(
+                "<BHBBff",
+                DSFIO.POOL_SELECT,
+                pool_idx,
+                DSFIO.TERRAIN_PATCH_FLAGS_LOD,
+                flag,
+                0,
+                lod,
+            )
+            + DSFIO.encode_patch_triangles(
+                coords.tobytes(), cross_pool, pool_map if cross_pool else None
+            )
+        )
+    file_name = str(tmp_path / "test.dsf")
+    md5sum = write_test_dsf(file_name, pools, scals, b"".join(cmds))
+
+    with open(file_name, "rb") as f:
+        data = f.read()
+    # the MD5 signature computed on the fly is the one of the file body
+    assert data[-16:] == md5sum == hashlib.md5(data[:-16]).digest()
+    atoms = DSFIO.read_dsf_atoms(data)
+    assert [atom_id for (atom_id, _) in atoms] == [
+        b"DAEH",
+        b"NFED",
+        b"DOEG",
+        b"SDMC",
+    ]
+    atoms = dict(atoms)
+    geod = list(DSFIO.iter_atoms(atoms[b"DOEG"]))
+    assert [atom_id for (atom_id, _) in geod] == [b"LOOP"] * 3 + [b"LACS"] * 3
+    for (array, (_, payload)) in zip(pool_arrays, geod[:3]):
+        decoded = DSFIO.decode_pool_atom(payload)
+        assert decoded.dtype == numpy.uint16
+        numpy.testing.assert_array_equal(decoded, array)
+    for (scal, (_, payload)) in zip(scals, geod[3:]):
+        numpy.testing.assert_array_equal(DSFIO.decode_scal_atom(payload), scal)
+    decoded = DSFIO.decode_terrain_patches(atoms[b"SDMC"])
+    assert len(decoded) == len(patches)
+    for (patch, expected) in zip(decoded, patches):
+        (terrain_idx, pool_idx, flag, lod, coords, cross_pool) = expected
+        assert patch[:4] == (terrain_idx, pool_idx, flag, numpy.float32(lod))
+        if cross_pool:
+            coords = coords.reshape(-1, 2).copy()
+            coords[:, 0] = pool_map[coords[:, 0]]
+            coords = coords.reshape(-1)
+        assert patch[4] == coords.tolist()
+
+
+def test_bad_md5_signature(tmp_path):
+    file_name = str(tmp_path / "test.dsf")
+    write_test_dsf(file_name, [], [], b"")
+    with open(file_name, "rb") as f:
+        data = bytearray(f.read())
+    data[-1] ^= 1
+    with pytest.raises(ValueError):
+        DSFIO.read_dsf_atoms(bytes(data))
+
+
+################################################################################
+# 7z archives, written by hand after the 7z format description : signature
+# header, packed streams, then the header (possibly itself packed).
+
+
+def number_7z(value):
+    if value < 0x80:
+        return bytes([value])
+    return b"\xff" + struct.pack("<Q", value)
+
+
+def coder_7z(coder_id, props=b""):
+    flags = len(coder_id) | (0x20 if props else 0)
+    return (
+        bytes([flags])
+        + coder_id
+        + (number_7z(len(props)) + props if props else b"")
+    )
+
+
+def pack_7z(method, data):
+    # (folder, packed data) of a single coder folder
+    if method == "copy":
+        return (b"\x01" + coder_7z(b"\x00"), data)
+    if method == "lzma":
+        (lc, lp, pb, dict_size) = (3, 0, 2, 1 << 20)
+        packed = lzma.compress(
+            data,
+            format=lzma.FORMAT_RAW,
+            filters=[{"id": lzma.FILTER_LZMA1, "lc": lc, "lp": lp, "pb": pb,
+                      "dict_size": dict_size}],
+        )
+        props = bytes([(pb * 5 + lp) * 9 + lc]) + struct.pack("<I", dict_size)
+        return (b"\x01" + coder_7z(b"\x03\x01\x01", props), packed)
+    packed = lzma.compress(
+        data,
+        format=lzma.FORMAT_RAW,
+        filters=[{"id": lzma.FILTER_LZMA2, "dict_size": 1 << 20}],
+    )
+    if method == "lzma2":
+        return (b"\x01" + coder_7z(b"\x21", b"\x10"), packed)
+    # bcj+lzma2 : two coders bound together, as 7z does for executables
+    return (
+        b"\x02"
+        + coder_7z(b"\x03\x03\x01\x03")
+        + coder_7z(b"\x21", b"\x10")
+        + b"\x01\x00",
+        packed,
+    )
+
+
+def streams_info_7z(pack_pos, folder, packed, data, substreams=True):
+    unpack_sizes = number_7z(len(data))
+    if folder[0] == 2:
+        unpack_sizes *= 2
+    return (
+        b"\x06" + number_7z(pack_pos) + b"\x01"
+        + b"\x09" + number_7z(len(packed)) + b"\x00"
+        + b"\x07\x0b\x01\x00" + folder
+        + b"\x0c" + unpack_sizes
+        + b"\x0a\x01" + struct.pack("<I", zlib.crc32(data)) + b"\x00"
+        + (b"\x08\x00" if substreams else b"")
+        + b"\x00"
+    )
+
+
+def write_7z(data, method, encoded_header):
+    (folder, packed) = pack_7z(method, data)
+    # header with the main streams, then the name of the single file
+    name = "test.dsf\0".encode("utf-16-le")
+    header = (
+        b"\x01\x04" + streams_info_7z(0, folder, packed, data)
+        + b"\x05\x01\x11" + number_7z(1 + len(name)) + b"\x00" + name
+        + b"\x00\x00"
+    )
+    if encoded_header:
+        (header_folder, packed_header) = pack_7z("lzma", header)
+        header_pos = len(packed)
+        packed += packed_header
+        header = b"\x17" + streams_info_7z(
+            header_pos, header_folder, packed_header, header, False
+        )
+    start_header = struct.pack(
+        "<QQI", len(packed), len(header), zlib.crc32(header)
+    )
+    return (
+        DSFIO._7z_signature
+        + b"\x00\x04"
+        + struct.pack("<I", zlib.crc32(start_header))
+        + start_header
+        + packed
+        + header
+    )
+
+
+@pytest.mark.parametrize("encoded_header", (False, True))
+@pytest.mark.parametrize("method", ("copy", "lzma", "lzma2"))
+def test_unpack_7z(tmp_path, method, encoded_header):
+    rng = numpy.random.default_rng(1)
+    # somewhat compressible, and more than the 127 of a one byte 7z number
+    data = rng.integers(0, 16, 100000, dtype=numpy.uint8).tobytes()
+    archive = write_7z(data, method, encoded_header)
+    assert DSFIO.unpack_7z(archive) == data
+    file_name = tmp_path / "test.dsf"
+    file_name.write_bytes(archive)
+    assert DSFIO.read_dsf_file(str(file_name)) == data
+
+
+def test_unpack_7z_corrupted():
+    archive = bytearray(write_7z(b"XPLNEDSF" * 100, "lzma2", False))
+    archive[40] ^= 1
+    with pytest.raises(ValueError):
+        DSFIO.unpack_7z(bytes(archive))
+
+
+def test_unpack_7z_several_coders(tmp_path, monkeypatch):
+    # BCJ+LZMA2 is not handled in-process, the overlay goes to DSFTool
+    archive = write_7z(b"XPLNEDSF" * 100, "bcj+lzma2", False)
+    with pytest.raises(ValueError):
+        DSFIO.unpack_7z(archive)
+    file_name = tmp_path / "test.dsf"
+    file_name.write_bytes(archive)
+    monkeypatch.setattr(OVL.UI, "vprint", lambda *args: None)
+    dest_file = tmp_path / "Earth nav data" / "test.dsf"
+    assert not OVL.extract_overlay(str(file_name), str(dest_file))
+    assert not dest_file.exists()
+    assert not (tmp_path / "Earth nav data" / "test.dsf.tmp").exists()
+
+
+################################################################################
+# Overlay extraction from a synthetic DSF.
+
+
+def atom(atom_id, payload=b""):
+    return atom_id + struct.pack("<I", 8 + len(payload)) + payload
+
+
+def overlay_commands():
+    # The commands of the CMDS atom, in order, as (bytes, kind[, state]) :
+    # kind is "kept", "excluded", "object" (kept with keep_objects) or None
+    # for the state and terrain commands, state is (uses_32bit_pool, pool,
+    # definition, subtype, junction_offset) for the commands kept
+    pack = struct.pack
+    return [
+        # terrain patch in pool 0, which nothing else uses
+        (pack("<BH", DSFIO.POOL_SELECT, 0), None),
+        (pack("<BB", DSFIO.SET_DEFINITION_8, 0), None),
+        (pack("<BBff", DSFIO.TERRAIN_PATCH_FLAGS_LOD, 1, 0, -1), None),
+        (pack("<BB3H", DSFIO.PATCH_TRIANGLE, 3, 0, 1, 2), None),
+        (pack("<BB", 32, 2) + b"hi", None),  # comment
+        # object, then excluded and kept polygons in pool 1
+        (pack("<BH", DSFIO.POOL_SELECT, 1), None),
+        (pack("<BH", 7, 4), "object", (False, 1, 0, 0, 0)),
+        (pack("<BB", DSFIO.SET_DEFINITION_8, 1), None),
+        (pack("<BHB3H", 12, 0, 3, 0, 1, 2), "excluded"),
+        (pack("<BH", DSFIO.SET_DEFINITION_16, 300), None),
+        (
+            pack("<BHB", 14, 0, 2) + pack("<B3H", 3, 0, 1, 2)
+            + pack("<B3H", 3, 3, 4, 5),
+            "kept", (False, 1, 300, 0, 0),
+        ),
+        # polygon range in pool 2
+        (pack("<BH", DSFIO.POOL_SELECT, 2), None),
+        (pack("<BHHH", 13, 0, 0, 4), "kept", (False, 2, 300, 0, 0)),
+        # networks in the 32 bit pool 1, one subtype excluded
+        (pack("<BH", DSFIO.POOL_SELECT, 1), None),
+        (pack("<BB", DSFIO.SET_DEFINITION_8, 0), None),
+        (pack("<BB", DSFIO.ROAD_SUBTYPE, 5), None),
+        (pack("<BI", DSFIO.JUNCTION_OFFSET, 100), None),
+        (pack("<BB2H", 9, 2, 0, 1), "kept", (True, 1, 0, 5, 100)),
+        (pack("<BB", DSFIO.ROAD_SUBTYPE, 7), None),
+        (pack("<BB2I", 11, 2, 1, 2), "excluded"),
+        (pack("<BB", DSFIO.ROAD_SUBTYPE, 6), None),
+        (pack("<BHH", 10, 0, 1), "kept", (True, 1, 0, 6, 100)),
+    ]
+
+
+@pytest.mark.parametrize("keep_objects", (False, True))
+def test_write_overlay_dsf(tmp_path, keep_objects):
+    commands = overlay_commands()
+    polygons = b"".join(b"lib/poly%d.pol\0" % k for k in range(301))
+    atoms = [
+        (b"DAEH", atom(b"PORP", b"sim/west\x005\x00")),
+        (
+            b"NFED",
+            atom(b"TRET", b"terrain_Water\0")
+            + atom(b"TJBO", b"lib/obj.obj\0")
+            + atom(b"YLOP", polygons)
+            + atom(b"WTEN", b"lib/roads.net\0"),
+        ),
+        (
+            b"DOEG",
+            b"".join(atom(b"LOOP", b"pool%d" % k) for k in range(3))
+            + b"".join(atom(b"LACS", b"scal%d" % k) for k in range(3))
+            + b"".join(atom(b"23OP", b"pool32_%d" % k) for k in range(2))
+            + b"".join(atom(b"23CS", b"scal32_%d" % k) for k in range(2)),
+        ),
+        (b"SDMC", b"".join(item[0] for item in commands)),
+    ]
+    file_name = str(tmp_path / "overlay.dsf")
+    kept = DSFIO.write_overlay_dsf(
+        atoms, file_name, exclude_pol={1}, exclude_net={7},
+        keep_objects=keep_objects,
+    )
+    # the pools left are renumbered (16 bit 1, 2 -> 0, 1 and 32 bit 1 -> 0),
+    # the definitions keep their index
+    pool_maps = ({1: 0, 2: 1}, {1: 0})
+    expected = []
+    for (command, *kind_state) in commands:
+        if kind_state[0] == "kept" or (
+            kind_state[0] == "object" and keep_objects
+        ):
+            (is_32bit, pool, definition, subtype, junction) = kind_state[1]
+            expected.append((is_32bit, pool_maps[is_32bit][pool], definition,
+                             subtype, junction, command))
+    assert kept == len(expected) == 4 + keep_objects
+    with open(file_name, "rb") as f:
+        result = dict(DSFIO.read_dsf_atoms(f.read()))
+    assert (
+        DSFIO.filter_overlay_commands(result[b"SDMC"], set(), set(), True)
+        == expected
+    )
+    properties = DSFIO.split_strings(dict(DSFIO.iter_atoms(result[b"DAEH"]))[
+        b"PORP"
+    ])
+    assert properties == ["sim/overlay", "1", "sim/west", "5"]
+    definitions = dict(DSFIO.iter_atoms(result[b"NFED"]))
+    assert bytes(definitions[b"YLOP"]) == polygons
+    assert bytes(definitions[b"WTEN"]) == b"lib/roads.net\0"
+    assert bytes(definitions[b"TRET"]) == b""
+    assert bytes(definitions[b"TJBO"]) == (
+        b"lib/obj.obj\0" if keep_objects else b""
+    )
+    assert [
+        (atom_id, bytes(payload))
+        for (atom_id, payload) in DSFIO.iter_atoms(result[b"DOEG"])
+    ] == [
+        (b"LOOP", b"pool1"),
+        (b"LOOP", b"pool2"),
+        (b"LACS", b"scal1"),
+        (b"LACS", b"scal2"),
+        (b"23OP", b"pool32_1"),
+        (b"23CS", b"scal32_1"),
+    ]
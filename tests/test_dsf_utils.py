@@ -0,0 +1,147 @@
+import types
+from math import atan, exp, pi
+import numpy
+import pytest
+import O4_Geo_Utils as GEO
+import O4_DSF_Utils as DSF
+
+mesh_zl = 16
+
+
+def texture(key):
+    # the textures of a tile with some zones at a lower zoomlevel
+    (til_x, til_y) = key
+    if (til_x // 16 + til_y // 16) % 3:
+        return (til_x, til_y, mesh_zl, "BI")
+    return ((til_x // 32) * 16, (til_y // 32) * 16, mesh_zl - 1, "GO2")
+
+
+class texture_dict(dict):
+    # stands for the dico_customzl of zone_list_to_ortho_dico
+    def __missing__(self, key):
+        self[key] = texture(key)
+        return self[key]
+
+
+def grid_lon(k, zl):
+    return (k / 2 ** (zl - 5) - 1) * 180
+
+
+def lat_of_ratio_y(ratio_y):
+    return 360 / pi * atan(exp(pi * ratio_y)) - 90
+
+
+def grid_lat(k, zl):
+    return lat_of_ratio_y(1 - k / 2 ** (zl - 5))
+
+
+def old_assign_textures(tile, dico_customzl, node_coords, tri_idx):
+    # the per triangle lookups of build_dsf that assign_textures replaced
+    textures = []
+    tri_st = []
+    for tri in range(len(tri_idx) // 3):
+        (n1, n2, n3) = tri_idx[3 * tri : 3 * tri + 3]
+        bary_lon = (
+            node_coords[5 * n1 + 0]
+            + node_coords[5 * n2 + 0]
+            + node_coords[5 * n3 + 0]
+        ) / 3
+        bary_lat = (
+            node_coords[5 * n1 + 1]
+            + node_coords[5 * n2 + 1]
+            + node_coords[5 * n3 + 1]
+        ) / 3
+        texture_attributes = dico_customzl[
+            GEO.wgs84_to_orthogrid(bary_lat, bary_lon, tile.mesh_zl)
+        ]
+        textures.append(texture_attributes)
+        st = []
+        for n in (n1, n2, n3):
+            (s, t) = GEO.st_coord(
+                node_coords[5 * n + 1], node_coords[5 * n], *texture_attributes
+            )
+            st.extend((int(round(s * 65535)), int(round(t * 65535))))
+        tri_st.append(st)
+    return (textures, tri_st)
+
+
+def synthetic_mesh(tile, rng):
+    nodes = []
+    tris = []
+
+    def add_tri(points):
+        tris.append(range(len(nodes), len(nodes) + 3))
+        nodes.extend(points)
+
+    # random triangles
+    for _ in range(2000):
+        center = (tile.lon + rng.random(), tile.lat + rng.random())
+        add_tri(center + rng.normal(0, 0.002, (3, 2)))
+    # triangles with their three nodes exactly on a line of the orthogrid, of
+    # the mesh zoomlevel or of a lower one, and so their barycenter (almost)
+    mult = 2 ** (mesh_zl - 5)
+    (k_lon, k_lat) = GEO.wgs84_to_orthogrid(tile.lat + 1, tile.lon, mesh_zl)
+    (k_lon, k_lat) = (k_lon // 16, k_lat // 16)
+    for i in range(300):
+        zl = mesh_zl - i % 2
+        step = 2 ** (mesh_zl - zl)
+        k = rng.integers(1, int(mult / 90)) * step
+        lat = grid_lat(k_lat + k, mesh_zl)
+        lon = grid_lon(k_lon + k, mesh_zl)
+        others = tile.lon + rng.random(3)
+        add_tri([(x, lat) for x in others])
+        others = tile.lat + rng.random(3)
+        add_tri([(lon, y) for y in others])
+        add_tri([(lon, lat)] * 3)
+    # triangles whose nodes have a t coordinate at a rounding tie
+    for _ in range(300):
+        (lon, lat) = (tile.lon + rng.random(), tile.lat + rng.random())
+        key = GEO.wgs84_to_orthogrid(lat, lon, mesh_zl)
+        (tex_x, tex_y, zl, _) = texture(key)
+        t = GEO.st_coord(lat, lon, *texture(key))[1]
+        t = (round(t * 65535) + 0.5) / 65535
+        lat = lat_of_ratio_y(1 - (1 - t + tex_y // 16) / 2 ** (zl - 5))
+        add_tri([(lon, lat), (lon + 1e-6, lat), (lon + 2e-6, lat)])
+    # shuffle the nodes, and share some of them between triangles
+    order = rng.permutation(len(nodes))
+    node_coords = numpy.zeros((len(nodes), 5))
+    node_coords[order, :2] = nodes
+    node_coords[:, 2] = rng.uniform(0, 3000, len(nodes))
+    tri_idx = order[numpy.array(tris).ravel()]
+    tri_idx[rng.random(len(tri_idx)) < 0.05] = tri_idx[0]
+    return (node_coords.ravel(), tri_idx.tolist())
+
+
+@pytest.fixture
+def tile():
+    return types.SimpleNamespace(lat=45, lon=5, mesh_zl=mesh_zl)
+
+
+def counted(calls, name, function):
+    def wrapper(*args):
+        calls[name] += 1
+        return function(*args)
+
+    return wrapper
+
+
+def test_same_as_scalar_loops(monkeypatch, tile):
+    rng = numpy.random.default_rng(0)
+    (node_coords, tri_idx) = synthetic_mesh(tile, rng)
+    dico_customzl = texture_dict()
+    (old_textures, old_st) = old_assign_textures(
+        tile, dico_customzl, node_coords, tri_idx
+    )
+    # count the values recomputed with the scalar formulas
+    calls = {"st_coord": 0, "_ratio_y": 0}
+    for name in calls:
+        monkeypatch.setattr(
+            GEO, name, counted(calls, name, getattr(GEO, name))
+        )
+    (texture_list, tri_textures, tri_st) = DSF.assign_textures(
+        tile, dico_customzl, node_coords, tri_idx
+    )
+    assert calls["st_coord"] > 100 and calls["_ratio_y"] > 100
+    assert [texture_list[i] for i in tri_textures] == old_textures
+    assert tri_st.dtype == numpy.uint16
+    assert tri_st.tolist() == old_st
@@ -0,0 +1,165 @@
+import threading
+import types
+import pytest
+import O4_Http_Utils as HTTP
+import O4_Mock_Servers as MOCK
+
+
+def assert_cap(slot, cap):
+    # cap holders at once, the next one has to wait
+    for _ in range(cap):
+        assert slot.acquire(timeout=1)
+    assert not slot.acquire(timeout=0.05)
+    # until one of them is done
+    waiter = threading.Thread(target=slot.acquire, kwargs={"timeout": 5})
+    waiter.start()
+    slot.release()
+    waiter.join()
+    assert not slot.acquire(timeout=0.05)
+    for _ in range(cap):
+        slot.release()
+
+
+def test_host_caps(monkeypatch):
+    monkeypatch.setattr(HTTP, "http_max_per_host", 0)
+    monkeypatch.setattr(
+        HTTP, "http_host_caps", [["Tiles.Example.com:8080", 2]]
+    )
+    slot = HTTP.host_slot("https://tiles.example.com:8080/16/1/2.jpg")
+    assert_cap(slot, 2)
+    # the same slot for all the requests to the host
+    assert HTTP.host_slot("https://TILES.example.com:8080/3.jpg") is slot
+    assert HTTP.host_slot("https://other.example.com/1.jpg") is HTTP._no_slot
+    monkeypatch.setattr(HTTP, "http_max_per_host", 4)
+    assert_cap(HTTP.host_slot("https://other.example.com/1.jpg"), 4)
+
+
+def test_slot_threads(monkeypatch):
+    # never more than the cap within the slot
+    monkeypatch.setattr(HTTP, "http_max_per_host", 3)
+    (inside, most) = ([0], [0])
+    lock = threading.Lock()
+    barrier = threading.Barrier(8)
+
+    def request():
+        barrier.wait()
+        for _ in range(20):
+            with HTTP.host_slot("https://tiles.example.com/1.jpg"):
+                with lock:
+                    inside[0] += 1
+                    most[0] = max(most[0], inside[0])
+                threading.Event().wait(0.001)
+                with lock:
+                    inside[0] -= 1
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert most[0] == 3
+
+
+def test_keep_alive(monkeypatch):
+    monkeypatch.setattr(HTTP, "http_keep_alive", False)
+    assert HTTP.new_session().headers["Connection"] == "close"
+    monkeypatch.setattr(HTTP, "http_keep_alive", True)
+    assert HTTP.new_session().headers.get("Connection") != "close"
+
+
+@pytest.fixture
+def sessions(monkeypatch):
+    monkeypatch.setattr(HTTP, "_sessions", {})
+    yield
+    HTTP.close_sessions()
+
+
+def test_session_per_host(sessions):
+    session = HTTP.get_session("https://tiles.example.com/16/1/2.jpg")
+    assert HTTP.get_session("HTTPS://Tiles.Example.com/other") is session
+    assert HTTP.get_session("http://tiles.example.com/1.jpg") is not session
+    assert HTTP.get_session("https://other.example.com/1.jpg") is not session
+    # renewed after a failure, once only
+    HTTP.reset_session("https://tiles.example.com/1.jpg", session)
+    renewed = HTTP.get_session("https://tiles.example.com/1.jpg")
+    assert renewed is not session
+    HTTP.reset_session("https://tiles.example.com/1.jpg", session)
+    assert HTTP.get_session("https://tiles.example.com/1.jpg") is renewed
+
+
+def test_connection_reuse(sessions, monkeypatch):
+    monkeypatch.setattr(HTTP, "http_pool_size", 4)
+    with MOCK.mock_server() as server:
+        url = server.url + "/anything"
+        session = HTTP.get_session(url)
+        assert session.get_adapter(url)._pool_maxsize == 4
+        for _ in range(5):
+            response = HTTP.get_session(url).get(url, timeout=10)
+            assert response.status_code == 404
+        # all of them over a single connection, kept alive
+        pools = session.get_adapter(url).poolmanager.pools
+        assert len(pools) == 1
+        pool = pools[next(iter(pools.keys()))]
+        assert (pool.num_connections, pool.num_requests) == (1, 5)
+    assert server.stats["requests"] == 5
+
+
+class fake_clock:
+    def __init__(self):
+        self.now = 100.0
+        self.slept = 0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = fake_clock()
+    monkeypatch.setattr(
+        HTTP,
+        "time",
+        types.SimpleNamespace(monotonic=clock.monotonic, sleep=clock.sleep),
+    )
+    return clock
+
+
+def test_token_bucket(clock):
+    bucket = HTTP.token_bucket(rate=2, burst=3)
+    # a burst at once, then rate per second
+    for _ in range(3):
+        assert bucket.acquire()
+    assert clock.slept == 0
+    for _ in range(4):
+        assert bucket.acquire()
+    assert clock.slept == pytest.approx(2)
+    # tokens pile up while idle, up to the burst
+    clock.now += 60
+    start = clock.slept
+    for _ in range(4):
+        assert bucket.acquire()
+    assert clock.slept - start == pytest.approx(0.5)
+
+
+def test_token_bucket_abort(clock):
+    bucket = HTTP.token_bucket(rate=0.1)
+    assert bucket.acquire()
+    assert not bucket.acquire(abort=lambda: True)
+    assert clock.slept == 0
+    # waits by steps of at most 0.5 s, checking abort in between
+    checks = []
+    assert not bucket.acquire(
+        abort=lambda: len(checks) > 3 or checks.append(1)
+    )
+    assert clock.slept == pytest.approx(2)
+
+
+def test_no_rate_limit(clock):
+    bucket = HTTP.token_bucket(rate=0, burst=1)
+    for _ in range(100):
+        assert bucket.acquire(abort=lambda: True)
+    assert clock.slept == 0
@@ -0,0 +1,15 @@
+import collections
+import O4_Imagery_Utils as IMG
+
+
+def test_coverage_answers_bounded(monkeypatch):
+    monkeypatch.setattr(IMG, "_coverage_answers", collections.OrderedDict())
+    monkeypatch.setattr(IMG, "coverage_cache_size", 3)
+    for key in range(3):
+        assert IMG.remember_coverage(key, key % 2 == 0) is (key % 2 == 0)
+    # the least recently used answer goes first
+    assert IMG.coverage_answer(0) is True
+    IMG.remember_coverage(3, False)
+    assert list(IMG._coverage_answers) == [2, 0, 3]
+    assert IMG.coverage_answer(1) is None
+    assert IMG.coverage_answer(3) is False
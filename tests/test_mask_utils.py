@@ -0,0 +1,99 @@
+import types
+import numpy
+import pytest
+from PIL import Image, ImageFilter
+import O4_Geo_Utils as GEO
+import O4_Mask_Utils as MASK
+
+
+def sand_reference(img_array, blur_width):
+    # the sand blur of blur_mask before convolve_axis, line by line
+    b_img_array = numpy.array(img_array)
+    kernel = numpy.array(range(1, 2 * blur_width))
+    kernel[blur_width:] = range(blur_width - 1, 0, -1)
+    kernel = kernel / blur_width ** 2
+    for i in range(len(b_img_array)):
+        b_img_array[i] = numpy.convolve(b_img_array[i], kernel, "same")
+    b_img_array = b_img_array.transpose()
+    for i in range(len(b_img_array)):
+        b_img_array[i] = numpy.convolve(b_img_array[i], kernel, "same")
+    b_img_array = b_img_array.transpose()
+    b_img_array = 2 * numpy.minimum(b_img_array, 127)
+    return numpy.array(b_img_array, dtype=numpy.uint8)
+
+
+def sand_tile(blur_width):
+    tile = types.SimpleNamespace(lat=45, mask_zl=14, masking_mode="sand")
+    pxscal = GEO.webmercator_pixel_size(tile.lat + 0.5, tile.mask_zl)
+    tile.masks_width = (blur_width + 0.5) * pxscal
+    return tile
+
+
+def noisy_mask(size, rng):
+    # 30% of noise plus a solid block
+    img_array = ((rng.random((size, size)) < 0.3) * 255).astype(numpy.uint8)
+    img_array[size // 4 : size // 2, size // 4 : 3 * size // 4] = 255
+    return img_array
+
+
+@pytest.mark.parametrize("blur_width", (2, 30, 80))
+def test_sand_short_kernels(blur_width):
+    # below blur_fft_min_kernel taps the lines are convolved as before
+    assert 2 * blur_width - 1 < MASK.blur_fft_min_kernel
+    img_array = noisy_mask(700, numpy.random.default_rng(blur_width))
+    numpy.testing.assert_array_equal(
+        MASK.blur_mask(img_array, sand_tile(blur_width), 0),
+        sand_reference(img_array, blur_width),
+    )
+
+
+@pytest.mark.parametrize(
+    ("size", "blur_width"), ((700, 81), (1024, 300), (2048, 200))
+)
+def test_sand_long_kernels(size, blur_width):
+    # Through FFTs the sums which are integers (e.g. within solid areas)
+    # come out on either side of them, where the direct convolution had its
+    # own rounding, hence the truncation to bytes may lose one level (two
+    # once mapped to 0-254) on a few percent of the pixels at most.
+    assert 2 * blur_width - 1 >= MASK.blur_fft_min_kernel
+    rng = numpy.random.default_rng(size)
+    solid = numpy.zeros((size, size), dtype=numpy.uint8)
+    solid[size // 4 : 3 * size // 4, : size // 2] = 255
+    for img_array in (noisy_mask(size, rng), solid):
+        blurred = MASK.blur_mask(img_array, sand_tile(blur_width), 0)
+        reference = sand_reference(img_array, blur_width)
+        assert blurred.dtype == numpy.uint8
+        difference = numpy.abs(blurred.astype(int) - reference)
+        assert difference.max() <= 2
+        assert (difference > 0).mean() <= 0.1
+
+
+def grow_reference(mask_array):
+    return (
+        numpy.array(
+            Image.fromarray(mask_array)
+            .convert("L")
+            .filter(ImageFilter.GaussianBlur(1)),
+            dtype=numpy.uint8,
+        )
+        > 0
+    ).astype(numpy.uint8) * 255
+
+
+def test_grow_mask():
+    rng = numpy.random.default_rng(0)
+    for k in range(12):
+        (rows, cols) = rng.integers(300, 1000, 2)
+        # from a few blobs (blurred by runs of blocks) to noise (blurred whole)
+        mask_array = (
+            (rng.random((rows, cols)) < (0, 0.00002, 0.3)[k % 3]) * 255
+        ).astype(numpy.uint8)
+        for (y, x) in rng.integers(0, min(rows, cols), (3, 2)):
+            mask_array[y : y + rows // 8, x : x + cols // 8] = 255
+        for step in range(3):
+            grown_array = MASK.grow_mask(mask_array)
+            assert grown_array.dtype == numpy.uint8
+            numpy.testing.assert_array_equal(
+                grown_array, grow_reference(mask_array)
+            )
+            mask_array = grown_array
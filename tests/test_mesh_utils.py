@@ -0,0 +1,128 @@
+import os
+import types
+import numpy
+import pytest
+import O4_File_Names as FNAMES
+import O4_Triangle_IO as TRIIO
+import O4_Mesh_Utils as MESH
+
+
+@pytest.fixture
+def tile(tmp_path):
+    # a small mesh as Triangle4XP leaves it, before write_mesh_file
+    rng = numpy.random.default_rng(0)
+    tile = types.SimpleNamespace(
+        lat=45, lon=5, iterate=0, build_dir=str(tmp_path)
+    )
+    nbr_vert = 500
+    vertices = numpy.zeros((nbr_vert, 6))
+    vertices[:, :2] = rng.random((nbr_vert, 2))
+    vertices[:, 2] = rng.uniform(-50, 3000, nbr_vert)
+    vertices[:, 3:5] = rng.uniform(-1, 1, (nbr_vert, 2))
+    tris = numpy.column_stack(
+        (
+            rng.integers(1, nbr_vert + 1, (900, 3)),
+            rng.choice((0, 1, 2, 4, 64), 900),
+        )
+    )
+    TRIIO.write_table(FNAMES.output_ele_file(tile), "900 3 1\n", tris, "%d")
+    tile.vertices = vertices.ravel()
+    return tile
+
+
+def write_mesh(tile):
+    MESH.write_mesh_file(tile, tile.vertices)
+    return FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)
+
+
+def read_text_mesh(mesh_file):
+    # the parse of the text file only
+    bin_file = FNAMES.mesh_bin_file(mesh_file)
+    if os.path.exists(bin_file):
+        os.rename(bin_file, bin_file + ".saved")
+    try:
+        return MESH.read_mesh_file(mesh_file)
+    finally:
+        os.remove(bin_file)
+        if os.path.exists(bin_file + ".saved"):
+            os.rename(bin_file + ".saved", bin_file)
+
+
+def assert_same_mesh(result, expected):
+    assert len(result) == len(expected) == 6
+    for (value, reference) in zip(result, expected):
+        if isinstance(reference, numpy.ndarray):
+            assert value.dtype == reference.dtype
+            numpy.testing.assert_array_equal(value, reference)
+        else:
+            assert value == reference
+
+
+def test_mesh_round_trip(tile):
+    mesh_file = write_mesh(tile)
+    assert os.path.isfile(FNAMES.mesh_bin_file(mesh_file))
+    text = read_text_mesh(mesh_file)
+    # the sidecar holds what a reader of the text file gets
+    assert_same_mesh(MESH.read_mesh_file(mesh_file), text)
+    (mesh_version, nbr_nodes, node_coords, nbr_tris, tri_idx, tri_types) = text
+    assert (mesh_version, nbr_nodes, nbr_tris) == (2.0, 500, 900)
+    numpy.testing.assert_allclose(
+        node_coords.reshape(-1, 5)[:, :2],
+        tile.vertices.reshape(-1, 6)[:, :2] + (tile.lon, tile.lat),
+    )
+    # without a sidecar, the text parse writes one for the next readers
+    os.remove(FNAMES.mesh_bin_file(mesh_file))
+    assert_same_mesh(MESH.read_mesh_file(mesh_file), text)
+    assert os.path.isfile(FNAMES.mesh_bin_file(mesh_file))
+    assert_same_mesh(MESH.read_mesh_bin_file(mesh_file), text)
+
+
+def write_other_sidecar(mesh_file):
+    # a valid sidecar for the current text file, but with other arrays, to
+    # tell which of the two read_mesh_file used
+    MESH.write_mesh_bin_file(
+        mesh_file,
+        2.0,
+        numpy.zeros(5 * 3),
+        numpy.array([0, 1, 2], dtype=numpy.uint32),
+        numpy.array([7], dtype=numpy.uint32),
+    )
+    assert MESH.read_mesh_file(mesh_file)[1] == 3
+
+
+def test_stale_sidecar(tile):
+    mesh_file = write_mesh(tile)
+    text = read_text_mesh(mesh_file)
+    stat = os.stat(mesh_file)
+    # modification time changed (e.g. the moulinette rewrote the mesh)
+    write_other_sidecar(mesh_file)
+    os.utime(mesh_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert_same_mesh(MESH.read_mesh_file(mesh_file), text)
+    # size changed with the same modification time
+    write_other_sidecar(mesh_file)
+    stat = os.stat(mesh_file)
+    with open(mesh_file, "a") as f:
+        f.write("\n")
+    os.utime(mesh_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert_same_mesh(MESH.read_mesh_file(mesh_file), text)
+
+
+@pytest.mark.parametrize("damage", ("crc", "truncated", "header"))
+def test_corrupted_sidecar(tile, damage):
+    mesh_file = write_mesh(tile)
+    text = read_text_mesh(mesh_file)
+    bin_file = FNAMES.mesh_bin_file(mesh_file)
+    with open(bin_file, "rb") as f:
+        data = bytearray(f.read())
+    if damage == "crc":
+        data[MESH.mesh_bin_header.size + 100] ^= 1
+    elif damage == "truncated":
+        data = data[:-4]
+    else:
+        data = data[: MESH.mesh_bin_header.size // 2]
+    with open(bin_file, "wb") as f:
+        f.write(data)
+    assert MESH.read_mesh_bin_file(mesh_file) is None
+    assert_same_mesh(MESH.read_mesh_file(mesh_file), text)
+    # and the sidecar was written again
+    assert_same_mesh(MESH.read_mesh_bin_file(mesh_file), text)
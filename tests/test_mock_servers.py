@@ -0,0 +1,288 @@
+import bz2
+import io
+from xml.etree import ElementTree
+import numpy
+import pytest
+import requests
+from PIL import Image
+import O4_File_Names as FNAMES
+import O4_Imagery_Utils as IMG
+import O4_OSM_Utils as OSM
+import O4_DEM_Utils as DEM
+import O4_Mock_Servers as MOCK
+
+
+def test_base_server_answers_404():
+    with MOCK.mock_server() as server:
+        response = requests.get(server.url + "/anything", timeout=10)
+    assert response.status_code == 404
+    assert server.stats["404"] == 1
+
+
+# a tile of the imagery tests, near 45N 5E
+(zoom, til_x, til_y) = (16, 33678, 23462)
+
+
+@pytest.fixture
+def imagery(monkeypatch, tmp_path):
+    # starts a mock imagery server with the given settings, and loads its
+    # providers
+    servers = []
+
+    def start(**settings):
+        server = MOCK.mock_imagery_server(**settings).start()
+        servers.append(server)
+        provider_dir = str(tmp_path / ("Providers" + str(len(servers))))
+        monkeypatch.setattr(FNAMES, "Provider_dir", provider_dir)
+        monkeypatch.setattr(IMG, "providers_dict", {})
+        MOCK.write_providers(provider_dir, server.url)
+        IMG.initialize_providers_dict()
+        return (server, IMG.providers_dict)
+
+    # no waiting between retries
+    monkeypatch.setattr(IMG.time, "sleep", lambda seconds: None)
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def pixels(image):
+    if isinstance(image, bytes):
+        image = Image.open(io.BytesIO(image))
+    return numpy.asarray(image.convert("RGB"), dtype=numpy.int32)
+
+
+def get_tile(provider, x=til_x, y=til_y):
+    return IMG.get_wmts_image(zoom, x, y, provider)
+
+
+def zoomed_out(levels):
+    # what get_wmts_image makes of the tile from the one levels above
+    (x, y) = (til_x >> levels, til_y >> levels)
+    size = 256 >> levels
+    (x0, y0) = ((til_x - (x << levels)) * size, (til_y - (y << levels)) * size)
+    image = Image.open(io.BytesIO(MOCK.render_tile(zoom - levels, x, y)))
+    return pixels(
+        image.crop((x0, y0, x0 + size, y0 + size)).resize(
+            (256, 256), Image.BICUBIC
+        )
+    )
+
+
+def test_tms_and_wmts(imagery):
+    (server, providers) = imagery()
+    for code in ("MOCKT", "MOCKW"):
+        (success, image) = get_tile(providers[code])
+        assert success
+        expected = pixels(MOCK.render_tile(zoom, til_x, til_y))
+        assert (pixels(image) == expected).all()
+    assert server.stats["200"] == 2
+
+
+def test_wms(imagery):
+    (server, providers) = imagery()
+    bbox = (560000.0, 5620000.0, 562000.0, 5618000.0)
+    (success, image) = IMG.get_wms_image(bbox, 512, 256, providers["MOCKS"])
+    assert success
+    assert (pixels(image) == pixels(MOCK.render(*bbox, 512, 256))).all()
+    (server, providers) = imagery(hole_rate=1)
+    (success, image) = IMG.get_wms_image(bbox, 512, 256, providers["MOCKS"])
+    assert not success and image.size == (512, 256)
+    assert (pixels(image) == 255).all()
+
+
+def test_holes_fall_back_to_lower_zl(imagery):
+    # a hole at the tile only, above max_zl, and everywhere
+    (server, providers) = imagery(holes=[(zoom, til_x, til_y)])
+    (success, image) = get_tile(providers["MOCKT"])
+    assert success and server.stats["404"] == 1
+    assert (pixels(image) == zoomed_out(1)).all()
+    (server, providers) = imagery(max_zl=zoom - 3)
+    (success, image) = get_tile(providers["MOCKT"])
+    assert success and server.stats["404"] == 3
+    assert (pixels(image) == zoomed_out(3)).all()
+    # at most 5 levels up
+    (server, providers) = imagery(max_zl=zoom - 6)
+    (success, image) = get_tile(providers["MOCKT"])
+    assert not success and server.stats["404"] == 6
+    assert (pixels(image) == 255).all()
+    # no fallback outside of the webmercator grid type
+    (server, providers) = imagery(hole_rate=1)
+    (success, image) = get_tile(providers["MOCKW"])
+    assert not success and server.stats["404"] == 1
+
+
+def test_empty_images(imagery):
+    # a tile empty at its zoomlevel but not at the next lower one
+    x = next(
+        x
+        for x in range(til_x, til_x + 1000, 2)
+        if MOCK.draw(0, "empty", (zoom, x, til_y)) < 0.5
+        and MOCK.draw(0, "empty", (zoom - 1, x // 2, til_y // 2)) >= 0.5
+    )
+    (server, providers) = imagery(empty_rate=0.5)
+    # recognized by their Content-Length under the Bing and ArcGIS paths
+    for code in ("MOCKB", "MOCKA"):
+        server.reset_stats()
+        (success, image) = get_tile(providers[code], x)
+        assert success
+        assert server.stats["empty"] == 1 and server.stats["200"] == 2
+        assert not (pixels(image) == 255).all()
+    # a plain white tile elsewhere
+    server.reset_stats()
+    (success, image) = get_tile(providers["MOCKT"], x)
+    assert success and server.stats["requests"] == 1
+    assert (pixels(image) == 255).all()
+
+
+def first_error_then_success(rate, zoom, y):
+    # a tile whose first request gets an error and the second one not
+    return next(
+        x
+        for x in range(til_x, til_x + 1000)
+        if MOCK.draw(0, "error", "/tms/%d/%d/%d.jpg" % (zoom, x, y), 1) < rate
+        and MOCK.draw(0, "error", "/tms/%d/%d/%d.jpg" % (zoom, x, y), 2)
+        >= rate
+    )
+
+
+def test_error_retries(imagery, monkeypatch):
+    (server, providers) = imagery(error_rate=0.5)
+    x = first_error_then_success(0.5, zoom, til_y)
+    # errors are not retried unless check_tms_response
+    monkeypatch.setattr(IMG, "check_tms_response", False)
+    (success, image) = get_tile(providers["MOCKT"], x)
+    assert not success and server.stats["500"] == 1
+    assert (pixels(image) == 255).all()
+    server.reset_stats()
+    monkeypatch.setattr(IMG, "check_tms_response", True)
+    # not the one of Ortho4XP.cfg, which other tests may have loaded
+    monkeypatch.setattr(IMG, "max_baddata_retries", 10)
+    (success, image) = get_tile(providers["MOCKT"], x)
+    assert success and server.stats["500"] == 1 and server.stats["200"] == 1
+    assert (pixels(image) == pixels(MOCK.render_tile(zoom, x, til_y))).all()
+    # all the tiles of a texture eventually come
+    server.reset_stats()
+    for y in range(til_y, til_y + 4):
+        for x in range(til_x, til_x + 4):
+            assert get_tile(providers["MOCKT"], x, y)[0]
+    assert server.stats["200"] == 16 and server.stats["500"] > 0
+    # up to max_baddata_retries of them
+    monkeypatch.setattr(IMG, "max_baddata_retries", 3)
+    (server, providers) = imagery(error_rate=1)
+    (success, image) = get_tile(providers["MOCKT"])
+    assert not success and server.stats["500"] == 3
+
+
+osm_extract = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+  <node id="1" lat="45.5" lon="5.5"/>
+  <node id="2" lat="45.6" lon="5.5"/>
+  <node id="3" lat="46.5" lon="5.5"/>
+  <node id="4" lat="44.5" lon="4.5"/>
+  <node id="5" lat="44.6" lon="4.5"/>
+  <node id="6" lat="45.2" lon="5.2"/>
+  <node id="7" lat="45.3" lon="5.2"/>
+  <node id="8" lat="45.3" lon="5.3"/>
+  <node id="9" lat="47.0" lon="7.0"/>
+  <node id="10" lat="47.1" lon="7.0"/>
+  <node id="11" lat="47.1" lon="7.1"/>
+  <node id="12" lat="45.4" lon="5.4">
+    <tag k="highway" v="crossing"/>
+  </node>
+  <way id="20">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <nd ref="3"/>
+    <tag k="highway" v="primary"/>
+  </way>
+  <way id="21">
+    <nd ref="4"/>
+    <nd ref="5"/>
+    <tag k="highway" v="primary"/>
+  </way>
+  <way id="22">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <tag k="railway" v="rail"/>
+  </way>
+  <way id="23">
+    <nd ref="6"/>
+    <nd ref="7"/>
+    <nd ref="8"/>
+    <nd ref="6"/>
+  </way>
+  <way id="24">
+    <nd ref="9"/>
+    <nd ref="10"/>
+    <nd ref="11"/>
+    <nd ref="9"/>
+  </way>
+  <relation id="30">
+    <member type="way" ref="23" role="outer"/>
+    <member type="way" ref="24" role="outer"/>
+    <tag k="natural" v="water"/>
+    <tag k="type" v="multipolygon"/>
+  </relation>
+  <relation id="31">
+    <member type="way" ref="24" role="outer"/>
+    <tag k="natural" v="water"/>
+  </relation>
+</osm>
+"""
+
+
+def osm_ids(content):
+    root = ElementTree.fromstring(content)
+    return {
+        osm_type: {int(e.get("id")) for e in root.iter(osm_type)}
+        for osm_type in ("node", "way", "relation")
+    }
+
+
+@pytest.mark.parametrize("suffix", (".osm", ".osm.bz2"))
+def test_overpass(monkeypatch, tmp_path, suffix):
+    osm_file = str(tmp_path / ("extract" + suffix))
+    with (bz2.open if suffix.endswith("bz2") else open)(osm_file, "wb") as f:
+        f.write(osm_extract.encode("utf-8"))
+    with MOCK.mock_overpass_server(osm_file) as server:
+        monkeypatch.setattr(
+            OSM, "overpass_custom_url", server.url + "/api/interpreter"
+        )
+        content = OSM.get_overpass_data(
+            ('way["highway"]', 'rel["natural"="water"]'), (45, 5, 46, 6)
+        )
+    assert server.stats["200"] == 1
+    # ways with a node in the bbox, relations with a member in it, then
+    # (._;>>;) their members and nodes, in or out of the bbox
+    assert osm_ids(content) == {
+        "node": {1, 2, 3, 6, 7, 8, 9, 10, 11},
+        "way": {20, 23, 24},
+        "relation": {30},
+    }
+    # and the parser reads the answer
+    layer = OSM.OSM_layer()
+    assert layer.update_dicosm(content)
+    assert len(layer.dicosmw) == 3 and len(layer.dicosmr) == 1
+
+
+def test_elevation_mirror(monkeypatch, tmp_path):
+    # the archive of Viewfinderpanoramas holding the tile and its neighbour
+    monkeypatch.setattr(FNAMES, "Elevation_dir", str(tmp_path / "Elevation"))
+    fixture_dir = str(tmp_path / "fixture")
+    data = {}
+    for (lat, lon) in ((45, 5), (44, 5)):
+        data[(lat, lon)] = bytes(range(256)) * (lat + lon)
+        file_name = str(tmp_path / "source.hgt")
+        with open(file_name, "wb") as f:
+            f.write(data[(lat, lon)])
+        MOCK.write_elevation_fixture(fixture_dir, "View", lat, lon, file_name)
+    with MOCK.mock_elevation_server(fixture_dir) as server:
+        monkeypatch.setattr(DEM, "elevation_mirror_url", server.url)
+        assert DEM.ensure_elevation("View", 45, 5)
+        # no archive for that one
+        assert not DEM.ensure_elevation("View", 45, 6)
+    assert server.stats["200"] == 1 and server.stats["404"] == 1
+    for ((lat, lon), content) in data.items():
+        with open(FNAMES.viewfinderpanorama(lat, lon), "rb") as f:
+            assert f.read() == content
@@ -0,0 +1,364 @@
+import bz2
+import html
+import io
+import types
+import pytest
+import O4_OSM_Utils as OSM
+
+# An Overpass answer (out body; >; out skel qt; style) with merged nodes, an
+# empty way, a multipolygon split in several ways, ill formed relations and
+# tags with entities.
+overpass_sample = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="Overpass API 0.7.62.1 084b4234">
+<note>The data included in this document is from www.openstreetmap.org. The data is made available under ODbL.</note>
+<meta osm_base="2024-07-08T12:00:00Z"/>
+
+  <node id="1" lat="45.1000000" lon="5.1000000"/>
+  <node id="2" lat="45.2000000" lon="5.1000000"/>
+  <node id="3" lat="45.2000000" lon="5.2000000"/>
+  <node id="4" lat="45.1000000" lon="5.2000000"/>
+  <node id="5" lat="45.1000000" lon="5.1000000"/>
+  <node id="6" lat="45.3000000" lon="5.3000000"/>
+  <node id="7" lat="45.3500000" lon="5.4000000"/>
+  <node id="8" lat="45.4000000" lon="5.3000000"/>
+  <node id="9" lat="45.3200000" lon="5.3100000"/>
+  <node id="10" lat="45.3300000" lon="5.3200000"/>
+  <node id="11" lat="45.3200000" lon="5.3300000"/>
+  <node id="12" lat="45.0500000" lon="5.0500000">
+    <tag k="amenity" v="fuel"/>
+    <tag k="name" v="Caf&#233; &amp; Bar &quot;Chez Jo&#39;&quot;"/>
+    <tag k="name:ru" v="Заправка"/>
+  </node>
+  <node id="13" lat="45.0600000" lon="5.0600000">
+    <tag k="amenity" v="bench"/>
+  </node>
+  <way id="20">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <nd ref="3"/>
+    <nd ref="4"/>
+    <nd ref="1"/>
+    <tag k="building" v="yes"/>
+    <tag k="name" v="A &amp; B &lt;C&gt;"/>
+  </way>
+  <way id="21">
+    <tag k="highway" v="residential"/>
+  </way>
+  <way id="22">
+    <nd ref="5"/>
+    <nd ref="6"/>
+    <nd ref="7"/>
+  </way>
+  <way id="23">
+    <nd ref="7"/>
+    <nd ref="8"/>
+    <nd ref="5"/>
+    <tag k="natural" v="coastline"/>
+  </way>
+  <way id="24">
+    <nd ref="9"/>
+    <nd ref="10"/>
+    <nd ref="11"/>
+    <nd ref="9"/>
+  </way>
+  <way id="25">
+    <nd ref="12"/>
+    <nd ref="13"/>
+    <tag k="highway" v="track"/>
+    <tag k="note" v="&apos;quoted&apos; &amp;amp;"/>
+  </way>
+  <relation id="100">
+    <member type="way" ref="23" role="outer"/>
+    <member type="way" ref="22" role="outer"/>
+    <member type="way" ref="24" role="inner"/>
+    <member type="node" ref="1" role="label"/>
+    <tag k="natural" v="water"/>
+    <tag k="name" v="Lac &lt;&gt; &quot;&#39;"/>
+    <tag k="type" v="multipolygon"/>
+  </relation>
+  <relation id="101">
+    <member type="way" ref="22" role="outer"/>
+    <tag k="natural" v="water"/>
+    <tag k="type" v="multipolygon"/>
+  </relation>
+  <relation id="102">
+    <member type="way" ref="999" role="outer"/>
+    <member type="relation" ref="100" role="subarea"/>
+    <member type="way" ref="24" role="inner"/>
+    <tag k="natural" v="water"/>
+  </relation>
+  <relation id="103">
+    <member type="way" ref="20" role="outer"/>
+    <tag k="landuse" v="forest"/>
+    <tag k="name" v="Bois &amp; Pr&#233;s"/>
+  </relation>
+
+</osm>
+"""
+
+
+def old_update_dicosm(layer, pfile, input_tags, target_tags):
+    # the line by line parser that OSM_parser replaced, tag values are kept
+    # as they stand in the xml (escaped)
+    dicosmn_id_map = {}
+    dicosmw_id_map = {}
+    first_line = pfile.readline()
+    if "<osm " not in first_line:
+        first_line = pfile.readline()
+    separator = "'" if "'" in first_line else '"'
+    for line in pfile:
+        items = line.split(separator)
+        if "<node id=" in items[0]:
+            osmtype = "n"
+            for j in range(0, len(items)):
+                if items[j] == " lat=":
+                    latp = float(items[j + 1])
+                elif items[j] == " lon=":
+                    lonp = float(items[j + 1])
+            if (lonp, latp) not in layer.dicosmn_reverse:
+                layer.dicosmn_reverse[(lonp, latp)] = layer.next_node_id
+                layer.dicosmn[layer.next_node_id] = (lonp, latp)
+                layer.next_node_id -= 1
+            osmid = layer.dicosmn_reverse[(lonp, latp)]
+            dicosmn_id_map[items[1]] = osmid
+        elif "<way id=" in items[0]:
+            osmtype = "w"
+            osmid = layer.next_way_id
+            layer.next_way_id -= 1
+            dicosmw_id_map[items[1]] = osmid
+            layer.dicosmw[osmid] = []
+            if not input_tags:
+                layer.dicosmfirst["w"].add(osmid)
+        elif "<nd ref=" in items[0]:
+            layer.dicosmw[osmid].append(dicosmn_id_map[items[1]])
+        elif "<relation id=" in items[0]:
+            osmtype = "r"
+            osmid = layer.next_rel_id
+            layer.next_rel_id -= 1
+            layer.dicosmr[osmid] = {"outer": [], "inner": []}
+            layer.dicosmrorig[osmid] = {"outer": [], "inner": []}
+            dico_rel_check = {"inner": {}, "outer": {}}
+            if not input_tags:
+                layer.dicosmfirst["r"].add(osmid)
+        elif "<member type=" in items[0]:
+            role = items[5]
+            if items[1] != "way" or role not in ("outer", "inner"):
+                continue
+            if items[3] not in dicosmw_id_map:
+                continue
+            wayid = dicosmw_id_map[items[3]]
+            layer.dicosmrorig[osmid][role].append(wayid)
+            (endpt1, endpt2) = (layer.dicosmw[wayid][0],
+                                layer.dicosmw[wayid][-1])
+            if endpt1 == endpt2:
+                layer.dicosmr[osmid][role].append(layer.dicosmw[wayid])
+            else:
+                dico_rel_check[role].setdefault(endpt1, []).append(wayid)
+                dico_rel_check[role].setdefault(endpt2, []).append(wayid)
+        elif "<tag k=" in items[0]:
+            if (
+                (not input_tags)
+                or (("all", "") in target_tags[osmtype])
+                or ((items[1], "") in target_tags[osmtype])
+                or ((items[1], items[3]) in target_tags[osmtype])
+            ):
+                layer.dicosmtags[osmtype].setdefault(osmid, {})[
+                    items[1]
+                ] = items[3]
+                if input_tags and (
+                    ((items[1], "") in input_tags[osmtype])
+                    or ((items[1], items[3]) in input_tags[osmtype])
+                ):
+                    layer.dicosmfirst[osmtype].add(osmid)
+        elif "</way" in items[0]:
+            if not layer.dicosmw[osmid]:
+                del layer.dicosmw[osmid]
+                layer.next_way_id += 1
+                layer.dicosmfirst["w"].discard(osmid)
+                layer.dicosmtags["w"].pop(osmid, None)
+        elif "</relation>" in items[0]:
+            if any(
+                len(ways) != 2
+                for role in ("outer", "inner")
+                for ways in dico_rel_check[role].values()
+            ):
+                del layer.dicosmr[osmid]
+                del layer.dicosmrorig[osmid]
+                layer.next_rel_id += 1
+                layer.dicosmfirst["r"].discard(osmid)
+                layer.dicosmtags["r"].pop(osmid, None)
+                continue
+            for role in ["outer", "inner"]:
+                while dico_rel_check[role]:
+                    nodeids = []
+                    endpt = next(iter(dico_rel_check[role]))
+                    wayid = dico_rel_check[role][endpt][0]
+                    endptinit = layer.dicosmw[wayid][0]
+                    endpt2 = layer.dicosmw[wayid][-1]
+                    nodeids.extend(layer.dicosmw[wayid][:-1])
+                    while endpt2 != endptinit:
+                        if dico_rel_check[role][endpt2][0] == wayid:
+                            wayid = dico_rel_check[role][endpt2][1]
+                        else:
+                            wayid = dico_rel_check[role][endpt2][0]
+                        endpt1 = endpt2
+                        if layer.dicosmw[wayid][0] == endpt1:
+                            endpt2 = layer.dicosmw[wayid][-1]
+                            nodeids.extend(layer.dicosmw[wayid][:-1])
+                        else:
+                            endpt2 = layer.dicosmw[wayid][0]
+                            nodeids.extend(layer.dicosmw[wayid][-1:0:-1])
+                        del dico_rel_check[role][endpt1]
+                    nodeids.append(endptinit)
+                    layer.dicosmr[osmid][role].append(nodeids)
+                    del dico_rel_check[role][endptinit]
+            if target_tags is None:
+                for wayid in (
+                    layer.dicosmrorig[osmid]["outer"]
+                    + layer.dicosmrorig[osmid]["inner"]
+                ):
+                    layer.dicosmfirst["w"].discard(wayid)
+            if not layer.dicosmr[osmid]["outer"]:
+                del layer.dicosmr[osmid]
+                del layer.dicosmrorig[osmid]
+                layer.next_rel_id += 1
+                layer.dicosmfirst["r"].discard(osmid)
+                layer.dicosmtags["r"].pop(osmid, None)
+
+
+def old_layer(text, input_tags=None, target_tags=None):
+    layer = types.SimpleNamespace(
+        dicosmn={},
+        dicosmn_reverse={},
+        dicosmw={},
+        dicosmr={},
+        dicosmrorig={},
+        dicosmfirst={"n": set(), "w": set(), "r": set()},
+        dicosmtags={"n": {}, "w": {}, "r": {}},
+        next_node_id=-1,
+        next_way_id=-1,
+        next_rel_id=-1,
+    )
+    old_update_dicosm(layer, io.StringIO(text), input_tags, target_tags)
+    return layer
+
+
+def assert_same_layer(layer, old):
+    assert dict(layer.dicosmn) == old.dicosmn
+    assert layer.dicosmn_reverse == old.dicosmn_reverse
+    assert dict(layer.dicosmw) == old.dicosmw
+    assert layer.dicosmr == old.dicosmr
+    assert layer.dicosmrorig == old.dicosmrorig
+    assert layer.dicosmfirst == old.dicosmfirst
+    # tag values are now stored unescaped
+    assert layer.dicosmtags == {
+        osmtype: {
+            osmid: {
+                html.unescape(key): html.unescape(value)
+                for (key, value) in tags.items()
+            }
+            for (osmid, tags) in old.dicosmtags[osmtype].items()
+        }
+        for osmtype in old.dicosmtags
+    }
+    assert (layer.next_node_id, layer.next_way_id, layer.next_rel_id) == (
+        old.next_node_id,
+        old.next_way_id,
+        old.next_rel_id,
+    )
+
+
+query_tags = {
+    "n": [("amenity", "fuel")],
+    "w": [("building", "")],
+    "r": [("natural", "water"), ("landuse", "")],
+}
+kept_tags = {
+    osmtype: tags + [("name", ""), ("type", "multipolygon")]
+    for (osmtype, tags) in query_tags.items()
+}
+
+
+@pytest.fixture
+def osm_inputs(tmp_path):
+    data = overpass_sample.encode("utf-8")
+    (tmp_path / "sample.osm").write_bytes(data)
+    with bz2.open(tmp_path / "sample.osm.bz2", "wb") as f:
+        f.write(data)
+    return {
+        "bytes": data,
+        "raw": str(tmp_path / "sample.osm"),
+        "bz2": str(tmp_path / "sample.osm.bz2"),
+    }
+
+
+@pytest.mark.parametrize("source", ("bytes", "raw", "bz2"))
+@pytest.mark.parametrize("chunk_size", (1 << 24, 256, 1))
+@pytest.mark.parametrize(
+    "input_tags, target_tags", ((None, None), (query_tags, kept_tags))
+)
+def test_same_as_line_parser(
+    monkeypatch, osm_inputs, source, chunk_size, input_tags, target_tags
+):
+    # files are read by chunks, which must not change the result
+    monkeypatch.setattr(OSM, "osm_chunk_size", chunk_size)
+    layer = OSM.OSM_layer()
+    assert layer.update_dicosm(osm_inputs[source], input_tags, target_tags)
+    old = old_layer(overpass_sample, input_tags, target_tags)
+    assert_same_layer(layer, old)
+    # the sample covers what it is meant to
+    assert len(layer.dicosmn) == 12 and len(layer.dicosmw) == 5
+    assert sorted(layer.dicosmr) == [-2, -1]
+    assert layer.dicosmtags["n"][-11]["name"] == 'Café & Bar "Chez Jo\'"'
+
+
+def test_successive_queries(osm_inputs):
+    # a second answer adds to the same layer, nodes already there are shared
+    layer = OSM.OSM_layer()
+    layer.update_dicosm(osm_inputs["bytes"], query_tags, kept_tags)
+    layer.update_dicosm(osm_inputs["bz2"])
+    old = old_layer(overpass_sample, query_tags, kept_tags)
+    old_update_dicosm(old, io.StringIO(overpass_sample), None, None)
+    assert_same_layer(layer, old)
+
+
+def test_single_quotes():
+    text = overpass_sample.replace('"', "'").replace(
+        "&quot;", '"'
+    ).replace("&#39;", "&apos;")
+    layer = OSM.OSM_layer()
+    assert layer.update_dicosm(text.encode("utf-8"))
+    assert_same_layer(layer, old_layer(text))
+
+
+def test_truncated_answer():
+    layer = OSM.OSM_layer()
+    data = overpass_sample.encode("utf-8")
+    assert not layer.update_dicosm(data[: data.rfind(b"</osm>")])
+
+
+@pytest.mark.parametrize("suffix", ("osm", "osm.bz2"))
+def test_write_and_read_back(tmp_path, osm_inputs, suffix):
+    # tag values are escaped again when written
+    layer = OSM.OSM_layer()
+    layer.update_dicosm(osm_inputs["bytes"], query_tags, kept_tags)
+    file_name = str(tmp_path / ("written." + suffix))
+    assert layer.write_to_file(file_name)
+    opener = bz2.open if suffix.endswith("bz2") else open
+    with opener(file_name, "rt", encoding="utf-8") as f:
+        text = f.read()
+    assert 'v="A &amp; B &lt;C&gt;"' in text
+    assert 'v="Lac &lt;&gt; &quot;\'"' in text
+    assert 'v="Café &amp; Bar &quot;Chez Jo\'&quot;"' in text
+    read_back = OSM.OSM_layer()
+    assert read_back.update_dicosm(file_name)
+    assert dict(read_back.dicosmn) == dict(layer.dicosmn)
+    # ways and relations are written in another order
+    for osmtype in ("n", "w", "r"):
+        assert sorted(
+            map(sorted, (tags.items() for tags in
+                         read_back.dicosmtags[osmtype].values()))
+        ) == sorted(
+            map(sorted, (tags.items() for tags in
+                         layer.dicosmtags[osmtype].values()))
+        )
@@ -0,0 +1,93 @@
+import functools
+import multiprocessing
+import queue
+import O4_UI_Utils as UI
+import O4_Parallel_Utils as PARALLEL
+import O4_Trace_Utils as TRACE
+
+
+def task(common, value):
+    UI.vprint(1, "task", common, value)
+    UI.vprint(3, "too verbose", value)
+    UI.lvprint(1, "logged", value)
+    if value == 3:
+        raise ValueError("bad value")
+    return 1
+
+
+def test_process_messages(monkeypatch):
+    # the messages of the worker processes are printed by the main one, with
+    # its verbosity
+    printed = []
+    monkeypatch.setattr(UI, "verbosity", 1)
+    monkeypatch.setattr(
+        UI,
+        "vprint",
+        lambda level, *args: printed.append(args) if level <= 1 else None,
+    )
+    monkeypatch.setattr(
+        UI, "lvprint", lambda level, *args: printed.append(("log",) + args)
+    )
+    tasks = queue.Queue()
+    for value in range(5):
+        tasks.put((value,))
+    success = PARALLEL.parallel_execute(
+        task, tasks, 2, backend="process", common_args=("common",)
+    )
+    assert success == 0
+    for value in range(5):
+        assert ("task", "common", str(value)) in printed
+        assert ("log", "logged", str(value)) in printed
+    assert not any("too verbose" in args for args in printed)
+    assert ("   Parallel task failed:", "bad value") in printed
+
+
+def write_task(value):
+    TRACE.add_bytes("bytes_written", value)
+    return 1
+
+
+def test_process_bytes(monkeypatch):
+    # the bytes counted in the worker processes go to the build traces
+    monkeypatch.setattr(TRACE, "trace_builds", True)
+    monkeypatch.setattr(
+        TRACE, "_counters", {"bytes_downloaded": 0, "bytes_written": 0}
+    )
+    tasks = queue.Queue()
+    for value in range(1, 6):
+        tasks.put((value,))
+    assert PARALLEL.parallel_execute(write_task, tasks, 2, backend="process")
+    assert TRACE._counters["bytes_written"] == 15
+
+
+def common_task(common, value):
+    return common() == "common" and value in range(5)
+
+
+def test_process_start_failure(monkeypatch):
+    # With the spawn start method (Windows, macOS) the common arguments are
+    # pickled when the pool starts its processes, on the first submit. When
+    # they cannot be, the tasks run in threads instead.
+    printed = []
+    monkeypatch.setattr(UI, "vprint", lambda level, *args: printed.append(args))
+    monkeypatch.setattr(
+        PARALLEL.concurrent.futures,
+        "ProcessPoolExecutor",
+        functools.partial(
+            PARALLEL.concurrent.futures.ProcessPoolExecutor,
+            mp_context=multiprocessing.get_context("spawn"),
+        ),
+    )
+    tasks = queue.Queue()
+    for value in range(5):
+        tasks.put((value,))
+    success = PARALLEL.parallel_execute(
+        common_task, tasks, 2, backend="process",
+        common_args=(lambda: "common",),
+    )
+    assert success == 1
+    assert tasks.empty()
+    assert any(
+        args[0] == "   Could not start worker processes, using threads:"
+        for args in printed
+    )
@@ -0,0 +1,95 @@
+import threading
+import time
+import types
+import O4_UI_Utils as UI
+import O4_Tile_Utils as TILE
+
+
+def test_batch_owns_flags(monkeypatch, tmp_path):
+    # With several tiles in flight, a step which starts or ends must neither
+    # clear a Stop meant for all of them nor end is_working.
+    seen = []
+    stopped = threading.Event()
+
+    def batch_tile(template, lat, lon, *args):
+        return types.SimpleNamespace(lat=lat, lon=lon)
+
+    def batch_step(stage, tile):
+        UI.clear_red_flag()
+        if (tile.lat, stage) == (0, "mesh"):
+            # the user hits Stop while the other tile is at its mask step
+            UI.red_flag = True
+            stopped.set()
+        elif tile.lat == 1:
+            stopped.wait(5)
+            time.sleep(0.1)
+        seen.append((tile.lat, stage, UI.is_working, UI.red_flag))
+        UI.timings_and_bottom_line(time.time())
+        return 1
+
+    monkeypatch.setattr(TILE, "batch_tile", batch_tile)
+    monkeypatch.setattr(TILE, "batch_step", batch_step)
+    monkeypatch.setattr(TILE, "batch_tiles_in_flight", 2)
+    monkeypatch.setattr(TILE, "batch_mesh_slots", 2)
+    monkeypatch.setattr(UI, "is_working", False)
+    monkeypatch.setattr(UI, "red_flag", False)
+    template = types.SimpleNamespace(custom_build_dir="")
+    result = TILE.build_tile_list(
+        template,
+        [(0, 10), (1, 20)],
+        False,
+        True,
+        False,
+        False,
+        False,
+        False,
+        state_file=str(tmp_path / "state.json"),
+    )
+    assert result == 0
+    assert (0, "mesh", True, True) in seen
+    assert (1, "mesh", True, True) in seen
+    assert UI.red_flag
+    assert not UI.is_working and not UI.batch_running
+
+
+def test_step_out_of_batch(monkeypatch):
+    monkeypatch.setattr(UI, "red_flag", True)
+    monkeypatch.setattr(UI, "is_working", True)
+    UI.clear_red_flag()
+    UI.timings_and_bottom_line(time.time())
+    assert not UI.red_flag and not UI.is_working
+
+
+def test_failed_step_ends_tile(monkeypatch, tmp_path):
+    # A step which fails ends its tile, the next steps would read its
+    # missing or partial output, the other tiles go on.
+    seen = []
+
+    def batch_tile(template, lat, lon, *args):
+        return types.SimpleNamespace(lat=lat, lon=lon)
+
+    def batch_step(stage, tile):
+        seen.append((tile.lat, stage))
+        return 0 if (tile.lat, stage) == (0, "mesh") else 1
+
+    monkeypatch.setattr(TILE, "batch_tile", batch_tile)
+    monkeypatch.setattr(TILE, "batch_step", batch_step)
+    monkeypatch.setattr(UI, "is_working", False)
+    monkeypatch.setattr(UI, "red_flag", False)
+    template = types.SimpleNamespace(custom_build_dir="")
+    state_file = tmp_path / "state.json"
+    result = TILE.build_tile_list(
+        template,
+        [(0, 10), (1, 20)],
+        False,
+        True,
+        True,
+        True,
+        False,
+        False,
+        state_file=str(state_file),
+    )
+    assert result == 1
+    assert seen == [(0, "mesh"), (1, "mesh"), (1, "mask"), (1, "dsf")]
+    # the batch is kept for a resume
+    assert state_file.exists()
@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+import types
+import pytest
+import O4_File_Names as FNAMES
+import O4_Trace_Utils as TRACE
+
+
+@TRACE.traced("leaf")
+def leaf():
+    # no tile, part of the step of its caller
+    TRACE.add_bytes("bytes_written", 100)
+
+
+@TRACE.traced("inner")
+def inner(tile):
+    leaf()
+    leaf()
+
+
+@TRACE.traced("work")
+def work(tile):
+    leaf()
+
+
+@TRACE.traced("step")
+def step(tile):
+    inner(tile)
+    inner(tile)
+    # spans of worker threads are attributed to the step of their tile
+    threads = [threading.Thread(target=work, args=(tile,)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+@pytest.fixture
+def tracing(monkeypatch, tmp_path):
+    monkeypatch.setattr(FNAMES, "Tmp_dir", str(tmp_path))
+    monkeypatch.setattr(TRACE, "trace_builds", True)
+    TRACE.take_bytes()
+    return types.SimpleNamespace(lat=45, lon=5)
+
+
+def read_json(file_name):
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def test_step_profile(tracing):
+    tile = tracing
+    step(tile)
+    profile = read_json(FNAMES.profile_file(45, 5))
+    spans = profile["steps"]["step"]["spans"]
+    assert {path: stats["count"] for (path, stats) in spans.items()} == {
+        "step": 1,
+        "step/inner": 2,
+        "step/inner/leaf": 4,
+        "step/work": 3,
+        "step/work/leaf": 3,
+    }
+    written = {path: stats["bytes_written"] for (path, stats) in spans.items()}
+    assert written == {
+        "step": 700,
+        "step/inner": 400,
+        "step/inner/leaf": 400,
+        "step/work": 300,
+        "step/work/leaf": 300,
+    }
+    for stats in spans.values():
+        assert stats["wall"] >= 0 and stats["cpu"] >= 0
+        assert stats["bytes_downloaded"] == 0
+    assert spans["step"]["wall"] >= spans["step/inner"]["wall"]
+    summary = read_json(FNAMES.profile_summary_file())
+    assert summary["tiles"] == {"+45+005": 1}
+    assert summary["steps"]["step"]["runs"] == 1
+    assert summary["steps"]["step"]["bytes_written"] == 700
+    # a second run replaces the profile of the step, and adds to the summary
+    step(tile)
+    spans = read_json(FNAMES.profile_file(45, 5))["steps"]["step"]["spans"]
+    assert spans["step/inner/leaf"]["count"] == 4
+    summary = read_json(FNAMES.profile_summary_file())
+    assert summary["tiles"] == {"+45+005": 2}
+    assert summary["steps"]["step"]["runs"] == 2
+    assert summary["steps"]["step"]["bytes_written"] == 1400
+
+
+def test_steps_of_a_tile(tracing):
+    # a span of a tile opens a step when none is in progress, and steps are
+    # kept side by side in the profile of the tile
+    tile = tracing
+    inner(tile)
+    with TRACE.span("custom", (45, 5)):
+        work(tile)
+    steps = read_json(FNAMES.profile_file(45, 5))["steps"]
+    assert sorted(steps["inner"]["spans"]) == ["inner", "inner/leaf"]
+    assert sorted(steps["custom"]["spans"]) == ["custom", "custom/work",
+                                                "custom/work/leaf"]
+    # other tiles have their own profiles
+    inner(types.SimpleNamespace(lat=-12, lon=130))
+    assert os.path.isfile(FNAMES.profile_file(-12, 130))
+    summary = read_json(FNAMES.profile_summary_file())
+    assert summary["tiles"] == {"+45+005": 2, "-12+130": 1}
+    assert summary["steps"]["inner"]["runs"] == 2
+
+
+def test_spans_without_tile(tracing):
+    # not part of any step, nothing saved
+    leaf()
+    with TRACE.span("loose"):
+        leaf()
+    assert not os.path.exists(os.path.dirname(FNAMES.profile_summary_file()))
+
+
+def test_disabled(tracing, monkeypatch):
+    monkeypatch.setattr(TRACE, "trace_builds", False)
+    tile = tracing
+    step(tile)
+    assert not os.path.exists(FNAMES.profile_file(45, 5))
+    assert TRACE.take_bytes() == {"bytes_downloaded": 0, "bytes_written": 0}
@@ -0,0 +1,161 @@
+import io
+import numpy
+import pytest
+import O4_Triangle_IO as TRIIO
+
+trailer = "# Generated by Triangle4XP -pq10AuYBQP\n"
+
+
+def old_rows(ids, values, fmt):
+    # the per value formatting that write_rows replaced
+    lines = []
+    for (i, row) in enumerate(values):
+        items = [fmt.format(x) for x in row]
+        if ids is not None:
+            items.insert(0, str(ids[i]))
+        lines.append(" ".join(items) + "\n")
+    return "".join(lines)
+
+
+def random_floats(rng, shape):
+    values = rng.uniform(-1000, 1000, shape)
+    values.ravel()[::7] = numpy.round(values.ravel()[::7])
+    values.ravel()[1::11] *= 1e-12
+    values.ravel()[2::13] = -0.0
+    values.ravel()[3::17] *= 1e9
+    return values
+
+
+@pytest.mark.parametrize(
+    "fmt, old_fmt", (("%.15f", "{:.15f}"), ("%.9f", "{:.9f}"))
+)
+def test_write_rows_floats(monkeypatch, fmt, old_fmt):
+    # several chunks, the last one partial
+    monkeypatch.setattr(TRIIO, "rows_per_chunk", 64)
+    rng = numpy.random.default_rng(0)
+    values = random_floats(rng, (1000, 6))
+    ids = numpy.arange(1, 1001)
+    for (row_ids, expected_ids) in ((ids, ids.tolist()), (None, None)):
+        f = io.StringIO()
+        TRIIO.write_rows(f, row_ids, values, fmt)
+        assert f.getvalue() == old_rows(expected_ids, values.tolist(), old_fmt)
+
+
+def test_write_rows_ints():
+    rng = numpy.random.default_rng(1)
+    values = rng.integers(-(2**40), 2**40, (500, 3))
+    ids = rng.integers(0, 2**40, 500)
+    f = io.StringIO()
+    TRIIO.write_rows(f, ids, values, "%d")
+    assert f.getvalue() == old_rows(ids.tolist(), values.tolist(), "{}")
+    f = io.StringIO()
+    TRIIO.write_rows(f, None, values[:, 0], "%d")
+    assert f.getvalue() == old_rows(None, values[:, :1].tolist(), "{}")
+
+
+def test_node_round_trip(tmp_path):
+    rng = numpy.random.default_rng(2)
+    values = random_floats(rng, (300, 6))
+    file_name = str(tmp_path / "test.1.node")
+    TRIIO.write_table(file_name, "300  2  4  0\n", values, "%.15f",
+                      trailer=trailer)
+    (header, table, tail) = TRIIO.read_node_file(file_name)
+    assert (header, tail) == ("300  2  4  0\n", trailer)
+    assert table.dtype == numpy.float64
+    expected = [[float("{:.15f}".format(x)) for x in row] for row in values]
+    numpy.testing.assert_array_equal(table, expected)
+
+
+def test_ele_round_trip(tmp_path):
+    rng = numpy.random.default_rng(3)
+    values = rng.integers(1, 10**6, (400, 4))
+    file_name = str(tmp_path / "test.1.ele")
+    # Triangle numbers the items from 0 or 1
+    for first_id in (0, 1):
+        TRIIO.write_table(file_name, "400  3  1\n", values, "%d",
+                          first_id=first_id, trailer=trailer)
+        (header, table, tail) = TRIIO.read_ele_file(file_name)
+        assert (header, tail) == ("400  3  1\n", trailer)
+        assert table.dtype == numpy.int64
+        numpy.testing.assert_array_equal(table, values)
+
+
+def test_triangle_layout(tmp_path):
+    # as written by Triangle4XP, aligned columns and a comment line
+    file_name = tmp_path / "test.1.node"
+    file_name.write_text(
+        "3  2  4  0\n"
+        "   1  0  0  0  -0  0  0\n"
+        "   2  1.5  0  12.25  0  0  0\n"
+        "   3  0  1  0  0  0.5  3\n"
+        + trailer
+    )
+    (header, table, tail) = TRIIO.read_node_file(str(file_name))
+    assert tail == trailer
+    numpy.testing.assert_array_equal(
+        table,
+        [[0, 0, 0, 0, 0, 0], [1.5, 0, 12.25, 0, 0, 0], [0, 1, 0, 0, 0.5, 3]],
+    )
+
+
+@pytest.mark.parametrize("tail", ("", trailer))
+def test_no_rows(tmp_path, tail):
+    file_name = str(tmp_path / "test.1.ele")
+    TRIIO.write_table(file_name, "0  3  1\n", numpy.zeros((0, 4)), "%d",
+                      trailer=tail)
+    (header, table, read_tail) = TRIIO.read_ele_file(file_name)
+    assert (header, read_tail) == ("0  3  1\n", tail)
+    assert table.shape == (0, 4)
+
+
+def test_poly_segments(tmp_path):
+    # the segments section of a .poly file, as in Vector_Map.write_poly_file
+    rng = numpy.random.default_rng(4)
+    segments = rng.integers(1, 10**5, (250, 3))
+    ids = numpy.arange(1, 251)
+    file_name = tmp_path / "test.poly"
+    with open(file_name, "w") as f:
+        f.write("0 2 1 0\n\n250 1\n")
+        TRIIO.write_rows(f, ids, segments, "%d")
+        f.write("\n0\n")
+    text = file_name.read_text()
+    assert text == (
+        "0 2 1 0\n\n250 1\n"
+        + old_rows(ids.tolist(), segments.tolist(), "{}")
+        + "\n0\n"
+    )
+    lines = text.split("\n")[3:253]
+    numpy.testing.assert_array_equal(
+        [[int(x) for x in line.split()] for line in lines],
+        numpy.column_stack((ids, segments)),
+    )
+
+
+@pytest.mark.parametrize(
+    "body",
+    (
+        # not a number
+        "1 0 0 x\n2 1 1 1\n",
+        # a value missing, more rows than the header says, or less
+        "1 0 0 1\n2 1 1\n",
+        "1 0 0 1\n2 1 1 1\n3 2 2 2\n",
+        "1 0 0 1\n",
+        # a value too many on one line, one missing on the other
+        "1 0 0 1 5\n2 1 1\n",
+        # lines not numbered consecutively
+        "1 0 0 1\n3 1 1 1\n",
+    ),
+)
+def test_malformed(tmp_path, body):
+    file_name = tmp_path / "test.1.node"
+    file_name.write_text("2 2 1 0\n" + body + trailer)
+    with pytest.raises(ValueError):
+        TRIIO.read_node_file(str(file_name))
+
+
+def test_malformed_ele(tmp_path):
+    # a float among the node indices of a triangle
+    file_name = tmp_path / "test.1.ele"
+    file_name.write_text("1 3 1\n1 1 2.5 3 0\n")
+    with pytest.raises(ValueError):
+        TRIIO.read_ele_file(str(file_name))
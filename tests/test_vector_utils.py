@@ -0,0 +1,69 @@
+import numpy
+import pytest
+import O4_Vector_Utils as VECT
+
+
+def random_ways(rng):
+    # short random walks in the unit square, a third of them on a 1/32 grid
+    # so that edges meet at nodes, cross at existing nodes or overlap
+    ways = []
+    for i in range(300):
+        nbr_nodes = rng.integers(2, 8)
+        if i % 3:
+            way = rng.random(2) + numpy.cumsum(
+                rng.normal(0, 0.02, (nbr_nodes, 2)), axis=0
+            )
+        else:
+            way = (
+                rng.integers(0, 33, 2)
+                + numpy.cumsum(rng.integers(-1, 2, (nbr_nodes, 2)), axis=0)
+            ) / 32
+        ways.append((way.tolist(), rng.integers(0, 9)))
+    # long collinear ways over many short ones, and ways along them
+    for k in range(1, 8):
+        ways.append(([[k / 8, 0], [k / 8, 1]], 1))
+        ways.append(([[0, k / 8], [1, k / 8]], 2))
+        ways.append(([[0.1, k / 8], [0.7, k / 8], [0.9, k / 8]], 4))
+        ways.append(([[0, 0], [k / 8, 1 - k / 8], [1, 1]], 8))
+    return ways
+
+
+def build_map(ways, batch_min, monkeypatch):
+    monkeypatch.setattr(VECT, "encroach_batch_min", batch_min)
+    vector_map = VECT.Vector_Map()
+    for (way, marker) in ways:
+        way = [(x, y, 100 * x + y) for (x, y) in way]
+        vector_map.insert_way(way, int(marker))
+    return vector_map
+
+
+@pytest.mark.parametrize("seed", (0, 1, 2))
+def test_prefilter_changes_nothing(tmp_path, monkeypatch, seed):
+    ways = random_ways(numpy.random.default_rng(seed))
+    maps = {}
+    calls = {}
+    for (name, batch_min) in (("filtered", 4), ("unfiltered", 10**9)):
+        calls[name] = 0
+        are_encroached = VECT.Vector_Map.are_encroached
+
+        def counted(self, *args):
+            calls[name] += 1
+            return are_encroached(self, *args)
+
+        monkeypatch.setattr(VECT.Vector_Map, "are_encroached", counted)
+        maps[name] = build_map(ways, batch_min, monkeypatch)
+        monkeypatch.undo()
+        maps[name].write_node_file(str(tmp_path / (name + ".node")))
+        maps[name].write_poly_file(str(tmp_path / (name + ".poly")))
+    # the prefilter did sort out most candidates
+    assert calls["filtered"] < calls["unfiltered"] / 2
+    (filtered, unfiltered) = (maps["filtered"], maps["unfiltered"])
+    assert len(filtered.edges_dico) > 1000
+    assert filtered.nodes_dico == unfiltered.nodes_dico
+    assert filtered.data_nodes == unfiltered.data_nodes
+    assert filtered.edges_dico == unfiltered.edges_dico
+    assert filtered.data_edges == unfiltered.data_edges
+    for suffix in (".node", ".poly"):
+        assert (tmp_path / ("filtered" + suffix)).read_bytes() == (
+            tmp_path / ("unfiltered" + suffix)
+        ).read_bytes()